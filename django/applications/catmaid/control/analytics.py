@@ -24,34 +24,29 @@ def analyze_skeletons(request, project_id=None):
 
     cursor = connection.cursor()
 
-    query = '''
-        SELECT tc2.skeleton_id
-        FROM treenode_connector tc1,
-             treenode_connector tc2,
-             relation r1,
-             relation r2
-        WHERE tc1.skeleton_id IN (%s)
-          AND tc1.relation_id = r1.id
-          AND %s
-          AND tc1.connector_id = tc2.connector_id
-          AND tc2.relation_id = r2.id
-          AND %s
-        GROUP BY tc2.skeleton_id'''
+    downstream = '''
+        SELECT DISTINCT post_skeleton_id
+        FROM synapse_edge
+        WHERE pre_skeleton_id IN (%s)''' % s_skids
+    upstream = '''
+        SELECT DISTINCT pre_skeleton_id
+        FROM synapse_edge
+        WHERE post_skeleton_id IN (%s)''' % s_skids
 
     if 0 == extra:
         # Just skids
         pass
     elif 1 == extra:
         # Include downstream skeletons
-        cursor.execute(query % (s_skids, "r1.relation_name = 'presynaptic_to'", "r2.relation_name = 'postsynaptic_to'"))
+        cursor.execute(downstream)
         skids.extend([s[0] for s in cursor.fetchall()])
     elif 2 == extra:
         # Include upstream skeletons
-        cursor.execute(query % (s_skids, "r1.relation_name = 'postsynaptic_to'", "r2.relation_name = 'presynaptic_to'"))
+        cursor.execute(upstream)
         skids.extend([s[0] for s in cursor.fetchall()])
     elif 3 == extra:
         # Include both upstream and downstream skeletons
-        cursor.execute(query % (s_skids, "(r1.relation_name = 'presynaptic_to' OR r1.relation_name = 'postsynaptic_to')", "(r2.relation_name = 'presynaptic_to' OR r2.relation_name = 'postsynaptic_to')"))
+        cursor.execute(downstream + ' UNION ' + upstream)
         skids.extend([s[0] for s in cursor.fetchall()])
 
 
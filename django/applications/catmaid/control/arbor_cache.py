@@ -0,0 +1,114 @@
+""" A cache of the topology of skeletons.
+
+Navigating along a skeleton (e.g. to the next branch node or the previous
+branch node or root) only needs to know the parent and children of each node.
+An Arbor holds this information for a whole skeleton in compact lists, along
+with the size of the subtree below each node. If ARBOR_CACHE_SIZE is larger
+than zero, every server process keeps the Arbors of that many recently used
+skeletons in memory.
+
+Each skeleton has an edit version number, stored in Django's cache, which is
+incremented by every operation that changes the topology of the skeleton. A
+cached Arbor is only used as long as its version is current.
+"""
+
+import numpy as np
+
+from collections import OrderedDict
+
+from django.conf import settings
+
+from catmaid.control.array_tree import ArrayTree
+from catmaid.control.common import get_cache_version, \
+        increment_cache_version
+
+
+def _version_key(skeleton_id):
+    return 'catmaid.arbor.version.%s' % int(skeleton_id)
+
+def get_skeleton_version(skeleton_id):
+    """ Returns the current edit version of a skeleton. """
+    return get_cache_version(_version_key(skeleton_id))
+
+def invalidate_skeletons(skeleton_ids):
+    """ Marks the cached Arbors of the passed in skeletons as invalid. This
+    should be called by every view that adds, removes or reconnects treenodes.
+    """
+    if settings.ARBOR_CACHE_SIZE <= 0:
+        return
+    for skeleton_id in skeleton_ids:
+        increment_cache_version(_version_key(skeleton_id))
+
+
+class Arbor(object):
+    """ The topology of a skeleton. Nodes are referred to by their index in
+    the ascending list of treenode IDs. All fields are plain lists, which are
+    faster to access element by element than arrays.
+    """
+
+    def __init__(self, ids, parent_ids):
+        """ Expects an array of treenode IDs and an array of the same length
+        with the respective parent IDs, where -1 marks the root node. """
+        tree = ArrayTree(ids, parent_ids)
+        children, offsets = tree.children()
+        self.ids = tree.ids
+        self.parents = tree.parents.tolist()
+        self.children = children.tolist()
+        self.offsets = offsets.tolist()
+        self.subtree_sizes = tree.subtree_sizes().tolist()
+
+    def __len__(self):
+        return len(self.parents)
+
+    def index_of(self, node_id):
+        """ Returns the index of a treenode ID. Raises a KeyError if the node
+        is not part of the arbor. """
+        i = int(np.searchsorted(self.ids, node_id))
+        if i == len(self.ids) or self.ids[i] != node_id:
+            raise KeyError('Treenode #%s is not part of the skeleton' % node_id)
+        return i
+
+    def node_id(self, i):
+        return int(self.ids[i])
+
+    def children_of(self, i):
+        return self.children[self.offsets[i]:self.offsets[i + 1]]
+
+    def n_children(self, i):
+        return self.offsets[i + 1] - self.offsets[i]
+
+    def is_end(self, i):
+        return self.offsets[i + 1] == self.offsets[i]
+
+    def is_branch(self, i):
+        return self.offsets[i + 1] - self.offsets[i] > 1
+
+
+_arbors = OrderedDict()
+
+def get_arbor(cursor, skeleton_id):
+    """ Returns the Arbor of a skeleton. It is taken from the cache if enabled
+    and the skeleton wasn't changed since it was cached.
+    """
+    size = settings.ARBOR_CACHE_SIZE
+    if size > 0:
+        skeleton_id = int(skeleton_id)
+        version = get_skeleton_version(skeleton_id)
+        entry = _arbors.pop(skeleton_id, None)
+        if entry is not None and entry[0] == version:
+            # Mark as most recently used
+            _arbors[skeleton_id] = entry
+            return entry[1]
+
+    cursor.execute('''
+        SELECT id, COALESCE(parent_id, -1)
+        FROM treenode
+        WHERE skeleton_id=%s''', [skeleton_id])
+    rows = np.array(cursor.fetchall(), dtype=np.int64).reshape(-1, 2)
+    arbor = Arbor(rows[:, 0], rows[:, 1])
+
+    if size > 0:
+        _arbors[skeleton_id] = (version, arbor)
+        while len(_arbors) > size:
+            _arbors.popitem(last=False)
+    return arbor
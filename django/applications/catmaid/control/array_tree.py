@@ -0,0 +1,242 @@
+# An 'ArrayTree' is an array based representation of a skeleton: node IDs,
+# the index of each node's parent and optionally the location and other
+# properties of each node are stored in NumPy arrays. Compared to networkx
+# graphs, this needs only a fraction of the memory and allows to compute
+# measurements of whole arbors with vectorized operations instead of Python
+# loops.
+
+import numpy as np
+
+from itertools import izip, repeat
+from networkx import DiGraph
+
+
+class ArrayTree(object):
+    """ A tree of nodes, represented by an array of node IDs (sorted
+    ascending), an array of the same length with the index of each node's
+    parent (-1 for the root), an optional Nx3 array of locations and a
+    dictionary of further per-node property arrays.
+    """
+
+    def __init__(self, ids, parent_ids, locations=None, properties=None):
+        """ Expects an array of node IDs and an array of the same length with
+        the respective parent IDs, where -1 marks the root node. Locations are
+        expected as Nx3 array with one row per node, if provided. Properties
+        are expected as dictionary of property names and arrays with one
+        value per node.
+        """
+        ids = np.asarray(ids, dtype=np.int64)
+        parent_ids = np.asarray(parent_ids, dtype=np.int64)
+        order = np.argsort(ids, kind='mergesort')
+        self.ids = ids[order]
+        parent_ids = parent_ids[order]
+        is_root = parent_ids == -1
+        self.parents = np.searchsorted(self.ids, parent_ids)
+        self.parents[is_root] = -1
+        # Every parent has to be part of the tree
+        if len(self.ids):
+            found = self.ids[np.minimum(self.parents, len(self.ids) - 1)]
+            if not np.all(is_root | (found == parent_ids)):
+                raise ValueError("Parent nodes are missing in tree")
+        if locations is None:
+            self.locations = None
+        else:
+            self.locations = np.asarray(locations, dtype=np.float64)[order]
+        self.properties = dict((name, np.asarray(values)[order])
+                for name, values in (properties or {}).iteritems())
+
+    @classmethod
+    def from_digraph(cls, tree):
+        """ Creates an ArrayTree from a networkx DiGraph with edges from
+        parents to children. """
+        ids = tree.nodes()
+        pred = tree.pred
+        parent_ids = [next(iter(pred[node]), -1) for node in ids]
+        return cls(ids, parent_ids)
+
+    def to_digraph(self):
+        """ Creates a networkx DiGraph with edges from children to parents, in
+        which every node has its properties as attributes. """
+        tree = DiGraph()
+        names = self.properties.keys()
+        columns = [self.properties[name].tolist() for name in names]
+        rows = izip(*columns) if columns else repeat(())
+        for node, values in izip(self.ids.tolist(), rows):
+            tree.add_node(node, dict(izip(names, values)))
+        children = np.flatnonzero(self.parents != -1)
+        tree.add_edges_from(izip(self.ids[children].tolist(),
+                self.ids[self.parents[children]].tolist()))
+        return tree
+
+    def __len__(self):
+        return len(self.ids)
+
+    def index_of(self, node_ids):
+        """ Returns the array indices of the passed in node IDs. """
+        return np.searchsorted(self.ids, node_ids)
+
+    def root(self):
+        """ Returns the index of the first node without parent. """
+        return int(np.flatnonzero(self.parents == -1)[0])
+
+    def n_children(self):
+        """ Returns an array with the number of children of each node. """
+        return np.bincount(self.parents[self.parents != -1],
+                minlength=len(self.ids))
+
+    def children(self):
+        """ Returns a tuple of two arrays that list the children of all nodes:
+        the children of node i are children[offsets[i]:offsets[i+1]], in
+        ascending order of their IDs. """
+        n_children = self.n_children()
+        offsets = np.zeros(len(self.ids) + 1, dtype=np.int64)
+        np.cumsum(n_children, out=offsets[1:])
+        order = np.argsort(self.parents, kind='mergesort')
+        # Roots have a parent index of -1 and are sorted first
+        children = order[len(order) - offsets[-1]:]
+        return children, offsets
+
+    def subtree_sizes(self):
+        """ Returns for each node the number of nodes in the subtree it is the
+        root of, including itself. """
+        depths = self.depths()
+        parents = self.parents.tolist()
+        sizes = [1] * len(parents)
+        # Children are visited before their parents
+        for i in np.argsort(-depths, kind='mergesort').tolist():
+            parent = parents[i]
+            if -1 != parent:
+                sizes[parent] += sizes[i]
+        return np.array(sizes, dtype=np.int64)
+
+    def sum_to_root(self, weights):
+        """ Returns for each node the sum of the passed in per-node weights of
+        all nodes on the path to the root, the root excluded. With edge
+        lengths as weights (where a node's weight is the length of the edge to
+        its parent), this results in the distance to the root. Pointer
+        jumping is used, so that only a logarithmic number of vectorized
+        steps with respect to the depth of the tree is needed.
+        """
+        weights = np.asarray(weights)
+        total = np.where(self.parents != -1, weights, 0)
+        ancestors = self.parents.copy()
+        while True:
+            jump = np.flatnonzero(ancestors != -1)
+            if 0 == len(jump):
+                return total
+            targets = ancestors[jump]
+            total[jump] += total[targets]
+            ancestors[jump] = ancestors[targets]
+
+    def depths(self):
+        """ Returns the number of edges between each node and the root. """
+        return self.sum_to_root(np.ones(len(self.ids), dtype=np.int64))
+
+    def edge_lengths(self, locations=None):
+        """ Returns for each node the length of the edge to its parent, which
+        is zero for the root. """
+        if locations is None:
+            locations = self.locations
+        lengths = np.zeros(len(self.ids))
+        children = np.flatnonzero(self.parents != -1)
+        if len(children):
+            delta = locations[children] - locations[self.parents[children]]
+            lengths[children] = np.sqrt((delta * delta).sum(axis=1))
+        return lengths
+
+    def cable_length(self):
+        """ Returns the summed length of all edges. """
+        return float(self.edge_lengths().sum())
+
+    def smoothed_locations(self, n_children=None, lengths=None):
+        """ Returns a copy of the locations in which every slab node is moved
+        towards the average location of its neighbors, weighted by the length
+        of the edges to them: 0.4 * own location + 0.6 * weighted average.
+        Root, branch and end nodes keep their location. A root node with two
+        children counts as slab node.
+        """
+        if n_children is None:
+            n_children = self.n_children()
+        if lengths is None:
+            lengths = self.edge_lengths()
+        n_nodes = len(self.ids)
+        children = np.flatnonzero(self.parents != -1)
+        parents = self.parents[children]
+        d = lengths[children]
+        # Both ends of each edge add their neighbor's location, weighted by
+        # the length of the edge.
+        ends = np.concatenate((parents, children))
+        weights = np.concatenate((d, d))
+        total = np.bincount(ends, weights=weights, minlength=n_nodes)
+        smoothed = self.locations.copy()
+        is_root = self.parents == -1
+        slab = (is_root & (n_children == 2)) | (~is_root & (n_children == 1))
+        weighted = slab & (total != 0)
+        for dim in xrange(3):
+            neighbors = np.concatenate((self.locations[children, dim],
+                                        self.locations[parents, dim]))
+            s = np.bincount(ends, weights=weights * neighbors,
+                    minlength=n_nodes)
+            average = np.zeros(n_nodes)
+            average[weighted] = s[weighted] / total[weighted]
+            smoothed[slab, dim] = self.locations[slab, dim] * 0.4 + \
+                    average[slab] * 0.6
+        return smoothed
+
+    def partition(self):
+        """ Partition the tree as a list of sequences of node indices, with
+        branch nodes repeated as ends of all sequences except the longest one
+        that finishes at the root. Each sequence runs from an end node to
+        either the root or a branch node. End nodes are visited in order of
+        descending distance to the root. """
+        depths = self.depths()
+        ends = np.flatnonzero(self.n_children() == 0)
+        ends = ends[np.argsort(-depths[ends], kind='mergesort')]
+        parents = self.parents.tolist()
+        seen = [False] * len(parents)
+        for end in ends.tolist():
+            sequence = [end]
+            parent = parents[end]
+            while -1 != parent:
+                sequence.append(parent)
+                if seen[parent]:
+                    break
+                seen[parent] = True
+                parent = parents[parent]
+            if len(sequence) > 1:
+                yield sequence
+
+    def measure(self):
+        """ Returns a dictionary with the raw cable length, the smoothed cable
+        length, the smoothed cable length of the principal branch (the path
+        from the end node farthest away from the root, in number of edges, to
+        the root), the number of end nodes and the number of branch nodes.
+        The root counts as end node if it has a single child.
+        """
+        n_nodes = len(self.ids)
+        n_children = self.n_children()
+        lengths = self.edge_lengths()
+        smoothed = self.smoothed_locations(n_children, lengths)
+        smoothed_lengths = self.edge_lengths(smoothed)
+
+        is_root = self.parents == -1
+        n_ends = int(np.count_nonzero(~is_root & (n_children == 0)) +
+                     np.count_nonzero(is_root & (n_children == 1)))
+        n_branch = int(np.count_nonzero(n_children > 2) +
+                       np.count_nonzero(~is_root & (n_children == 2)))
+
+        principal_branch_cable = 0.0
+        if n_nodes > 1:
+            depths = self.depths()
+            ends = np.flatnonzero(n_children == 0)
+            farthest = ends[np.argmax(depths[ends])]
+            principal_branch_cable = float(
+                    self.sum_to_root(smoothed_lengths)[farthest])
+
+        return {
+            'raw_cable': float(lengths.sum()),
+            'smooth_cable': float(smoothed_lengths.sum()),
+            'principal_branch_cable': principal_branch_cable,
+            'n_ends': n_ends,
+            'n_branch': n_branch,
+        }
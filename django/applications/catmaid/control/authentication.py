@@ -1,9 +1,11 @@
 import re
 import json
+import time
 
 from functools import wraps
 from itertools import groupby
 
+from guardian.core import ObjectPermissionChecker
 from guardian.models import UserObjectPermission, GroupObjectPermission
 from guardian.shortcuts import get_perms_for_model
 
@@ -15,6 +17,7 @@ from django.contrib.auth import authenticate, logout, login
 from django.contrib.auth.models import User, Group
 from django.contrib.auth.forms import UserCreationForm
 from django.db import connection
+from django.db.models.signals import post_save, post_delete, m2m_changed
 from django.http import HttpResponse, HttpResponseRedirect
 from django.core.exceptions import ObjectDoesNotExist
 from django.shortcuts import _get_queryset, render
@@ -22,7 +25,8 @@ from django.shortcuts import _get_queryset, render
 
 from catmaid.models import Project, UserRole, ClassInstance, \
         ClassInstanceClassInstance
-from catmaid.control.common import my_render_to_response
+from catmaid.control.common import my_render_to_response, \
+        get_cache_version, increment_cache_version
 
 def login_vnc(request):
     return my_render_to_response(request,
@@ -89,6 +93,74 @@ def logout_user(request):
     return HttpResponse(json.dumps(profile_context))
 
 
+# The roles of users in projects and the edit domains of users are needed by
+# almost every request. If PERMISSION_CACHE_TIMEOUT is larger than zero, they
+# are cached in each server process for this many seconds. Each cache entry
+# remembers the generation of the permission data it was computed from. Every
+# change of group memberships or object permissions increments the generation
+# in Django's cache, which invalidates the entries of all processes that share
+# the cache backend.
+_PERMISSION_GENERATION_KEY = 'catmaid.permissions.generation'
+_project_roles_cache = {}
+_user_domain_cache = {}
+
+def _permission_generation():
+    return get_cache_version(_PERMISSION_GENERATION_KEY)
+
+def _get_cached(store, key):
+    """ Returns the value stored for key if it is neither expired nor computed
+    from an older generation of the permission data, None otherwise. """
+    if settings.PERMISSION_CACHE_TIMEOUT <= 0:
+        return None
+    entry = store.get(key)
+    if entry is None:
+        return None
+    value, expires, generation = entry
+    if expires < time.time() or generation != _permission_generation():
+        store.pop(key, None)
+        return None
+    return value
+
+def _set_cached(store, key, value):
+    timeout = settings.PERMISSION_CACHE_TIMEOUT
+    if timeout > 0:
+        store[key] = (value, time.time() + timeout, _permission_generation())
+
+def invalidate_permission_cache(*args, **kwargs):
+    """ Marks all cached project roles and edit domains as invalid. This is
+    called for all changes of users, groups, group memberships and object
+    permissions and can be used as signal handler.
+    """
+    _project_roles_cache.clear()
+    _user_domain_cache.clear()
+    if settings.PERMISSION_CACHE_TIMEOUT > 0:
+        increment_cache_version(_PERMISSION_GENERATION_KEY)
+
+for model in (User, Group, UserObjectPermission, GroupObjectPermission):
+    post_save.connect(invalidate_permission_cache, sender=model,
+            dispatch_uid='catmaid.permissions.save.%s' % model.__name__)
+    post_delete.connect(invalidate_permission_cache, sender=model,
+            dispatch_uid='catmaid.permissions.delete.%s' % model.__name__)
+m2m_changed.connect(invalidate_permission_cache, sender=User.groups.through,
+        dispatch_uid='catmaid.permissions.groups')
+
+def get_project_roles(user, project_id):
+    """ Returns the set of project permission codenames (e.g. 'can_browse',
+    'can_annotate' and 'can_administer') that the user has on the project,
+    either directly or through group membership. Raises
+    Project.DoesNotExist if there is no such project.
+    """
+    key = (user.id, int(project_id))
+    roles = _get_cached(_project_roles_cache, key)
+    if roles is None:
+        p = Project.objects.get(pk=project_id)
+        if user.is_active:
+            roles = frozenset(ObjectPermissionChecker(user).get_perms(p))
+        else:
+            roles = frozenset()
+        _set_cached(_project_roles_cache, key, roles)
+    return roles
+
 def requires_user_role(roles):
     """
     This decorator will return a JSON error response unless the user is logged in
@@ -97,11 +169,11 @@ def requires_user_role(roles):
 
     def decorated_with_requires_user_role(f):
         def inner_decorator(request, roles=roles, *args, **kwargs):
-            p = Project.objects.get(pk=kwargs['project_id'])
             u = request.user
+            project_roles = get_project_roles(u, kwargs['project_id'])
 
             # Check for admin privs in all cases.
-            has_role = u.has_perm('can_administer', p)
+            has_role = 'can_administer' in project_roles
 
             if not has_role:
                 # Check the indicated role(s)
@@ -109,9 +181,9 @@ def requires_user_role(roles):
                     roles = [roles]
                 for role in roles:
                     if role == UserRole.Annotate:
-                        has_role = u.has_perm('can_annotate', p)
+                        has_role = 'can_annotate' in project_roles
                     elif role == UserRole.Browse:
-                        has_role = u.has_perm('can_browse', p)
+                        has_role = 'can_browse' in project_roles
                     if has_role:
                         break
 
@@ -293,13 +365,12 @@ def can_edit_all_or_fail(user, ob_ids, table_name):
     or if the object does not exist."""
     # Sanitize arguments -- can't give them to django to sanitize,
     # for django will quote the table name
-    ob_ids = set(ob_ids)
-    str_ob_ids = ','.join(str(int(x)) for x in ob_ids)
+    ob_ids = set(int(x) for x in ob_ids)
     if not re.match('^[a-z_]+$', table_name):
         raise Exception('Invalid table name: %s' % table_name)
 
     cursor = connection.cursor()
-    cursor.execute("SELECT user_id, count(*) FROM %s WHERE id IN (%s) GROUP BY user_id" % (table_name, str_ob_ids))
+    cursor.execute("SELECT user_id, count(*) FROM %s WHERE id = ANY(%%s) GROUP BY user_id" % table_name, (list(ob_ids),))
     rows = tuple(cursor.fetchall())
     # Check that all ids to edit exist
     if rows and len(ob_ids) == sum(row[1] for row in rows):
@@ -316,12 +387,33 @@ def can_edit_all_or_fail(user, ob_ids, table_name):
     raise ObjectDoesNotExist('One or more of the %s unique objects were not found in table %s' % (len(ob_ids), table_name))
 
 
+def editable_ids(user, ob_ids, table_name):
+    """ Returns the set of those of the passed in object IDs that the user
+    can edit. This needs a single query for the owners of all objects, no
+    matter how many there are. IDs of objects that don't exist are not
+    part of the result."""
+    if not re.match('^[a-z_]+$', table_name):
+        raise Exception('Invalid table name: %s' % table_name)
+
+    cursor = connection.cursor()
+    cursor.execute("SELECT id, user_id FROM %s WHERE id = ANY(%%s)" % table_name,
+            (list(set(int(x) for x in ob_ids)),))
+    rows = cursor.fetchall()
+    if user.is_superuser:
+        return set(row[0] for row in rows)
+    domain = user_domain(cursor, user.id)
+    return set(row[0] for row in rows if row[1] in domain)
+
+
 def user_can_edit(cursor, user_id, other_user_id):
     """ Determine whether the user with id 'user_'id' can edit the work of the user with id 'other_user_id'. This will be the case when the user_id belongs to a group whose name is identical to ther username of other_user_id.
-    This function is equivalent to 'other_user_id in user_domain(cursor, user_id), but consumes less resources."""
+    This function is equivalent to 'other_user_id in user_domain(cursor, user_id), but consumes less resources if the domain of the user isn't cached."""
     # The group with identical name to the username is implicit, doesn't have to exist. Therefore, check this edge case before querying:
     if user_id == other_user_id:
         return True
+    domain = _get_cached(_user_domain_cache, user_id)
+    if domain is not None:
+        return other_user_id in domain
     # Retrieve a value larger than zero when the user_id belongs to a group with name equal to that associated with other_user_id
     cursor.execute("""
     SELECT count(*)
@@ -340,7 +432,11 @@ def user_can_edit(cursor, user_id, other_user_id):
 def user_domain(cursor, user_id):
     """ This function returns the set of all other user_id, including the self, that the user has edit rights on via group membership.
     A user can edit nodes of other user(s) when the user belongs to a group named like that other user(s). Belonging to the self group is implicit, and therefore the self group--a group named like the user--doesn't have to exist; the user_id is added to the set in all cases.
-    If a user can only edit its own nodes, then the returned set contains only its own user_id. """
+    If a user can only edit its own nodes, then the returned set contains only its own user_id.
+    The returned set is cached and must not be modified. """
+    domain = _get_cached(_user_domain_cache, user_id)
+    if domain is not None:
+        return domain
     cursor.execute("""
     SELECT u2.id
     FROM auth_user u1,
@@ -354,6 +450,8 @@ def user_domain(cursor, user_id):
     """ % int(user_id))
     domain = set(row[0] for row in cursor.fetchall())
     domain.add(user_id)
+    domain = frozenset(domain)
+    _set_cached(_user_domain_cache, user_id, domain)
     return domain
 
 @requires_user_role([UserRole.Annotate])
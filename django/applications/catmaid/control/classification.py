@@ -3,6 +3,7 @@ import json
 from collections import defaultdict
 
 from django import forms
+from django.db import connection
 from django.db.models import Q
 from django.conf import settings
 from django.contrib.formtools.wizard.views import SessionWizardView
@@ -17,6 +18,8 @@ from catmaid.control.common import get_class_to_id_map, \
         get_relation_to_id_map, insert_into_log
 from catmaid.control.ajax_templates import render_block_to_string
 from catmaid.control.ontology import get_class_links_qs, get_features
+from catmaid.control.ontology_cache import get_ontology, \
+        count_linked_instances
 from catmaid.control.authentication import requires_user_role
 from catmaid.control.roi import link_roi_to_class_instance
 from catmaid.models import Class, ClassClass, ClassInstance, \
@@ -195,7 +198,8 @@ def get_child_links( parent_ci ):
     # that is not linked by a relation named 'classified_by'.
     cici_q = ClassInstanceClassInstance.objects.filter(
         class_instance_b=parent_ci).exclude(
-            relation__relation_name='classified_by')
+            relation__relation_name='classified_by').select_related(
+                'class_instance_a__class_column')
     children = [cici for cici in cici_q]
 
     # Collect all child node class instances
@@ -659,37 +663,33 @@ def link_existing_classification( workspace_pid, user, project, ontology_root_ci
         class_instance_a = cp_ci,
         class_instance_b = ontology_root_ci)
 
-def collect_reachable_classes( parent_class):
-    """ Find all classes that are directly linked to <parent_class>
-    and that are linked to a super class to which <parent class> is
-    linked with a 'is_a' relation (if available). Collect the link
-    of such a class if it doesn't use an 'is_a' relation.
+def _num_linked_instances(ontology, counts, ci, c, restriction):
+    """ Returns the number of class instances that are linked to <ci> with
+    the relation guarded by a cardinality restriction, based on the counts
+    returned by count_linked_instances(). For restrictions on sub-types, only
+    the linked instances of class <c> are counted.
     """
-    available_links = []
-    # Get all links to classes directly linked to the parent class
-    cc_q = ClassClass.objects.filter(class_b=parent_class)
-    # Add every link that does't use an 'is_a' relation
-    for cc in cc_q:
-        if cc.relation.relation_name != 'is_a':
-            available_links.append(cc)
-    # Get all links from super-classes
-    super_cc_q = ClassClass.objects.filter(class_a=parent_class,
-        relation__relation_name='is_a')
-    # Collect all reachable classes of each super class
-    for cc in super_cc_q:
-        super_links = collect_reachable_classes( cc.class_b )
-        available_links = available_links + super_links
-
-    return available_links
-
-def get_child_classes( workspace_pid, parent_ci ):
+    relation_id = ontology.links[restriction.restricted_link_id].relation_id
+    if restriction.cardinality_type in (3, 4):
+        return counts.get((ci.id, relation_id, c.id), 0)
+    return sum(n for (ci_id, rel_id, _), n in counts.iteritems()
+            if ci_id == ci.id and rel_id == relation_id)
+
+def get_child_classes( workspace_pid, parent_ci, ontology=None, counts=None ):
     """ Gets all possible child classes out of the linked ontology in
     the semantic space. If the addition of a child-class woult violate
-    a restriction, it isn't used.
+    a restriction, it isn't used. The ontology of the workspace and the
+    linked instance counts of count_linked_instances() can be passed in
+    to share them between many parent class instances.
     """
-    parent_class = parent_ci.class_column
-    # Get all possible child classes
-    available_links = collect_reachable_classes( parent_class )
+    if ontology is None:
+        ontology = get_ontology(workspace_pid)
+    if counts is None:
+        counts = count_linked_instances([parent_ci.id])
+    # Get all possible child classes. These are the classes directly
+    # linked to the parent class and the ones linked to a super class
+    # to which the parent class is linked with an 'is_a' relation.
+    available_links = ontology.reachable_links(parent_ci.class_column_id)
     # Create a dictionary where all classes are assigned to a class which
     # is used as a generalization (if possible). The generalization of a
     # class is linked to it with an 'is_a' relation.
@@ -699,24 +699,14 @@ def get_child_classes( workspace_pid, parent_ci ):
         # Iterate all links that might be relevant for this element
         for link in links:
             # Get all restrictions for the current link
-            restrictions_q = Restriction.objects.filter(restricted_link=link)
-            restrictions = restrictions + [ r for r in restrictions_q]
+            restrictions = restrictions + ontology.restrictions(link.id)
 
-        if len(restrictions) == 0:
-            disabled = False
-        else:
-            # If there are restrictions, test if they would be violated
-            # by adding the current class
-            disabled = False
-            for r in restrictions:
-                # Find out type of the restriction
-                cr_q = CardinalityRestriction.objects.filter(id=r.id)
-                if cr_q.count() > 0:
-                    # It is a cardinality restriction
-                    disabled = cr_q[0].would_violate( parent_ci, c )
-                else:
-                    # Unknown restriction
-                    raise Exception("Couldn't identify the restriction with ID %d." % (r.id))
+        # If there are restrictions, test if they would be violated
+        # by adding the current class
+        disabled = False
+        for r in restrictions:
+            disabled = r.would_violate( parent_ci, c,
+                _num_linked_instances(ontology, counts, parent_ci, c, r) )
 
         # Create child class data structure
         current_child = Child(c, rel, disabled)
@@ -728,8 +718,8 @@ def get_child_classes( workspace_pid, parent_ci ):
         c = cc.class_a
         r = cc.relation
         # Test if the current child class has sub-types
-        sub_class_links = get_class_links_qs( workspace_pid, 'is_a', c )
-        if sub_class_links.count() == 0:
+        sub_class_links = ontology.sub_class_links( c.id )
+        if len(sub_class_links) == 0:
             # Add class to generic 'Element' group
             add_class( 'Elememt', [cc], c, r )
         else:
@@ -806,13 +796,15 @@ def list_classification_graph(request, workspace_pid, project_id=None, link_id=N
         if cls_prj.project_id != project_id:
             raise Exception("The link was found, but belongs to another project.")
 
+    # Classes, links and restrictions are looked up in the ontology
+    ontology = get_ontology(workspace_pid)
+
     response_on_error = ''
     try:
         def get_class_name( klass ):
             if superclass_in_name:
-                super_class_links_q = get_class_links_qs( workspace_pid,
-                    'is_a', klass, False )
-                if super_class_links_q.count() > 0:
+                super_class_links_q = ontology.super_class_links( klass.id )
+                if len(super_class_links_q) > 0:
                     cname = super_class_links_q[0].class_b.class_name
                     return "%s: %s" % (cname, klass.class_name)
                 else:
@@ -820,21 +812,25 @@ def list_classification_graph(request, workspace_pid, project_id=None, link_id=N
             else:
                 return klass.class_name
 
-        def make_roi_html(roi):
-            img_data = (roi.id, settings.STATIC_URL)
+        def make_roi_html(roi_id):
+            img_data = (roi_id, settings.STATIC_URL)
             return "<img class='roiimage' roi_id='%s' " \
                     "src='%s/images/camera.png' \>" % img_data
 
-        def get_rois(ci):
-            # Find ROIs for this class instance
-            roi_links = RegionOfInterestClassInstance.objects.filter(
-                class_instance=ci)
-            roi_htmls = []
-            for roi_link in roi_links:
-                roi_htmls.append( make_roi_html(roi_link.region_of_interest) )
-            roi_html = ''.join(roi_htmls)
-            # Return HTML an links as tuple
-            return roi_html, roi_links
+        def get_rois(cis):
+            # Find ROIs for all passed class instances at once
+            roi_links = defaultdict(list)
+            for roi_link in RegionOfInterestClassInstance.objects.filter(
+                    class_instance__in=cis).order_by('id'):
+                roi_links[roi_link.class_instance_id].append(roi_link)
+            rois = {}
+            for ci in cis:
+                links = roi_links[ci.id]
+                roi_html = ''.join( make_roi_html(roi_link.region_of_interest_id)
+                    for roi_link in links )
+                # Map HTML and links as tuple
+                rois[ci.id] = (roi_html, links)
+            return rois
 
         if 0 == parent_id:
             cls_graph = root_link.class_instance_b
@@ -848,7 +844,7 @@ def list_classification_graph(request, workspace_pid, project_id=None, link_id=N
             child_types_jstree = child_types_to_jstree_dict( child_types )
 
             # Get ROI information
-            roi_html, roi_links = get_rois(root_link.class_instance_b)
+            roi_html, roi_links = get_rois([cls_graph])[cls_graph.id]
             roi_json = json.dumps( [r.id for r in roi_links] )
 
             # Build title, based on ROIs
@@ -893,16 +889,29 @@ def list_classification_graph(request, workspace_pid, project_id=None, link_id=N
             response_on_error = 'Could not retrieve child nodes.'
             #add_template_fields( child_nodes )
 
+            # Query ROIs, linked instance counts and sub-children of all
+            # children at once.
+            children = [child_link.class_instance_a for child_link in child_links]
+            rois = get_rois(children)
+            counts = count_linked_instances(
+                [parent_ci.id] + [child.id for child in children])
+            parents_with_children = set(
+                ClassInstanceClassInstance.objects.filter(
+                    class_instance_b__in=children).exclude(
+                        relation__relation_name='classified_by').values_list(
+                            'class_instance_b', flat=True))
+
             # Get child types
-            child_types = get_child_classes( workspace_pid, parent_ci )
+            child_types = get_child_classes( workspace_pid, parent_ci,
+                ontology, counts )
 
             child_data = []
-            for child_link in child_links:
-                child = child_link.class_instance_a
-                roi_html, roi_links = get_rois(child)
+            for child_link, child in zip(child_links, children):
+                roi_html, roi_links = rois[child.id]
                 roi_json = json.dumps( [r.id for r in roi_links] )
                 # Get sub-child information
-                subchild_types = get_child_classes( workspace_pid, child )
+                subchild_types = get_child_classes( workspace_pid, child,
+                    ontology, counts )
                 subchild_types_jstree = child_types_to_jstree_dict( subchild_types )
                 # Build title
                 if roi_html:
@@ -920,8 +929,7 @@ def list_classification_graph(request, workspace_pid, project_id=None, link_id=N
                 # Test if there are children links present and mark
                 # node as leaf if there are none. Also, mark not as
                 # leaf if in edit mode and new nodes can be added.
-                sub_child_links = get_child_links( child )
-                if len(sub_child_links) > 0:
+                if child.id in parents_with_children:
                     data['state'] = 'closed'
                 elif display_edit_tools and len(subchild_types) > 0:
                     data['state'] = 'closed'
@@ -1414,6 +1422,59 @@ def graph_instanciates_feature_complex(graph, feature):
         # More than one?
         raise Exception('Found more than one ontology node link of one class instance.')
 
+def get_graph_paths(graphs):
+    """ Returns for each of the passed classification graphs a tuple of the
+    class ID of its root and the set of all paths from its root to any of its
+    class instances. A path is a tuple of (class ID, relation ID) pairs, one
+    for every link along it. A graph instantiates a feature if the feature's
+    key() equals one of the graph's root class ID and path combinations. The
+    links of all graphs are fetched with a single query.
+    """
+    if not graphs:
+        return []
+    cursor = connection.cursor()
+    cursor.execute('''
+        WITH RECURSIVE links(class_instance_b, class_instance_a, class_id,
+                relation_id) AS (
+            SELECT cici.class_instance_b, cici.class_instance_a, ci.class_id,
+                cici.relation_id
+            FROM class_instance_class_instance cici, class_instance ci
+            WHERE cici.class_instance_b = ANY(%s)
+              AND cici.class_instance_a = ci.id
+          UNION
+            SELECT cici.class_instance_b, cici.class_instance_a, ci.class_id,
+                cici.relation_id
+            FROM links l, class_instance_class_instance cici, class_instance ci
+            WHERE cici.class_instance_b = l.class_instance_a
+              AND cici.class_instance_a = ci.id
+        )
+        SELECT class_instance_b, class_instance_a, class_id, relation_id
+        FROM links
+        ''', ([g.id for g in graphs],))
+    children = defaultdict(list)
+    for ci_b, ci_a, class_id, relation_id in cursor.fetchall():
+        children[ci_b].append((ci_a, (class_id, relation_id)))
+
+    graph_paths = []
+    for g in graphs:
+        paths = set()
+        visited = set([g.id])
+        open_nodes = [(g.id, ())]
+        while open_nodes:
+            ci_id, path = open_nodes.pop()
+            for child_id, link in children[ci_id]:
+                # Every class instance is visited only once, which also
+                # stops at cycles.
+                if child_id in visited:
+                    continue
+                visited.add(child_id)
+                child_path = path + (link,)
+                paths.add(child_path)
+                open_nodes.append((child_id, child_path))
+        graph_paths.append((g.class_column_id, paths))
+
+    return graph_paths
+
 def graphs_instanciate_feature(graphlist, feature):
     """ A delegate method to be able to use different implementations in a
     simple manner. Benchmarks show that the complex query is faster.
@@ -1,7 +1,9 @@
 import json
+import numpy as np
 import scipy.cluster.hierarchy as hier
 import scipy.spatial.distance as dist
-from numpy import array as nparray
+
+from collections import defaultdict
 
 from django import forms
 from django.forms.formsets import formset_factory
@@ -12,7 +14,7 @@ from django.template.context import RequestContext
 
 from catmaid.models import Class
 from catmaid.control.classification import ClassInstanceProxy, \
-        get_root_classes_qs, graph_instanciates_feature
+        get_root_classes_qs, get_graph_paths
 from catmaid.control.ontology import get_features
 
 metrics = (
@@ -159,13 +161,13 @@ class ClusteringWizard(SessionWizardView):
             features.append(self.features[int(f_id)])
 
         # Create binary matrix
-        bin_matrix = nparray(create_binary_matrix(graphs, features))
+        bin_matrix = create_binary_matrix(graphs, features)
         # Calculate the distance matrix
-        dst_matrix = dist.pdist(bin_matrix, metric)
+        condensed_dst_matrix = dist.pdist(bin_matrix, metric)
         # The distance matrix now has no redundancies, but we need the square form
-        dst_matrix = dist.squareform(dst_matrix)
-        # Calculate linkage matrix
-        linkage_matrix = hier.linkage(bin_matrix, linkage, metric)
+        dst_matrix = dist.squareform(condensed_dst_matrix)
+        # Calculate linkage matrix from the distances computed already
+        linkage_matrix = hier.linkage(condensed_dst_matrix, linkage)
         # Obtain the clustering dendrogram data
         graph_names = [ g.name for g in graphs ]
         dendrogram = hier.dendrogram(linkage_matrix, no_plot=True,
@@ -212,21 +214,22 @@ def setup_clustering(request, workspace_pid=None):
     return view(request)
 
 def create_binary_matrix(graphs, features):
-    """ Creates a binary matrix for the graphs passed."""
-    num_features = len(features)
-    num_graphs = len(graphs)
-    # Fill matrix with zeros
-    matrix = [ [ 0 for j in range(num_features)] for i in range(num_graphs) ]
+    """ Creates a binary matrix for the graphs passed, with one row per graph
+    and one column per feature. All graphs are loaded at once and features
+    are matched against their paths in memory.
+    """
+    graph_paths = get_graph_paths(graphs)
+    # Map feature keys to the columns of all features with this key
+    columns = defaultdict(list)
+    for j, feature in enumerate(features):
+        columns[feature.key()].append(j)
+
     # Put a one at each position where the tree has
     # a feature defined
-    for i in range(num_graphs):
-        graph = graphs[i]
-        for j in range(num_features):
-            feature = features[j]
-            # Check if a feature (root-leaf path in graph) is part of the
-            # current graph
-            if graph_instanciates_feature(graph, feature):
-                matrix[i][j] = 1
+    matrix = np.zeros((len(graphs), len(features)), dtype=np.int)
+    for i, (root_class_id, paths) in enumerate(graph_paths):
+        for path in paths:
+            for j in columns.get((root_class_id, path), ()):
+                matrix[i, j] = 1
 
     return matrix
-
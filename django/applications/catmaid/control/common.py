@@ -1,9 +1,15 @@
 import string
 import random
 import json
+import threading
+import time
 
 from collections import defaultdict
 
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection, transaction
+from django.db.backends.postgresql_psycopg2.base import utc_tzinfo_factory
 from django.http import HttpResponse
 from django.shortcuts import render_to_response
 from django.template.context import RequestContext
@@ -13,6 +19,55 @@ from catmaid.models import Log, NeuronSearch, CELL_BODY_CHOICES, \
         SORT_ORDERS_DICT,  Relation, Class, ClassInstance, \
         ClassInstanceClassInstance
 
+def get_cache_version(key):
+    """ Returns the version number stored under <key> in Django's cache.
+    Server processes use such versions to tell if data they keep in memory is
+    still valid. If no version is known (yet or anymore), a new one is created
+    based on the current time, which can't match the version of any existing
+    in-memory entry.
+    """
+    version = cache.get(key)
+    if version is None:
+        version = int(time.time() * 1000)
+        # add() won't overwrite a version set by another process meanwhile
+        if not cache.add(key, version, None):
+            version = cache.get(key, version)
+    return version
+
+_pending_cache_versions = threading.local()
+
+def increment_cache_version(key):
+    """ Increments the version number stored under <key> in Django's cache,
+    which invalidates all data created with the current version. Until a
+    transaction is committed, other processes still read the old data and
+    could store it under the new version. Hence, within a transaction, the
+    version is incremented again by increment_pending_cache_versions().
+    """
+    _increment_cache_version(key)
+    if connection.in_atomic_block:
+        keys = getattr(_pending_cache_versions, 'keys', None)
+        if keys is None:
+            keys = _pending_cache_versions.keys = set()
+        keys.add(key)
+
+def increment_pending_cache_versions():
+    """ Increments all versions again that have been incremented within a
+    transaction. This has to be called after the transaction is committed,
+    which CacheVersionMiddleware does at the end of every request.
+    """
+    keys = getattr(_pending_cache_versions, 'keys', None)
+    _pending_cache_versions.keys = None
+    for key in keys or ():
+        _increment_cache_version(key)
+
+def _increment_cache_version(key):
+    try:
+        cache.incr(key)
+    except ValueError:
+        # The key doesn't exist (anymore), a fresh one will be created by the
+        # next reader.
+        pass
+
 def _create_relation(user, project_id, relation_id, instance_a_id, instance_b_id):
     relation = ClassInstanceClassInstance()
     relation.user = user
@@ -208,6 +263,21 @@ def get_relation_to_id_map(project_id):
 def get_class_to_id_map(project_id):
     return {cname: ID for cname, ID in Class.objects.filter(project=project_id).values_list("class_name", "id")}
 
+def lock_connectors_of_skeletons(cursor, skeleton_ids):
+    """ Locks all connectors linked to the passed skeletons, in the order of
+    their IDs. The synapse edge trigger locks the connector of every link it
+    processes, in no particular order. Statements that change many links
+    should lock the connectors in a fixed order first, so that two of them
+    can't deadlock each other.
+    """
+    cursor.execute('''
+        SELECT 1 FROM connector
+        WHERE id IN (SELECT connector_id FROM treenode_connector
+                     WHERE skeleton_id = ANY(%s))
+        ORDER BY id
+        FOR NO KEY UPDATE
+        ''', (list(skeleton_ids),))
+
 def urljoin(a, b):
     """ Joins to URL parts a and b while making sure this
     exactly one slash inbetween.
@@ -222,3 +292,38 @@ def id_generator(size=6, chars=string.ascii_lowercase + string.digits):
     """ Creates a random string of the specified length.
     """
     return ''.join(random.choice(chars) for x in range(size))
+
+# Number of rows a server-side cursor fetches at once
+CURSOR_ITERSIZE = 10000
+
+def stream_rows(query, params):
+    """ Returns a generator of the result rows of a query, which are fetched
+    in batches through a server-side cursor. Such a cursor only lives within a
+    transaction. If the caller is in an atomic block already, its transaction
+    is used. Otherwise, a transaction is opened for as long as the generator
+    runs. Consumers must not write to the database while iterating in this
+    case: their writes would be committed only when the generator is exhausted
+    and be rolled back silently if it is closed early.
+    """
+    if connection.in_atomic_block:
+        for row in _stream_rows(query, params):
+            yield row
+    else:
+        with transaction.atomic():
+            for row in _stream_rows(query, params):
+                yield row
+
+def _stream_rows(query, params):
+    connection.ensure_connection()
+    cursor = connection.connection.cursor(
+            name='catmaid_stream_' + id_generator(12))
+    # Like Django's own cursors, return naive datetimes unless time zone
+    # support is enabled.
+    cursor.tzinfo_factory = utc_tzinfo_factory if settings.USE_TZ else None
+    cursor.itersize = CURSOR_ITERSIZE
+    try:
+        cursor.execute(query, params)
+        for row in cursor:
+            yield row
+    finally:
+        cursor.close()
@@ -1,20 +1,20 @@
+import csv
 import json
 
 from string import upper
-from itertools import imap
 from datetime import datetime, timedelta
 
 from django.db import connection
-from django.db.models import Count
 from django.shortcuts import get_object_or_404
-from django.http import HttpResponse
+from django.http import HttpResponse, StreamingHttpResponse
 
 from catmaid.fields import Double3D
 from catmaid.models import Project, Stack, ProjectStack, Connector, \
-        ConnectorClassInstance, Treenode, TreenodeConnector, UserRole
+        TreenodeConnector, UserRole
 from catmaid.control.authentication import requires_user_role, can_edit_or_fail
 from catmaid.control.common import cursor_fetch_dictionary, \
-        get_relation_to_id_map
+        get_relation_to_id_map, stream_rows
+from catmaid.control.spatial import invalidate_project
 
 @requires_user_role([UserRole.Annotate, UserRole.Browse])
 def graphedge_list(request, project_id=None):
@@ -133,8 +133,107 @@ def _many_to_many_synapses(skids1, skids2, relation_name):
                   (row[15], row[16], row[17])) for row in cursor.fetchall())
 
 
+# The SQL expressions of the connector table columns, used for sorting
+CONNECTOR_TABLE_SORT_COLUMNS = ('connector_id', 'other_skeleton_id', 'x', 'y',
+        'z', 'z', 'confidence', 'upper(labels)', 'n_partner_nodes',
+        'upper(username)', 'other_treenode_id', 'edition_time')
+
+def _connector_table_query(project_id, skeleton_id, relation_type):
+    """ Returns a query and its parameters for the rows of the connector table
+    of a skeleton: one row per connector linked to the skeleton with the
+    given relation and partner node on the other side of the connector. A
+    connector without partner has a single row, with the location of the
+    connector in place of the partner node's location. Partner node counts
+    come from the skeleton summary table.
+    """
+    relation_map = get_relation_to_id_map(project_id)
+    for rel in ['presynaptic_to', 'postsynaptic_to', 'labeled_as']:
+        if rel not in relation_map:
+            raise Exception('Failed to find the required relation %s' % rel)
+
+    if relation_type == 1:
+        relation_id = relation_map['presynaptic_to']
+        inverse_relation_id = relation_map['postsynaptic_to']
+    else:
+        relation_id = relation_map['postsynaptic_to']
+        inverse_relation_id = relation_map['presynaptic_to']
+
+    query = '''
+        SELECT c.id AS connector_id,
+            tn_other.skeleton_id AS other_skeleton_id,
+            coalesce(tn_other.location_x, c.location_x) AS x,
+            coalesce(tn_other.location_y, c.location_y) AS y,
+            coalesce(tn_other.location_z, c.location_z) AS z,
+            coalesce(tc_other.confidence, tc_this.confidence) AS confidence,
+            coalesce(l.labels, '') AS labels,
+            coalesce(ss.num_nodes, 0) AS n_partner_nodes,
+            u.username,
+            tn_other.id AS other_treenode_id,
+            to_char(c.edition_time, 'DD-MM-YYYY HH24:MI') AS last_modified,
+            c.edition_time,
+            tc_this.treenode_id AS this_treenode_id
+        FROM treenode_connector tc_this
+        JOIN connector c ON c.id = tc_this.connector_id
+        LEFT JOIN treenode_connector tc_other
+          ON tc_other.connector_id = c.id
+          AND tc_other.relation_id = %(inverse_relation_id)s
+        LEFT JOIN treenode tn_other ON tn_other.id = tc_other.treenode_id
+        LEFT JOIN skeleton_summary ss ON ss.skeleton_id = tn_other.skeleton_id
+        JOIN auth_user u ON u.id = coalesce(tn_other.user_id, c.user_id)
+        LEFT JOIN (
+            SELECT cci.connector_id,
+                string_agg(ci.name, ', ' ORDER BY upper(ci.name)) AS labels
+            FROM connector_class_instance cci, class_instance ci,
+                treenode_connector tc
+            WHERE cci.relation_id = %(labeled_as)s
+              AND cci.class_instance_id = ci.id
+              AND cci.connector_id = tc.connector_id
+              AND tc.skeleton_id = %(skeleton_id)s
+              AND tc.relation_id = %(relation_id)s
+            GROUP BY cci.connector_id
+        ) l ON l.connector_id = c.id
+        WHERE tc_this.skeleton_id = %(skeleton_id)s
+          AND tc_this.relation_id = %(relation_id)s
+          AND tc_this.project_id = %(project_id)s
+        '''
+    params = {
+        'project_id': int(project_id),
+        'skeleton_id': skeleton_id,
+        'relation_id': relation_id,
+        'inverse_relation_id': inverse_relation_id,
+        'labeled_as': relation_map['labeled_as'],
+    }
+    return query, params
+
+class _Echo(object):
+    """ A file-like object that returns what is written to it, which allows
+    to use a csv.writer to format single lines. """
+    def write(self, value):
+        return value
+
+def _stream_connector_csv(query, params):
+    """ Streams all rows of the connector table as CSV, with a header line.
+    """
+    writer = csv.writer(_Echo())
+    yield writer.writerow(['connector_id', 'other_skeleton_id', 'x', 'y',
+            'z', 'confidence', 'labels', 'n_partner_nodes', 'username',
+            'other_treenode_id', 'last_modified', 'this_treenode_id'])
+    for row in stream_rows('''
+            SELECT connector_id, other_skeleton_id, x, y, z, confidence,
+                labels, n_partner_nodes, username, other_treenode_id,
+                last_modified, this_treenode_id
+            FROM (%s) rows
+            ORDER BY connector_id, other_treenode_id, this_treenode_id
+            ''' % query, params):
+        yield writer.writerow([u'' if v is None else unicode(v).encode('utf-8')
+                for v in row])
+
 @requires_user_role([UserRole.Annotate, UserRole.Browse])
 def list_connector(request, project_id=None):
+    """ Returns a page of the connectors of a skeleton in the format of
+    DataTables. Sorting and paging is done by the database. If the format
+    parameter is csv, all rows are streamed as CSV instead.
+    """
     stack_id = request.POST.get('stack_id', None)
     skeleton_id = request.POST.get('skeleton_id', None)
 
@@ -155,219 +254,81 @@ def list_connector(request, project_id=None):
     sorting_column = int(request.POST.get('iSortCol_0', 0))
     sort_descending = upper(request.POST.get('sSortDir_0', 'DESC')) != 'ASC'
 
-    response_on_error = ''
-    try:
-        response_on_error = 'Could not fetch relations.'
-        relation_map = get_relation_to_id_map(project_id)
-        for rel in ['presynaptic_to', 'postsynaptic_to', 'element_of', 'labeled_as']:
-            if rel not in relation_map:
-                raise Exception('Failed to find the required relation %s' % rel)
-
-        if relation_type == 1:
-            relation_type_id = relation_map['presynaptic_to']
-            inverse_relation_type_id = relation_map['postsynaptic_to']
-        else:
-            relation_type_id = relation_map['postsynaptic_to']
-            inverse_relation_type_id = relation_map['presynaptic_to']
-
-        response_on_error = 'Failed to select connectors.'
-        cursor = connection.cursor()
-        cursor.execute(
-            '''
-            SELECT
-            connector.id AS connector_id,
-            tn_other.user_id AS connector_user_id,
-            treenode_user.username AS connector_username,
-            connector.location_x AS connector_x,
-            connector.location_y AS connector_y,
-            connector.location_z AS connector_z,
-            tn_other.id AS other_treenode_id,
-            tn_other.location_x AS other_treenode_x,
-            tn_other.location_y AS other_treenode_y,
-            tn_other.location_z AS other_treenode_z,
-            tn_other.skeleton_id AS other_skeleton_id,
-            tn_this.location_x AS this_treenode_x,
-            tn_this.location_y AS this_treenode_y,
-            tn_this.location_z AS this_treenode_z,
-            tn_this.id AS this_treenode_id,
-            tc_this.relation_id AS this_to_connector_relation_id,
-            tc_other.relation_id AS connector_to_other_relation_id,
-            tc_other.confidence AS confidence,
-            to_char(connector.edition_time, 'DD-MM-YYYY HH24:MI') AS last_modified
-            FROM
-            treenode tn_other,
-            treenode_connector tc_other,
-            connector,
-            "auth_user" treenode_user,
-            treenode_connector tc_this,
-            treenode tn_this
-            WHERE
-            treenode_user.id = tn_other.user_id AND
-            tn_other.id = tc_other.treenode_id AND
-            tc_other.connector_id = connector.id AND
-            tc_other.relation_id = %s AND
-            tc_this.connector_id = connector.id AND
-            tn_this.id = tc_this.treenode_id AND
-            tn_this.skeleton_id = %s AND
-            tc_this.relation_id = %s
-            ORDER BY
-            connector_id, other_treenode_id, this_treenode_id
-            ''',  [inverse_relation_type_id, skeleton_id, relation_type_id])
-
-        connectors = cursor_fetch_dictionary(cursor)
-        connected_skeletons = map(lambda con: con['other_skeleton_id'], connectors)
-        connector_ids = map(lambda con: con['connector_id'], connectors)
-
-        response_on_error = 'Failed to find counts of treenodes in skeletons.'
-        skel_tn_count = Treenode.objects.filter(skeleton__in=connected_skeletons)\
-        .values('skeleton').annotate(treenode_count=Count('skeleton'))
-        # .values to group by skeleton_id. See http://tinyurl.com/dj-values-annotate
-
-        skeleton_to_treenode_count = {}
-        for s in skel_tn_count:
-            skeleton_to_treenode_count[s['skeleton']] = s['treenode_count']
-
-        # Rather than do a LEFT OUTER JOIN to also include the connectors
-        # with no partners, just do another query to find the connectors
-        # without the conditions:
-
-        response_on_error = 'Failed to select all connectors.'
-        cursor.execute(
-            '''
-            SELECT
-            connector.id AS connector_id,
-            connector.user_id AS connector_user_id,
-            connector_user.username AS connector_username,
-            connector.location_x AS connector_x,
-            connector.location_y AS connector_y,
-            connector.location_z AS connector_z,
-            tn_this.id AS this_treenode_id,
-            tc_this.relation_id AS this_to_connector_relation_id,
-            tc_this.confidence AS confidence,
-            to_char(connector.edition_time, 'DD-MM-YYYY HH24:MI') AS last_modified
-            FROM
-            connector,
-            "auth_user" connector_user,
-            treenode_connector tc_this,
-            treenode tn_this
-            WHERE
-            connector_user.id = connector.user_id AND
-            tc_this.connector_id = connector.id AND
-            tn_this.id = tc_this.treenode_id AND
-            tn_this.skeleton_id = %s AND
-            tc_this.relation_id = %s
-            ORDER BY
-            connector_id, this_treenode_id
-            ''',  [skeleton_id, relation_type_id])
-        for row in cursor_fetch_dictionary(cursor):
-            connector_id = row['connector_id']
-            if connector_id not in connector_ids:
-                connectors.append(row)
-                connector_ids.append(connector_id)
-
-        # For each of the connectors, find all of its labels:
-        response_on_error = 'Failed to find the labels for connectors'
-        if (connector_ids > 0):
-            connector_labels = ConnectorClassInstance.objects.filter(
-                project=project_id,
-                connector__in=connector_ids,
-                relation=relation_map['labeled_as']).values(
-                'connector',
-                'class_instance__name')
-
-            labels_by_connector = {}  # Key: Connector ID, Value: List of labels.
-            for label in connector_labels:
-                if label['connector'] not in labels_by_connector:
-                    labels_by_connector[label['connector']] = [label['class_instance__name']]
-                else:
-                    labels_by_connector[label['connector']].append(label['class_instance__name'])
-                # Sort labels by name
-            for labels in labels_by_connector.values():
-                labels.sort(key=upper)
-
-        total_result_count = len(connectors)
-
-        if 0 == total_result_count:
-            return empty_result()
-
-        # Paging
-        if display_length == 0:
-            connectors = connectors[display_start:]
-            connector_ids = connector_ids[display_start:]
-        else:
-            connectors = connectors[display_start:display_start + display_length]
-            connector_ids = connector_ids[display_start:display_start + display_length]
-
-        response_on_error = 'Could not retrieve resolution and translation parameters for project.'
-        if stack_id:
-            resolution = get_object_or_404(Stack, id=int(stack_id)).resolution
-            translation = get_object_or_404(ProjectStack, stack=int(stack_id), project=project_id).translation
-        else:
-            resolution = Double3D(1.0, 1.0, 1.0)
-            translation = Double3D(0.0, 0.0, 0.0)
-
-        # Format output
-        aaData_output = []
-        for c in connectors:
-            response_on_error = 'Failed to format output for connector with ID %s.' % c['connector_id']
-            if 'other_skeleton_id' in c:
-                connected_skeleton_treenode_count = skeleton_to_treenode_count[c['other_skeleton_id']]
-            else:
-                c['other_skeleton_id'] = ''
-                c['other_treenode_id'] = ''
-                c['other_treenode_x'] = c['connector_x']
-                c['other_treenode_y'] = c['connector_y']
-                c['other_treenode_z'] = c['connector_z']
-                connected_skeleton_treenode_count = 0
-
-            if c['connector_id'] in labels_by_connector:
-                labels = ', '.join(map(str, labels_by_connector[c['connector_id']]))
-            else:
-                labels = ''
-
-            row = []
-            row.append(c['connector_id'])
-            row.append(c['other_skeleton_id'])
-            row.append(c['other_treenode_x']) #('%.2f' % )
-            row.append(c['other_treenode_y'])
-            z = c['other_treenode_z']
-            row.append(z)
-            # FIXME: This is the only place we need a stack nad this can be
+    query, params = _connector_table_query(project_id, skeleton_id,
+            relation_type)
+
+    if request.POST.get('format', request.GET.get('format')) == 'csv':
+        response = StreamingHttpResponse(_stream_connector_csv(query, params),
+                content_type='text/csv')
+        response['Content-Disposition'] = \
+                'attachment; filename="connectors_%s.csv"' % skeleton_id
+        return response
+
+    if sorting_column < 0 or sorting_column >= len(CONNECTOR_TABLE_SORT_COLUMNS):
+        raise ValueError("Can't sort by column %s" % sorting_column)
+    # Ties are broken by connector and partner node in the same direction,
+    # connectors without partners come last in ascending order.
+    direction = 'DESC' if sort_descending else 'ASC'
+    order = ', '.join('%s %s' % (column, direction) for column in (
+            CONNECTOR_TABLE_SORT_COLUMNS[sorting_column], 'connector_id',
+            'other_treenode_id', 'this_treenode_id'))
+    page = '''
+        SELECT *, count(*) OVER () AS n_rows
+        FROM (%s) rows
+        ORDER BY %s
+        OFFSET %%(offset)s
+        ''' % (query, order)
+    params['offset'] = display_start
+    if display_length > 0:
+        page += ' LIMIT %(limit)s'
+        params['limit'] = display_length
+
+    cursor = connection.cursor()
+    cursor.execute(page, params)
+    connectors = cursor_fetch_dictionary(cursor)
+
+    if connectors:
+        total_result_count = connectors[0]['n_rows']
+    else:
+        # The page is empty, count all rows instead
+        cursor.execute('SELECT count(*) FROM (%s) rows' % query, params)
+        total_result_count = cursor.fetchone()[0]
+
+    if 0 == total_result_count:
+        return empty_result()
+
+    if stack_id:
+        resolution = get_object_or_404(Stack, id=int(stack_id)).resolution
+        translation = get_object_or_404(ProjectStack, stack=int(stack_id), project=project_id).translation
+    else:
+        resolution = Double3D(1.0, 1.0, 1.0)
+        translation = Double3D(0.0, 0.0, 0.0)
+
+    # Format output
+    aaData_output = []
+    for c in connectors:
+        z = c['z']
+        aaData_output.append([
+            c['connector_id'],
+            c['other_skeleton_id'] or '',
+            float('%.2f' % c['x']),
+            float('%.2f' % c['y']),
+            float('%.2f' % z),
+            # FIXME: This is the only place we need a stack and this can be
             # done in the client as well. So we really want to keep this and
             # have a more complicated API?
-            row.append(int((z - translation.z) / resolution.z))
-            row.append(c['confidence'])
-            row.append(labels)
-            row.append(connected_skeleton_treenode_count)
-            row.append(c['connector_username'])
-            row.append(c['other_treenode_id'])
-            row.append(c['last_modified'])
-            aaData_output.append(row)
-
-        # Sort output
-        def fetch_value_for_sorting(row):
-            value = row[sorting_column]
-            if isinstance(value, str) or isinstance(value, unicode):
-                return upper(value)
-            return value
-        aaData_output.sort(key=fetch_value_for_sorting)
-
-        # Fix excessive decimal precision in coordinates
-        for row in aaData_output:
-            row[2] = float('%.2f' % row[2])
-            row[3] = float('%.2f' % row[3])
-            row[4] = float('%.2f' % row[4])
-
-        if sort_descending:
-            aaData_output.reverse()
+            int((z - translation.z) / resolution.z),
+            c['confidence'],
+            c['labels'],
+            c['n_partner_nodes'],
+            c['username'],
+            c['other_treenode_id'] or '',
+            c['last_modified']])
 
-        return HttpResponse(json.dumps({
-            'iTotalRecords': total_result_count,
-            'iTotalDisplayRecords': total_result_count,
-            'aaData': aaData_output}))
-
-    except Exception as e:
-        raise Exception(response_on_error + ':' + str(e))
+    return HttpResponse(json.dumps({
+        'iTotalRecords': total_result_count,
+        'iTotalDisplayRecords': total_result_count,
+        'aaData': aaData_output}))
 
 def _connector_skeletons(connector_ids, project_id):
     """ Return a dictionary of connector ID as keys and a dictionary as value
@@ -495,6 +456,7 @@ def create_connector(request, project_id=None):
         location_z=float(query_parameters['z']),
         confidence=parsed_confidence)
     new_connector.save()
+    invalidate_project(project_id)
 
     return HttpResponse(json.dumps({'connector_id': new_connector.id}))
 
@@ -504,6 +466,7 @@ def delete_connector(request, project_id=None):
     connector_id = int(request.POST.get("connector_id", 0))
     can_edit_or_fail(request.user, connector_id, 'connector')
     Connector.objects.filter(id=connector_id).delete()
+    invalidate_project(project_id)
     return HttpResponse(json.dumps({
         'message': 'Removed connector and class_instances',
         'connector_id': connector_id}))
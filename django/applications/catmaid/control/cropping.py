@@ -11,14 +11,21 @@ from catmaid.control.common import id_generator, json_error_response
 import urllib2 as urllib
 import os.path
 import glob
+import copy
+import hashlib
+import struct
+from fractions import Fraction
+from itertools import izip
+from multiprocessing.pool import ThreadPool
 from time import time
 from math import cos, sin, radians
 
+import numpy as np
+
 # The libuuid import is a workaround for a bug with GraphicsMagick
 # which expects the library to be loaded already. Therefore, it
 # has to be loaded before pgmagick.
-from pgmagick import Blob, Image, ImageList, Geometry, ChannelType, \
-        CompositeOperator as co
+from pgmagick import Blob, Image, Geometry
 
 from celery.task import task
 
@@ -29,6 +36,8 @@ file_extension = "tiff"
 # The path were cropped files get stored in
 crop_output_path = os.path.join(settings.MEDIA_ROOT,
     settings.MEDIA_CROPPING_SUBDIRECTORY)
+# The path where fetched tiles are cached, if enabled
+tile_cache_path = os.path.join(crop_output_path, 'tiles')
 
 class CropJob:
     """ A small container class to keep information about the cropping
@@ -181,14 +190,8 @@ class ImagePart:
 
     def get_image( self ):
         # Open the image
-        try:
-            img_file = urllib.urlopen( self.path )
-            img_data = img_file.read()
-            bytes_read = len(img_data)
-        except urllib.HTTPError as e:
-            raise ImageRetrievalError(self.path, "Error code: %s" % e.code)
-        except urllib.URLError as e:
-            raise ImageRetrievalError(self.path, e.reason)
+        img_data = fetch_tile( self.path )
+        bytes_read = len(img_data)
 
         blob = Blob( img_data )
         image = Image( blob )
@@ -206,6 +209,75 @@ class ImagePart:
                                                float(src_width * src_height))
         return image
 
+def fetch_tile( path ):
+    """ Returns the content of the tile at the given URL. If
+    CROPPING_TILE_CACHE_MAX_AGE is larger than zero, tiles are stored in a
+    cache folder that is shared by all cropping jobs and reused as long as
+    they are younger than this many seconds.
+    """
+    max_age = settings.CROPPING_TILE_CACHE_MAX_AGE
+    if max_age > 0:
+        cache_path = os.path.join(tile_cache_path, hashlib.sha1(path.encode("utf-8")).hexdigest())
+        try:
+            if time() - os.path.getmtime( cache_path ) < max_age:
+                with open( cache_path, 'rb' ) as f:
+                    return f.read()
+        except (IOError, OSError):
+            pass
+
+    try:
+        img_file = urllib.urlopen( path )
+        img_data = img_file.read()
+    except urllib.HTTPError as e:
+        raise ImageRetrievalError(path, "Error code: %s" % e.code)
+    except urllib.URLError as e:
+        raise ImageRetrievalError(path, e.reason)
+
+    if max_age > 0:
+        # Write to a temporary file first, so that other jobs never read a
+        # partially written tile. The cache is optional, failures are ignored.
+        tmp_path = cache_path + '.' + id_generator()
+        try:
+            if not os.path.exists( tile_cache_path ):
+                os.makedirs( tile_cache_path )
+            with open( tmp_path, 'wb' ) as f:
+                f.write( img_data )
+            os.rename( tmp_path, cache_path )
+        except (IOError, OSError):
+            if os.path.exists( tmp_path ):
+                os.remove( tmp_path )
+
+    return img_data
+
+def image_to_array( image, single_channel=False ):
+    """ Returns the pixels of a pgmagick image as NumPy array of 8 bit values,
+    either with three channels (RGB) or, optionally, with only the red one.
+    """
+    width = image.size().width()
+    height = image.size().height()
+    blob = Blob()
+    image.write( blob, 'RGB', 8 )
+    data = np.frombuffer( blob.data, dtype=np.uint8 ).reshape( height, width, 3 )
+    return data[:, :, 0] if single_channel else data
+
+def array_to_image( data ):
+    """ Creates a pgmagick image from a NumPy array of 8 bit values with either
+    three channels (RGB) or one (gray).
+    """
+    height, width = data.shape[:2]
+    magick = 'GRAY' if data.ndim == 2 else 'RGB'
+    blob = Blob( np.ascontiguousarray( data, dtype=np.uint8 ).tostring() )
+    return Image( blob, Geometry( width, height ), 8, magick )
+
+def get_image_part_data( image_part ):
+    """ Fetches and crops an image part and returns its pixels. This is run by
+    the threads of the tile fetching pool. """
+    return image_to_array( image_part.get_image() )
+
+def get_tile_data( path, single_channel=False ):
+    """ Fetches a whole tile and returns its pixels. """
+    return image_to_array( Image( Blob( fetch_tile( path ) ) ), single_channel )
+
 def to_x_index( x, job, enforce_bounds=True ):
     """ Converts a real world position to a x pixel position.
     Also, makes sure the value is in bounds.
@@ -233,26 +305,10 @@ def to_z_index( z, job, enforce_bounds=True ):
         section = min(max(section, 0.0), job.ref_stack.dimension.z - 1.0)
     return int( section )
 
-def addMetaData( path, job, result ):
-    """ Use this method to add meta data to the image. Due to a bug in
-    exiv2, its python wrapper pyexiv2 is of no use to us. This bug
-    (http://dev.exiv2.org/issues/762) hinders us to work on multi-page
-    TIFF files. Instead, we use a separate tool called exiftool to write
-    meta data. Currently, there seems no better solution than this. If the
-    tool is not found, no meta data is produced and no error is raised.
+def imagej_description( job, n_images ):
+    """ Creates an ImageJ specific image description, which allows easy
+    embedding of units and display options.
     """
-    # Add resolution information in pixel per nanometer. The stack info
-    # available is nm/px and refers to a zoom-level of zero.
-    res_x_scaled = job.ref_stack.resolution.x * 2**job.zoom_level
-    res_y_scaled = job.ref_stack.resolution.y * 2**job.zoom_level
-    res_x_nm_px = 1.0 / res_x_scaled
-    res_y_nm_px = 1.0 / res_y_scaled
-    res_args = "-EXIF:XResolution={0} -EXIF:YResolution={1} -EXIF:" \
-            "ResolutionUnit=None".format( str(res_x_nm_px), str(res_y_nm_px) )
-
-    # ImageJ specific meta data to allow easy embedding of units and
-    # display options.
-    n_images = len( result )
     ij_version= "1.45p"
     unit = "nm"
     newline = "\n"
@@ -267,34 +323,119 @@ def addMetaData( path, job, result ):
                     "modulo the channel count is not zero" )
         n_slices = n_images / n_channels
         ij_data += "images={1}{0}channels={2}{0}slices={3}{0}hyperstack=true{0}mode=color{0}".format( newline, str(n_images), str(n_channels), str(n_slices) )
-    ij_args = "-EXIF:ImageDescription=\"{0}\"".format( ij_data )
-
-    # Information about the software used
-    sw_args = "-EXIF:Software=\"Created with CATMAID and GraphicsMagic, " \
-            "processed with exiftool.\""
-    # Build up the final tag changing arguments for each slice
-    tag_args = "{0} {1} {2}".format( res_args, ij_args, sw_args )
-    per_slice_tag_args = []
-    for i in range(0, n_images):
-        # the string EXIF gets replaced for every image with IFD<N>
-        slice_args = tag_args.replace( "EXIF", "IFD" + str(i) )
-        per_slice_tag_args.append( slice_args  )
-    final_tag_args = " ".join( per_slice_tag_args )
-    # Create the final call and execute
-    call = "exiftool -overwrite_original {0} {1}".format( final_tag_args, path )
-    os.system( call )
-
-    # Re-save the image with GraphicsMagick, otherwise ImageJ won't read the
-    # images directly.
-    images = ImageList()
-    images.readImages( path )
-    images.writeImages( path )
+    return ij_data
+
+class TiffWriter:
+    """ Writes a multi-page TIFF file one page at a time, so that only a single
+    image has to be kept in memory. Pages are stored uncompressed as 8 bit gray
+    or RGB images. All pages share the same image description, resolution (in
+    pixels per unit) and software tags. The description can be replaced until
+    the file is closed, as long as it doesn't exceed the reserved length.
+    """
+    description_length = 512
+
+    def __init__( self, f, x_resolution, y_resolution, software ):
+        self.f = f
+        self.n_pages = 0
+        # Offset of the field that has to point to the next IFD
+        self.next_ifd_field = 4
+        software += '\0'
+        # Header, followed by the shared tag values
+        self.description_offset = 8
+        rationals_offset = self.description_offset + self.description_length
+        self.x_resolution_offset = rationals_offset
+        self.y_resolution_offset = rationals_offset + 8
+        self.bits_per_sample_offset = rationals_offset + 16
+        self.software_offset = rationals_offset + 24
+        self.software_length = len(software)
+        f.write( struct.pack( '<2sHI', 'II', 42, 0 ) )
+        f.write( '\0' * self.description_length )
+        f.write( struct.pack( '<4I', *(self.rational( x_resolution ) +
+                self.rational( y_resolution ) ) ) )
+        f.write( struct.pack( '<4H', 8, 8, 8, 0 ) )
+        f.write( software )
+
+    @staticmethod
+    def rational( value ):
+        f = Fraction( value ).limit_denominator( 1000000 )
+        return f.numerator, f.denominator
+
+    def set_description( self, description ):
+        description = description.encode( 'ascii' )
+        if len( description ) >= self.description_length:
+            raise ValueError( "TIFF image description is too long" )
+        # Unused space is filled with line breaks, which ImageJ ignores
+        padding = self.description_length - len( description ) - 1
+        self.f.seek( self.description_offset )
+        self.f.write( description + '\n' * padding + '\0' )
+        self.f.seek( 0, os.SEEK_END )
+
+    def write_page( self, data ):
+        """ Appends a NumPy array of 8 bit values with shape (height, width)
+        or (height, width, 3) as new page. """
+        data = np.ascontiguousarray( data, dtype=np.uint8 )
+        height, width = data.shape[:2]
+        samples = 1 if data.ndim == 2 else data.shape[2]
+        f = self.f
+        f.seek( 0, os.SEEK_END )
+        # Pixel data and IFDs start at word boundaries
+        if f.tell() % 2:
+            f.write( '\0' )
+        data_offset = f.tell()
+        f.write( data.tostring() )
+        if f.tell() % 2:
+            f.write( '\0' )
+        ifd_offset = f.tell()
+
+        if 1 == samples:
+            bits_per_sample = (3, 1, 8)
+        else:
+            bits_per_sample = (3, samples, self.bits_per_sample_offset)
+        # Tags as (tag, type, count, value), sorted by tag. Types: 2 ASCII,
+        # 3 SHORT, 4 LONG, 5 RATIONAL.
+        entries = [
+            (256, 4, 1, width),
+            (257, 4, 1, height),
+            (258,) + bits_per_sample,
+            (259, 3, 1, 1),
+            (262, 3, 1, 1 if 1 == samples else 2),
+            (270, 2, self.description_length, self.description_offset),
+            (273, 4, 1, data_offset),
+            (277, 3, 1, samples),
+            (278, 4, 1, height),
+            (279, 4, 1, data.nbytes),
+            (282, 5, 1, self.x_resolution_offset),
+            (283, 5, 1, self.y_resolution_offset),
+            (284, 3, 1, 1),
+            (296, 3, 1, 1),
+            (305, 2, self.software_length, self.software_offset),
+        ]
+        f.write( struct.pack( '<H', len(entries) ) )
+        for tag, tag_type, count, value in entries:
+            if 3 == tag_type and 1 == count:
+                f.write( struct.pack( '<HHIHH', tag, tag_type, count, value, 0 ) )
+            else:
+                f.write( struct.pack( '<HHII', tag, tag_type, count, value ) )
+        f.write( struct.pack( '<I', 0 ) )
+
+        # Link the previous IFD to this one
+        f.seek( self.next_ifd_field )
+        f.write( struct.pack( '<I', ifd_offset ) )
+        self.next_ifd_field = ifd_offset + 2 + 12 * len(entries)
+        self.n_pages += 1
 
 def extract_substack( job ):
     """ Extracts a sub-stack as specified in the passed job while respecting
     rotation requests. A list of pgmagick images is returned -- one for each
     slice, starting on top.
     """
+    return [array_to_image(data) for data in iter_substack( job )]
+
+def iter_substack( job ):
+    """ Extracts a sub-stack as specified in the passed job while respecting
+    rotation requests. This is a generator of NumPy arrays -- one for each
+    slice and stack, starting on top. Only a single slice is kept in memory.
+    """
 
     # Make sure tile source getters have been initialized on the job
     if job.needs_initialization:
@@ -303,28 +444,25 @@ def extract_substack( job ):
     # Treat rotation requests special
     if abs(job.rotation_cw) < 0.00001:
         # No rotation, create the sub-stack
-        cropped_stack = extract_substack_no_rotation( job )
+        for data in extract_substack_no_rotation( job ):
+            yield data
     elif abs(job.rotation_cw - 90.0) < 0.00001:
         # 90 degree rotation, create the sub-stack and do a simple rotation
-        cropped_stack = extract_substack_no_rotation( job )
-        for img in cropped_stack:
-            img.rotate(270.0)
+        for data in extract_substack_no_rotation( job ):
+            yield np.rot90(data, 1)
     elif abs(job.rotation_cw - 180.0) < 0.00001:
         # 180 degree rotation, create the sub-stack and do a simple rotation
-        cropped_stack = extract_substack_no_rotation( job )
-        for img in cropped_stack:
-            img.rotate(180.0)
+        for data in extract_substack_no_rotation( job ):
+            yield np.rot90(data, 2)
     elif abs(job.rotation_cw - 270.0) < 0.00001:
         # 270 degree rotation, create the sub-stack and do a simple rotation
-        cropped_stack = extract_substack_no_rotation( job )
-        for img in cropped_stack:
-            img.rotate(90.0)
+        for data in extract_substack_no_rotation( job ):
+            yield np.rot90(data, 3)
     else:
         # Some methods do counter-clockwise rotation
         rotation_ccw = 360.0 - job.rotation_cw
-        # There is rotation requested. First, backup the cropping
-        # coordinates and manipulate the job to create a cropped
-        # stack of the bounding box of the rotated box.
+        # There is rotation requested. First, create a copy of the job
+        # with the bounding box of the rotated box as cropping coordinates.
         real_x_min = job.x_min
         real_x_max = job.x_max
         real_y_min = job.y_min
@@ -341,30 +479,23 @@ def extract_substack( job ):
         rot_p4 = rotate2d(rotation_ccw,
             [real_x_max, real_y_min], center)
         # Find new (larger) bounding box of rotated ROI and write
-        # them into the job
-        job.x_min = min([rot_p1[0], rot_p2[0], rot_p3[0], rot_p4[0]])
-        job.y_min = min([rot_p1[1], rot_p2[1], rot_p3[1], rot_p4[1]])
-        job.x_max = max([rot_p1[0], rot_p2[0], rot_p3[0], rot_p4[0]])
-        job.y_max = max([rot_p1[1], rot_p2[1], rot_p3[1], rot_p4[1]])
-        # Create the enlarged sub-stack
-        cropped_stack = extract_substack_no_rotation( job )
-
-        # Next, rotate the whole result stack counterclockwise to have the
-        # actual ROI axis aligned.
-        for img in cropped_stack:
-            img.rotate(rotation_ccw)
-
-        # Last, do a second crop to remove the not needed parts. The region
-        # to crop is defined by the relative original crop-box coordinates to
-        # to the rotated bounding box.
+        # them into the job copy
+        bb_job = copy.copy(job)
+        bb_job.x_min = min([rot_p1[0], rot_p2[0], rot_p3[0], rot_p4[0]])
+        bb_job.y_min = min([rot_p1[1], rot_p2[1], rot_p3[1], rot_p4[1]])
+        bb_job.x_max = max([rot_p1[0], rot_p2[0], rot_p3[0], rot_p4[0]])
+        bb_job.y_max = max([rot_p1[1], rot_p2[1], rot_p3[1], rot_p4[1]])
+
+        # The region to crop after the rotation is defined by the relative
+        # original crop-box coordinates to the rotated bounding box.
         rot_bb_p1 = rotate2d(rotation_ccw,
-            [job.x_min, job.y_min], center)
+            [bb_job.x_min, bb_job.y_min], center)
         rot_bb_p2 = rotate2d(rotation_ccw,
-            [job.x_min, job.y_max], center)
+            [bb_job.x_min, bb_job.y_max], center)
         rot_bb_p3 = rotate2d(rotation_ccw,
-            [job.x_max, job.y_max], center)
+            [bb_job.x_max, bb_job.y_max], center)
         rot_bb_p4 = rotate2d(rotation_ccw,
-            [job.x_max, job.y_min], center)
+            [bb_job.x_max, bb_job.y_min], center)
         # Get bounding box minimum coordinates in world space
         bb_x_min = min([rot_bb_p1[0], rot_bb_p2[0], rot_bb_p3[0], rot_bb_p4[0]])
         bb_y_min = min([rot_bb_p1[1], rot_bb_p2[1], rot_bb_p3[1], rot_bb_p4[1]])
@@ -383,35 +514,35 @@ def extract_substack( job ):
         crop_y_max_px = to_y_index(crop_y_max, job, False)
         crop_width_px = crop_x_max_px - crop_x_min_px
         crop_height_px = crop_y_max_px - crop_y_min_px
-        # Crop all images (Geometry: width, height, xOffset, yOffset)
+        # Geometry: width, height, xOffset, yOffset
         crop_geometry = Geometry(crop_width_px, crop_height_px,
             crop_x_min_px, crop_y_min_px)
-        for img in cropped_stack:
-            img.crop(crop_geometry)
-
-        # Reset the original job parameters
-        job.x_min = real_x_min
-        job.x_max = real_x_max
-        job.y_min = real_y_min
-        job.y_max = real_y_max
 
-    return cropped_stack
+        # Create the enlarged sub-stack, rotate each slice counterclockwise to
+        # have the actual ROI axis aligned and remove the not needed parts.
+        for data in extract_substack_no_rotation( bb_job ):
+            img = array_to_image( data )
+            img.rotate(rotation_ccw)
+            img.crop(crop_geometry)
+            yield image_to_array( img, data.ndim == 2 )
 
-def extract_substack_no_rotation( job ):
-    """ Extracts a sub-stack as specified in the passed job without respecting
-    rotation requests. A list of pgmagick images is returned -- one for each
-    slice, starting on top.
+def get_stack_bounding_boxes( job ):
+    """ Returns a dictionary that maps the ID of each stack of the job to the
+    bounding box of the cropped region in pixel coordinates of this stack.
     """
-
     # The actual bounding boxes used for creating the images of each stack
     # depend not only on the request, but also on the translation of the stack
     # wrt. the project. Therefore, a dictionary with bounding box information for
     # each stack is created.
+    translations = {}
+    for ps in ProjectStack.objects.filter(project_id=job.project_id,
+            stack_id__in=[s.id for s in job.stacks]):
+        translations[ps.stack_id] = ps.translation
+
     s_to_bb = {}
     for stack in job.stacks:
         # Retrieve translation relative to current project
-        translation = ProjectStack.objects.get(
-                project_id=job.project_id, stack_id=stack.id).translation
+        translation = translations[stack.id]
         x_min_t = job.x_min - translation.x
         x_max_t = job.x_max - translation.x
         y_min_t = job.y_min - translation.y
@@ -452,6 +583,68 @@ def extract_substack_no_rotation( job ):
         bb.height = height
         s_to_bb[stack.id] = bb
 
+    return s_to_bb
+
+def get_image_parts( job, stack, bb, z ):
+    """ Returns a list of image parts that make up the cropped region of a
+    single slice of a stack.
+    """
+    # Shortcut for tile width and height
+    tile_width = stack.tile_width
+    tile_height = stack.tile_height
+    # Get indices for bounding tiles (0 indexed)
+    tile_x_min = int(bb.px_x_min / tile_width)
+    tile_x_max = int(bb.px_x_max / tile_width)
+    tile_y_min = int(bb.px_y_min / tile_height)
+    tile_y_max = int(bb.px_y_max / tile_height)
+    # Get the number of needed tiles for each direction
+    num_x_tiles = tile_x_max - tile_x_min + 1
+    num_y_tiles = tile_y_max - tile_y_min + 1
+    # Associate image parts with all tiles
+    image_parts = []
+    x_dst = bb.px_x_offset
+    for nx, x in enumerate( range(tile_x_min, tile_x_max + 1) ):
+        # The min x,y for the image part in the current tile are 0
+        # for all tiles except the first one.
+        cur_px_x_min = 0 if nx > 0 else bb.px_x_min - x * tile_width
+        # The max x,y for the image part of current tile are the tile
+        # size (exclusive) except for the last one.
+        if nx < (num_x_tiles - 1):
+            cur_px_x_max = tile_width
+        else:
+            cur_px_x_max = bb.px_x_max - x * tile_width
+        # Reset y destination component
+        y_dst = bb.px_y_offset
+        for ny, y in enumerate( range(tile_y_min, tile_y_max + 1) ):
+            cur_px_y_min = 0 if ny > 0 else bb.px_y_min - y * tile_height
+            if ny < (num_y_tiles - 1):
+                cur_px_y_max = tile_height
+            else:
+                cur_px_y_max = bb.px_y_max - y * tile_height
+            # Create an image part definition
+            path = job.get_tile_path(stack, (x, y, z))
+            try:
+                part = ImagePart(path, cur_px_x_min, cur_px_x_max,
+                        cur_px_y_min, cur_px_y_max, x_dst, y_dst)
+                image_parts.append( part )
+            except:
+                # ignore failed slices
+                pass
+            # Update y component of destination position
+            y_dst += cur_px_y_max - cur_px_y_min
+        # Update x component of destination position
+        x_dst += cur_px_x_max - cur_px_x_min
+
+    return image_parts
+
+def extract_substack_no_rotation( job ):
+    """ Extracts a sub-stack as specified in the passed job without respecting
+    rotation requests. This is a generator of NumPy arrays -- one for each
+    slice and stack, starting on top. The tiles of a slice are fetched in
+    parallel by a pool of CROPPING_FETCH_THREADS threads.
+    """
+    s_to_bb = get_stack_bounding_boxes( job )
+
     # Get number of wanted slices
     px_z_min = to_z_index(job.z_min, job)
     px_z_max = to_z_index(job.z_max, job)
@@ -463,100 +656,47 @@ def extract_substack_no_rotation( job ):
     # Each stack to export is treated as a separate channel. The order
     # of the exported dimensions is XYCZ. This means all the channels of
     # one slice are exported, then the next slice follows, etc.
-    cropped_stack = []
-    # Accumulator for estimated result size
-    estimated_total_size = 0
-    # Iterate over all slices
-    for nz in range(n_slices):
-        for stack in job.stacks:
-            bb = s_to_bb[stack.id]
-            # Shortcut for tile width and height
-            tile_width = stack.tile_width
-            tile_height = stack.tile_height
-            # Get indices for bounding tiles (0 indexed)
-            tile_x_min = int(bb.px_x_min / tile_width)
-            tile_x_max = int(bb.px_x_max / tile_width)
-            tile_y_min = int(bb.px_y_min / tile_height)
-            tile_y_max = int(bb.px_y_max / tile_height)
-            # Get the number of needed tiles for each direction
-            num_x_tiles = tile_x_max - tile_x_min + 1
-            num_y_tiles = tile_y_max - tile_y_min + 1
-            # Associate image parts with all tiles
-            image_parts = []
-            x_dst = bb.px_x_offset
-            for nx, x in enumerate( range(tile_x_min, tile_x_max + 1) ):
-                # The min x,y for the image part in the current tile are 0
-                # for all tiles except the first one.
-                cur_px_x_min = 0 if nx > 0 else bb.px_x_min - x * tile_width
-                # The max x,y for the image part of current tile are the tile
-                # size minus one except for the last one.
-                if nx < (num_x_tiles - 1):
-                    cur_px_x_max = tile_width - 1
-                else:
-                    cur_px_x_max = bb.px_x_max - x * tile_width
-                # Reset y destination component
-                y_dst = bb.px_y_offset
-                for ny, y in enumerate( range(tile_y_min, tile_y_max + 1) ):
-                    cur_px_y_min = 0 if ny > 0 else bb.px_y_min - y * tile_height
-                    if ny < (num_y_tiles - 1):
-                        cur_px_y_max = tile_height - 1
-                    else:
-                        cur_px_y_max = bb.px_y_max - y * tile_height
-                    # Create an image part definition
-                    z = bb.px_z_min + nz
-                    path = job.get_tile_path(stack, (x, y, z))
-                    try:
-                        part = ImagePart(path, cur_px_x_min, cur_px_x_max,
-                                cur_px_y_min, cur_px_y_max, x_dst, y_dst)
-                        image_parts.append( part )
-                    except:
-                        # ignore failed slices
-                        pass
-                    # Update y component of destination position
-                    y_dst += cur_px_y_max - cur_px_y_min
-                # Update x component of destination position
-                x_dst += cur_px_x_max - cur_px_x_min
-
-            # Write out the image parts and make sure the maximum allowed file
-            # size isn't exceeded.
-            cropped_slice = None
-            for ip in image_parts:
-                # Get (correctly cropped) image
-                image = ip.get_image()
-
-                # Estimate total file size and abort if this exceeds the
-                # maximum allowed file size.
-                estimated_total_size = estimated_total_size + ip.estimated_size
-                if estimated_total_size > settings.GENERATED_FILES_MAXIMUM_SIZE:
-                    raise ValueError("The estimated size of the requested image "
-                                     "region is larger than the maximum allowed "
-                                     "file size: %0.2f > %s Bytes" % \
-                                     (estimated_total_size,
-                                      settings.GENERATED_FILES_MAXIMUM_SIZE))
-
-                # It is unfortunately not possible to create proper composite
-                # images based on a canvas image newly created like this:
-                # cropped_slice = Image( Geometry(bb.width, bb.height), Color("black"))
-                # Therefore, this workaround is used.
-                if not cropped_slice:
-                    cropped_slice = Image(image)
-                    cropped_slice.backgroundColor("black")
-                    cropped_slice.erase()
-                    # The '!' makes sure the aspect ration is ignored
-                    cropped_slice.scale('%sx%s!' % (bb.width, bb.height))
-                # Draw the image onto result image
-                cropped_slice.composite( image, ip.x_dst, ip.y_dst, co.OverCompositeOp )
-                # Delete tile image - it's not needed anymore
-                del image
-
-            if cropped_slice:
+    pool = ThreadPool(max(1, settings.CROPPING_FETCH_THREADS))
+    try:
+        # Accumulator for estimated result size
+        estimated_total_size = 0
+        # Iterate over all slices
+        for nz in range(n_slices):
+            for stack in job.stacks:
+                bb = s_to_bb[stack.id]
+                image_parts = get_image_parts(job, stack, bb, bb.px_z_min + nz)
+                if not image_parts:
+                    continue
+
+                # Fetch the image parts concurrently, but copy them onto the
+                # result slice in order, while making sure the maximum allowed
+                # file size isn't exceeded.
+                cropped_slice = np.zeros((bb.height, bb.width, 3), dtype=np.uint8)
+                for ip, data in izip(image_parts,
+                        pool.imap(get_image_part_data, image_parts)):
+                    # Estimate total file size and abort if this exceeds the
+                    # maximum allowed file size.
+                    estimated_total_size = estimated_total_size + ip.estimated_size
+                    if estimated_total_size > settings.GENERATED_FILES_MAXIMUM_SIZE:
+                        raise ValueError("The estimated size of the requested image "
+                                         "region is larger than the maximum allowed "
+                                         "file size: %0.2f > %s Bytes" % \
+                                         (estimated_total_size,
+                                          settings.GENERATED_FILES_MAXIMUM_SIZE))
+
+                    # Draw the image onto result image, parts that reach
+                    # over the border of the result are clipped.
+                    height = max(0, min(data.shape[0], bb.height - ip.y_dst))
+                    width = max(0, min(data.shape[1], bb.width - ip.x_dst))
+                    cropped_slice[ip.y_dst:ip.y_dst + height,
+                                  ip.x_dst:ip.x_dst + width] = data[:height, :width]
+
                 # Optionally, use only a single channel
                 if job.single_channel:
-                    cropped_slice.channel( ChannelType.RedChannel )
-                # Add the image to the cropped stack
-                cropped_stack.append( cropped_slice )
-
-    return cropped_stack
+                    cropped_slice = cropped_slice[:, :, 0]
+                yield cropped_slice
+    finally:
+        pool.terminate()
 
 def rotate2d(degrees, point, origin):
     """ A rotation function that rotates a point counter-clockwise around
@@ -578,23 +718,25 @@ def process_crop_job(job, create_message=True):
     and the creation of the sub-stack. It can be executed as Celery task.
     """
     try:
-        # Create the sub-stack
-        cropped_stack = extract_substack( job )
-
-        # Create tho output image
-        outputImage = ImageList()
-        for img in cropped_stack:
-            outputImage.append( img )
+        # Resolution information in pixel per nanometer. The stack info
+        # available is nm/px and refers to a zoom-level of zero.
+        res_x_nm_px = 1.0 / (job.ref_stack.resolution.x * 2**job.zoom_level)
+        res_y_nm_px = 1.0 / (job.ref_stack.resolution.y * 2**job.zoom_level)
+
+        # Write the slices of the sub-stack one by one to a temporary
+        # location, along with some meta data.
+        with open( job.output_path, 'wb' ) as output_file:
+            writer = TiffWriter( output_file, res_x_nm_px, res_y_nm_px,
+                    "Created with CATMAID" )
+            for data in iter_substack( job ):
+                writer.write_page( data )
+            writer.set_description( imagej_description( job, writer.n_pages ) )
 
-        # Save the resulting micro_stack to a temporary location
         no_error_occured = True
         error_message = ""
         # Only produce an image if parts of stacks are within the output
-        if len( cropped_stack ) > 0:
-            outputImage.writeImages( job.output_path )
-            # Add some meta data to the image
-            addMetaData( job.output_path, job, cropped_stack )
-        else:
+        if 0 == writer.n_pages:
+            os.remove( job.output_path )
             no_error_occured = False
             error_message = "A region outside the stack has been selected. " \
                     "Therefore, no image was produced."
@@ -718,7 +860,9 @@ def crop(request, project_id=None, stack_ids=None, x_min=None, x_max=None,
 def cleanup( max_age=1209600 ):
     """ Cleans up the temporarily space of the cropped stacks.
     Such a stack is deleted if it is older than max_age, which
-    is specified in seconds and  defaults to two weeks (1209600). 
+    is specified in seconds and  defaults to two weeks (1209600).
+    Cached tiles are deleted if they are older than
+    CROPPING_TILE_CACHE_MAX_AGE. 
     """ 
     search_pattern = os.path.join(crop_output_path, file_prefix + "*." + file_extension)
     now = time()
@@ -727,6 +871,16 @@ def cleanup( max_age=1209600 ):
         file_ctime = os.path.getctime( item )
         if (now - file_ctime) > max_age:
             files_to_remove.append( item )
+    # Cached tiles are removed once they are too old to be used
+    tile_max_age = settings.CROPPING_TILE_CACHE_MAX_AGE
+    if tile_max_age > 0:
+        for item in glob.glob( os.path.join(tile_cache_path, "*") ):
+            try:
+                if (now - os.path.getmtime( item )) > tile_max_age:
+                    files_to_remove.append( item )
+            except OSError:
+                # The tile was replaced meanwhile
+                pass
     for item in files_to_remove:
             os.remove( item )
 
@@ -9,7 +9,7 @@ from django.shortcuts import get_object_or_404
 from catmaid.models import Project, Class, ClassInstance, Relation, Connector, \
         ConnectorClassInstance, UserRole, Treenode, TreenodeClassInstance, \
         ChangeRequest
-from catmaid.control.authentication import requires_user_role, can_edit_or_fail
+from catmaid.control.authentication import requires_user_role, editable_ids
 from catmaid.fields import Double3D
 
 def get_link_model(node_type):
@@ -163,15 +163,16 @@ def label_update(request, project_id=None, location_id=None, ntype=None):
     labels_to_delete = table.objects.filter(**kwargs).exclude(class_instance__name__in=new_tags)
 
     if delete_existing_labels:
-        # Iterate over all labels that should get deleted to check permission
-        # on each one. Remember each label that couldn't be deleted in the
-        # other_labels array.
+        # Iterate over all labels that should get deleted, the permission on
+        # each one is checked for all of them at once. Remember each label
+        # that couldn't be deleted in the other_labels array.
         other_labels = []
         deleted_labels = []
+        editable = editable_ids(request.user,
+                [l.id for l in labels_to_delete], table._meta.db_table)
         for l in labels_to_delete:
             try:
-                can_edit_or_fail(request.user, l.id, table._meta.db_table)
-                if remove_label(l.id, ntype):
+                if l.id in editable and remove_label(l.id, ntype):
                     deleted_labels.append(l)
                 else:
                     other_labels.append(l)
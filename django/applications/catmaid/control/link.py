@@ -6,6 +6,7 @@ from django.core.exceptions import ObjectDoesNotExist
 from catmaid.models import UserRole, Project, Relation, Treenode, Connector, \
         TreenodeConnector, ClassInstance
 from catmaid.control.authentication import requires_user_role, can_edit_or_fail
+from catmaid.control.spatial import invalidate_project
 
 @requires_user_role(UserRole.Annotate)
 def create_link(request, project_id=None):
@@ -52,6 +53,7 @@ def create_link(request, project_id=None):
         skeleton=from_treenode.skeleton,  # treenode.skeleton_id where treenode.id = from_id
         connector=to_connector  # connector_id = to_id
     ).save()
+    invalidate_project(project_id)
 
     return HttpResponse(json.dumps({'message': 'success'}), content_type='text/json')
 
@@ -74,5 +76,6 @@ def delete_link(request, project_id=None):
     can_edit_or_fail(request.user, links[0].id, 'treenode_connector')
 
     links[0].delete()
+    invalidate_project(project_id)
     return HttpResponse(json.dumps({'result': 'Removed treenode to connector link'}))
 
@@ -8,6 +8,8 @@ from django.contrib.auth.models import User
 from catmaid.control.authentication import requires_user_role, \
         can_edit_class_instance_or_fail, can_edit_all_or_fail
 from catmaid.control.common import insert_into_log
+from catmaid.control.spatial import invalidate_project
+from catmaid.control.arbor_cache import invalidate_skeletons
 from catmaid.models import UserRole, Project, Class, ClassInstance, \
         ClassInstanceClassInstance, Relation, Treenode
 
@@ -116,6 +118,11 @@ def delete_neuron(request, project_id=None, neuron_id=None):
         # Therefore, raw SQL needs to be used to use true cascading deletion.
         cursor.execute('''
         BEGIN;
+        -- Like lock_connectors_of_skeletons(), within this transaction
+        SELECT 1 FROM connector WHERE id IN (
+            SELECT connector_id FROM treenode_connector
+            WHERE skeleton_id=%s AND project_id=%s)
+        ORDER BY id FOR NO KEY UPDATE;
         DELETE FROM change_request WHERE treenode_id IN (
             SELECT id FROM treenode WHERE skeleton_id=%s AND project_id=%s);
         DELETE FROM change_request WHERE connector_id IN (
@@ -127,7 +134,10 @@ def delete_neuron(request, project_id=None, neuron_id=None):
         DELETE FROM class_instance WHERE id=%s AND project_id=%s;
         DELETE FROM review WHERE skeleton_id=%s AND project_id=%s;
         COMMIT;
-        ''', (skid, project_id) * 7)
+        ''', (skid, project_id) * 8)
+
+    invalidate_project(project_id)
+    invalidate_skeletons(skeleton_ids)
 
     # Insert log entry and refer to position of the first skeleton's root node
     insert_into_log(project_id, request.user.id, 'remove_neuron', root_location,
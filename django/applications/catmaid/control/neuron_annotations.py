@@ -48,47 +48,63 @@ def create_basic_annotated_entity_query(project, params, relations, classes,
     if name:
         filters['name__iregex'] = name
 
-    # Add annotator and time constraints, if available
+    # Annotator and time constraints apply to the annotation links. If
+    # annotations are requested, they constrain the links to those. Otherwise,
+    # entities with any matching annotation link are found.
+    link_conditions = []
     if annotator_id:
-        filters['cici_via_a__user'] = annotator_id
-        filters['cici_via_a__relation_id'] = annotated_with
+        link_conditions.append(('cici.user_id = %s', 'cici_via_a__user',
+                annotator_id))
     if start_date:
-        filters['cici_via_a__creation_time__gte'] = start_date
+        link_conditions.append(('cici.creation_time >= %s',
+                'cici_via_a__creation_time__gte', start_date))
     if end_date:
-        filters['cici_via_a__creation_time__lte'] = end_date
-
-    # Get map of annotations to expand and their sub-annotations
-    sub_annotation_ids = get_sub_annotation_ids(project, annotations_to_expand,
-            relations, classes)
+        link_conditions.append(('cici.creation_time <= %s',
+                'cici_via_a__creation_time__lte', end_date))
 
-    # Collect all annotations and their sub-annotation IDs (if requested) in a
-    # set each. For the actual query each set is connected with AND while
-    # for everything within one set OR is used.
-    annotation_id_sets = []
-    for a in annotations:
-        current_annotation_ids = set([a])
-        # Add sub annotations, if requested
-        sa_ids = sub_annotation_ids.get(a)
-        if sa_ids and len(sa_ids):
-            current_annotation_ids.update(sa_ids)
-        annotation_id_sets.append(current_annotation_ids)
-
-    # Due to Django's QuerySet syntax, we have to add the first
-    # annotation ID set constraint to the first filter we add.
-    if annotation_id_sets:
-        first_id_set = annotation_id_sets.pop()
+    if link_conditions and not annotations:
         filters['cici_via_a__relation_id'] = annotated_with
-        # Use IN (OR) for a single annotation and its sub-annotations
-        filters['cici_via_a__class_instance_b_id__in'] = first_id_set
+        for condition, lookup, value in link_conditions:
+            filters[lookup] = value
 
-    # Create basic filter, possibly containing *one* annotation ID set
+    # Create basic filter
     entities = ClassInstance.objects.filter(**filters)
 
-    # Add remaining filters for annotation constraints, if any
-    for annotation_id_set in annotation_id_sets:
-        entities = entities.filter(
-            cici_via_a__relation_id=annotated_with,
-            cici_via_a__class_instance_b_id__in=annotation_id_set)
+    # Every requested annotation adds the set of entities annotated with it
+    # and, if requested, with one of its sub-annotations, which are looked up
+    # in the annotation closure table. The result is the intersection of
+    # those sets.
+    link_filter = ''.join('\n                  AND ' + condition
+            for condition, lookup, value in link_conditions)
+    link_params = [value for condition, lookup, value in link_conditions]
+    annotation_subqueries = []
+    annotation_params = []
+    for a in annotations:
+        if a in annotations_to_expand:
+            annotation_subqueries.append('''
+                SELECT cici.class_instance_a
+                FROM class_instance_class_instance cici
+                WHERE cici.relation_id = %s
+                  AND cici.class_instance_b IN (
+                      SELECT %s
+                      UNION
+                      SELECT descendant_id FROM annotation_closure
+                      WHERE ancestor_id = %s)''' + link_filter)
+            annotation_params.extend((annotated_with, a, a))
+        else:
+            annotation_subqueries.append('''
+                SELECT cici.class_instance_a
+                FROM class_instance_class_instance cici
+                WHERE cici.relation_id = %s
+                  AND cici.class_instance_b = %s''' + link_filter)
+            annotation_params.extend((annotated_with, a))
+        annotation_params.extend(link_params)
+
+    if annotation_subqueries:
+        entities = entities.extra(
+                where=['class_instance.id IN (%s)' % \
+                        '\nINTERSECT'.join(annotation_subqueries)],
+                params=annotation_params)
 
     # Create final query. Without any restriction, the result set will contain
     # all instances of the given set of allowed classes.
@@ -102,48 +118,71 @@ def get_sub_annotation_ids(project_id, annotation_set, relations, classes):
     if not annotation_set:
         return {}
 
-    aaa_tuples = ClassInstanceClassInstance.objects.filter(
-            project_id=project_id,
-            class_instance_a__class_column=classes['annotation'],
-            class_instance_b__class_column=classes['annotation'],
-            relation_id = relations['annotated_with']).values_list(
-                    'class_instance_b', 'class_instance_a')
-
-    # A set wrapper to keep a set in a dictionary
-    class set_wrapper:
-        def __init__(self):
-            self.data = set()
-
-    # Create a dictionary of all annotations annotating a set of annotations
-    aaa = {}
-    for aa in aaa_tuples:
-        sa_set = aaa.get(aa[0])
-        if sa_set is None:
-            sa_set = set_wrapper()
-            aaa[aa[0]] = sa_set
-        sa_set.data.add(aa[1])
-
-    # Collect all sub-annotations by following the annotation hierarchy for
-    # every annotation in the annotation set passed.
-    sa_ids = {}
-    for a in annotation_set:
-        # Start with an empty result set for each requested annotation
-        ls = set()
-        working_set = set([a])
-        while working_set:
-            parent_id = working_set.pop()
-            # Try to get the sub-annotations for this parent
-            child_ids = aaa.get(parent_id) or set_wrapper()
-            for child_id in child_ids.data:
-                if child_id not in sa_ids:
-                    # Add all children as sub annotations
-                    ls.add(child_id)
-                    working_set.add(child_id)
-        # Store the result list for this ID
-        sa_ids[a] = list(ls)
+    cursor = connection.cursor()
+    cursor.execute('''
+        SELECT ancestor_id, descendant_id
+        FROM annotation_closure
+        WHERE ancestor_id IN (%s)
+        ''' % ','.join(str(int(a)) for a in annotation_set))
+
+    sa_ids = {a: [] for a in annotation_set}
+    for ancestor_id, descendant_id in cursor.fetchall():
+        sa_ids[ancestor_id].append(descendant_id)
 
     return sa_ids
 
+def update_annotation_closure(project_id, annotation_ids, annotated_with,
+        annotation_class):
+    """ Rebuild the rows of the annotation closure table that can be affected
+    by a change of the sub-annotations of the passed in annotations: the ones
+    of these annotations and of all annotations they are transitively
+    annotated with. This has to be called after meta annotation links have
+    been added or removed.
+    """
+    if not annotation_ids:
+        return
+
+    cursor = connection.cursor()
+    # Serialize updates of the closure, concurrent changes of the same
+    # hierarchy would otherwise insert the same rows twice.
+    cursor.execute('LOCK TABLE annotation_closure IN EXCLUSIVE MODE')
+
+    annotation_ids = list(set(annotation_ids))
+    cursor.execute('''
+        SELECT ancestor_id FROM annotation_closure
+        WHERE descendant_id = ANY(%s)
+        ''', (annotation_ids,))
+    ancestor_ids = set(annotation_ids)
+    ancestor_ids.update(row[0] for row in cursor.fetchall())
+    ancestor_ids = list(ancestor_ids)
+
+    cursor.execute('''
+        DELETE FROM annotation_closure WHERE ancestor_id = ANY(%s)
+        ''', (ancestor_ids,))
+
+    # UNION removes duplicates, which makes the recursion terminate on cyclic
+    # annotation hierarchies.
+    cursor.execute('''
+        INSERT INTO annotation_closure (ancestor_id, descendant_id, project_id)
+        WITH RECURSIVE closure (ancestor_id, descendant_id) AS (
+            SELECT cici.class_instance_b, cici.class_instance_a
+            FROM class_instance_class_instance cici, class_instance ci
+            WHERE cici.class_instance_b = ANY(%s)
+              AND cici.relation_id = %s
+              AND cici.class_instance_a = ci.id
+              AND ci.class_id = %s
+            UNION
+            SELECT c.ancestor_id, cici.class_instance_a
+            FROM closure c, class_instance_class_instance cici, class_instance ci
+            WHERE cici.class_instance_b = c.descendant_id
+              AND cici.relation_id = %s
+              AND cici.class_instance_a = ci.id
+              AND ci.class_id = %s
+        )
+        SELECT ancestor_id, descendant_id, %s FROM closure
+        ''', (ancestor_ids, annotated_with, annotation_class, annotated_with,
+            annotation_class, project_id))
+
 def create_annotated_entity_list(project, entities_qs, relations, annotations=True):
     """ Executes the expected class instance queryset in <entities> and expands
     it to aquire more information.
@@ -383,6 +422,20 @@ def _annotate_entities(project_id, entity_ids, annotation_map):
             # Remember which entities got newly annotated
             annotation_objects[ci] = newly_annotated
 
+    # Annotations that got new sub-annotations need their closure updated
+    newly_annotated_ids = set()
+    for e in annotation_objects.itervalues():
+        newly_annotated_ids.update(e)
+    if newly_annotated_ids:
+        sub_annotation_ids = set(ClassInstance.objects.filter(
+                id__in=newly_annotated_ids,
+                class_column=annotation_class).values_list('id', flat=True))
+        if sub_annotation_ids:
+            update_annotation_closure(project_id,
+                    [a.id for a, e in annotation_objects.iteritems()
+                            if e & sub_annotation_ids],
+                    r.id, annotation_class.id)
+
     return annotation_objects
 
 @requires_user_role(UserRole.Annotate)
@@ -466,6 +519,17 @@ def remove_annotation(request, project_id=None, annotation_id=None):
                 .filter(id__in=[cici.id for cici in cicis_to_delete]) \
                 .delete()
 
+        # Update the annotation closure if sub-annotations were removed
+        annotation_class = Class.objects.get(project_id=project_id,
+                class_name='annotation')
+        if ClassInstance.objects.filter(
+                id__in=[cici.class_instance_a_id for cici in cicis_to_delete],
+                class_column=annotation_class).exists():
+            annotated_with = Relation.objects.get(project_id=project_id,
+                    relation_name='annotated_with')
+            update_annotation_closure(project_id, [int(annotation_id)],
+                    annotated_with.id, annotation_class.id)
+
     if len(cicis_to_delete) > 1:
         message = "Removed annotation from %s entities." % len(cicis_to_delete)
     elif len(cicis_to_delete) == 1:
@@ -5,7 +5,7 @@ from collections import defaultdict
 from datetime import datetime
 import itertools as itertools
 
-from django.db import connection
+from django.db import connection, transaction
 from django.http import HttpResponse
 from django.contrib.auth.models import User
 
@@ -14,12 +14,10 @@ from catmaid.models import UserRole, Treenode, TreenodeConnector, Connector, \
 from catmaid.control.authentication import requires_user_role, \
         can_edit_all_or_fail, user_domain
 from catmaid.control.common import get_relation_to_id_map, insert_into_log
+from catmaid.control.spatial import fetch_section, invalidate_project, \
+        nearest_treenode
 from catmaid.control.treenode import can_edit_treenode_or_fail
-
-try:
-    import networkx as nx
-except:
-    pass
+from catmaid.control.arbor_cache import get_arbor
 
 
 @requires_user_role([UserRole.Annotate, UserRole.Browse])
@@ -69,50 +67,12 @@ def node_list_tuples(request, project_id=None):
         # For a superuser, the domain is all users, and implicit.
         domain = None if is_superuser else user_domain(cursor, user_id)
 
-        # Fetch treenodes which are in the bounding box,
-        # which in z it includes the full thickess of the prior section
-        # and of the next section (therefore the '<' and not '<=' for zhigh)
+        # Fetch treenodes and connectors in the bounding box of the field of
+        # view. Neighboring sections are included as parents and children of
+        # nodes in the current section. Rows can come from the section cache.
         params['bottom'] = params['top'] + params['height']
         params['right'] = params['left'] + params['width']
-        cursor.execute('''
-        SELECT
-            t1.id,
-            t1.parent_id,
-            t1.location_x,
-            t1.location_y,
-            t1.location_z,
-            t1.confidence,
-            t1.radius,
-            t1.skeleton_id,
-            t1.user_id,
-            t2.id,
-            t2.parent_id,
-            t2.location_x,
-            t2.location_y,
-            t2.location_z,
-            t2.confidence,
-            t2.radius,
-            t2.skeleton_id,
-            t2.user_id
-        FROM treenode t1
-             INNER JOIN treenode t2 ON
-               (   (t1.id = t2.parent_id OR t1.parent_id = t2.id)
-                OR (t1.parent_id IS NULL AND t1.id = t2.id))
-        WHERE
-            t1.location_z = %(z)s
-            AND t1.location_x > %(left)s
-            AND t1.location_x < %(right)s
-            AND t1.location_y > %(top)s
-            AND t1.location_y < %(bottom)s
-            AND t1.project_id = %(project_id)s
-        LIMIT %(limit)s
-        ''', params)
-
-        # Above, notice that the join is done for:
-        # 1. A parent-child or child-parent pair (where the first one is in section z)
-        # 2. A node with itself when the parent is null
-        # This is by far the fastest way to retrieve all parents and children nodes
-        # of the nodes in section z within the specified 2d bounds.
+        trows, crows = fetch_section(cursor, params)
 
         # A list of tuples, each tuple containing the selected columns for each treenode
         # The id is the first element of each tuple
@@ -121,7 +81,7 @@ def node_list_tuples(request, project_id=None):
         treenode_ids = set()
 
         n_retrieved_nodes = 0 # at one per row, only those within the section
-        for row in cursor.fetchall():
+        for row in trows:
             n_retrieved_nodes += 1
             t1id = row[0]
             if t1id not in treenode_ids:
@@ -132,57 +92,6 @@ def node_list_tuples(request, project_id=None):
                 treenode_ids.add(t2id)
                 treenodes.append(row[9:17] + (is_superuser or row[17] == user_id or row[17] in domain,))
 
-
-        # Find connectors related to treenodes in the field of view
-        # Connectors found attached to treenodes
-        crows = []
-
-        if treenode_ids:
-            response_on_error = 'Failed to query connector locations.'
-            cursor.execute('''
-            SELECT connector.id,
-                connector.location_x,
-                connector.location_y,
-                connector.location_z,
-                connector.confidence,
-                treenode_connector.relation_id,
-                treenode_connector.treenode_id,
-                treenode_connector.confidence,
-                connector.user_id
-            FROM treenode_connector,
-                 connector
-            WHERE treenode_connector.treenode_id IN (%s)
-              AND treenode_connector.connector_id = connector.id
-            ''' % ','.join(map(str, treenode_ids)))
-
-            crows = list(cursor.fetchall())
-
-        # Obtain connectors within the field of view that were not captured above.
-        # Uses a LEFT OUTER JOIN to include disconnected connectors,
-        # that is, connectors that aren't referenced from treenode_connector.
-
-        cursor.execute('''
-        SELECT connector.id,
-            connector.location_x,
-            connector.location_y,
-            connector.location_z,
-            connector.confidence,
-            treenode_connector.relation_id,
-            treenode_connector.treenode_id,
-            treenode_connector.confidence,
-            connector.user_id
-        FROM connector LEFT OUTER JOIN treenode_connector
-                       ON connector.id = treenode_connector.connector_id
-        WHERE connector.project_id = %(project_id)s
-          AND connector.location_z = %(z)s
-          AND connector.location_x > %(left)s
-          AND connector.location_x < %(right)s
-          AND connector.location_y > %(top)s
-          AND connector.location_y < %(bottom)s
-        ''', params)
-
-        crows.extend(cursor.fetchall())
-
         connectors = []
         # A set of missing treenode IDs
         missing_treenode_ids = set()
@@ -336,6 +245,7 @@ def update_confidence(request, project_id=None, node_id=0):
         rows_affected = Treenode.objects.filter(id=tnid).update(confidence=new_confidence,editor=request.user)
 
     if rows_affected > 0:
+        invalidate_project(project_id)
         location = Location.objects.filter(id=tnid).values_list('location_x',
                 'location_y', 'location_z')[0]
         insert_into_log(project_id, request.user.id, "change_confidence", location, "Changed to %s" % new_confidence)
@@ -377,46 +287,67 @@ def most_recent_treenode(request, project_id=None):
     }))
 
 
-def _update(Kind, table, nodes, now, user):
+def _update(table, nodes, now, user):
+    """ Moves all passed in nodes of the given table with a single UPDATE
+    statement. Each node is expected as sequence of ID, X, Y and Z.
+    """
     if not nodes:
         return
-    # 0: id
-    # 1: X
-    # 2: Y
-    # 3: Z
-    can_edit_all_or_fail(user, (node[0] for node in nodes.itervalues()), table)
-    for node in nodes.itervalues():
-        Kind.objects.filter(id=int(node[0])).update(
-            editor=user,
-            edition_time=now,
-            location_x=float(node[1]),
-            location_y=float(node[2]),
-            location_z=float(node[3]))
+    can_edit_all_or_fail(user, (node[0] for node in nodes), table)
+    params = [user.id, now]
+    for node in nodes:
+        params.extend((int(node[0]), float(node[1]), float(node[2]),
+                float(node[3])))
+    cursor = connection.cursor()
+    cursor.execute('''
+        UPDATE %s n
+        SET editor_id = %%s, edition_time = %%s,
+            location_x = v.x, location_y = v.y, location_z = v.z
+        FROM (VALUES %s) v(id, x, y, z)
+        WHERE n.id = v.id
+        ''' % (table, ', '.join(['(%s, %s::float8, %s::float8, %s::float8)'] *
+                len(nodes))), params)
 
 
 @requires_user_role(UserRole.Annotate)
 def node_update(request, project_id=None):
-    N = len(request.POST)
-    if 0 != N % 4:
-        raise Exception("Incorrect number of posted items for node_update.")
-
+    """ Moves treenodes and connectors. Nodes are passed as lists of ID, X, Y
+    and Z, either JSON encoded in the t (treenodes) and c (connectors) fields
+    or form encoded, e.g. t[0][0] for the ID of the first treenode and t[0][1]
+    for its X coordinate. All nodes are updated in a single transaction.
+    """
+    nodes = {'t': [], 'c': []}
+    form_nodes = {'t': defaultdict(dict), 'c': defaultdict(dict)}
     pattern = re.compile('^[tc]\[(\d+)\]\[(\d+)\]$')
 
-    nodes = {'t': {}, 'c': {}}
     for key, value in request.POST.iteritems():
-        i, j = pattern.match(key).groups()
-        i = int(i)
-        j = int(j)
-        node = nodes[key[0]].get(i)
-        if not node:
-            nodes[key[0]][i] = node = {}
-        node[j] = value
+        if key in nodes:
+            nodes[key] = json.loads(value)
+            continue
+        match = pattern.match(key)
+        if not match:
+            raise ValueError("Unexpected parameter for node_update: %s" % key)
+        i, j = match.groups()
+        form_nodes[key[0]][int(i)][int(j)] = value
+
+    for kind, form in form_nodes.iteritems():
+        for i in sorted(form.keys()):
+            node = form[i]
+            if 4 != len(node):
+                raise ValueError("Incorrect number of posted items for node_update.")
+            nodes[kind].append([node[j] for j in xrange(4)])
+
+    for node in nodes['t'] + nodes['c']:
+        if 4 != len(node):
+            raise ValueError("Incorrect number of posted items for node_update.")
 
     now = datetime.now()
-    _update(Treenode, 'treenode', nodes['t'], now, request.user)
-    _update(Connector, 'connector', nodes['c'], now, request.user)
+    with transaction.atomic():
+        _update('treenode', nodes['t'], now, request.user)
+        _update('connector', nodes['c'], now, request.user)
+    invalidate_project(project_id)
 
-    num_updated_nodes = len(nodes['t'].keys()) + len(nodes['c'].keys())
+    num_updated_nodes = len(nodes['t']) + len(nodes['c'])
     return HttpResponse(json.dumps({'updated': num_updated_nodes}))
 
 
@@ -459,61 +390,25 @@ def node_nearest(request, project_id=None):
             for neur_skel_relation in neuron_skeletons:
                 skeletons.append(neur_skel_relation.class_instance_a_id)
 
-        # Get all treenodes connected to skeletons
+        # Find the closest treenode among all treenodes of the skeletons
         response_on_error = 'Finding the treenodes failed.'
-        treenodes = Treenode.objects.filter(project=project_id, skeleton__in=skeletons)
-
-        def getNearestTreenode(x, y, z, treenodes):
-            minDistance = -1
-            nearestTreenode = None
-            for tn in treenodes:
-                xdiff = x - tn.location_x
-                ydiff = y - tn.location_y
-                zdiff = z - tn.location_z
-                distanceSquared = xdiff ** 2 + ydiff ** 2 + zdiff ** 2
-                if distanceSquared < minDistance or minDistance < 0:
-                    nearestTreenode = tn
-                    minDistance = distanceSquared
-            return nearestTreenode
-
-        nearestTreenode = getNearestTreenode(
-            params['x'],
-            params['y'],
-            params['z'],
-            treenodes)
-        if nearestTreenode is None:
+        nearest = nearest_treenode(connection.cursor(), project_id, skeletons,
+                (params['x'], params['y'], params['z']))
+        if nearest is None:
             raise Exception('No treenodes were found for skeletons in %s' % skeletons)
 
+        treenode_id, skeleton_id, location = nearest
         return HttpResponse(json.dumps({
-            'treenode_id': nearestTreenode.id,
-            'x': int(nearestTreenode.location_x),
-            'y': int(nearestTreenode.location_y),
-            'z': int(nearestTreenode.location_z),
-            'skeleton_id': nearestTreenode.skeleton_id}))
+            'treenode_id': treenode_id,
+            'x': int(location[0]),
+            'y': int(location[1]),
+            'z': int(location[2]),
+            'skeleton_id': skeleton_id}))
 
     except Exception as e:
         raise Exception(response_on_error + ':' + str(e))
 
 
-def _skeleton_as_graph(skeleton_id):
-    # Fetch all nodes of the skeleton
-    cursor = connection.cursor()
-    cursor.execute('''
-        SELECT id, parent_id
-        FROM treenode
-        WHERE skeleton_id=%s''', [skeleton_id])
-    # Create a directed graph of the skeleton
-    graph = nx.DiGraph()
-    for row in cursor.fetchall():
-        # row[0]: id
-        # row[1]: parent_id
-        graph.add_node(row[0])
-        if row[1]:
-            # Create directional edge from parent to child
-            graph.add_edge(row[1], row[0])
-    return graph
-
-
 def _fetch_location(location_id):
     return _fetch_locations([location_id])[0]
 
@@ -584,20 +479,22 @@ def find_previous_branchnode_or_root(request, project_id=None):
         tnid = int(request.POST['tnid'])
         alt = 1 == int(request.POST['alt'])
         skid = Treenode.objects.get(pk=tnid).skeleton_id
-        graph = _skeleton_as_graph(skid)
+        arbor = get_arbor(connection.cursor(), skid)
         # Travel upstream until finding a parent node with more than one child
         # or reaching the root node
         seq = [] # Does not include the starting node tnid
+        i = arbor.index_of(tnid)
         while True:
-            parents = graph.predecessors(tnid)
-            if parents: # list of parents is not empty
-                tnid = parents[0] # Can ony have one parent
-                seq.append(tnid)
-                if 1 != len(graph.successors(tnid)):
+            parent = arbor.parents[i]
+            if -1 != parent:
+                i = parent
+                seq.append(arbor.node_id(i))
+                if 1 != arbor.n_children(i):
                     break # Found a branch node
             else:
                 break # Found the root node
 
+        tnid = arbor.node_id(i)
         if seq and alt:
             tnid = _find_first_interesting_node(seq)
 
@@ -611,32 +508,27 @@ def find_next_branchnode_or_end(request, project_id=None):
     try:
         tnid = int(request.POST['tnid'])
         skid = Treenode.objects.get(pk=tnid).skeleton_id
-        graph = _skeleton_as_graph(skid)
+        arbor = get_arbor(connection.cursor(), skid)
+
+        children = arbor.children_of(arbor.index_of(tnid))
+        # If more than one branch exists, sort based on downstream arbor size.
+        if len(children) > 1:
+            children = sorted(children, key=lambda c: arbor.subtree_sizes[c],
+                    reverse=True)
 
-        children = graph.successors(tnid)
         branches = []
-        for childNodeID in children:
+        for child in children:
             # Travel downstream until finding a child node with more than one
             # child or reaching an end node
-            seq = [childNodeID] # Does not include the starting node tnid
-            branchEnd = childNodeID
-            while True:
-                branchChildren = graph.successors(branchEnd)
-                if 1 == len(branchChildren):
-                    branchEnd = branchChildren[0]
-                    seq.append(branchEnd)
-                else:
-                    break # Found an end node or a branch node
+            seq = [arbor.node_id(child)] # Does not include the starting node tnid
+            branchEnd = child
+            while 1 == arbor.n_children(branchEnd):
+                branchEnd = arbor.children[arbor.offsets[branchEnd]]
+                seq.append(arbor.node_id(branchEnd))
 
-            branches.append([childNodeID,
+            branches.append([seq[0],
                              _find_first_interesting_node(seq),
-                             branchEnd])
-
-        # If more than one branch exists, sort based on downstream arbor size.
-        if len(children) > 1:
-            branches.sort(
-                   key=lambda b: len(nx.algorithms.traversal.depth_first_search.dfs_successors(graph, b[0])),
-                   reverse=True)
+                             seq[-1]])
 
         # Leaf nodes will have no branches
         if len(children) > 0:
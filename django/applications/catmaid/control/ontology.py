@@ -1,5 +1,7 @@
 import json
 
+from collections import OrderedDict
+
 from django.http import HttpResponse
 from django.db import connection
 from django.shortcuts import get_object_or_404
@@ -8,6 +10,7 @@ from catmaid.models import UserRole, Relation, Class, ClassClass, Restriction, \
         CardinalityRestriction
 from catmaid.control.authentication import requires_user_role
 from catmaid.control.common import get_relation_to_id_map, get_class_to_id_map
+from catmaid.control.ontology_cache import get_ontology
 
 
 # Root classes can be seen as namespaces in the semantic space. Different
@@ -48,6 +51,15 @@ class Feature:
     def __len__(self):
         return len(self.links)
 
+    def key(self):
+        """ Returns a hashable representation of this feature: the ID of the
+        class it starts at and a tuple of (class_a ID, relation ID) pairs of
+        its links. It can be compared to the paths returned by
+        classification.get_graph_paths().
+        """
+        return (self.links[0].class_b.id,
+                tuple((l.class_a.id, l.relation.id) for l in self.links))
+
 class FeatureLink:
     def __init__(self, class_a, class_b, relation, super_class = None):
         self.class_a = class_a
@@ -172,6 +184,8 @@ def list_ontology(request, project_id=None):
 
     relation_map = get_relation_to_id_map(project_id)
     class_map = get_class_to_id_map(project_id)
+    # Child counts, links and restrictions are looked up in the ontology
+    ontology = get_ontology(project_id)
 
     response_on_error = ''
     try:
@@ -206,8 +220,7 @@ def list_ontology(request, project_id=None):
                 for root_node in root_node_q:
                     root_id = root_node.id
                     root_name = root_node.class_name
-                    num_children = ClassClass.objects.filter(
-                        class_b=root_id, project=project_id).count()
+                    num_children = ontology.num_children(root_id)
 
                     data = {'data': {'title': '%s (%d)' % (root_name, root_id) },
                         'attr': {'id': 'node_%s' % root_id, 'rel': 'root',
@@ -223,13 +236,12 @@ def list_ontology(request, project_id=None):
             else:
                 response_on_error = 'Could not retrieve child nodes.'
                 # Select all classes that are linked with the passed relation
-                cc_q = ClassClass.objects.filter(class_b=class_b_id,
-                    relation=parent_id, project=project_id)
+                cc_q = ontology.links_to(class_b_id, parent_id)
 
                 links = []
                 for cc in cc_q:
                     # Get known restrictions
-                    restrictions = get_restrictions( cc )
+                    restrictions = get_restrictions( cc, ontology )
                     restrictions_json = json.dumps( restrictions )
                     # Create name, mark restrictin availability with *
                     node_name = "%s (%d)" % (cc.class_a.class_name, cc.class_a.id)
@@ -244,8 +256,7 @@ def list_ontology(request, project_id=None):
                                       'ccid': cc.id}}
                     # Only add a 'state' field if this node has children
                     # (i.e. relations where it is class_b).
-                    num_children = ClassClass.objects.filter(
-                        class_b=cc.class_a.id, project=project_id).count()
+                    num_children = ontology.num_children(cc.class_a.id)
                     if num_children > 0:
                         data['state'] = 'closed'
                     # Add this class-class link to the list
@@ -254,10 +265,9 @@ def list_ontology(request, project_id=None):
                 return HttpResponse(json.dumps(tuple(l for l in links)))
         elif parent_type in ["class", "root"]:
             # A relation is wanted
-            cc_q = ClassClass.objects.filter(
-                project=project_id, class_b_id=parent_id)
+            cc_q = ontology.links_to(parent_id)
             # Combine same relations into one
-            relations = {}
+            relations = OrderedDict()
             for cc in cc_q:
                 if cc.relation not in relations:
                     relations[ cc.relation ] = []
@@ -279,14 +289,18 @@ def list_ontology(request, project_id=None):
     except Exception as e:
         raise Exception(response_on_error + ': ' + str(e))
 
-def get_restrictions( cc_link ):
+def get_restrictions( cc_link, ontology=None ):
     """ Returns a map with <restrition_type> as key and a list
-    of data structures, desribing each restriction type.
+    of data structures, desribing each restriction type. The
+    restrictions are looked up in the passed in ontology of the
+    link's project, which is loaded if not given.
     """
+    if ontology is None:
+        ontology = get_ontology(cc_link.project_id)
     restrictions = {}
     # Add cardinality restrictions
-    cardinality_restrictions_q = CardinalityRestriction.objects.filter(
-        restricted_link=cc_link)
+    cardinality_restrictions_q = ontology.cardinality_restrictions.get(
+        cc_link.id, [])
     for cr in cardinality_restrictions_q:
         if 'cardinality' not in restrictions:
             restrictions['cardinality'] = []
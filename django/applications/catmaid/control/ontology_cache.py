@@ -0,0 +1,178 @@
+""" A cache of the semantic space of workspaces.
+
+The ontology editor and the classification editor expand trees of classes
+that are linked to each other by class-class links, which can carry
+restrictions. An Ontology holds all links and restrictions of a workspace,
+indexed by the classes they connect, so that child counts, sub-classes and
+restrictions can be looked up without further queries. It is loaded with a
+constant number of queries. If ONTOLOGY_CACHE_SIZE is larger than zero, every
+server process keeps the Ontologies of that many recently used workspaces in
+memory.
+
+Each workspace has a version number, stored in Django's cache, which is
+incremented whenever a class, relation, class-class link or restriction of the
+workspace is saved or deleted. A cached Ontology is only used as long as its
+version is current.
+"""
+
+from collections import defaultdict, OrderedDict
+
+from django.conf import settings
+from django.db import connection
+from django.db.models.signals import post_save, post_delete
+
+from catmaid.models import Class, Relation, ClassClass, Restriction, \
+        CardinalityRestriction
+from catmaid.control.common import get_cache_version, \
+        increment_cache_version
+
+
+def _version_key(workspace_pid):
+    return 'catmaid.ontology.version.%s' % int(workspace_pid)
+
+def get_ontology_version(workspace_pid):
+    """ Returns the current version of the semantic space of a workspace. """
+    return get_cache_version(_version_key(workspace_pid))
+
+def invalidate_ontology(workspace_pid):
+    """ Marks the cached Ontology of a workspace as invalid. This is called
+    for all saved and deleted classes, relations, class-class links and
+    restrictions and needs to be called after changing them with plain SQL.
+    """
+    _ontologies.pop(int(workspace_pid), None)
+    if settings.ONTOLOGY_CACHE_SIZE > 0:
+        increment_cache_version(_version_key(workspace_pid))
+
+def _invalidate_instance_ontology(sender, instance, **kwargs):
+    invalidate_ontology(instance.project_id)
+
+for model in (Class, Relation, ClassClass, Restriction, CardinalityRestriction):
+    post_save.connect(_invalidate_instance_ontology, sender=model,
+            dispatch_uid='catmaid.ontology.save.%s' % model.__name__)
+    post_delete.connect(_invalidate_instance_ontology, sender=model,
+            dispatch_uid='catmaid.ontology.delete.%s' % model.__name__)
+
+
+class Ontology(object):
+    """ All class-class links and restrictions of a workspace. Links are
+    ClassClass objects with their classes and relation loaded, restrictions
+    are CardinalityRestriction objects. Both are ordered by ID.
+    """
+
+    def __init__(self, workspace_pid):
+        self.workspace_pid = int(workspace_pid)
+        self.links = {}
+        self.links_by_class_b = defaultdict(list)
+        self.links_by_class_a = defaultdict(list)
+        links = ClassClass.objects.filter(project=self.workspace_pid) \
+                .select_related('class_a', 'class_b', 'relation').order_by('id')
+        for link in links:
+            self.links[link.id] = link
+            self.links_by_class_b[link.class_b_id].append(link)
+            self.links_by_class_a[link.class_a_id].append(link)
+
+        self.cardinality_restrictions = defaultdict(list)
+        cardinality_ids = set()
+        for r in CardinalityRestriction.objects.filter(
+                restricted_link__project=self.workspace_pid).order_by('id'):
+            self.cardinality_restrictions[r.restricted_link_id].append(r)
+            cardinality_ids.add(r.id)
+
+        # The restriction table contains the rows of all restriction types,
+        # the ones that aren't cardinality restrictions are unknown.
+        self.unknown_restrictions = defaultdict(list)
+        for rid, link_id in Restriction.objects.filter(
+                restricted_link__project=self.workspace_pid) \
+                .order_by('id').values_list('id', 'restricted_link_id'):
+            if rid not in cardinality_ids:
+                self.unknown_restrictions[link_id].append(rid)
+
+    def links_to(self, class_id, relation_id=None):
+        """ Returns the links where the passed class is class_b, optionally
+        only the ones with the passed relation. """
+        links = self.links_by_class_b.get(class_id, [])
+        if relation_id is None:
+            return links
+        return [l for l in links if l.relation_id == relation_id]
+
+    def links_from(self, class_id, relation_name=None):
+        """ Returns the links where the passed class is class_a, optionally
+        only the ones with a relation of the passed name. """
+        links = self.links_by_class_a.get(class_id, [])
+        if relation_name is None:
+            return links
+        return [l for l in links if l.relation.relation_name == relation_name]
+
+    def num_children(self, class_id):
+        return len(self.links_by_class_b.get(class_id, []))
+
+    def sub_class_links(self, class_id):
+        """ Returns the 'is_a' links of the sub-classes of a class. """
+        return [l for l in self.links_to(class_id)
+                if l.relation.relation_name == 'is_a']
+
+    def super_class_links(self, class_id):
+        """ Returns the 'is_a' links of a class to its super-classes. """
+        return self.links_from(class_id, 'is_a')
+
+    def restrictions(self, link_id):
+        """ Returns the cardinality restrictions of a link. An exception is
+        raised if the link has restrictions of another type. """
+        unknown = self.unknown_restrictions.get(link_id)
+        if unknown:
+            raise Exception("Couldn't identify the restriction with ID %d." %
+                    unknown[0])
+        return self.cardinality_restrictions.get(link_id, [])
+
+    def reachable_links(self, class_id):
+        """ Returns all links to classes that are directly linked to the
+        passed class by a relation other than 'is_a', including the ones of
+        all its super-classes. """
+        available_links = [l for l in self.links_to(class_id)
+                if l.relation.relation_name != 'is_a']
+        for link in self.super_class_links(class_id):
+            available_links.extend(self.reachable_links(link.class_b_id))
+        return available_links
+
+
+_ontologies = OrderedDict()
+
+def get_ontology(workspace_pid):
+    """ Returns the Ontology of a workspace. It is taken from the cache if
+    enabled and the workspace's semantic space wasn't changed since it was
+    cached.
+    """
+    workspace_pid = int(workspace_pid)
+    size = settings.ONTOLOGY_CACHE_SIZE
+    if size > 0:
+        version = get_ontology_version(workspace_pid)
+        entry = _ontologies.pop(workspace_pid, None)
+        if entry is not None and entry[0] == version:
+            # Mark as most recently used
+            _ontologies[workspace_pid] = entry
+            return entry[1]
+
+    ontology = Ontology(workspace_pid)
+
+    if size > 0:
+        _ontologies[workspace_pid] = (version, ontology)
+        while len(_ontologies) > size:
+            _ontologies.popitem(last=False)
+    return ontology
+
+def count_linked_instances(class_instance_ids):
+    """ Returns the number of class instances linked to each of the passed
+    class instances, by relation and class of the linked instance, as a dict
+    of (class_instance_b, relation_id, class_id) to count.
+    """
+    if not class_instance_ids:
+        return {}
+    cursor = connection.cursor()
+    cursor.execute('''
+        SELECT cici.class_instance_b, cici.relation_id, ci.class_id, count(*)
+        FROM class_instance_class_instance cici, class_instance ci
+        WHERE cici.class_instance_b = ANY(%s)
+          AND cici.class_instance_a = ci.id
+        GROUP BY cici.class_instance_b, cici.relation_id, ci.class_id
+        ''', (list(class_instance_ids),))
+    return dict(((b, r, c), n) for b, r, c, n in cursor.fetchall())
@@ -0,0 +1,358 @@
+""" Export of all tracing data of a project.
+
+All skeletons with more than one treenode, their synapses and annotations are
+written to gzip compressed files:
+
+  <name>.skeletons.csv.gz           skeleton ID, treenode ID, parent ID, x, y, z
+  <name>.synapses.csv.gz            synapse ID, pre treenode and skeleton ID,
+                                    post treenode and skeleton ID
+  <name>.skID_vs_annotID.csv.gz     skeleton ID, annotation or neuron ID
+  <name>.annotID_vs_name.csv.gz     annotation or neuron ID, name
+  <name>.graphml.gz                 all of the above as one GraphML graph
+
+The export is split into parts, most of which cover a range of skeleton IDs.
+Rows are read through server-side cursors and written right away, so that
+memory usage doesn't depend on the size of the project. Each part is written
+to its own file in a working folder, which is only renamed once the part is
+complete. Parts can therefore be exported in parallel by multiple processes
+and an interrupted export can be resumed. Parts are gzip members, which are
+concatenated into the final files at the end.
+"""
+
+import gzip
+import json
+import os
+import shutil
+
+from django.conf import settings
+from django.db import connection
+from django.http import HttpResponse
+
+from catmaid.models import Message, User, UserRole
+from catmaid.control.authentication import requires_user_role
+from catmaid.control.common import get_relation_to_id_map, id_generator, \
+        stream_rows
+
+from celery.task import task
+
+
+# The path were project exports get stored in
+project_export_path = os.path.join(settings.MEDIA_ROOT,
+    settings.MEDIA_EXPORT_SUBDIRECTORY)
+
+GRAPHML_HEADER = '''<?xml version="1.0" encoding="UTF-8"?>
+<graphml xmlns="http://graphml.graphdrawing.org/xmlns"
+         xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance"
+         xsi:schemaLocation="http://graphml.graphdrawing.org/xmlns http://graphml.graphdrawing.org/xmlns/1.0/graphml.xsd">
+<key id="skid" for="node" attr.name="skeleton id" attr.type="long"/>
+<key id="x" for="node" attr.name="x" attr.type="float"/>
+<key id="y" for="node" attr.name="y" attr.type="float"/>
+<key id="z" for="node" attr.name="z" attr.type="float"/>
+<key id="pre_skid" for="edge" attr.name="presynaptic skeleton id" attr.type="long"/>
+<key id="post_skid" for="edge" attr.name="postsynaptic skeleton id" attr.type="long"/>
+<graph id="CNS">\n'''
+
+GRAPHML_FOOTER = "</graph>\n</graphml>"
+
+
+def escape_csv(text):
+    return text.replace('"', '\\"')
+
+
+class ProjectExport(object):
+    """ The export of a project into a folder. The name is used as prefix of
+    all files, the skeleton ID space is split into n_chunks ranges.
+    """
+
+    def __init__(self, project_id, output_path, name, n_chunks=1):
+        self.project_id = int(project_id)
+        self.output_path = output_path
+        self.name = name
+        self.n_chunks = max(1, int(n_chunks))
+        self.work_path = os.path.join(output_path, name + '.parts')
+        self.relations = get_relation_to_id_map(self.project_id)
+
+    def output_names(self):
+        """ Returns the names of all created files. """
+        return [self.name + suffix for suffix in ('.skeletons.csv.gz',
+            '.synapses.csv.gz', '.skID_vs_annotID.csv.gz',
+            '.annotID_vs_name.csv.gz', '.graphml.gz')]
+
+    def prepare(self, resume=False):
+        """ Creates the working folder along with the plan of the export, i.e.
+        the skeleton ID ranges. If resume is true and an earlier export left a
+        working folder, its plan and finished parts are kept.
+        """
+        plan_path = os.path.join(self.work_path, 'plan.json')
+        if os.path.exists(self.work_path):
+            if resume and os.path.exists(plan_path):
+                self.load_plan()
+                return
+            shutil.rmtree(self.work_path)
+        os.makedirs(self.work_path)
+
+        cursor = connection.cursor()
+        cursor.execute('''
+        SELECT min(ci.id), max(ci.id)
+        FROM class_instance ci, class c
+        WHERE ci.project_id = %s
+          AND ci.class_id = c.id
+          AND c.class_name = 'skeleton'
+        ''', (self.project_id,))
+        first, last = cursor.fetchone()
+        if first is None:
+            self.ranges = []
+        else:
+            step = (last - first) / self.n_chunks + 1
+            self.ranges = [(start, min(start + step, last + 1)) for start in
+                    xrange(first, last + 1, step)]
+        with open(plan_path, 'w') as f:
+            json.dump(self.ranges, f)
+
+    def load_plan(self):
+        """ Loads the plan created by prepare(), e.g. in another process. """
+        with open(os.path.join(self.work_path, 'plan.json')) as f:
+            self.ranges = json.load(f)
+
+    def parts(self):
+        """ Returns a list of (output name, part name, writer, arguments)
+        tuples, ordered as they are combined into the output files. Every
+        writer expects a file and the arguments. """
+        skeletons, synapses, annotations, names, graphml = self.output_names()
+        parts = []
+        parts.append((skeletons, 'header', self.write_text,
+            ('"skeleton ID", "treenode ID", "parent treenode ID", "x", "y", "z"\n',)))
+        for i, r in enumerate(self.ranges):
+            parts.append((skeletons, 'chunk%s' % i, self.write_treenodes, r))
+        parts.append((synapses, 'header', self.write_text,
+            ('"synapse ID", "presynaptic treenode ID", "presynaptic skeleton ID", "postsynaptic treenode ID", "postsynaptic skeleton ID"\n',)))
+        for i, r in enumerate(self.ranges):
+            parts.append((synapses, 'chunk%s' % i, self.write_synapses, r))
+        parts.append((annotations, 'header', self.write_text,
+            ('"skeleton ID", "annotation ID"\n',)))
+        for i, r in enumerate(self.ranges):
+            parts.append((annotations, 'chunk%s' % i, self.write_annotations, r))
+        parts.append((names, 'header', self.write_text,
+            ('"annotation ID", "text"\n',)))
+        parts.append((names, 'names', self.write_annotation_names, ()))
+        parts.append((graphml, 'header', self.write_text, (GRAPHML_HEADER,)))
+        for i, r in enumerate(self.ranges):
+            parts.append((graphml, 'nodes%s' % i, self.write_graphml_nodes, r))
+        for i, r in enumerate(self.ranges):
+            parts.append((graphml, 'edges%s' % i, self.write_graphml_edges, r))
+        parts.append((graphml, 'footer', self.write_text, (GRAPHML_FOOTER,)))
+        return parts
+
+    def part_path(self, output_name, part_name):
+        return os.path.join(self.work_path, '%s.%s.gz' % (output_name, part_name))
+
+    def export_part(self, i):
+        """ Exports the part with the passed in index, unless it has been
+        exported already. """
+        output_name, part_name, writer, args = self.parts()[i]
+        path = self.part_path(output_name, part_name)
+        if os.path.exists(path):
+            return
+        tmp_path = path + '.tmp'
+        f = gzip.open(tmp_path, 'wb')
+        try:
+            writer(f, *args)
+        finally:
+            f.close()
+        os.rename(tmp_path, path)
+
+    def combine(self):
+        """ Concatenates all parts to the final output files and removes the
+        working folder. """
+        parts = self.parts()
+        for output_name in self.output_names():
+            path = os.path.join(self.output_path, output_name)
+            tmp_path = path + '.tmp'
+            with open(tmp_path, 'wb') as output:
+                for part in parts:
+                    if part[0] == output_name:
+                        with open(self.part_path(part[0], part[1]), 'rb') as f:
+                            shutil.copyfileobj(f, output)
+            os.rename(tmp_path, path)
+        shutil.rmtree(self.work_path)
+
+    def run(self, resume=False):
+        """ Exports all parts in this process. """
+        self.prepare(resume)
+        for i in xrange(len(self.parts())):
+            self.export_part(i)
+        self.combine()
+
+    def skeleton_filter(self, column):
+        """ Returns a condition that limits the passed in skeleton ID column to
+        skeletons of the current range with more than one treenode. """
+        return '''
+          {0} >= %(first)s AND {0} < %(last)s
+          AND {0} IN (
+            SELECT skeleton_id
+            FROM treenode
+            WHERE project_id = %(project_id)s
+              AND skeleton_id >= %(first)s AND skeleton_id < %(last)s
+            GROUP BY skeleton_id
+            HAVING count(*) > 1)'''.format(column)
+
+    def range_params(self, first, last):
+        return {
+            'project_id': self.project_id,
+            'first': first,
+            'last': last,
+            'model_of': self.relations['model_of'],
+            'annotated_with': self.relations['annotated_with'],
+            'presynaptic_to': self.relations['presynaptic_to'],
+            'postsynaptic_to': self.relations['postsynaptic_to'],
+        }
+
+    def write_text(self, f, text):
+        f.write(text)
+
+    def treenode_rows(self, first, last):
+        return stream_rows('''
+        SELECT t.skeleton_id, t.id, t.parent_id,
+               t.location_x, t.location_y, t.location_z
+        FROM treenode t
+        WHERE t.project_id = %(project_id)s AND ''' +
+        self.skeleton_filter('t.skeleton_id'), self.range_params(first, last))
+
+    def synapse_rows(self, first, last):
+        return stream_rows('''
+        SELECT tc2.id, tc1.treenode_id, tc1.skeleton_id,
+               tc2.treenode_id, tc2.skeleton_id
+        FROM treenode_connector tc1, treenode_connector tc2
+        WHERE tc1.project_id = %(project_id)s
+          AND tc1.relation_id = %(presynaptic_to)s
+          AND tc2.relation_id = %(postsynaptic_to)s
+          AND tc1.connector_id = tc2.connector_id
+          AND ''' + self.skeleton_filter('tc1.skeleton_id'),
+        self.range_params(first, last))
+
+    def write_treenodes(self, f, first, last):
+        for row in self.treenode_rows(first, last):
+            f.write("%s,%s,%s,%s,%s,%s\n" % row)
+
+    def write_synapses(self, f, first, last):
+        for row in self.synapse_rows(first, last):
+            f.write("%s,%s,%s,%s,%s\n" % row)
+
+    def write_annotations(self, f, first, last):
+        # Annotations and neurons of all skeletons in the range
+        rows = stream_rows('''
+        SELECT c1.class_instance_a, c2.class_instance_b
+        FROM class_instance_class_instance c1,
+             class_instance_class_instance c2
+        WHERE c1.project_id = %(project_id)s
+          AND ''' + self.skeleton_filter('c1.class_instance_a') + '''
+          AND c1.relation_id = %(model_of)s
+          AND c1.class_instance_b = c2.class_instance_a
+          AND c2.relation_id = %(annotated_with)s
+        UNION ALL
+        SELECT c.class_instance_a, c.class_instance_b
+        FROM class_instance_class_instance c
+        WHERE c.project_id = %(project_id)s
+          AND ''' + self.skeleton_filter('c.class_instance_a') + '''
+          AND c.relation_id = %(model_of)s
+        ''', self.range_params(first, last))
+        for row in rows:
+            f.write("%s, %s\n" % row)
+
+    def write_annotation_names(self, f):
+        # Names of all annotations and neurons that are used by skeletons
+        # with more than one treenode.
+        rows = stream_rows('''
+        WITH skeletons AS (
+            SELECT skeleton_id
+            FROM treenode
+            WHERE project_id = %(project_id)s
+            GROUP BY skeleton_id
+            HAVING count(*) > 1
+        ), neurons AS (
+            SELECT DISTINCT c.class_instance_b AS id
+            FROM class_instance_class_instance c, skeletons s
+            WHERE c.class_instance_a = s.skeleton_id
+              AND c.relation_id = %(model_of)s
+        )
+        SELECT ci.id, ci.name
+        FROM class_instance ci
+        WHERE ci.id IN (
+            SELECT c.class_instance_b
+            FROM class_instance_class_instance c, neurons n
+            WHERE c.class_instance_a = n.id
+              AND c.relation_id = %(annotated_with)s)
+        UNION ALL
+        SELECT ci.id, ci.name
+        FROM class_instance ci, neurons n
+        WHERE ci.id = n.id
+        ''', self.range_params(None, None))
+        for row in rows:
+            f.write('%s, "%s"\n' % (row[0], escape_csv(row[1]).encode('utf-8')))
+
+    def write_graphml_nodes(self, f, first, last):
+        for row in self.treenode_rows(first, last):
+            f.write('''<node id="n%s">
+<data key="skid">%s</data>
+<data key="x">%s</data>
+<data key="y">%s</data>
+<data key="z">%s</data>
+</node>\n''' % (row[1], row[0], row[3], row[4], row[5]))
+            if row[2]:
+                f.write('<edge id="e%s" directed="false" source="n%s" target="n%s" />\n' % (row[1], row[1], row[2]))
+
+    def write_graphml_edges(self, f, first, last):
+        for row in self.synapse_rows(first, last):
+            f.write('<edge id="e%s" directed="true" source="n%s" target="n%s">\n<data key="pre_skid">%s</data>\n<data key="post_skid">%s</data>\n</edge>\n' % \
+                    (row[0], row[1], row[3], row[2], row[4]))
+
+
+@task()
+def process_project_export(user_id, project_id, name):
+    """ Exports a project and notifies the user about the result. It can be
+    executed as Celery task. """
+    export = ProjectExport(project_id, project_export_path, name)
+    msg = Message()
+    msg.user = User.objects.get(pk=user_id)
+    msg.read = False
+    try:
+        export.run()
+    except (IOError, OSError) as e:
+        msg.title = "Project export failed"
+        msg.text = "The export of project %s has been aborted, because an " \
+                "error occured: %s" % (project_id, str(e))
+        msg.action = ""
+        msg.save()
+        return msg.text
+
+    urls = [os.path.join(settings.CATMAID_URL, settings.MEDIA_URL,
+            settings.MEDIA_EXPORT_SUBDIRECTORY, output_name) for output_name
+            in export.output_names()]
+    msg.title = "Project export finished"
+    msg.text = "Exporting project %s finished. You can download the files " \
+            "from these locations: %s" % (project_id, ", ".join(
+                "<a href='%s'>%s</a>" % (url, url) for url in urls))
+    msg.action = urls[0]
+    msg.save()
+    return msg.text
+
+@requires_user_role(UserRole.Admin)
+def export_project(request, project_id=None):
+    """ Starts the export of all skeletons, synapses and annotations of a
+    project. The user is notified once the files are ready for download.
+    """
+    if not os.path.exists(project_export_path) or \
+            not os.access(project_export_path, os.W_OK):
+        raise Exception("Please make sure your output folder (%s) exists " \
+                "and is writable. It is configured by MEDIA_ROOT and " \
+                "MEDIA_EXPORT_SUBDIRECTORY in settings.py." % \
+                project_export_path)
+
+    name = 'project_%s_%s' % (project_id, id_generator())
+    proc = process_project_export.delay(request.user.id, project_id, name)
+    if proc.failed():
+        raise Exception("Something went wrong while queuing the export: " + \
+                proc.result)
+    return HttpResponse(json.dumps({'message': 'The project is currently ' \
+            'exporting. You will be notified once it is ready for download.'}),
+            content_type='text/json')
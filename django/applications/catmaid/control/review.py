@@ -61,13 +61,14 @@ def get_review_count(skeleton_ids):
     """ Returns a dictionary that maps skelton IDs to dictonaries that map
     user_ids to a review count for this particular skeleton.
     """
-    # Count nodes that have been reviewed by each user in each partner skeleton
+    # Read the number of nodes that have been reviewed by each user in each
+    # partner skeleton from the review summary.
     cursor = connection.cursor()
     cursor.execute('''
-    SELECT skeleton_id, reviewer_id, count(*)
-    FROM review
+    SELECT skeleton_id, reviewer_id, num_reviewed_nodes
+    FROM review_summary
     WHERE skeleton_id IN (%s)
-    GROUP BY reviewer_id, skeleton_id
+      AND num_reviewed_nodes > 0
     ''' % ",".join(map(str, skeleton_ids)))
     # Build dictionary
     reviews = defaultdict(lambda: defaultdict(int))
@@ -84,28 +85,91 @@ def get_review_status(skeleton_ids, project_id=None, whitelist_id=False,
     Otherwise, if <user_ids> evaluates to false a union review is returned.
     Otherwise a list of user IDs is expected to create a review status for a
     sub-union or a single user.
+
+    The status is read from the skeleton and review summaries where
+    possible: if the accepted reviews of a skeleton are all of its reviews or
+    all reviews of a single reviewer. Only for the remaining skeletons the
+    reviewed nodes are counted.
     """
     if user_ids and excluding_user_ids:
         raise ValueError("user_ids and excluding_user_ids can't be used at the same time")
     if not skeleton_ids:
         raise ValueError("Need at least one skeleton ID")
 
+    skeleton_id_list = ",".join(map(str, skeleton_ids))
     cursor = connection.cursor()
 
-    class Skeleton:
-        num_nodes = 0
-        num_reviewed = 0
-    skeletons = defaultdict(Skeleton)
+    # Get node count and union review count of each skeleton
+    cursor.execute('''
+    SELECT skeleton_id, num_nodes, num_reviewed_nodes
+    FROM skeleton_summary
+    WHERE skeleton_id IN (%s)
+      AND num_nodes > 0
+    ''' % skeleton_id_list)
+    skeletons = {row[0]: row[1:] for row in cursor.fetchall()}
 
-    # Count nodes of each skeleton
+    # Get the reviewers of each skeleton
     cursor.execute('''
-    SELECT skeleton_id, count(skeleton_id)
-    FROM treenode
+    SELECT skeleton_id, reviewer_id, num_reviewed_nodes, first_review_time
+    FROM review_summary
     WHERE skeleton_id IN (%s)
-    GROUP BY skeleton_id
-    ''' % ",".join(map(str, skeleton_ids)))
-    for row in cursor.fetchall():
-        skeletons[row[0]].num_nodes = row[1]
+      AND num_reviewed_nodes > 0
+    ''' % skeleton_id_list)
+    reviewers = defaultdict(dict)
+    for skid, rid, num_reviewed, first_review_time in cursor.fetchall():
+        reviewers[skid][rid] = (num_reviewed, first_review_time)
+
+    # Reviewers can be accepted without restriction or only with reviews after
+    # a certain time. The latter can be treated like the former, if their
+    # first review in a skeleton is not before this time.
+    if whitelist_id:
+        whitelist = dict(ReviewerWhitelist.objects.filter(
+                project_id=project_id, user_id=whitelist_id).values_list(
+                        'reviewer_id', 'accept_after'))
+        is_accepted = lambda rid: rid in whitelist
+    elif user_ids:
+        whitelist = {}
+        user_ids = set(user_ids)
+        is_accepted = lambda rid: rid in user_ids
+    elif excluding_user_ids:
+        whitelist = {}
+        excluding_user_ids = set(excluding_user_ids)
+        is_accepted = lambda rid: rid not in excluding_user_ids
+    else:
+        whitelist = {}
+        is_accepted = lambda rid: True
+
+    status = {}
+    to_count = []
+    for skid, (num_nodes, num_reviewed_union) in skeletons.iteritems():
+        skeleton_reviewers = reviewers.get(skid, {})
+        accepted = []
+        partially_accepted = False
+        for rid, (num_reviewed, first_review_time) in skeleton_reviewers.iteritems():
+            if not is_accepted(rid):
+                continue
+            accept_after = whitelist.get(rid)
+            if accept_after and first_review_time < accept_after:
+                partially_accepted = True
+                break
+            accepted.append(num_reviewed)
+
+        if partially_accepted:
+            to_count.append(skid)
+            continue
+        if not accepted:
+            num_reviewed = 0
+        elif len(accepted) == len(skeleton_reviewers):
+            num_reviewed = num_reviewed_union
+        elif len(accepted) == 1:
+            num_reviewed = accepted[0]
+        else:
+            to_count.append(skid)
+            continue
+        status[skid] = int(100 * num_reviewed / num_nodes)
+
+    if not to_count:
+        return status
 
     query_joins = ""
     # Optionally, add a filter
@@ -139,14 +203,11 @@ def get_review_status(skeleton_ids, project_id=None, whitelist_id=False,
           WHERE skeleton_id IN (%s)%s
           GROUP BY skeleton_id, treenode_id) AS sub
     GROUP BY skeleton_id
-    ''' % (query_joins, ",".join(map(str, skeleton_ids)), user_filter))
-    for row in cursor.fetchall():
-        skeletons[row[0]].num_reviewed = row[1]
-
-    status = {}
-    for skid, s in skeletons.iteritems():
-        ratio = int(100 * s.num_reviewed / s.num_nodes)
-        status[skid] = ratio
+    ''' % (query_joins, ",".join(map(str, to_count)), user_filter))
+    num_reviewed = dict(cursor.fetchall())
+    for skid in to_count:
+        num_nodes = skeletons[skid][0]
+        status[skid] = int(100 * num_reviewed.get(skid, 0) / num_nodes)
 
     return status
 
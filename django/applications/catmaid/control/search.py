@@ -1,89 +1,223 @@
+import base64
 import json
 
+from django.conf import settings
+from django.db import connection
 from django.http import HttpResponse
 
-from catmaid.models import UserRole, ClassInstance, TreenodeClassInstance
+from catmaid.models import UserRole
 from catmaid.control.authentication import requires_user_role
 from catmaid.control.common import get_relation_to_id_map
 
 
+def like_pattern(search_string, prefix='%', suffix='%'):
+    """ Escape the wildcard characters of LIKE in the search string and
+    surround it with the given prefix and suffix.
+    """
+    escaped = search_string.replace('\\', '\\\\').replace('%', '\\%') \
+            .replace('_', '\\_')
+    return prefix + escaped + suffix
+
+def encode_cursor(row):
+    """ Create an opaque cursor string from the sort key of a result row.
+    """
+    key = [row['rank'], row['sort_name'], row['id']]
+    return base64.urlsafe_b64encode(json.dumps(key))
+
+def decode_cursor(cursor):
+    """ Get the sort key back from a cursor string created by encode_cursor().
+    A ValueError is raised for malformed cursors.
+    """
+    try:
+        rank, sort_name, oid = json.loads(base64.urlsafe_b64decode(str(cursor)))
+        return int(rank), unicode(sort_name), int(oid)
+    except (TypeError, ValueError):
+        raise ValueError("Invalid cursor: %s" % cursor)
+
+def find_class_instances(project_id, search_string, class_names=None,
+        limit=None, cursor=None):
+    """ Find all class instances of a project whose name contains the search
+    string (case insensitive), which is answered by the trigram index on
+    class_instance names. Without a limit, all matches are returned, ordered
+    by class name and name. Otherwise, at most <limit> matches are returned,
+    ranked by how well they match: exact matches first, then names starting
+    with the search string, then all others. Ties are ordered by name. A
+    cursor of the last returned match allows to get the next matches.
+    """
+    conditions = ['ci.project_id = %(project_id)s',
+                  'ci.name ILIKE %(pattern)s']
+    params = {
+        'project_id': project_id,
+        'pattern': like_pattern(search_string),
+        'prefix_pattern': like_pattern(search_string, prefix=''),
+        'search_string': search_string,
+    }
+    if class_names:
+        conditions.append('c.class_name = ANY(%(class_names)s)')
+        params['class_names'] = list(class_names)
+
+    query = '''
+        SELECT ci.id, ci.name, c.class_name,
+            CASE WHEN lower(ci.name) = lower(%%(search_string)s) THEN 0
+                 WHEN ci.name ILIKE %%(prefix_pattern)s THEN 1
+                 ELSE 2
+            END AS rank,
+            lower(ci.name) AS sort_name
+        FROM class_instance ci, class c
+        WHERE ci.class_id = c.id
+          AND %s
+        ''' % '\n          AND '.join(conditions)
+
+    if limit is None:
+        query += 'ORDER BY c.class_name, ci.name'
+    else:
+        query = 'SELECT * FROM (%s) m' % query
+        if cursor:
+            query += ' WHERE (m.rank, m.sort_name, m.id) > ' \
+                     '(%(rank)s, %(sort_name)s, %(id)s)'
+            params['rank'], params['sort_name'], params['id'] = cursor
+        query += ' ORDER BY m.rank, m.sort_name, m.id LIMIT %(limit)s'
+        params['limit'] = limit
+
+    c = connection.cursor()
+    c.execute(query, params)
+    columns = [col[0] for col in c.description]
+    return [dict(zip(columns, row)) for row in c.fetchall()]
+
+def count_class_instances(project_id, search_string):
+    """ Count the class instances of a project whose name contains the search
+    string for each class.
+    """
+    c = connection.cursor()
+    c.execute('''
+        SELECT c.class_name, count(*)
+        FROM class_instance ci, class c
+        WHERE ci.class_id = c.id
+          AND ci.project_id = %s
+          AND ci.name ILIKE %s
+        GROUP BY c.class_name
+        ''', (project_id, like_pattern(search_string)))
+    return dict(c.fetchall())
+
+def add_label_nodes(project_id, rows):
+    """ Add to every label row the treenodes labeled with it, the most
+    recently created first. At most SEARCH_MAX_LABEL_NODES treenodes are
+    added per label.
+    """
+    label_rows = {row['id']: row for row in rows if row['class_name'] == 'label'}
+    if not label_rows:
+        return
+
+    relation_map = get_relation_to_id_map(project_id)
+    c = connection.cursor()
+    c.execute('''
+        SELECT class_instance_id, id, location_x, location_y, location_z,
+            skeleton_id
+        FROM (
+            SELECT tci.class_instance_id, t.id, t.location_x, t.location_y,
+                t.location_z, t.skeleton_id,
+                row_number() OVER (PARTITION BY tci.class_instance_id
+                                   ORDER BY t.id DESC) AS n
+            FROM treenode_class_instance tci, treenode t
+            WHERE tci.class_instance_id = ANY(%s)
+              AND tci.project_id = %s
+              AND tci.relation_id = %s
+              AND tci.treenode_id = t.id
+              AND t.project_id = %s
+        ) labeled
+        WHERE n <= %s
+        ORDER BY class_instance_id, id DESC
+        ''', (label_rows.keys(), project_id, relation_map['labeled_as'],
+            project_id, settings.SEARCH_MAX_LABEL_NODES))
+
+    for label_id, node_id, x, y, z, skeleton_id in c.fetchall():
+        row = label_rows[label_id]
+        if 'nodes' not in row:
+            row['nodes'] = []
+        row['nodes'].append({
+            'id': node_id,
+            'x': int(x),
+            'y': int(y),
+            'z': int(z),
+            'skid': skeleton_id})
+
 @requires_user_role([UserRole.Annotate, UserRole.Browse])
 def search(request, project_id=None):
-    def format_node_data(node):
-        '''
-        Formats node data for our json output.
-
-        When we start using Django 1.4, we can use prefetch_related instead of using
-        .values('treenode__xxx'), and will then be able to access a proper location
-        object.
-        '''
-        return {
-            'id': node['treenode'],
-            'x': int(node['treenode__location_x']),
-            'y': int(node['treenode__location_y']),
-            'z': int(node['treenode__location_z']),
-            'skid': node['treenode__skeleton']}
+    """ Search class instances (e.g. neurons, skeletons, groups and labels) by
+    name. If the search string is a number, the neuron or skeleton with this
+    ID is found as well. Labels come with the treenodes they are linked to.
 
+    Without a limit, the plain list of all matches is returned, ordered by
+    class name and name. If a limit is passed, the matches are ranked and
+    returned in pages of this size, together with their total number, the
+    number of matches per class and a cursor to get the next page. The
+    matches can be restricted to some classes with class_names[].
+    """
     search_string = request.GET.get('substring', "")
+    limit = request.GET.get('limit', None)
+    cursor = request.GET.get('cursor', None)
+    class_names = [v for k,v in request.GET.iteritems()
+            if k.startswith('class_names[')]
 
-    ids = set()
+    if limit is not None:
+        limit = int(limit)
+        if limit < 1:
+            raise ValueError("The limit has to be positive")
+    if cursor:
+        cursor = decode_cursor(cursor)
 
-    # 1. Query ClassInstance objects, where the name contains the search string.
-    # This retrieves neurons, skeletons and groups by name.
-    row_query = ClassInstance.objects.values('id', 'name', 'class_column__class_name').filter(
-        name__icontains=search_string,
-        project=project_id).order_by('class_column__class_name', 'name')
-    rows = list(row_query)
-    for row in rows:
-        ids.add(row['id'])
+    # 1. Query class instances whose name contains the search string. This
+    # retrieves neurons, skeletons, groups and labels by name. One more row
+    # than requested tells if there is a next page.
+    rows = find_class_instances(project_id, search_string, class_names,
+            None if limit is None else limit + 1, cursor)
+    next_cursor = None
+    if limit is not None and len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(rows[-1])
+
+    # 2. Query skeletons and neurons by ID, if the search string is a number.
+    # With paging, they are only part of the first page.
+    if not cursor:
+        try:
+            oid = int(search_string)
+            ids = set(row['id'] for row in rows)
+            c = connection.cursor()
+            c.execute('''
+                SELECT ci.id, ci.name, c.class_name
+                FROM class_instance ci, class c
+                WHERE ci.id = %s
+                  AND ci.project_id = %s
+                  AND ci.class_id = c.id
+                  AND c.class_name IN ('neuron', 'skeleton')
+                ''', (oid, project_id))
+            id_rows = [{'id': r[0], 'name': r[1], 'class_name': r[2]}
+                    for r in c.fetchall() if r[0] not in ids]
+            if class_names:
+                id_rows = [r for r in id_rows if r['class_name'] in class_names]
+            rows = rows + id_rows if limit is None else id_rows + rows
+        except ValueError:
+            pass
 
-    # 2. Query skeletons and neurons by ID, if the search string is a number
-    try:
-        oid = int(search_string)
-        oid_query = ClassInstance.objects.filter(
-                pk=int(oid),
-                class_column__class_name__in=('neuron', 'skeleton')
-                ).values('id', 'name', 'class_column__class_name')
-        for row in oid_query:
-            if row['id'] not in ids:
-                rows.append(row)
-    except ValueError:
-        pass
-
-    # 3. Query labels in treenodes. First get a list of matching labels,
-    # and then find a list of treenodes for each label.
-    relation_map = get_relation_to_id_map(project_id)
-    matching_labels = set()
-    label_rows = {}
     for row in rows:
-        # Change key-name of class_column__class_name for json output
-        row['class_name'] = row.pop('class_column__class_name')
-        # Prepare for retrieving nodes holding text labels
-        if row['class_name'] == 'label':
-            matching_labels.add(row['name'])
-            label_rows[row['id']] = row
-
-    node_query = TreenodeClassInstance.objects.filter(
-        project=project_id,
-        treenode__project=project_id,
-        relation=relation_map['labeled_as'],
-        class_instance__name__in=matching_labels)\
-    .order_by('-treenode__id')\
-    .values('treenode',
-        'treenode__location_x',
-        'treenode__location_y',
-        'treenode__location_z',
-        'treenode__skeleton',
-        'class_instance__name',
-        'class_instance__id')
-
-    for node in node_query:
-        row_with_node = label_rows[node['class_instance__id']]
-        nodes = row_with_node.get('nodes', None)
-        if not nodes:
-            nodes = []
-            row_with_node['nodes'] = nodes
-        nodes.append(format_node_data(node))
-
-    return HttpResponse(json.dumps(rows))
+        row.pop('rank', None)
+        row.pop('sort_name', None)
+
+    # 3. Query the treenodes of matching labels.
+    add_label_nodes(project_id, rows)
+
+    if limit is None:
+        return HttpResponse(json.dumps(rows))
+
+    facets = count_class_instances(project_id, search_string)
+    if class_names:
+        n_matches = sum(n for name, n in facets.iteritems() if name in class_names)
+    else:
+        n_matches = sum(facets.itervalues())
 
+    return HttpResponse(json.dumps({
+        'results': rows,
+        'n_matches': n_matches,
+        'facets': facets,
+        'cursor': next_cursor,
+    }))
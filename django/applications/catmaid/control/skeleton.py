@@ -18,11 +18,13 @@ from catmaid.objects import Skeleton
 from catmaid.control.authentication import requires_user_role, \
         can_edit_class_instance_or_fail, can_edit_or_fail
 from catmaid.control.common import insert_into_log, get_class_to_id_map, \
-        get_relation_to_id_map, _create_relation
+        get_relation_to_id_map, _create_relation, lock_connectors_of_skeletons
 from catmaid.control.neuron import _delete_if_empty
 from catmaid.control.neuron_annotations import create_annotation_query, \
         _annotate_entities, _update_neuron_annotations
 from catmaid.control.review import get_treenodes_to_reviews, get_review_status
+from catmaid.control.spatial import invalidate_project
+from catmaid.control.arbor_cache import invalidate_skeletons
 from catmaid.control.treenode import _create_interpolated_treenode
 from catmaid.control.tree_util import find_root, reroot, edge_count_to_root
 
@@ -291,15 +293,30 @@ def split_skeleton(request, project_id=None):
     new neuron are updated to refer to the new skeleton.
     """
     treenode_id = int(request.POST['treenode_id'])
-    treenode = Treenode.objects.get(pk=treenode_id)
-    skeleton_id = treenode.skeleton_id
     upstream_annotation_map = json.loads(request.POST.get('upstream_annotation_map'))
     downstream_annotation_map = json.loads(request.POST.get('downstream_annotation_map'))
+
+    if not _split_skeleton(request.user, treenode_id, int(project_id),
+            upstream_annotation_map, downstream_annotation_map):
+        return HttpResponse(json.dumps({'error': 'Can\'t split at the root node: it doesn\'t have a parent.'}))
+
+    return HttpResponse(json.dumps({}), content_type='text/json')
+
+def _split_skeleton(user, treenode_id, project_id, upstream_annotation_map,
+        downstream_annotation_map):
+    """ Split the skeleton of the passed in treenode so that the treenode and
+    all nodes downstream of it become a new skeleton, modeling a new neuron.
+    Treenodes, connector links and reviews of the downstream part are moved
+    to the new skeleton with one UPDATE statement each, without loading the
+    skeleton. Returns the new skeleton, or None if the treenode is root.
+    """
+    treenode = Treenode.objects.get(pk=treenode_id)
+    skeleton_id = treenode.skeleton_id
     cursor = connection.cursor()
 
     # Check if the treenode is root!
-    if not treenode.parent:
-        return HttpResponse(json.dumps({'error': 'Can\'t split at the root node: it doesn\'t have a parent.'}))
+    if not treenode.parent_id:
+        return None
 
     # Check if annotations are valid
     if not check_annotations_on_split(project_id, skeleton_id,
@@ -309,7 +326,6 @@ def split_skeleton(request, project_id=None):
           "One part has to keep the whole set of annotations!")
 
     skeleton = ClassInstance.objects.select_related('user').get(pk=skeleton_id)
-    project_id=int(project_id)
 
     # retrieve neuron of this skeleton
     neuron = ClassInstance.objects.get(
@@ -317,28 +333,8 @@ def split_skeleton(request, project_id=None):
         cici_via_b__class_instance_a_id=skeleton_id)
 
     # Make sure the user has permissions to edit
-    can_edit_class_instance_or_fail(request.user, neuron.id, 'neuron')
+    can_edit_class_instance_or_fail(user, neuron.id, 'neuron')
 
-    # retrieve the id, parent_id of all nodes in the skeleton
-    # with minimal ceremony
-    cursor.execute('''
-    SELECT id, parent_id FROM treenode WHERE skeleton_id=%s
-    ''' % skeleton_id) # no need to sanitize
-    # build the networkx graph from it
-    graph = nx.DiGraph()
-    for row in cursor.fetchall():
-        graph.add_node( row[0] )
-        if row[1]:
-            # edge from parent_id to id
-            graph.add_edge( row[1], row[0] )
-    # find downstream nodes starting from target treenode_id
-    # and generate the list of IDs to change, starting at treenode_id (inclusive)
-    change_list = nx.bfs_tree(graph, treenode_id).nodes()
-    if not change_list:
-        # When splitting an end node, the bfs_tree doesn't return any nodes,
-        # which is surprising, because when the splitted tree has 2 or more nodes
-        # the node at which the split is made is included in the list.
-        change_list.append(treenode_id)
     # create a new skeleton
     new_skeleton = ClassInstance()
     new_skeleton.name = 'Skeleton'
@@ -366,35 +362,72 @@ def split_skeleton(request, project_id=None):
     cici.user = skeleton.user # The same user that owned the skeleton to split
     cici.project_id = project_id
     cici.save()
-    # update skeleton_id of list in treenode table
-    # This creates a lazy QuerySet that, upon calling update, returns a new QuerySet
-    # that is then executed. It does NOT create an update SQL query for every treenode.
-    tns = Treenode.objects.filter(id__in=change_list).update(skeleton=new_skeleton)
-    # update the skeleton_id value of the treenode_connector table
-    tc = TreenodeConnector.objects.filter(
-        relation__relation_name__endswith = 'synaptic_to',
-        treenode__in=change_list,
-    ).update(skeleton=new_skeleton)
-    # setting new root treenode's parent to null
-    Treenode.objects.filter(id=treenode_id).update(parent=None, editor=request.user)
 
-    # Update annotations of existing neuron to have only over set
-    _update_neuron_annotations(project_id, request.user, neuron.id,
-            upstream_annotation_map)
+    params = {
+        'treenode_id': treenode_id,
+        'skeleton_id': skeleton_id,
+        'new_skeleton_id': new_skeleton.id,
+        'editor_id': user.id,
+    }
+
+    # Move the treenode and all nodes downstream of it to the new skeleton.
+    # The downstream nodes are found by following the parent_id index
+    # recursively, starting at treenode_id (inclusive). The split node
+    # becomes the root of the new skeleton.
+    cursor.execute('''
+    WITH RECURSIVE downstream (id) AS (
+        SELECT %(treenode_id)s
+      UNION ALL
+        SELECT t.id
+        FROM treenode t, downstream d
+        WHERE t.parent_id = d.id
+    )
+    UPDATE treenode
+    SET skeleton_id = %(new_skeleton_id)s,
+        parent_id = CASE WHEN id = %(treenode_id)s THEN NULL ELSE parent_id END,
+        editor_id = CASE WHEN id = %(treenode_id)s THEN %(editor_id)s ELSE editor_id END
+    WHERE id IN (SELECT id FROM downstream)
+    ''', params)
+
+    # update the skeleton_id value of the treenode_connector table
+    lock_connectors_of_skeletons(cursor, [skeleton_id])
+    cursor.execute('''
+    UPDATE treenode_connector tc
+    SET skeleton_id = %(new_skeleton_id)s
+    FROM treenode t, relation r
+    WHERE tc.skeleton_id = %(skeleton_id)s
+      AND tc.treenode_id = t.id
+      AND t.skeleton_id = %(new_skeleton_id)s
+      AND tc.relation_id = r.id
+      AND r.relation_name LIKE '%%synaptic_to'
+    ''', params)
 
     # Update all reviews of the treenodes that are moved to a new neuron to
     # refer to the new skeleton.
-    Review.objects.filter(treenode_id__in=change_list).update(skeleton=new_skeleton)
+    cursor.execute('''
+    UPDATE review r
+    SET skeleton_id = %(new_skeleton_id)s
+    FROM treenode t
+    WHERE r.skeleton_id = %(skeleton_id)s
+      AND r.treenode_id = t.id
+      AND t.skeleton_id = %(new_skeleton_id)s
+    ''', params)
+    invalidate_project(project_id)
+    invalidate_skeletons([skeleton_id, new_skeleton.id])
+
+    # Update annotations of existing neuron to have only over set
+    _update_neuron_annotations(project_id, user, neuron.id,
+            upstream_annotation_map)
 
     # Update annotations of under skeleton
     _annotate_entities(project_id, [new_neuron.id], downstream_annotation_map)
 
     # Log the location of the node at which the split was done
     location = (treenode.location_x, treenode.location_y, treenode.location_z)
-    insert_into_log(project_id, request.user.id, "split_skeleton", location,
+    insert_into_log(project_id, user.id, "split_skeleton", location,
                     "Split skeleton with ID {0} (neuron: {1})".format( skeleton_id, neuron.name ) )
 
-    return HttpResponse(json.dumps({}), content_type='text/json')
+    return new_skeleton
 
 @requires_user_role([UserRole.Annotate, UserRole.Browse])
 def root_for_skeleton(request, project_id=None, skeleton_id=None):
@@ -478,7 +511,7 @@ def skeleton_ancestry(request, project_id=None):
     except Exception as e:
         raise Exception(response_on_error + ':' + str(e))
 
-def _connected_skeletons(skeleton_ids, op, relation_id_1, relation_id_2, model_of_id, cursor):
+def _connected_skeletons(skeleton_ids, op, outgoing, model_of_id, cursor):
     class Partner:
         def __init__(self):
             self.name = None
@@ -492,20 +525,20 @@ def _connected_skeletons(skeleton_ids, op, relation_id_1, relation_id_2, model_o
         return Partner()
     partners = defaultdict(newPartner)
 
-    # Obtain the synapses made by all skeleton_ids considering the desired direction of the synapse, as specified by relation_id_1 and relation_id_2:
+    # Obtain the number of synapses made by all skeleton_ids considering the
+    # desired direction of the synapse (outgoing or incoming):
+    if outgoing:
+        source, target = 'pre_skeleton_id', 'post_skeleton_id'
+    else:
+        source, target = 'post_skeleton_id', 'pre_skeleton_id'
     cursor.execute('''
-    SELECT t1.skeleton_id, t2.skeleton_id
-    FROM treenode_connector t1,
-         treenode_connector t2
-    WHERE t1.skeleton_id IN (%s)
-      AND t1.relation_id = %s
-      AND t1.connector_id = t2.connector_id
-      AND t2.relation_id = %s
-    ''' % (','.join(map(str, skeleton_ids)), int(relation_id_1), int(relation_id_2)))
-
-    # Sum the number of synapses
-    for srcID, partnerID in cursor.fetchall():
-        partners[partnerID].skids[srcID] += 1
+    SELECT %s, %s, n_synapses
+    FROM synapse_edge
+    WHERE %s IN (%s)
+    ''' % (source, target, source, ','.join(map(str, skeleton_ids))))
+
+    for srcID, partnerID, n_synapses in cursor.fetchall():
+        partners[partnerID].skids[srcID] += n_synapses
 
     # There may not be any synapses
     if not partners:
@@ -588,8 +621,8 @@ def _skeleton_info_raw(project_id, skeletons, op):
     relation_ids = dict(cursor.fetchall())
 
     # Obtain partner skeletons and their info
-    incoming = _connected_skeletons(skeletons, op, relation_ids['postsynaptic_to'], relation_ids['presynaptic_to'], relation_ids['model_of'], cursor)
-    outgoing = _connected_skeletons(skeletons, op, relation_ids['presynaptic_to'], relation_ids['postsynaptic_to'], relation_ids['model_of'], cursor)
+    incoming = _connected_skeletons(skeletons, op, False, relation_ids['model_of'], cursor)
+    outgoing = _connected_skeletons(skeletons, op, True, relation_ids['model_of'], cursor)
 
     def prepare(partners):
         for partnerID in partners.keys():
@@ -690,33 +723,22 @@ def get_connectivity_matrix(project_id, row_skeleton_ids, col_skeleton_ids):
     synapse counts.
     """
     cursor = connection.cursor()
-    relation_map = get_relation_to_id_map(project_id)
-    post_rel_id = relation_map['postsynaptic_to']
-    pre_rel_id = relation_map['presynaptic_to']
 
-    # Obtain all synapses made between row skeletons and column skeletons.
+    # Obtain the number of synapses between row skeletons and column skeletons.
     cursor.execute('''
-    SELECT t1.skeleton_id, t2.skeleton_id
-    FROM treenode_connector t1,
-         treenode_connector t2
-    WHERE t1.skeleton_id IN (%s)
-      AND t2.skeleton_id IN (%s)
-      AND t1.connector_id = t2.connector_id
-      AND t1.relation_id = %s
-      AND t2.relation_id = %s
+    SELECT pre_skeleton_id, post_skeleton_id, n_synapses
+    FROM synapse_edge
+    WHERE pre_skeleton_id IN (%s)
+      AND post_skeleton_id IN (%s)
     ''' % (','.join(map(str, row_skeleton_ids)),
-           ','.join(map(str, col_skeleton_ids)),
-           pre_rel_id, post_rel_id))
+           ','.join(map(str, col_skeleton_ids))))
 
     # Build a sparse connectivity representation. For all skeletons requested
     # map a dictionary of partner skeletons and the number of synapses
     # connecting to each partner.
     outgoing = defaultdict(dict)
-    for r in cursor.fetchall():
-        source, target = r[0], r[1]
-        mapping = outgoing[source]
-        count = mapping.get(target, 0)
-        mapping[target] = count + 1
+    for source, target, n_synapses in cursor.fetchall():
+        outgoing[source][target] = n_synapses
 
     return outgoing
 
@@ -778,44 +800,47 @@ def _reroot_skeleton(treenode_id, project_id):
         # Obtain the treenode from the response
         response_on_error = 'An error occured while rerooting. No valid query result.'
         treenode = q_treenode[0]
-        first_parent = treenode.parent
 
         # If no parent found it is assumed this node is already root
-        if first_parent is None:
+        if treenode.parent_id is None:
             return False
 
-        # Traverse up the chain of parents, reversing the parent relationships so
-        # that the selected treenode (with ID treenode_id) becomes the root.
-        new_parent = treenode
-        new_confidence = treenode.confidence
-        node = first_parent
-
-        while True:
-            response_on_error = 'Failed to update treenode with id %s to have new parent %s' % (node.id, new_parent.id)
-
-            # Store current values to be used in next iteration
-            parent = node.parent
-            confidence = node.confidence
+        # Reverse the parent relationships along the path from the selected
+        # treenode up to the current root so that the selected treenode
+        # becomes the root. Every node on the path gets the confidence of the
+        # edge to its former child, which is now its parent. The path is
+        # found with a recursive query and updated in one statement.
+        response_on_error = 'Failed to reverse the path from treenode with ' \
+                'ID %s to the root.' % treenode.id
+        cursor = connection.cursor()
+        cursor.execute('''
+        WITH RECURSIVE path (id, parent_id, confidence) AS (
+            SELECT id, parent_id, confidence
+            FROM treenode
+            WHERE id = %(treenode_id)s
+          UNION ALL
+            SELECT t.id, t.parent_id, t.confidence
+            FROM treenode t, path p
+            WHERE t.id = p.parent_id
+        ), reversed (id, parent_id, confidence) AS (
+            SELECT parent_id, id, confidence
+            FROM path
+            WHERE parent_id IS NOT NULL
+          UNION ALL
+            -- The new root gets the maximum confidence
+            SELECT %(treenode_id)s, NULL, 5
+        )
+        UPDATE treenode t
+        SET parent_id = r.parent_id,
+            confidence = r.confidence
+        FROM reversed r
+        WHERE t.id = r.id
+        ''', {'treenode_id': treenode.id})
 
-            # Set new values
-            node.parent = new_parent
-            node.confidence = new_confidence
-            node.save()
-
-            if parent is None:
-                # Root has been reached
-                break
-            else:
-                # Prepare next iteration
-                new_parent = node
-                new_confidence = confidence
-                node = parent
-
-        # Finally make treenode root
-        response_on_error = 'Failed to set treenode with ID %s as root.' % treenode.id
         treenode.parent = None
-        treenode.confidence = 5 # reset to maximum confidence, now it is root.
-        treenode.save()
+        treenode.confidence = 5
+        invalidate_project(project_id)
+        invalidate_skeletons([treenode.skeleton_id])
 
         return treenode
 
@@ -931,6 +956,7 @@ def _join_skeleton(user, from_treenode_id, to_treenode_id, project_id,
         Treenode.objects.filter(skeleton=to_skid).update(skeleton=from_skid)
 
         response_on_error = 'Could not update TreenodeConnector table.'
+        lock_connectors_of_skeletons(connection.cursor(), [to_skid])
         TreenodeConnector.objects.filter(
             skeleton=to_skid).update(skeleton=from_skid)
 
@@ -949,6 +975,8 @@ def _join_skeleton(user, from_treenode_id, to_treenode_id, project_id,
         # Update the parent of to_treenode.
         response_on_error = 'Could not update parent of treenode with ID %s' % to_treenode_id
         Treenode.objects.filter(id=to_treenode_id).update(parent=from_treenode_id, editor=user)
+        invalidate_project(project_id)
+        invalidate_skeletons([from_skid, to_skid])
 
         # Update linked annotations of neuron
         response_on_error = 'Could not update annotations of neuron ' \
@@ -1112,6 +1140,9 @@ def _import_skeleton(request, project_id, arborescence, neuron_id=None, name=Non
         WHERE treenode.id = v.id AND treenode.skeleton_id = %s
         """ % (treenode_values, new_skeleton.id)) # Include skeleton ID for index performance.
 
+    invalidate_project(project_id)
+    invalidate_skeletons([new_skeleton.id])
+
     # Log import.
     insert_into_log(project_id, request.user.id, 'create_neuron',
                     new_location, 'Create neuron %d and skeleton '
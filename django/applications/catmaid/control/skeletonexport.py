@@ -1,9 +1,10 @@
 import json
+import struct
 import networkx as nx
-from itertools import imap
+import numpy as np
+from itertools import imap, izip
 from functools import partial
 from collections import defaultdict
-from math import sqrt
 from datetime import datetime
 
 from django.core.serializers.json import DjangoJSONEncoder
@@ -17,7 +18,9 @@ from catmaid.control.authentication import requires_user_role
 from catmaid.control.review import get_treenodes_to_reviews, \
         get_treenodes_to_reviews_with_time
 
-from tree_util import edge_count_to_root, partition
+from catmaid.control.array_tree import ArrayTree
+from catmaid.control.tree_util import edge_count_to_root
+from catmaid.control.spatial import skeletons_within_distance
 try:
     from exportneuroml import neuroml_single_cell, neuroml_network
 except ImportError:
@@ -66,13 +69,91 @@ def export_skeleton_response(request, project_id=None, skeleton_id=None, format=
         raise Exception, "Unknown format ('%s') in export_skeleton_response" % (format,)
 
 
+# Compact skeletons and arbors can optionally be returned in a binary format,
+# which is selected with the GET parameter format=binary or an Accept header
+# of application/octet-stream. All values are little endian. A response starts
+# with a 24 byte header: the magic bytes 'CMSK', the format version (uint16),
+# the kind of response (uint16, 0: skeleton, 1: arbor), the number of nodes,
+# the number of connector rows and the byte length of the tags (uint32 each)
+# and four bytes of padding. It is followed by the node columns, the connector
+# columns and the tags as UTF-8 encoded JSON object. Columns are ordered by
+# size and column blocks are padded to a multiple of eight bytes, which allows
+# clients to view each column as typed array without copying. Missing parent
+# IDs are represented as -1.
+BINARY_HEADER = struct.Struct('<4sHHIII4x')
+BINARY_MAGIC = 'CMSK'
+BINARY_VERSION = 1
+BINARY_KIND_SKELETON = 0
+BINARY_KIND_ARBOR = 1
+
+# (row index, struct type code) of each column. Nodes are sent as id,
+# parent_id, user_id, x, y, z, radius and confidence.
+BINARY_NODE_COLUMNS = ((0, 'q'), (1, 'q'), (2, 'i'), (3, 'f'), (4, 'f'),
+        (5, 'f'), (6, 'f'), (7, 'B'))
+# Connectors of compact skeletons are sent as treenode_id, connector_id, x, y,
+# z and relation (0: presynaptic, 1: postsynaptic).
+BINARY_SKELETON_CONNECTOR_COLUMNS = ((0, 'q'), (1, 'q'), (3, 'f'), (4, 'f'),
+        (5, 'f'), (2, 'B'))
+# Connectors of compact arbors are sent as treenode_id, connector_id, partner
+# treenode_id, partner skeleton_id, confidence, partner confidence, relation
+# and partner relation.
+BINARY_ARBOR_CONNECTOR_COLUMNS = ((0, 'q'), (2, 'q'), (4, 'q'), (5, 'q'),
+        (1, 'B'), (3, 'B'), (6, 'B'), (7, 'B'))
+
+
+def _wants_binary(request):
+    """ Returns True if the client asked for the binary response format. """
+    return 'binary' == request.GET.get('format') or \
+            'application/octet-stream' in request.META.get('HTTP_ACCEPT', '')
+
+def _pack_columns(rows, columns):
+    """ Transposes the passed in rows and packs the result column by column,
+    using the (row index, struct type code) pairs in columns. None values are
+    stored as -1. The result is padded to a multiple of eight bytes. """
+    n_rows = len(rows)
+    if 0 == n_rows:
+        return ''
+    values = zip(*rows)
+    data = []
+    for index, code in columns:
+        column = values[index]
+        if None in column:
+            column = [-1 if v is None else v for v in column]
+        data.append(struct.pack('<%s%s' % (n_rows, code), *column))
+    data = ''.join(data)
+    return data + '\0' * (-len(data) % 8)
+
+def _binary_response(kind, nodes, connectors, connector_columns, tags):
+    """ Creates a response in the binary format described above. """
+    tags = json.dumps(tags, separators=(',', ':')).encode('utf-8')
+    header = BINARY_HEADER.pack(BINARY_MAGIC, BINARY_VERSION, kind,
+            len(nodes), len(connectors), len(tags))
+    return HttpResponse(''.join((header,
+            _pack_columns(nodes, BINARY_NODE_COLUMNS),
+            _pack_columns(connectors, connector_columns),
+            tags)), content_type='application/octet-stream')
+
+
 @requires_user_role(UserRole.Browse)
 def compact_skeleton(request, project_id=None, skeleton_id=None, with_connectors=None, with_tags=None):
     """
         Performance-critical function. Do not edit unless to improve performance.
 
-        Returns, in JSON, [[nodes], [connectors], {nodeID: [tags]}], with connectors and tags being empty when 0 == with_connectors and 0 == with_tags, respectively
+        Returns, in JSON, [[nodes], [connectors], {nodeID: [tags]}], with connectors and tags being empty when 0 == with_connectors and 0 == with_tags, respectively.
+        If requested, the binary format described above is used instead of JSON.
     """
+    nodes, connectors, tags = _compact_skeleton(project_id, skeleton_id,
+            with_connectors, with_tags)
+
+    if _wants_binary(request):
+        return _binary_response(BINARY_KIND_SKELETON, nodes, connectors,
+                BINARY_SKELETON_CONNECTOR_COLUMNS, tags)
+
+    return HttpResponse(json.dumps((nodes, connectors, tags), separators=(',', ':')))
+
+
+def _compact_skeleton(project_id, skeleton_id, with_connectors, with_tags):
+    """ Returns a tuple of nodes, connectors and tags of a skeleton. """
 
     # Sanitize
     project_id = int(project_id)
@@ -136,7 +217,7 @@ def compact_skeleton(request, project_id=None, skeleton_id=None, with_connectors
         for row in cursor.fetchall():
             tags[row[0]].append(row[1])
 
-    return HttpResponse(json.dumps((nodes, connectors, tags), separators=(',', ':')))
+    return nodes, connectors, tags
 
 
 @requires_user_role(UserRole.Browse)
@@ -159,7 +240,20 @@ def compact_arbor(request, project_id=None, skeleton_id=None, with_nodes=None, w
     then the next 3 values are from the partner skeleton,
     and finally the two relations: first for the given skeleton_id and then for the other skeleton.
     The relation_id is 0 for pre and 1 for post.
+    If requested, the binary format described above is used instead of JSON.
     """
+    nodes, connectors, tags = _compact_arbor(project_id, skeleton_id,
+            with_nodes, with_connectors, with_tags)
+
+    if _wants_binary(request):
+        return _binary_response(BINARY_KIND_ARBOR, nodes, connectors,
+                BINARY_ARBOR_CONNECTOR_COLUMNS, tags)
+
+    return HttpResponse(json.dumps((nodes, connectors, tags), separators=(',', ':')))
+
+
+def _compact_arbor(project_id, skeleton_id, with_nodes, with_connectors, with_tags):
+    """ Returns a tuple of nodes, connectors and tags of an arbor. """
 
     # Sanitize
     project_id = int(project_id)
@@ -238,11 +332,10 @@ def compact_arbor(request, project_id=None, skeleton_id=None, with_nodes=None, w
         for row in cursor.fetchall():
             tags[row[0]].append(row[1])
 
-    return HttpResponse(json.dumps((nodes, connectors, tags), separators=(',', ':')))
+    return nodes, connectors, tags
 
 
-@requires_user_role([UserRole.Browse])
-def treenode_time_bins(request, project_id=None, skeleton_id=None):
+def _treenode_time_bins(skeleton_id):
     """ Return a map of time bins (minutes) vs. list of nodes. """
     minutes = defaultdict(list)
     epoch = datetime.utcfromtimestamp(0)
@@ -250,14 +343,23 @@ def treenode_time_bins(request, project_id=None, skeleton_id=None):
     for row in Treenode.objects.filter(skeleton_id=int(skeleton_id)).values_list('id', 'creation_time'):
         minutes[int((row[1] - epoch).total_seconds() / 60)].append(row[0])
 
-    return HttpResponse(json.dumps(minutes, separators=(',', ':')))
+    return minutes
+
+
+@requires_user_role([UserRole.Browse])
+def treenode_time_bins(request, project_id=None, skeleton_id=None):
+    """ Return a map of time bins (minutes) vs. list of nodes. """
+    return HttpResponse(json.dumps(_treenode_time_bins(skeleton_id), separators=(',', ':')))
 
 
 @requires_user_role([UserRole.Browse])
 def compact_arbor_with_minutes(request, project_id=None, skeleton_id=None, with_nodes=None, with_connectors=None, with_tags=None):
-    r = compact_arbor(request, project_id=project_id, skeleton_id=skeleton_id, with_nodes=with_nodes, with_connectors=with_connectors, with_tags=with_tags)
-    r.content = "%s, %s]" % (r.content[:-1], treenode_time_bins(request, project_id=project_id, skeleton_id=skeleton_id).content)
-    return r
+    """ Like compact_arbor, but with a map of time bins (minutes) vs. list of
+    nodes appended. Only JSON is supported as response format. """
+    nodes, connectors, tags = _compact_arbor(project_id, skeleton_id,
+            with_nodes, with_connectors, with_tags)
+    minutes = _treenode_time_bins(skeleton_id)
+    return HttpResponse(json.dumps((nodes, connectors, tags, minutes), separators=(',', ':')))
 
 
 # DEPRECATED. Will be removed.
@@ -389,18 +491,16 @@ def _measure_skeletons(skeleton_ids):
 
     cursor = connection.cursor()
     cursor.execute('''
-    SELECT id, parent_id, skeleton_id, location_x, location_y, location_z
+    SELECT id, COALESCE(parent_id, -1), skeleton_id,
+           location_x, location_y, location_z
     FROM treenode
     WHERE skeleton_id IN (%s)
+    ORDER BY skeleton_id
     ''' % skids_string)
 
-    # TODO should be all done with numpy,
-    # TODO  by partitioning the skeleton into sequences of x,y,z representing the slabs
-    # TODO  and then convolving them.
-
     class Skeleton():
-        def __init__(self):
-            self.nodes = {}
+        def __init__(self, n_nodes):
+            self.n_nodes = n_nodes
             self.raw_cable = 0
             self.smooth_cable = 0
             self.principal_branch_cable = 0
@@ -409,90 +509,21 @@ def _measure_skeletons(skeleton_ids):
             self.n_pre = 0
             self.n_post = 0
 
-    class Node():
-        def __init__(self, parent_id, x, y, z):
-            self.parent_id = parent_id
-            self.x = x
-            self.y = y
-            self.z = z
-            self.wx = x # weighted average of itself and neighbors
-            self.wy = y
-            self.wz = z
-            self.children = {} # node ID vs distance
-
-    skeletons = defaultdict(dict) # skeleton ID vs (node ID vs Node)
-    for row in cursor.fetchall():
-        skeleton = skeletons.get(row[2])
-        if not skeleton:
-            skeleton = Skeleton()
-            skeletons[row[2]] = skeleton
-        skeleton.nodes[row[0]] = Node(row[1], row[3], row[4], row[5])
-
-    for skeleton in skeletons.itervalues():
-        nodes = skeleton.nodes
-        tree = nx.DiGraph()
-        root = None
-        # Accumulate children
-        for nodeID, node in nodes.iteritems():
-            if not node.parent_id:
-                root = nodeID
-                continue
-            tree.add_edge(node.parent_id, nodeID)
-            parent = nodes[node.parent_id]
-            distance = sqrt(  pow(node.x - parent.x, 2)
-                            + pow(node.y - parent.y, 2)
-                            + pow(node.z - parent.z, 2))
-            parent.children[nodeID] = distance
-            # Measure raw cable, given that we have the parent already
-            skeleton.raw_cable += distance
-        # Utilize accumulated children and the distances to them
-        for nodeID, node in nodes.iteritems():
-            # Count end nodes and branch nodes
-            n_children = len(node.children)
-            if not node.parent_id:
-                if 1 == n_children:
-                    skeleton.n_ends += 1
-                    continue
-                if n_children > 2:
-                    skeleton.n_branch += 1
-                    continue
-                # Else, if 2 == n_children, the root node is in the middle of the skeleton, being a slab node
-            elif 0 == n_children:
-                skeleton.n_ends += 1
-                continue
-            elif n_children > 1:
-                skeleton.n_branch += 1
-                continue
-            # Compute weighted position for slab nodes only
-            # (root, branch and end nodes do not move)
-            oids = node.children.copy()
-            if node.parent_id:
-                oids[node.parent_id] = skeleton.nodes[node.parent_id].children[nodeID]
-            sum_distances = sum(oids.itervalues())
-            wx, wy, wz = 0, 0, 0
-            for oid, distance in oids.iteritems():
-                other = skeleton.nodes[oid]
-                w = distance / sum_distances if sum_distances != 0 else 0
-                wx += other.x * w
-                wy += other.y * w
-                wz += other.z * w
-            node.wx = node.x * 0.4 + wx * 0.6
-            node.wy = node.y * 0.4 + wy * 0.6
-            node.wz = node.z * 0.4 + wz * 0.6
-        # Find out nodes that belong to the principal branch
-        principal_branch_nodes = set(sorted(partition(tree, root), key=len)[-1])
-        # Compute smoothed cable length, also for principal branch
-        for nodeID, node in nodes.iteritems():
-            if not node.parent_id:
-                # root node
-                continue
-            parent = nodes[node.parent_id]
-            length = sqrt(  pow(node.wx - parent.wx, 2)
-                          + pow(node.wy - parent.wy, 2)
-                          + pow(node.wz - parent.wz, 2))
-            skeleton.smooth_cable += length
-            if nodeID in principal_branch_nodes:
-                skeleton.principal_branch_cable += length
+    skeletons = {}
+    # All IDs are small enough to be represented exactly as float64
+    rows = np.array(cursor.fetchall(), dtype=np.float64).reshape(-1, 6)
+    if len(rows):
+        # Split rows into skeletons
+        skids = rows[:, 2].astype(np.int64)
+        starts = np.concatenate(([0], np.flatnonzero(np.diff(skids)) + 1))
+        ends = np.concatenate((starts[1:], [len(rows)]))
+        for start, end in izip(starts, ends):
+            part = rows[start:end]
+            arbor = ArrayTree(part[:, 0].astype(np.int64),
+                              part[:, 1].astype(np.int64), part[:, 3:6])
+            skeleton = Skeleton(len(arbor))
+            skeleton.__dict__.update(arbor.measure())
+            skeletons[int(skids[start])] = skeleton
 
     # Count inputs
     cursor.execute('''
@@ -534,7 +565,7 @@ def _measure_skeletons(skeleton_ids):
 def measure_skeletons(request, project_id=None):
     skeleton_ids = tuple(int(v) for k,v in request.POST.iteritems() if k.startswith('skeleton_ids['))
     def asRow(skid, sk):
-        return (skid, int(sk.raw_cable), int(sk.smooth_cable), sk.n_pre, sk.n_post, len(sk.nodes), sk.n_branch, sk.n_ends, sk.principal_branch_cable)
+        return (skid, int(sk.raw_cable), int(sk.smooth_cable), sk.n_pre, sk.n_post, sk.n_nodes, sk.n_branch, sk.n_ends, sk.principal_branch_cable)
     return HttpResponse(json.dumps([asRow(skid, sk) for skid, sk in _measure_skeletons(skeleton_ids).iteritems()]))
 
 
@@ -857,47 +888,27 @@ def within_spatial_distance(request, project_id=None):
     if 0 == distance:
         return HttpResponse(json.dumps({"skeletons": []}))
     size_mode = int(request.POST.get("size_mode", 0))
-    having = ""
-
-    if 0 == size_mode:
-        having = "HAVING count(*) > 1"
-    elif 1 == size_mode:
-        having = "HAVING count(*) = 1"
-    # else, no constraint
 
     cursor = connection.cursor()
     cursor.execute('SELECT location_x, location_y, location_z FROM treenode WHERE id=%s' % tnid)
     pos = cursor.fetchone()
 
     limit = 100
-    x0 = pos[0] - distance
-    x1 = pos[0] + distance
-    y0 = pos[1] - distance
-    y1 = pos[1] + distance
-    z0 = pos[2] - distance
-    z1 = pos[2] + distance
-
-    # Cheap emulation of the distance
-    cursor.execute('''
-SELECT skeleton_id, count(*)
-FROM treenode
-WHERE project_id = %s
-  AND location_x > %s
-  AND location_x < %s
-  AND location_y > %s
-  AND location_y < %s
-  AND location_z > %s
-  AND location_z < %s
-GROUP BY skeleton_id
-%s
-LIMIT %s
-''' % (project_id, x0, x1, y0, y1, z0, z1, having, limit))
-
- 
-    skeletons = tuple(row[0] for row in cursor.fetchall())
+    skeletons = []
+    # Skeletons are sorted by the distance of their closest treenode
+    for skeleton_id, count, _ in skeletons_within_distance(cursor, project_id,
+            pos, distance):
+        if 0 == size_mode and count < 2:
+            continue
+        elif 1 == size_mode and count != 1:
+            continue
+        # else, no constraint
+        skeletons.append(skeleton_id)
+        if len(skeletons) == limit:
+            break
 
     return HttpResponse(json.dumps({"skeletons": skeletons,
-                                    "reached_limit": 100 == len(skeletons)}))
+                                    "reached_limit": limit == len(skeletons)}))
 
 @requires_user_role(UserRole.Browse)
 def partners_by_connector(request, project_id=None):
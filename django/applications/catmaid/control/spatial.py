@@ -0,0 +1,347 @@
+""" Spatial lookup of treenodes and connectors.
+
+The tracing overlay asks for all nodes within a field of view on every pan and
+zoom. The raw database rows for such a section query don't depend on the
+requesting user, which is why they can be shared between all users that look
+at the same part of a project. Results are stored in Django's cache, keyed by
+project, section and a bounding box that is aligned to a grid, so that
+neighboring views map to the same entry. Every write to the spatial data of
+a project bumps a per-project generation number, which is part of the cache
+key. Hereby all cached sections of a project become invalid at once, without
+having to know which sections were affected.
+
+Caching is only active if NODE_LIST_CACHE_TIMEOUT is larger than zero.
+
+Nearest node and radius queries on skeletons are answered by a NodeIndex, which
+keeps the treenodes of a skeleton in arrays and indexes their locations with a
+KD-tree. If NODE_INDEX_CACHE_SIZE is larger than zero, each server process
+keeps the indices of that many recently used skeletons in memory. They are
+tied to the generation number of their project as well.
+"""
+
+import math
+import numpy as np
+
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import cache
+
+from catmaid.control.common import get_cache_version, \
+        increment_cache_version
+
+try:
+    from scipy.spatial import cKDTree
+except ImportError:
+    cKDTree = None
+
+
+def _generation_key(project_id):
+    return 'catmaid.spatial.generation.%s' % int(project_id)
+
+def get_generation(project_id):
+    """ Returns the current generation number of the spatial data of a
+    project.
+    """
+    return get_cache_version(_generation_key(project_id))
+
+def invalidate_project(project_id):
+    """ Marks all cached spatial data of a project as invalid. This should be
+    called by every view that creates, moves or removes treenodes, connectors
+    or links between them.
+    """
+    if settings.NODE_LIST_CACHE_TIMEOUT <= 0 and \
+            settings.NODE_INDEX_CACHE_SIZE <= 0:
+        return
+    increment_cache_version(_generation_key(project_id))
+
+def align_to_grid(params):
+    """ Expands the bounding box defined by the 'left', 'top', 'right' and
+    'bottom' fields of params outwards so that all of them are multiples of
+    the configured grid size. The passed in dictionary is updated.
+    """
+    grid = settings.NODE_LIST_CACHE_GRID_SIZE
+    if grid <= 0:
+        return params
+    params['left'] = math.floor(params['left'] / grid) * grid
+    params['top'] = math.floor(params['top'] / grid) * grid
+    params['right'] = math.ceil(params['right'] / grid) * grid
+    params['bottom'] = math.ceil(params['bottom'] / grid) * grid
+    return params
+
+def fetch_treenodes_in_section(cursor, params):
+    """ Returns all treenodes in the bounding box of the section z, along with
+    their parents and children. Each row contains two treenodes, the first one
+    in section z: (id, parent_id, x, y, z, confidence, radius, skeleton_id,
+    user_id) for both of them.
+    """
+    # Fetch treenodes which are in the bounding box,
+    # which in z it includes the full thickess of the prior section
+    # and of the next section (therefore the '<' and not '<=' for zhigh)
+    cursor.execute('''
+    SELECT
+        t1.id,
+        t1.parent_id,
+        t1.location_x,
+        t1.location_y,
+        t1.location_z,
+        t1.confidence,
+        t1.radius,
+        t1.skeleton_id,
+        t1.user_id,
+        t2.id,
+        t2.parent_id,
+        t2.location_x,
+        t2.location_y,
+        t2.location_z,
+        t2.confidence,
+        t2.radius,
+        t2.skeleton_id,
+        t2.user_id
+    FROM treenode t1
+         INNER JOIN treenode t2 ON
+           (   (t1.id = t2.parent_id OR t1.parent_id = t2.id)
+            OR (t1.parent_id IS NULL AND t1.id = t2.id))
+    WHERE
+        t1.location_z = %(z)s
+        AND t1.location_x > %(left)s
+        AND t1.location_x < %(right)s
+        AND t1.location_y > %(top)s
+        AND t1.location_y < %(bottom)s
+        AND t1.project_id = %(project_id)s
+    LIMIT %(limit)s
+    ''', params)
+
+    # Above, notice that the join is done for:
+    # 1. A parent-child or child-parent pair (where the first one is in section z)
+    # 2. A node with itself when the parent is null
+    # This is by far the fastest way to retrieve all parents and children nodes
+    # of the nodes in section z within the specified 2d bounds.
+    return cursor.fetchall()
+
+def fetch_connectors_in_section(cursor, params, treenode_ids):
+    """ Returns all connectors linked to the passed in treenodes and all
+    connectors in the bounding box of section z. There is one row per link
+    and connectors without links are included once: (id, x, y, z, confidence,
+    relation_id, treenode_id, link confidence, user_id).
+    """
+    # Find connectors related to treenodes in the field of view
+    # Connectors found attached to treenodes
+    crows = []
+
+    if treenode_ids:
+        cursor.execute('''
+        SELECT connector.id,
+            connector.location_x,
+            connector.location_y,
+            connector.location_z,
+            connector.confidence,
+            treenode_connector.relation_id,
+            treenode_connector.treenode_id,
+            treenode_connector.confidence,
+            connector.user_id
+        FROM treenode_connector,
+             connector
+        WHERE treenode_connector.treenode_id IN %s
+          AND treenode_connector.connector_id = connector.id
+        ''', (tuple(treenode_ids),))
+
+        crows = list(cursor.fetchall())
+
+    # Obtain connectors within the field of view that were not captured above.
+    # Uses a LEFT OUTER JOIN to include disconnected connectors,
+    # that is, connectors that aren't referenced from treenode_connector.
+    cursor.execute('''
+    SELECT connector.id,
+        connector.location_x,
+        connector.location_y,
+        connector.location_z,
+        connector.confidence,
+        treenode_connector.relation_id,
+        treenode_connector.treenode_id,
+        treenode_connector.confidence,
+        connector.user_id
+    FROM connector LEFT OUTER JOIN treenode_connector
+                   ON connector.id = treenode_connector.connector_id
+    WHERE connector.project_id = %(project_id)s
+      AND connector.location_z = %(z)s
+      AND connector.location_x > %(left)s
+      AND connector.location_x < %(right)s
+      AND connector.location_y > %(top)s
+      AND connector.location_y < %(bottom)s
+    ''', params)
+
+    crows.extend(cursor.fetchall())
+
+    return crows
+
+def _fetch_section(cursor, params):
+    trows = fetch_treenodes_in_section(cursor, params)
+    treenode_ids = set()
+    for row in trows:
+        treenode_ids.add(row[0])
+        treenode_ids.add(row[9])
+    crows = fetch_connectors_in_section(cursor, params, treenode_ids)
+    return (trows, crows)
+
+def fetch_section(cursor, params):
+    """ Returns a tuple of treenode rows and connector rows of a section, as
+    returned by fetch_treenodes_in_section() and fetch_connectors_in_section().
+    If caching is enabled, the bounding box in params is aligned to the cache
+    grid and results are taken from the cache, if available. Since the node
+    limit isn't applied in any particular order, an aligned section that
+    reaches it could miss nodes of the requested bounding box. Such sections
+    are only remembered as too dense and the requested bounding box is
+    queried instead.
+    """
+    timeout = settings.NODE_LIST_CACHE_TIMEOUT
+    if timeout > 0:
+        aligned = align_to_grid(dict(params))
+        key = 'catmaid.spatial.section.%s.%s.%s.%s.%s.%s.%s.%s' % (
+                aligned['project_id'], get_generation(aligned['project_id']),
+                aligned['z'], aligned['left'], aligned['top'],
+                aligned['right'], aligned['bottom'], aligned['limit'])
+        section = cache.get(key)
+        if section is None:
+            section = _fetch_section(cursor, aligned)
+            if len(section[0]) >= aligned['limit']:
+                section = ()
+            cache.set(key, section, timeout)
+        if section:
+            return section
+
+    return _fetch_section(cursor, params)
+
+class NodeIndex(object):
+    """ Exact nearest node and radius queries on a set of treenodes. Treenode
+    IDs, skeleton IDs and locations are stored in arrays, the locations are
+    indexed with a KD-tree if SciPy is available. Without SciPy, queries fall
+    back to a vectorized search over all nodes.
+    """
+
+    def __init__(self, ids, skeleton_ids, locations):
+        self.ids = np.asarray(ids, dtype=np.int64)
+        self.skeleton_ids = np.asarray(skeleton_ids, dtype=np.int64)
+        self.locations = np.asarray(locations, dtype=np.float64).reshape(-1, 3)
+        if cKDTree is not None and len(self.ids):
+            self.tree = cKDTree(self.locations)
+        else:
+            self.tree = None
+
+    def __len__(self):
+        return len(self.ids)
+
+    def distances(self, point):
+        """ Returns the distance of every node to point. """
+        delta = self.locations - np.asarray(point, dtype=np.float64)
+        return np.sqrt((delta * delta).sum(axis=1))
+
+    def nearest(self, point, k=1):
+        """ Returns an array of distances and an array of indices of the k
+        nodes closest to point, closest first. """
+        k = min(k, len(self.ids))
+        if 0 == k:
+            return np.zeros(0), np.zeros(0, dtype=np.int64)
+        if self.tree is not None:
+            distances, indices = self.tree.query(point, k)
+            return np.atleast_1d(distances), np.atleast_1d(indices)
+        distances = self.distances(point)
+        indices = np.argsort(distances, kind='mergesort')[:k]
+        return distances[indices], indices
+
+    def within(self, point, radius):
+        """ Returns an array with the indices of all nodes that are at most
+        radius away from point. """
+        # Older SciPy versions have no radius queries on cKDTree
+        if self.tree is not None and hasattr(self.tree, 'query_ball_point'):
+            return np.array(sorted(self.tree.query_ball_point(point, radius)),
+                    dtype=np.int64)
+        return np.flatnonzero(self.distances(point) <= radius)
+
+
+_node_indices = OrderedDict()
+
+def skeleton_node_index(cursor, project_id, skeleton_id):
+    """ Returns a NodeIndex with all treenodes of a skeleton. Indices are
+    cached if NODE_INDEX_CACHE_SIZE is larger than zero, until the spatial
+    data of the project changes.
+    """
+    size = settings.NODE_INDEX_CACHE_SIZE
+    if size > 0:
+        generation = get_generation(project_id)
+        key = (int(project_id), int(skeleton_id))
+        entry = _node_indices.pop(key, None)
+        if entry is not None and entry[0] == generation:
+            # Mark as most recently used
+            _node_indices[key] = entry
+            return entry[1]
+
+    cursor.execute('''
+    SELECT id, location_x, location_y, location_z
+    FROM treenode
+    WHERE project_id = %s
+      AND skeleton_id = %s
+    ''', (int(project_id), int(skeleton_id)))
+    rows = np.array(cursor.fetchall(), dtype=np.float64).reshape(-1, 4)
+    index = NodeIndex(rows[:, 0], np.repeat(skeleton_id, len(rows)), rows[:, 1:])
+
+    if size > 0:
+        _node_indices[key] = (generation, index)
+        while len(_node_indices) > size:
+            _node_indices.popitem(last=False)
+    return index
+
+def nearest_treenode(cursor, project_id, skeleton_ids, point):
+    """ Returns a tuple of treenode ID, skeleton ID and location of the
+    treenode closest to point among all treenodes of the passed in skeletons,
+    or None if they have no treenodes.
+    """
+    nearest = None
+    for skeleton_id in skeleton_ids:
+        index = skeleton_node_index(cursor, project_id, skeleton_id)
+        distances, indices = index.nearest(point)
+        if len(indices) and (nearest is None or distances[0] < nearest[0]):
+            i = indices[0]
+            nearest = (distances[0], int(index.ids[i]),
+                    int(index.skeleton_ids[i]), tuple(index.locations[i]))
+    return None if nearest is None else nearest[1:]
+
+def skeletons_within_distance(cursor, project_id, point, distance):
+    """ Returns a list of (skeleton ID, number of treenodes within distance,
+    distance of the closest of them) tuples for all skeletons that have
+    treenodes at most distance away from point, closest skeletons first.
+    Candidates are found with the spatial index of the database, the
+    distance is then computed exactly.
+    """
+    x, y, z = point
+    cursor.execute('''
+    SELECT id, skeleton_id, location_x, location_y, location_z
+    FROM treenode
+    WHERE project_id = %s
+      AND location_z >= %s
+      AND location_z <= %s
+      AND location_x >= %s
+      AND location_x <= %s
+      AND location_y >= %s
+      AND location_y <= %s
+    ''', (int(project_id), z - distance, z + distance, x - distance,
+            x + distance, y - distance, y + distance))
+    rows = np.array(cursor.fetchall(), dtype=np.float64).reshape(-1, 5)
+    index = NodeIndex(rows[:, 0], rows[:, 1], rows[:, 2:])
+    distances = index.distances(point)
+    inside = distances <= distance
+    if not inside.any():
+        return []
+    skeleton_ids = index.skeleton_ids[inside]
+    distances = distances[inside]
+    # Sort by distance, so that the first occurrence of each skeleton is its
+    # closest node.
+    order = np.argsort(distances, kind='mergesort')
+    skeleton_ids = skeleton_ids[order]
+    distances = distances[order]
+    unique, first = np.unique(skeleton_ids, return_index=True)
+    counts = np.bincount(np.searchsorted(unique, skeleton_ids),
+            minlength=len(unique))
+    closest = np.argsort(first, kind='mergesort')
+    return [(int(unique[i]), int(counts[i]), float(distances[first[i]]))
+            for i in closest]
@@ -3,70 +3,331 @@ import time
 from datetime import timedelta, datetime
 from dateutil import parser as dateparser
 
+from celery.task import task
+
 from django.http import HttpResponse
 from django.db.models.aggregates import Count
-from django.db import connection
+from django.db import connection, transaction
 
 from catmaid.control.authentication import requires_user_role
-from catmaid.models import ClassInstance, Connector, Treenode, User, UserRole, \
-        Review, Relation, TreenodeConnector
+from catmaid.control.common import get_relation_to_id_map
+from catmaid.models import ClassInstance, Project, Relation, User, UserRole, \
+        Review
+
+
+# Events that happened less than this many seconds ago are not added to the
+# user activity rollup yet, because the transactions that created them might
+# not be committed.
+USER_ACTIVITY_UPDATE_DELAY = 300
+
+# The counters of the user activity rollup
+USER_ACTIVITY_COLUMNS = ('n_treenodes_created', 'n_treenodes_edited',
+        'n_connectors_created', 'n_connectors_edited', 'n_presynaptic_links',
+        'n_postsynaptic_links', 'n_reviews')
+
+def _user_activity_events(lower, upper, all_projects=False):
+    """ Returns a query that counts the events of all users of a project per
+    hour. Only events after <lower> and until (including) <upper> are taken
+    into account, both are SQL expressions. The query expects the parameters
+    project_id, presynaptic_to and postsynaptic_to.
+
+    With <all_projects>, the events of all projects are summed up instead,
+    of each project only the ones that aren't in the rollup yet. <lower> then
+    only limits the events that are looked at, and presynaptic_to and
+    postsynaptic_to are expected to be lists of relation IDs.
+
+    Nodes only store the time of their last edit. Of several edits of a node
+    between two updates of the rollup, only the last one is counted.
+    """
+    if all_projects:
+        source = "e LEFT JOIN user_activity_update w ON w.project_id = e.project_id"
+        def in_window(column):
+            return "%s > %s AND %s > coalesce(w.updated_until, '-infinity') " \
+                    "AND %s <= %s" % (column, lower, column, column, upper)
+        is_relation = "relation_id = ANY(%%(%s)s)"
+    else:
+        source = "e"
+        def in_window(column):
+            return "e.project_id = %%(project_id)s AND %s > %s AND %s <= %s" % \
+                    (column, lower, column, upper)
+        is_relation = "relation_id = %%(%s)s"
+
+    return '''
+    SELECT user_id, hour,
+        sum(n_treenodes_created)::integer AS n_treenodes_created,
+        sum(n_treenodes_edited)::integer AS n_treenodes_edited,
+        sum(n_connectors_created)::integer AS n_connectors_created,
+        sum(n_connectors_edited)::integer AS n_connectors_edited,
+        sum(n_presynaptic_links)::integer AS n_presynaptic_links,
+        sum(n_postsynaptic_links)::integer AS n_postsynaptic_links,
+        sum(n_reviews)::integer AS n_reviews
+    FROM (
+        SELECT user_id, date_trunc('hour', creation_time) AS hour,
+            count(*) AS n_treenodes_created, 0 AS n_treenodes_edited,
+            0 AS n_connectors_created, 0 AS n_connectors_edited,
+            0 AS n_presynaptic_links, 0 AS n_postsynaptic_links,
+            0 AS n_reviews
+        FROM treenode %(source)s
+        WHERE %(treenode_created)s
+        GROUP BY 1, 2
+        UNION ALL
+        SELECT editor_id, date_trunc('hour', edition_time),
+            0, count(*), 0, 0, 0, 0, 0
+        FROM treenode %(source)s
+        WHERE %(treenode_edited)s
+          AND edition_time > creation_time
+        GROUP BY 1, 2
+        UNION ALL
+        SELECT user_id, date_trunc('hour', creation_time),
+            0, 0, count(*), 0, 0, 0, 0
+        FROM connector %(source)s
+        WHERE %(connector_created)s
+        GROUP BY 1, 2
+        UNION ALL
+        SELECT editor_id, date_trunc('hour', edition_time),
+            0, 0, 0, count(*), 0, 0, 0
+        FROM connector %(source)s
+        WHERE %(connector_edited)s
+          AND edition_time > creation_time
+        GROUP BY 1, 2
+        UNION ALL
+        SELECT user_id, date_trunc('hour', creation_time),
+            0, 0, 0, 0,
+            sum(CASE WHEN %(presynaptic)s THEN 1 ELSE 0 END),
+            sum(CASE WHEN %(postsynaptic)s THEN 1 ELSE 0 END),
+            0
+        FROM treenode_connector %(source)s
+        WHERE %(link_created)s
+        GROUP BY 1, 2
+        UNION ALL
+        SELECT reviewer_id, date_trunc('hour', review_time),
+            0, 0, 0, 0, 0, 0, count(*)
+        FROM review %(source)s
+        WHERE %(reviewed)s
+        GROUP BY 1, 2
+    ) events
+    GROUP BY user_id, hour
+    ''' % {
+        'source': source,
+        'presynaptic': is_relation % 'presynaptic_to',
+        'postsynaptic': is_relation % 'postsynaptic_to',
+        'treenode_created': in_window('creation_time'),
+        'treenode_edited': in_window('edition_time'),
+        'connector_created': in_window('creation_time'),
+        'connector_edited': in_window('edition_time'),
+        'link_created': in_window('creation_time'),
+        'reviewed': in_window('review_time'),
+    }
+
+# The time until which the events of a project are in the rollup already
+_USER_ACTIVITY_UPDATED_UNTIL = '''(
+    SELECT coalesce(max(updated_until), '-infinity')
+    FROM user_activity_update
+    WHERE project_id = %(project_id)s)'''
+
+# The earliest time until which the events of any project are in the rollup
+_ALL_USER_ACTIVITY_UPDATED_UNTIL = '''(
+    SELECT min(coalesce(u.updated_until, '-infinity'))
+    FROM project p LEFT JOIN user_activity_update u ON u.project_id = p.id)'''
 
+def _user_activity_params(project_id):
+    if project_id is None:
+        params = {'presynaptic_to': [], 'postsynaptic_to': []}
+        for name, relation_id in Relation.objects.filter(
+                relation_name__in=params.keys()).values_list(
+                        'relation_name', 'id'):
+            params[name].append(relation_id)
+        return params
+    relations = get_relation_to_id_map(project_id)
+    return {
+        'project_id': int(project_id),
+        'presynaptic_to': relations.get('presynaptic_to', -1),
+        'postsynaptic_to': relations.get('postsynaptic_to', -1),
+    }
+
+def update_user_activity(project_id, delay=USER_ACTIVITY_UPDATE_DELAY):
+    """ Add all events of a project that happened since the last update and
+    more than <delay> seconds ago to the user activity rollup.
+    """
+    params = _user_activity_params(project_id)
+    with transaction.atomic():
+        cursor = connection.cursor()
+        # Updates of the same project must not overlap, otherwise events
+        # would be counted twice.
+        cursor.execute('''
+            LOCK TABLE user_activity_update IN SHARE ROW EXCLUSIVE MODE''')
+        cursor.execute("SELECT now() - %s * interval '1 second'", (delay,))
+        params['upper'] = cursor.fetchone()[0]
+
+        cursor.execute('''
+            CREATE TEMPORARY TABLE new_user_activity AS %s
+            ''' % _user_activity_events(_USER_ACTIVITY_UPDATED_UNTIL,
+                    '%(upper)s'), params)
+        cursor.execute('''
+            UPDATE user_activity a
+            SET %s
+            FROM new_user_activity n
+            WHERE a.project_id = %%(project_id)s
+              AND a.user_id = n.user_id
+              AND a.hour = n.hour
+            ''' % ', '.join('%s = a.%s + n.%s' % (c, c, c)
+                    for c in USER_ACTIVITY_COLUMNS), params)
+        cursor.execute('''
+            INSERT INTO user_activity (project_id, user_id, hour, %s)
+            SELECT %%(project_id)s, n.user_id, n.hour, %s
+            FROM new_user_activity n
+            WHERE NOT EXISTS (
+                SELECT 1 FROM user_activity a
+                WHERE a.project_id = %%(project_id)s
+                  AND a.user_id = n.user_id
+                  AND a.hour = n.hour)
+            ''' % (', '.join(USER_ACTIVITY_COLUMNS),
+                    ', '.join('n.%s' % c for c in USER_ACTIVITY_COLUMNS)),
+            params)
+        cursor.execute("DROP TABLE new_user_activity")
+
+        cursor.execute('''
+            UPDATE user_activity_update SET updated_until = %(upper)s
+            WHERE project_id = %(project_id)s
+            ''', params)
+        if 0 == cursor.rowcount:
+            cursor.execute('''
+                INSERT INTO user_activity_update (project_id, updated_until)
+                VALUES (%(project_id)s, %(upper)s)
+                ''', params)
+
+def _init_user_activity(project_id):
+    """ Adds the events of a project to the user activity rollup if this has
+    never been done before, or of all projects if <project_id> is None.
+    Otherwise, all events since the beginning would have to be counted on
+    every request until the rollup is updated for the first time.
+    """
+    projects = Project.objects.extra(where=['''NOT EXISTS (
+        SELECT 1 FROM user_activity_update u
+        WHERE u.project_id = project.id)'''])
+    if project_id is not None:
+        projects = projects.filter(id=project_id)
+    for pid in projects.values_list('id', flat=True):
+        update_user_activity(pid)
+
+@task()
+def update_all_user_activity():
+    """ Update the user activity rollup of all projects. Running this task
+    periodically keeps the amount of events that have to be counted when
+    statistics are requested small.
+    """
+    for project_id in Project.objects.values_list('id', flat=True):
+        update_user_activity(project_id)
+    return "Updated user activity"
+
+def get_user_activity(project_id, start_date=None, end_date=None,
+        user_id=None, interval=None, user_ids=None):
+    """ Returns a list of dictionaries with the counters of the user activity
+    rollup (see USER_ACTIVITY_COLUMNS) per user. With an <interval> of 'hour'
+    or 'day', the counters are split up further by time, which is then
+    available as 'date' field. Events not yet added to the rollup are counted
+    as well, projects without any rollup yet get it filled first. Start and
+    end date are rounded to full hours. If <project_id> is None, the counters
+    of all projects are summed up. Besides a single <user_id>, a list of
+    <user_ids> can be used to limit the result.
+    """
+    all_projects = project_id is None
+    _init_user_activity(project_id)
+    params = _user_activity_params(project_id)
+    conditions = []
+    if start_date:
+        conditions.append("hour >= date_trunc('hour', %(start_date)s::timestamptz)")
+        params['start_date'] = start_date
+    if end_date:
+        conditions.append("hour <= %(end_date)s")
+        params['end_date'] = end_date
+    if user_id:
+        conditions.append("user_id = %(user_id)s")
+        params['user_id'] = int(user_id)
+    if user_ids is not None:
+        conditions.append("user_id = ANY(%(user_ids)s)")
+        params['user_ids'] = [int(u) for u in user_ids]
+    where = ('WHERE ' + ' AND '.join(conditions)) if conditions else ''
+
+    if interval:
+        if interval not in ('hour', 'day'):
+            raise ValueError("Interval options are hour or day")
+        select = "user_id, date_trunc('%s', hour) AS date" % interval
+        group = "user_id, date"
+    else:
+        select = "user_id"
+        group = "user_id"
 
-def _process(query, minus1name):
     cursor = connection.cursor()
-    cursor.execute(query)
+    cursor.execute('''
+        SELECT %(select)s, %(counters)s
+        FROM (
+            SELECT user_id, hour, %(columns)s
+            FROM user_activity
+            %(rollup_where)s
+            UNION ALL
+            SELECT user_id, hour, %(columns)s
+            FROM (%(recent)s) recent
+        ) activity
+        %(where)s
+        GROUP BY %(group)s
+        ORDER BY %(group)s
+        ''' % {
+            'select': select,
+            'counters': ', '.join('sum(%s)::integer AS %s' % (c, c)
+                    for c in USER_ACTIVITY_COLUMNS),
+            'columns': ', '.join(USER_ACTIVITY_COLUMNS),
+            'rollup_where': '' if all_projects else
+                    'WHERE project_id = %(project_id)s',
+            'recent': _user_activity_events(_ALL_USER_ACTIVITY_UPDATED_UNTIL
+                    if all_projects else _USER_ACTIVITY_UPDATED_UNTIL,
+                    "'infinity'", all_projects),
+            'where': where,
+            'group': group,
+        }, params)
+    columns = [col[0] for col in cursor.description]
+    return [dict(zip(columns, row)) for row in cursor.fetchall()]
+
 
+def _process(rows, minus1name):
     # Get name dictonary separately to avoid joining the user table to the
-    # treenode table, which in turn improves performance.
+    # activity table, which in turn improves performance.
     names = dict(User.objects.values_list('id', 'username'))
 
     result = {'users': [],
               'values': []}
-    for row in cursor.fetchall():
-        result['values'].append(row[1])
-        s = (names[row[0]], row[1]) if -1 != row[0] else (minus1name, row[1])
+    for user_id, value in rows:
+        if not value:
+            continue
+        result['values'].append(value)
+        s = (names[user_id], value) if -1 != user_id else (minus1name, value)
         result['users'].append('%s (%d)' % s)
     return HttpResponse(json.dumps(result), content_type='text/json')
 
 
 @requires_user_role([UserRole.Annotate, UserRole.Browse])
 def stats_nodecount(request, project_id=None):
-    return _process('''
-    SELECT user_id, count(*)
-    FROM treenode
-    WHERE project_id=%s
-    GROUP BY user_id
-    ''' % int(project_id), "*anonymous*")
+    """ The number of treenodes each user created. """
+    return _process([(a['user_id'], a['n_treenodes_created'])
+            for a in get_user_activity(project_id)], "*anonymous*")
 
 
 @requires_user_role([UserRole.Annotate, UserRole.Browse])
 def stats_editor(request, project_id=None):
-    return _process('''
-    SELECT editor_id, count(editor_id)
-    FROM treenode
-    WHERE project_id=%s
-      AND editor_id != user_id
-    GROUP BY username
-    ''' % int(project_id), "*unedited*")
+    """ The number of treenode edits of each user. """
+    return _process([(a['user_id'], a['n_treenodes_edited'])
+            for a in get_user_activity(project_id)], "*unedited*")
 
 
 @requires_user_role([UserRole.Annotate, UserRole.Browse])
 def stats_summary(request, project_id=None):
     startdate = datetime.today()
+    today = startdate.replace(hour=0, minute=0, second=0, microsecond=0)
+    activity = get_user_activity(project_id, start_date=today,
+            user_id=request.user.id)
     result = {
-        'treenodes_created': Treenode.objects.filter(
-            project=project_id,
-            user=request.user.id,
-            creation_time__year=startdate.year,
-            creation_time__month=startdate.month,
-            creation_time__day=startdate.day).count(),
-        'connectors_created': Connector.objects.filter(
-            project=project_id,
-            user=request.user.id,
-            creation_time__year=startdate.year,
-            creation_time__month=startdate.month,
-            creation_time__day=startdate.day
-            ).count(),
+        'treenodes_created': sum(a['n_treenodes_created'] for a in activity),
+        'connectors_created': sum(a['n_connectors_created'] for a in activity),
     }
     for key, class_name in [
             ('skeletons_created', 'skeleton')
@@ -88,64 +349,36 @@ def stats_history(request, project_id=None):
     start_date = request.GET.get('start_date', datetime.now() - timedelta(30))
     end_date = request.GET.get('end_date', datetime.now())
 
-    # Look up all tree nodes for the project in the given date range.
-    # Also add a computed field which is just the day of the last edited
-    # date/time.
-    tree_nodes = Treenode.objects \
-        .filter(
-            project=project_id,
-            edition_time__range=(start_date, end_date)) \
-        .extra(select={
-            'date': 'to_char("treenode"."edition_time", \'YYYYMMDD\')'}) \
-        .order_by('user', 'date')
-
-    # Get the count of tree nodes for each user/day combination.
-    stats = tree_nodes.values('user__username', 'date') \
-        .annotate(count=Count('id'))
-
-    # Change the 'user__username' field name to just 'name'.
-    # (If <https://code.djangoproject.com/ticket/12222> ever gets implemented
-    # then this wouldn't be necessary.)
+    # Get the number of created and edited treenodes for each user/day
+    # combination.
+    names = dict(User.objects.values_list('id', 'username'))
     stats = [{
-        'name': stat['user__username'],
-        'date': stat['date'],
-        'count': stat['count']} for stat in stats]
+        'name': names.get(a['user_id']),
+        'date': a['date'].strftime('%Y%m%d'),
+        'count': a['n_treenodes_created'] + a['n_treenodes_edited']}
+        for a in get_user_activity(project_id, start_date, end_date,
+                interval='day')
+        if a['n_treenodes_created'] or a['n_treenodes_edited']]
 
     return HttpResponse(json.dumps(stats), content_type='text/json')
 
 def stats_user_activity(request, project_id=None):
+    """ Returns for one user the number of created treenodes as well as pre-
+    and postsynaptic links per hour as lists of [timestamp, count] pairs.
+    """
     username = request.GET.get('username', None)
-    all_users = User.objects.filter().values('username', 'id')
-    map_name_to_userid = {}
-    for user in all_users:
-        map_name_to_userid[user['username']] = user['id']
-    relations = dict((r.relation_name, r.id) for r in Relation.objects.filter(project=project_id))
-    # Retrieve all treenodes and creation time
-    stats = Treenode.objects \
-        .filter(
-            project=project_id,
-            user=map_name_to_userid[username] ) \
-        .order_by('creation_time') \
-        .values('creation_time')
-    # Extract the timestamps from the datetime objects
-    timepoints = [time.mktime(ele['creation_time'].timetuple()) for ele in stats]
-    # Retrieve TreenodeConnector creation times
-    stats_prelink = TreenodeConnector.objects \
-        .filter(
-            project=project_id,
-            user=map_name_to_userid[username],
-            relation=relations['presynaptic_to'] ) \
-        .order_by('creation_time').values('creation_time')
-    stats_postlink = TreenodeConnector.objects \
-        .filter(
-            project=project_id,
-            user=map_name_to_userid[username],
-            relation=relations['postsynaptic_to'] ) \
-        .order_by('creation_time').values('creation_time')
-    prelinks = [time.mktime(ele['creation_time'].timetuple()) for ele in stats_prelink]
-    postlinks = [time.mktime(ele['creation_time'].timetuple()) for ele in stats_postlink]
-    return HttpResponse(json.dumps({'skeleton_nodes': timepoints,
-         'presynaptic': prelinks, 'postsynaptic': postlinks}), content_type='text/json')
+    user = User.objects.get(username=username)
+    activity = get_user_activity(project_id, user_id=user.id, interval='hour')
+
+    def counts(column):
+        return [[time.mktime(a['date'].timetuple()), a[column]]
+                for a in activity if a[column]]
+
+    return HttpResponse(json.dumps({
+        'skeleton_nodes': counts('n_treenodes_created'),
+        'presynaptic': counts('n_presynaptic_links'),
+        'postsynaptic': counts('n_postsynaptic_links')}),
+        content_type='text/json')
 
 def stats_user_history(request, project_id=None):
     # Get the start date for the query, defaulting to 10 days ago.
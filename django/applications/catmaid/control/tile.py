@@ -1,5 +1,18 @@
+""" Tiles of HDF5 backed stacks.
+
+Every tile request reads a section of an image dataset and encodes it as an
+image. To avoid opening HDF5 files over and over again, each server process
+keeps the HDF5_FILE_POOL_SIZE most recently used files open. Encoded tiles can
+additionally be kept in memory, up to a total size of TILE_CACHE_SIZE bytes.
+Both are checked against the modification time of the HDF5 file, so that
+changed files are noticed. Blank tiles, which are returned for missing files,
+scales and sections, are encoded only once for each size and format.
+"""
+
 import os
 import cStringIO
+import threading
+from collections import OrderedDict
 from contextlib import closing
 import h5py
 import numpy as np
@@ -13,6 +26,161 @@ except:
 
 from django.http import HttpResponse
 
+
+# Supported output formats: file extension -> (PIL format, content type)
+TILE_FORMATS = {
+    'png': ('PNG', 'image/png'),
+    'jpg': ('JPEG', 'image/jpeg'),
+    'jpeg': ('JPEG', 'image/jpeg'),
+    'webp': ('WEBP', 'image/webp'),
+}
+
+# Open HDF5 files: path -> [modification time, h5py.File, number of users,
+# removed from pool]
+_hdf5_files = OrderedDict()
+# Encoded tiles: key -> (modification time, content type, data)
+_tiles = OrderedDict()
+_tiles_size = [0]
+# Encoded blank tiles: (format, width, height) -> (content type, data)
+_blank_tiles = OrderedDict()
+# Guards the pool and the caches, files are opened and read without it
+_lock = threading.Lock()
+
+
+def _remove_hdf5_file(entry):
+    """ Removes an HDF5 file from the pool. Returns True if it isn't used
+    anymore and should be closed by the caller. The caller has to hold the
+    lock. """
+    entry[3] = True
+    return 0 == entry[2]
+
+def _open_hdf5_file(fpath, mtime):
+    """ Returns an entry of an HDF5 file open for reading, taken from the pool
+    of open files if possible. Every entry has to be handed back with
+    _release_hdf5_file(), pooled files are closed only after their last user
+    released them.
+    """
+    pool_size = settings.HDF5_FILE_POOL_SIZE
+    if pool_size <= 0:
+        return [mtime, h5py.File(fpath, 'r'), 1, True]
+    with _lock:
+        entry = _hdf5_files.get(fpath)
+        if entry is not None and entry[0] == mtime:
+            # Mark as most recently used
+            del _hdf5_files[fpath]
+            _hdf5_files[fpath] = entry
+            entry[2] += 1
+            return entry
+
+    hfile = h5py.File(fpath, 'r')
+    to_close = []
+    with _lock:
+        entry = _hdf5_files.pop(fpath, None)
+        if entry is not None and entry[0] == mtime:
+            # Opened by another request in the meantime
+            to_close.append(hfile)
+        else:
+            if entry is not None and _remove_hdf5_file(entry):
+                to_close.append(entry[1])
+            entry = [mtime, hfile, 0, False]
+        _hdf5_files[fpath] = entry
+        entry[2] += 1
+        while len(_hdf5_files) > pool_size:
+            old = _hdf5_files.popitem(last=False)[1]
+            if _remove_hdf5_file(old):
+                to_close.append(old[1])
+    for f in to_close:
+        f.close()
+    return entry
+
+def _release_hdf5_file(entry):
+    """ Hands back an entry returned by _open_hdf5_file() and closes its file
+    if it isn't part of the pool anymore. """
+    with _lock:
+        entry[2] -= 1
+        close = entry[3] and 0 == entry[2]
+    if close:
+        entry[1].close()
+
+def _close_hdf5_file(fpath):
+    """ Closes a pooled HDF5 file, e.g. before writing to it. If it is still
+    being read from, it is closed as soon as this is done. """
+    with _lock:
+        entry = _hdf5_files.pop(fpath, None)
+        close = entry is not None and _remove_hdf5_file(entry)
+    if close:
+        entry[1].close()
+
+def _get_cached_tile(key, mtime):
+    """ Returns content type and data of a cached tile or None. The caller has
+    to hold the lock. """
+    entry = _tiles.get(key)
+    if entry is None:
+        return None
+    if entry[0] != mtime:
+        del _tiles[key]
+        _tiles_size[0] -= len(entry[2])
+        return None
+    # Mark as most recently used
+    del _tiles[key]
+    _tiles[key] = entry
+    return entry[1], entry[2]
+
+def _cache_tile(key, mtime, content_type, data):
+    """ Stores an encoded tile and evicts the least recently used ones if the
+    cache grows larger than allowed. The caller has to hold the lock. """
+    max_size = settings.TILE_CACHE_SIZE
+    if len(data) > max_size:
+        return
+    old = _tiles.pop(key, None)
+    if old is not None:
+        _tiles_size[0] -= len(old[2])
+    _tiles[key] = (mtime, content_type, data)
+    _tiles_size[0] += len(data)
+    while _tiles_size[0] > max_size:
+        _tiles_size[0] -= len(_tiles.popitem(last=False)[1][2])
+
+def _encode_tile(data, width, height, file_extension):
+    """ Encodes a two dimensional array of gray values as image of the
+    requested format. Returns content type and encoded data. """
+    pil_format, content_type = TILE_FORMATS[file_extension]
+    data = np.ascontiguousarray(data)
+    image = Image.frombuffer('L', (width, height), data, 'raw', 'L', 0, 1)
+    buf = cStringIO.StringIO()
+    image.save(buf, pil_format)
+    return content_type, buf.getvalue()
+
+def _blank_tile(width, height, file_extension):
+    """ Returns content type and data of an empty tile. They are created only
+    once for every size and format. """
+    key = (file_extension, width, height)
+    with _lock:
+        tile = _blank_tiles.get(key)
+    if tile is None:
+        tile = _encode_tile(np.zeros((height, width), dtype=np.uint8),
+                width, height, file_extension)
+        with _lock:
+            _blank_tiles[key] = tile
+            # Usually only few tile sizes are in use
+            while len(_blank_tiles) > 32:
+                _blank_tiles.popitem(last=False)
+    return tile
+
+def _read_tile(hfile, scale, x, y, z, width, height):
+    """ Reads a section of the image data of a scale level. Returns None if
+    the scale level or section don't exist. Sections at the border of the
+    image are filled up with zeros. """
+    hdfpath = '/' + str(int(scale)) + '/' + str(z) + '/data'
+    if hdfpath not in hfile:
+        return None
+    image_data = hfile[hdfpath]
+    data = image_data[y:y+height,x:x+width]
+    if data.shape != (height, width):
+        padded = np.zeros((height, width), dtype=data.dtype)
+        padded[:data.shape[0], :data.shape[1]] = data
+        data = padded
+    return data
+
 def get_tile(request, project_id=None, stack_id=None):
 
     scale = float(request.GET.get('scale', '0'))
@@ -23,39 +191,42 @@ def get_tile(request, project_id=None, stack_id=None):
     z = int(request.GET.get('z', '0'))
     col = request.GET.get('col', 'y')
     row = request.GET.get('row', 'x')
-    file_extension = request.GET.get('file_extension', 'png')
+    file_extension = request.GET.get('file_extension', 'png').lower()
     basename = request.GET.get('basename', 'raw')
 
+    if file_extension not in TILE_FORMATS:
+        raise ValueError('Unsupported tile format: %s' % file_extension)
+
     # need to know the stack name
     fpath=os.path.join( settings.HDF5_STORAGE_PATH, '{0}_{1}_{2}.hdf'.format( project_id, stack_id, basename ) )
 
-    if not os.path.exists( fpath ):
-        data=np.zeros( (height, width) )
-        pilImage = Image.frombuffer('RGBA',(width,height),data,'raw','L',0,1)
-        response = HttpResponse(content_type="image/png")
-        pilImage.save(response, "PNG")
-        return response
-        # return HttpResponse(json.dumps({'error': 'HDF5 file does not exists: {0}'.format(fpath)}))
-
-    with closing(h5py.File(fpath, 'r')) as hfile:
-        #import math
-        #zoomlevel = math.log(int(scale), 2)
-        hdfpath = '/' + str(int(scale)) + '/' + str(z) + '/data'
-        if not str(int(scale)) in hfile['/'].keys():
-            data=np.zeros( (height, width) )
-            pilImage = Image.frombuffer('RGBA',(width,height),data,'raw','L',0,1)
-            response = HttpResponse(content_type="image/png")
-            pilImage.save(response, "PNG")
-            return response            
-            # return HttpResponse(json.dumps({'error': 'HDF5 file does not contain scale: {0}'.format(str(int(scale)))}))
-        image_data=hfile[hdfpath]
-        data=image_data[y:y+height,x:x+width]
-        pilImage = Image.frombuffer('RGBA',(width,height),data,'raw','L',0,1)
-        response = HttpResponse(content_type="image/png")
-        pilImage.save(response, "PNG")
-        return response
-
-    return response
+    try:
+        mtime = os.stat(fpath).st_mtime
+    except OSError:
+        content_type, data = _blank_tile(width, height, file_extension)
+        return HttpResponse(data, content_type=content_type)
+
+    key = (int(project_id), int(stack_id), basename, scale, z, x, y, width,
+            height, file_extension)
+    with _lock:
+        tile = _get_cached_tile(key, mtime)
+
+    if tile is None:
+        entry = _open_hdf5_file(fpath, mtime)
+        try:
+            data = _read_tile(entry[1], scale, x, y, z, width, height)
+        finally:
+            _release_hdf5_file(entry)
+        if data is None:
+            tile = _blank_tile(width, height, file_extension)
+        else:
+            tile = _encode_tile(data, width, height, file_extension)
+            if settings.TILE_CACHE_SIZE > 0:
+                with _lock:
+                    _cache_tile(key, mtime, tile[0], tile[1])
+
+    content_type, data = tile
+    return HttpResponse(data, content_type=content_type)
 
 def put_tile(request, project_id=None, stack_id=None):
     """ Store labels to HDF5 """
@@ -74,6 +245,8 @@ def put_tile(request, project_id=None, stack_id=None):
     fpath=os.path.join( settings.HDF5_STORAGE_PATH, '{0}_{1}.hdf'.format( project_id, stack_id ) )
     #print >> sys.stderr, 'fpath', fpath
 
+    # A pooled read-only handle would prevent opening the file for writing
+    _close_hdf5_file(fpath)
     with closing(h5py.File(fpath, 'a')) as hfile:
         hdfpath = '/labels/scale/' + str(int(scale)) + '/data'
         #print >> sys.stderr, 'storage', x,y,z,height,width,hdfpath
@@ -1,11 +1,13 @@
 # A 'tree' is a networkx.DiGraph with a single root node (a node without parents)
 
+import numpy as np
+
 from operator import itemgetter
 from networkx import Graph, DiGraph
 from collections import defaultdict
-from math import sqrt
-from itertools import izip, islice
-from catmaid.models import Treenode
+from itertools import izip, groupby
+from catmaid.control.array_tree import ArrayTree
+from catmaid.control.common import stream_rows
 
 def find_root(tree):
     """ Search and return the first node that has zero predecessors.
@@ -124,23 +126,13 @@ def partition(tree, root_node=None):
     """ Partition the tree as a list of sequences of node IDs,
     with branch nodes repeated as ends of all sequences except the longest
     one that finishes at the root.
-    Each sequence runs from an end node to either the root or a branch node. """
-    distances = edge_count_to_root(tree, root_node=root_node) # distance in number of edges from root
-    seen = set()
-    # Iterate end nodes sorted from highest to lowest distance to root
-    endNodeIDs = (nID for nID in tree.nodes() if 0 == len(tree.successors(nID)))
-    for nodeID in sorted(endNodeIDs, key=distances.get, reverse=True):
-        sequence = [nodeID]
-        parentID = next(tree.predecessors_iter(nodeID), None)
-        while parentID is not None:
-            sequence.append(parentID)
-            if parentID in seen:
-                break
-            seen.add(parentID)
-            parentID = next(tree.predecessors_iter(parentID), None)
-
-        if len(sequence) > 1:
-            yield sequence
+    Each sequence runs from an end node to either the root or a branch node.
+    The root_node argument is not needed anymore, the root is the node without
+    a parent. """
+    arbor = ArrayTree.from_digraph(tree)
+    ids = arbor.ids.tolist()
+    for sequence in arbor.partition():
+        yield [ids[i] for i in sequence]
 
 
 def spanning_tree(tree, preserve):
@@ -186,40 +178,57 @@ def spanning_tree(tree, preserve):
 def cable_length(tree, locations):
     """ locations: a dictionary of nodeID vs iterable of node position (1d, 2d, 3d, ...)
     Returns the total cable length. """
-    return sum(sqrt(sum(pow(loc2 - loc1, 2) for loc1, loc2 in izip(locations[a], locations[b]))) for a,b in tree.edges_iter())
+    edges = tree.edges()
+    if not edges:
+        return 0
+    a = np.array([locations[e[0]] for e in edges], dtype=np.float64)
+    b = np.array([locations[e[1]] for e in edges], dtype=np.float64)
+    delta = (b - a).reshape(len(edges), -1)
+    return float(np.sqrt((delta * delta).sum(axis=1)).sum())
+
+
+def stream_array_trees(skeleton_ids, node_properties):
+    """ Return a lazy collection of pairs of (long, ArrayTree)
+    representing (skeleton_id, tree).
+    Treenodes are read ordered by skeleton through a server-side cursor, so
+    that only the nodes of a single skeleton are kept in memory at a time.
+    The node_properties is a list of strings, each being a name of a column
+    of the treenode table that is not the treenode id, parent_id or
+    skeleton_id. They are available as the tree's property arrays. If all of
+    location_x, location_y and location_z are requested, they are also used as
+    the tree's locations. """
+
+    columns = ('id', 'parent_id', 'skeleton_id')
+    props = []
+    for p in node_properties:
+        if p not in columns and p not in props:
+            props.append(p)
+
+    rows = stream_rows('''
+        SELECT %s
+        FROM treenode
+        WHERE skeleton_id = ANY(%%s)
+        ORDER BY skeleton_id
+        ''' % ', '.join(columns + tuple(props)), (list(skeleton_ids),))
+
+    for skid, skeleton_rows in groupby(rows, itemgetter(2)):
+        values = zip(*skeleton_rows)
+        parent_ids = [-1 if p is None else p for p in values[1]]
+        properties = dict(izip(props, (np.array(v) for v in values[3:])))
+        locations = None
+        if all(c in properties for c in ('location_x', 'location_y', 'location_z')):
+            locations = np.column_stack((properties['location_x'],
+                    properties['location_y'], properties['location_z']))
+        yield (skid, ArrayTree(values[0], parent_ids, locations, properties))
 
 
 def lazy_load_trees(skeleton_ids, node_properties):
     """ Return a lazy collection of pairs of (long, DiGraph)
-    representing (skeleton_id, tree).
+    representing (skeleton_id, tree), with edges from child to parent.
     The node_properties is a list of strings, each being a name of a column
     in the django model of the Treenode table that is not the treenode id, parent_id
-    or skeleton_id. """
-
-    values_list = ('id', 'parent_id', 'skeleton_id')
-    props = tuple(set(node_properties) - set(values_list))
-    values_list += props
-
-    ts = Treenode.objects.filter(skeleton__in=skeleton_ids) \
-            .order_by('skeleton') \
-            .values_list(*values_list)
-    skid = None
-    tree = None
-    for t in ts:
-        if t[2] != skid:
-            if tree:
-                yield (skid, tree)
-            # Prepare for the next one
-            skid = t[2]
-            tree = DiGraph()
-
-        fields = {k: v for k,v in izip(props, islice(t, 3, 3 + len(props)))}
-        tree.add_node(t[0], fields)
-
-        if t[1]:
-            # From child to parent
-            tree.add_edge(t[0], t[1])
-
-    if tree:
-        yield (skid, tree)
+    or skeleton_id. Trees are streamed like in stream_array_trees(), which
+    should be used instead if no networkx graph is needed. """
 
+    for skid, tree in stream_array_trees(skeleton_ids, node_properties):
+        yield (skid, tree.to_digraph())
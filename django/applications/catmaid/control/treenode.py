@@ -4,7 +4,7 @@ import math
 
 from collections import defaultdict
 
-from django.db import connection
+from django.db import connection, transaction
 from django.http import HttpResponse
 
 from catmaid.models import UserRole, Treenode, BrokenSlice, ClassInstance, \
@@ -14,6 +14,8 @@ from catmaid.control.authentication import requires_user_role, \
 from catmaid.control.common import get_relation_to_id_map, \
         get_class_to_id_map, insert_into_log, _create_relation
 from catmaid.control.neuron import _delete_if_empty
+from catmaid.control.spatial import invalidate_project
+from catmaid.control.arbor_cache import invalidate_skeletons
 
 
 def can_edit_treenode_or_fail(user, project_id, treenode_id):
@@ -83,6 +85,8 @@ def create_treenode(request, project_id=None):
         if parent_id:
             new_treenode.parent_id = parent_id
         new_treenode.save()
+        invalidate_project(project_id)
+        invalidate_skeletons([skeleton.id])
         return new_treenode
 
     def relate_neuron_to_skeleton(neuron, skeleton):
@@ -181,6 +185,175 @@ def create_treenode(request, project_id=None):
                                        str(traceback.format_exc())))
 
 
+@requires_user_role(UserRole.Annotate)
+def create_treenodes(request, project_id=None):
+    """ Add many new treenodes to the database in a single transaction.
+
+    The treenodes field is expected to be a JSON encoded list of nodes, each
+    being an object with a temporary id (unique within the request), x, y, z
+    and optionally radius (default -1) and confidence (default 5). A node can
+    have a parent_id, the ID of an existing treenode, or a parent, the
+    temporary id of another new node. Nodes without any of both are roots of
+    new skeletons, each of which models a new neuron. Permissions are checked
+    once for all neurons that new nodes are appended to.
+
+    Returned are the mapping of temporary ids to the IDs of the created
+    treenodes and the mapping of temporary ids to the skeleton IDs of the
+    nodes.
+    """
+    project_id = int(project_id)
+    nodes = json.loads(request.POST.get('treenodes', '[]'))
+    if not nodes:
+        raise ValueError("No treenodes to create given")
+
+    # Validate the parent references and find for each node the node of the
+    # request at the top of its branch.
+    by_tmp_id = {}
+    for node in nodes:
+        tmp_id = unicode(node['id'])
+        if tmp_id in by_tmp_id:
+            raise ValueError("Temporary treenode id %s is used twice" % tmp_id)
+        by_tmp_id[tmp_id] = node
+        if node.get('parent') is not None and node.get('parent_id') is not None:
+            raise ValueError("Treenode %s has both parent and parent_id" % tmp_id)
+
+    tops = {}
+    for tmp_id in by_tmp_id:
+        path, on_path = [], set()
+        current = tmp_id
+        while current not in tops:
+            path.append(current)
+            on_path.add(current)
+            parent = by_tmp_id[current].get('parent')
+            if parent is None:
+                tops[current] = current
+                break
+            parent = unicode(parent)
+            if parent not in by_tmp_id:
+                raise ValueError("Parent %s of treenode %s is not part of "
+                        "the request" % (parent, current))
+            if parent in on_path:
+                raise ValueError("Treenode %s is part of a cycle" % current)
+            current = parent
+        top = tops[current]
+        for n in path:
+            tops[n] = top
+
+    roots = set(t for t in tops.itervalues()
+            if by_tmp_id[t].get('parent_id') is None)
+    parent_ids = set(int(by_tmp_id[t]['parent_id'])
+            for t in tops.itervalues() if t not in roots)
+
+    relation_map = get_relation_to_id_map(project_id)
+    class_map = get_class_to_id_map(project_id)
+    cursor = connection.cursor()
+
+    # Get skeletons and neurons of all existing parents at once
+    parent_skeletons = {}
+    if parent_ids:
+        cursor.execute('''
+            SELECT t.id, t.skeleton_id, cici.class_instance_b
+            FROM treenode t, class_instance_class_instance cici
+            WHERE t.id = ANY(%s)
+              AND t.project_id = %s
+              AND cici.class_instance_a = t.skeleton_id
+              AND cici.relation_id = %s
+            ''', (list(parent_ids), project_id, relation_map['model_of']))
+        rows = cursor.fetchall()
+        parent_skeletons = dict((row[0], row[1]) for row in rows)
+        missing = parent_ids - set(parent_skeletons.iterkeys())
+        if missing:
+            raise ValueError("Could not find parent treenodes %s with a "
+                    "skeleton and neuron" % ', '.join(map(str, missing)))
+        # Raise an Exception if the user doesn't have permission to edit the
+        # neurons the skeletons of the parents are modeling.
+        for neuron_id in set(row[2] for row in rows):
+            can_edit_class_instance_or_fail(request.user, neuron_id, 'neuron')
+
+    with transaction.atomic():
+        # Reserve IDs for the new skeletons and neurons as well as the new
+        # treenodes, so that names and parents can be set right away.
+        cursor.execute('''
+            SELECT nextval('concept_id_seq') FROM generate_series(1, %s)
+            ''', (2 * len(roots) + len(nodes),))
+        ids = [row[0] for row in cursor.fetchall()]
+        new_neurons = {}
+        new_skeletons = {}
+        for root in roots:
+            new_skeletons[root] = ids.pop()
+            new_neurons[root] = ids.pop()
+        treenode_ids = dict((tmp_id, ids.pop()) for tmp_id in by_tmp_id)
+
+        if roots:
+            instances = []
+            for root in roots:
+                instances.append((new_skeletons[root], class_map['skeleton'],
+                        'skeleton %d' % new_skeletons[root]))
+                instances.append((new_neurons[root], class_map['neuron'],
+                        'neuron %d' % new_neurons[root]))
+            cursor.execute('''
+                INSERT INTO class_instance (id, user_id, project_id,
+                    class_id, name)
+                VALUES %s
+                ''' % ', '.join(['(%s, %s, %s, %s, %s)'] * len(instances)),
+                [v for i in instances for v in
+                    (i[0], request.user.id, project_id, i[1], i[2])])
+            cursor.execute('''
+                INSERT INTO class_instance_class_instance (user_id,
+                    project_id, relation_id, class_instance_a,
+                    class_instance_b)
+                VALUES %s
+                ''' % ', '.join(['(%s, %s, %s, %s, %s)'] * len(roots)),
+                [v for root in roots for v in (request.user.id, project_id,
+                    relation_map['model_of'], new_skeletons[root],
+                    new_neurons[root])])
+
+        skeleton_ids = {}
+        params = []
+        for tmp_id, node in by_tmp_id.iteritems():
+            top = tops[tmp_id]
+            if top in roots:
+                skeleton_ids[tmp_id] = new_skeletons[top]
+            else:
+                skeleton_ids[tmp_id] = parent_skeletons[int(by_tmp_id[top]['parent_id'])]
+            if node.get('parent') is not None:
+                parent_id = treenode_ids[unicode(node['parent'])]
+            elif node.get('parent_id') is not None:
+                parent_id = int(node['parent_id'])
+            else:
+                parent_id = None
+            params.extend((treenode_ids[tmp_id], request.user.id,
+                request.user.id, project_id, float(node['x']),
+                float(node['y']), float(node['z']),
+                float(node.get('radius', -1)), int(node.get('confidence', 5)),
+                skeleton_ids[tmp_id], parent_id))
+
+        cursor.execute('''
+            INSERT INTO treenode (id, user_id, editor_id, project_id,
+                location_x, location_y, location_z, radius, confidence,
+                skeleton_id, parent_id)
+            VALUES %s
+            RETURNING id
+            ''' % ', '.join(['(%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)'] *
+                len(by_tmp_id)), params)
+        if len(cursor.fetchall()) != len(by_tmp_id):
+            raise ValueError("Could not insert all treenodes")
+
+        for root in roots:
+            node = by_tmp_id[root]
+            insert_into_log(project_id, request.user.id, 'create_neuron',
+                    (node['x'], node['y'], node['z']), 'Create neuron %d and '
+                    'skeleton %d' % (new_neurons[root], new_skeletons[root]))
+
+    invalidate_project(project_id)
+    invalidate_skeletons(set(skeleton_ids.itervalues()))
+
+    return HttpResponse(json.dumps({
+        'treenode_ids': treenode_ids,
+        'skeleton_ids': skeleton_ids,
+    }))
+
+
 @requires_user_role(UserRole.Annotate)
 def create_interpolated_treenode(request, project_id=None):
     params = {}
@@ -263,6 +436,9 @@ def _create_interpolated_treenode(request, params, project_id, skip_last):
 
             parent_id = new_treenode.id
 
+        invalidate_project(project_id)
+        invalidate_skeletons([parent_skeleton_id])
+
         # parent_id contains the ID of the last added node
         return parent_id, parent_skeleton_id
 
@@ -284,6 +460,8 @@ def update_parent(request, project_id=None, treenode_id=None):
 
     child.parent_id = parent_id
     child.save()
+    invalidate_project(project_id)
+    invalidate_skeletons([child.skeleton_id])
 
     return HttpResponse(json.dumps({'success': True}))
 
@@ -301,6 +479,7 @@ def update_radius(request, project_id=None, treenode_id=None):
         # Update radius only for the treenode
         Treenode.objects.filter(pk=treenode_id).update(editor=request.user,
                                                        radius=radius)
+        invalidate_project(project_id)
         return HttpResponse(json.dumps({'success': True}))
 
     cursor.execute('''
@@ -324,6 +503,7 @@ def update_radius(request, project_id=None, treenode_id=None):
 
         Treenode.objects.filter(pk__in=include).update(editor=request.user,
                                                        radius=radius)
+        invalidate_project(project_id)
         return HttpResponse(json.dumps({'success': True}))
 
     if 2 == option:
@@ -342,6 +522,7 @@ def update_radius(request, project_id=None, treenode_id=None):
 
         Treenode.objects.filter(pk__in=include).update(editor=request.user,
                                                        radius=radius)
+        invalidate_project(project_id)
         return HttpResponse(json.dumps({'success': True}))
 
     if 3 == option:
@@ -359,6 +540,7 @@ def update_radius(request, project_id=None, treenode_id=None):
 
         Treenode.objects.filter(pk__in=include).update(editor=request.user,
                                                        radius=radius)
+        invalidate_project(project_id)
         return HttpResponse(json.dumps({'success': True}))
 
     if 4 == option:
@@ -373,6 +555,7 @@ def update_radius(request, project_id=None, treenode_id=None):
 
         Treenode.objects.filter(pk__in=include).update(editor=request.user,
                                                        radius=radius)
+        invalidate_project(project_id)
         return HttpResponse(json.dumps({'success': True}))
 
     if 5 == option:
@@ -382,6 +565,7 @@ def update_radius(request, project_id=None, treenode_id=None):
                 .filter(pk=treenode_id) \
                 .values('skeleton_id')) \
             .update(editor=request.user, radius=radius)
+        invalidate_project(project_id)
         return HttpResponse(json.dumps({'success': True}))
 
 
@@ -452,6 +636,8 @@ def delete_treenode(request, project_id=None):
         # Remove treenode
         response_on_error = 'Could not delete treenode.'
         Treenode.objects.filter(pk=treenode_id).delete()
+        invalidate_project(project_id)
+        invalidate_skeletons([treenode.skeleton_id])
         return HttpResponse(json.dumps({
             'deleted_neuron': deleted_neuron,
             'parent_id': parent_id,
@@ -3,15 +3,22 @@ import shutil
 import tarfile
 import json
 
+import numpy as np
+
+from collections import defaultdict
+from multiprocessing.pool import ThreadPool
+
 from django.conf import settings
 from django.http import HttpResponse
 from django.db.models import Count
 
 from catmaid.control.authentication import requires_user_role
 from catmaid.control.common import get_relation_to_id_map, id_generator
-from catmaid.control.cropping import CropJob, extract_substack, ImageRetrievalError
+from catmaid.control.cropping import CropJob, ImageRetrievalError, \
+        TiffWriter, get_tile_data, imagej_description, to_x_index, \
+        to_y_index, to_z_index
 from catmaid.models import ClassInstanceClassInstance, TreenodeConnector, \
-        Message, User, UserRole, Treenode
+        Message, User, UserRole, Treenode, ProjectStack
 
 from celery.task import task
 
@@ -69,6 +76,8 @@ class TreenodeExporter:
         # Cache for neuron and relation folder names
         self.skid_to_neuron_folder = {}
         self.relid_to_rel_folder = {}
+        # Neuron IDs of all exported skeletons, loaded when needed
+        self.skid_to_neuron_id = None
 
         # Get relation map
         self.relation_map = get_relation_to_id_map(job.project_id)
@@ -99,6 +108,20 @@ class TreenodeExporter:
         os.makedirs(output_path)
         self.output_path = output_path
 
+    def get_neuron_id(self, skeleton_id):
+        """ Returns the ID of the neuron modeled by a skeleton. The neurons of
+        all skeletons of the job are queried at once when this is called the
+        first time.
+        """
+        if self.skid_to_neuron_id is None:
+            self.skid_to_neuron_id = dict(
+                    ClassInstanceClassInstance.objects.filter(
+                        relation_id=self.relation_map['model_of'],
+                        project_id=self.job.project_id,
+                        class_instance_a__in=self.job.skeleton_ids) \
+                    .values_list('class_instance_a', 'class_instance_b'))
+        return self.skid_to_neuron_id[skeleton_id]
+
     def create_path(self, treenode):
         """ Based on the output path, this function will create a folder
         structure for a particular skeleton. Things that are supposedly
@@ -110,23 +133,19 @@ class TreenodeExporter:
         if treenode_path:
             return treenode_path
         else:
-            neuron_cici = ClassInstanceClassInstance.objects.get(
-                    relation_id=self.relation_map['model_of'],
-                    project_id=self.job.project_id,
-                    class_instance_a=treenode.skeleton.id)
             treenode_path = os.path.join(self.output_path,
-                    str(neuron_cici.class_instance_b_id))
-            self.skid_to_neuron_folder[treenode.skeleton.id] = treenode_path
+                    str(self.get_neuron_id(treenode.skeleton_id)))
+            self.skid_to_neuron_folder[treenode.skeleton_id] = treenode_path
 
             # Create path output_path/neuron_id
             try:
                 os.makedirs(treenode_path)
-                return treenode_path
             except OSError as e:
                 # Everything is fine if the path exists and is writable
                 if not os.path.exists(treenode_path) or not \
                         os.access(treenode_path, os.W_OK):
                     raise e
+            return treenode_path
 
     def get_entities_to_export(self):
         """ Returns a list of treenode links. If the job asks only for a
@@ -145,32 +164,86 @@ class TreenodeExporter:
             return Treenode.objects.filter(project_id=self.job.project_id,
                     skeleton_id__in=self.job.skeleton_ids)
 
-    def export_single_node(self, treenode):
-        """ Exports a treenode and expects the output path to be existing
-        and writable.
+    def get_location(self, treenode):
+        """ Returns the location of an exported entity. """
+        return treenode.location_x, treenode.location_y, treenode.location_z
+
+    def get_image_paths(self, treenode, n_sections, z_min, resolution_z):
+        """ Returns a list of (section offset, file path) tuples for the images
+        to create for an entity that spans n_sections sections, starting at
+        z_min. The output path is expected to be existing and writable.
         """
-        # Calculate bounding box for current connector
-        x_min = treenode.location_x - self.job.x_radius
-        x_max = treenode.location_x + self.job.x_radius
-        y_min = treenode.location_y - self.job.y_radius
-        y_max = treenode.location_y + self.job.y_radius
-        z_min = treenode.location_z - self.job.z_radius
-        z_max = treenode.location_z + self.job.z_radius
-        rotation_cw = 0
-        zoom_level = 0
-
-        # Create a single file for each section (instead of a mulipage TIFF)
-        crop_self = CropJob(self.job.user, self.job.project_id,
-                self.job.stack_id, x_min, x_max, y_min, y_max, z_min, z_max,
-                rotation_cw, zoom_level, single_channel=True)
-        cropped_stack = extract_substack(crop_self)
-        # Save each file in output path
+        # Images are named <treenode-id>.tiff. If more than one section is
+        # exported, each of them would replace the previous one, which is why
+        # only the last one is created.
         output_path = self.create_path(treenode)
-        for i, img in enumerate(cropped_stack):
-            # Save image in output path, named <treenode-id>.tiff
-            image_name = "%s.tiff" % treenode.id
-            treenode_image_path = os.path.join(output_path, image_name)
-            img.write(treenode_image_path)
+        image_name = "%s.tiff" % treenode.id
+        return [(n_sections - 1, os.path.join(output_path, image_name))]
+
+    def export_nodes(self, nodes):
+        """ Exports images of the region around each of the passed in nodes.
+        Nodes are grouped by section, so that every tile is fetched only once
+        per section, even if the regions of many nodes overlap it. Tiles are
+        fetched and images are written in parallel by a pool of
+        CROPPING_FETCH_THREADS threads. Returns a dictionary that maps nodes
+        whose images couldn't be created to an (error, URL) tuple.
+        """
+        # A cropping job is used to access the stack, the coordinate
+        # conversions and the tile source.
+        crop_job = CropJob(self.job.user, self.job.project_id,
+                self.job.stack_id, 0, 0, 0, 0, 0, 0, 0, 0,
+                single_channel=True)
+        crop_job.initialize()
+        stack = crop_job.ref_stack
+        translation = ProjectStack.objects.get(project_id=self.job.project_id,
+                stack_id=stack.id).translation
+
+        # Collect the images to create for each section: (node, path, x, y,
+        # width, height), in pixel coordinates of zoom level zero.
+        sections = defaultdict(list)
+        for node in nodes:
+            x, y, z = self.get_location(node)
+            x = x - translation.x
+            y = y - translation.y
+            z = z - translation.z
+            px_x_min = to_x_index(x - self.job.x_radius, crop_job, False)
+            px_x_max = to_x_index(x + self.job.x_radius, crop_job, False)
+            px_y_min = to_y_index(y - self.job.y_radius, crop_job, False)
+            px_y_max = to_y_index(y + self.job.y_radius, crop_job, False)
+            px_z_min = to_z_index(z - self.job.z_radius, crop_job)
+            px_z_max = to_z_index(z + self.job.z_radius, crop_job)
+            n_sections = px_z_max + 1 - px_z_min
+            z_min = z - self.job.z_radius + translation.z
+            for i, path in self.get_image_paths(node, n_sections, z_min,
+                    stack.resolution.z):
+                sections[px_z_min + i].append((node, path, px_x_min, px_y_min,
+                        px_x_max - px_x_min, px_y_max - px_y_min))
+
+        errors = {}
+        pool = ThreadPool(max(1, settings.CROPPING_FETCH_THREADS))
+        try:
+            for z in sorted(sections.keys()):
+                images = sections[z]
+                # Find all tiles of this section that are needed
+                tile_coords = set()
+                for node, path, x, y, width, height in images:
+                    x_range, y_range = _tile_range(stack, x, y, width, height)
+                    tile_coords.update((tx, ty) for tx in x_range for ty in y_range)
+                tile_coords = list(tile_coords)
+                urls = [crop_job.get_tile_path(stack, (tx, ty, z)) for \
+                        tx, ty in tile_coords]
+                tiles = dict(zip(tile_coords, pool.map(_fetch_tile, urls)))
+
+                # Cut the images out of the tiles and write them
+                results = pool.map(_write_image, [(stack, tiles) + image[1:] \
+                        for image in images])
+                for image, error in zip(images, results):
+                    if error:
+                        errors[image[0]] = (error.error, error.path)
+        finally:
+            pool.terminate()
+
+        return errors
 
     def post_process(self, nodes):
         """ Create a meta data file for all the nodes passed (usually all of the
@@ -200,11 +273,11 @@ class TreenodeExporter:
         # parent-id, nr. presynaptic sites, nr. postsynaptic sites, x, y, z
         skid_to_metadata = {}
         for n in nodes:
-            ls = skid_to_metadata.get(n.skeleton.id)
+            ls = skid_to_metadata.get(n.skeleton_id)
             if not ls:
                 ls = []
-                skid_to_metadata[n.skeleton.id] = ls
-            p = n.parent.id if n.parent else 'null'
+                skid_to_metadata[n.skeleton_id] = ls
+            p = n.parent_id if n.parent_id else 'null'
             n_pre = presynaptic_map.get(n.id, 0)
             n_post = postsynaptic_map.get(n.id, 0)
             x = n.location_x
@@ -241,13 +314,9 @@ class ConnectorExporter(TreenodeExporter):
         """
         # Get (and create if needed) cache entry for string of neuron id
         if connector_link.skeleton_id not in self.skid_to_neuron_folder:
-            neuron_cici = ClassInstanceClassInstance.objects.get(
-                    relation_id=self.relation_map['model_of'],
-                    project_id=self.job.project_id,
-                    class_instance_a=connector_link.skeleton.id)
-            self.skid_to_neuron_folder[connector_link.skeleton.id] = \
-                    str(neuron_cici.class_instance_b_id)
-        neuron_folder = self.skid_to_neuron_folder[connector_link.skeleton.id]
+            self.skid_to_neuron_folder[connector_link.skeleton_id] = \
+                    str(self.get_neuron_id(connector_link.skeleton_id))
+        neuron_folder = self.skid_to_neuron_folder[connector_link.skeleton_id]
 
         # get (and create if needed) cache entry for string of relation name
         if connector_link.relation_id not in self.relid_to_rel_folder:
@@ -262,7 +331,7 @@ class ConnectorExporter(TreenodeExporter):
 
         # Create path output_path/neuron_id/relation_name/connector_id
         connector_path = os.path.join(self.output_path, neuron_folder,
-                relation_folder, str(connector_link.connector.id))
+                relation_folder, str(connector_link.connector_id))
         try:
             os.makedirs(connector_path)
         except OSError as e:
@@ -309,42 +378,85 @@ class ConnectorExporter(TreenodeExporter):
 
         return connector_links
 
-    def export_single_node(self, connector_link):
-        """ Exports a single connector and expects the output path to be existing
-        and writable.
-        """
+    def get_location(self, connector_link):
+        """ Returns the location of an exported entity. """
         connector = connector_link.connector
+        return connector.location_x, connector.location_y, connector.location_z
 
-        # Calculate bounding box for current connector
-        x_min = connector.location_x - self.job.x_radius
-        x_max = connector.location_x + self.job.x_radius
-        y_min = connector.location_y - self.job.y_radius
-        y_max = connector.location_y + self.job.y_radius
-        z_min = connector.location_z - self.job.z_radius
-        z_max = connector.location_z + self.job.z_radius
-        rotation_cw = 0
-        zoom_level = 0
-
-        # Create a single file for each section (instead of a mulipage TIFF)
-        crop_self = CropJob(self.job.user, self.job.project_id,
-                self.job.stack_id, x_min, x_max, y_min, y_max, z_min, z_max,
-                rotation_cw, zoom_level, single_channel=True)
-        cropped_stack = extract_substack(crop_self)
-        # Save each file in output path
+    def get_image_paths(self, connector_link, n_sections, z_min, resolution_z):
+        """ Returns a list of (section offset, file path) tuples for the images
+        to create for an entity that spans n_sections sections, starting at
+        z_min. The output path is expected to be existing and writable.
+        """
+        connector = connector_link.connector
         connector_path = self.create_path(connector_link)
-        for i, img in enumerate(cropped_stack):
-            # Save image in output path, named after the image center's coordinates,
-            # rounded to full integers.
-            x = int(connector.location_x + 0.5)
-            y = int(connector.location_y + 0.5)
-            z = int(z_min + i * crop_self.stacks[0].resolution_z  + 0.5)
+        # Images are named after the image center's coordinates, rounded to
+        # full integers.
+        x = int(connector.location_x + 0.5)
+        y = int(connector.location_y + 0.5)
+        paths = []
+        for i in range(n_sections):
+            z = int(z_min + i * resolution_z + 0.5)
             image_name = "%s_%s_%s.tiff" % (x, y, z)
-            connector_image_path = os.path.join(connector_path, image_name)
-            img.write(connector_image_path)
+            paths.append((i, os.path.join(connector_path, image_name)))
+        return paths
 
     def post_process(self, nodes):
         pass
 
+def _tile_range(stack, x, y, width, height):
+    """ Returns the ranges of tile indices in x and y that cover the part of
+    the given region that is within the bounds of a stack. """
+    x_start = max(x, 0)
+    y_start = max(y, 0)
+    x_end = min(x + width, stack.dimension.x)
+    y_end = min(y + height, stack.dimension.y)
+    if x_end <= x_start or y_end <= y_start:
+        return [], []
+    return (range(x_start / stack.tile_width, (x_end - 1) / stack.tile_width + 1),
+            range(y_start / stack.tile_height, (y_end - 1) / stack.tile_height + 1))
+
+def _fetch_tile(url):
+    """ Returns the pixels of the red channel of a tile or the error that
+    prevented fetching it. This is run by the threads of the export pool. """
+    try:
+        return get_tile_data(url, single_channel=True)
+    except ImageRetrievalError as e:
+        return e
+
+def _write_image(args):
+    """ Creates an image of a region of a section from the tiles that cover
+    it and writes it as TIFF file. Parts outside of the stack remain black.
+    Returns the ImageRetrievalError of a missing tile, if any. This is run by
+    the threads of the export pool. """
+    stack, tiles, path, x, y, width, height = args
+    image = np.zeros((height, width), dtype=np.uint8)
+    x_range, y_range = _tile_range(stack, x, y, width, height)
+    for tx in x_range:
+        for ty in y_range:
+            tile = tiles[(tx, ty)]
+            if isinstance(tile, ImageRetrievalError):
+                return tile
+            # Intersection of the tile and the region in stack coordinates
+            tile_x = tx * stack.tile_width
+            tile_y = ty * stack.tile_height
+            x_start = max(x, tile_x)
+            y_start = max(y, tile_y)
+            x_end = min(x + width, tile_x + tile.shape[1])
+            y_end = min(y + height, tile_y + tile.shape[0])
+            if x_end <= x_start or y_end <= y_start:
+                continue
+            image[y_start - y:y_end - y, x_start - x:x_end - x] = \
+                    tile[y_start - tile_y:y_end - tile_y,
+                         x_start - tile_x:x_end - tile_x]
+
+    with open(path, 'wb') as f:
+        writer = TiffWriter(f, 1.0 / stack.resolution.x,
+                1.0 / stack.resolution.y, "Created with CATMAID")
+        writer.write_page(image)
+        writer.set_description(imagej_description(None, 1))
+    return None
+
 @task()
 def process_export_job(exporter):
     """ This method does the actual archive creation. It controls the data
@@ -363,15 +475,10 @@ def process_export_job(exporter):
     # Create a working directoy to create subfolders and images in
     exporter.create_basic_output_path()
 
-    # Store error codes and URLs for unreachable images for each failed link
-    error_urls = {}
     try:
-        # Export every node
-        for node in nodes:
-            try:
-                exporter.export_single_node(node)
-            except ImageRetrievalError as e:
-                error_urls[node] = (e.error, e.path)
+        # Export all nodes. Error codes and URLs for unreachable images are
+        # stored for each failed node.
+        error_urls = exporter.export_nodes(nodes)
         # Create error log, if needed
         if error_urls:
             error_path = os.path.join(exporter.output_path, "error_log.txt")
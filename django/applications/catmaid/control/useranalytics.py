@@ -2,9 +2,10 @@ import numpy as np
 
 from datetime import timedelta, datetime
 
+from django.db import connection
 from django.http import HttpResponse
 
-from catmaid.models import Connector, Treenode, Review
+from catmaid.control.stats import get_user_activity
 from catmaid.control.user_evaluation import _parse_date
 
 
@@ -18,36 +19,6 @@ from matplotlib.dates import  DateFormatter, DayLocator
 from pylab import figure
 from matplotlib.backends.backend_agg import FigureCanvasAgg
 
-class Bout(object):
-    """ Represents one bout, based on a list of events. The first event ist the
-    start date/time, the last event the end.
-    """
-    def __init__(self, start, end=None):
-        self.events = [start]
-        if end:
-            self.events.append(end)
-
-    def addEvent(self, e):
-        """ Increments the event counter.
-        """
-        self.events.append(e)
-
-    @property
-    def nrEvents(self):
-        return len(self.events)
-
-    @property
-    def start(self):
-        return self.events[0]
-
-    @property
-    def end(self):
-        return self.events[-1]
-
-    def __str__(self):
-        return "Bout with %s events [%s, %s]" % \
-                (self.nrEvents, self.start, self.end)
-
 def plot_useranalytics(request):
     """ Creates a PNG image containing different plots for analzing the
     performance of individual users over time.
@@ -61,7 +32,7 @@ def plot_useranalytics(request):
     if request.user.is_superuser:
         end = _parse_date(end_date) if end_date else datetime.now()
         start = _parse_date(start_date) if start_date else end - timedelta(end.isoweekday() + 7)
-        f = generateReport( userid, 10, start, end )
+        f = generateReport( int(userid), 10, start, end )
     else:
         f = figure(1, figsize=(6,6))
 
@@ -70,29 +41,78 @@ def plot_useranalytics(request):
     canvas.print_png(response)
     return response
 
-def eventTimes(user_id, start_date, end_date):
-    """ Returns a tuple containing a list of tree node edition times, connector
-    edition times and tree node review times within the date range specified
-    where the editor/reviewer is the given user.
+def dayStart(date):
+    """ Returns the beginning of the day of the given date/time. All event
+    times of a report are in seconds since the start of its first day.
+    """
+    return date.replace(hour=0, minute=0, second=0, microsecond=0)
+
+def eventTimes(user_ids, start_date, end_date):
+    """ Returns a dictionary that maps each of the given users to a tuple
+    containing an array of tree node edition times, connector edition times
+    and tree node review times within the date range specified where the
+    editor/reviewer is the user. Times are sorted and in seconds since the
+    start of the day of <start_date>.
+    """
+    params = {
+        'origin': dayStart(start_date),
+        'start_date': start_date,
+        'end_date': end_date,
+        'user_ids': list(user_ids),
+    }
+    times = dict((u, []) for u in user_ids)
+    cursor = connection.cursor()
+    for table, user_column, time_column in (
+            ('treenode', 'editor_id', 'edition_time'),
+            ('connector', 'editor_id', 'edition_time'),
+            ('review', 'reviewer_id', 'review_time')):
+        cursor.execute('''
+            SELECT %(user)s, EXTRACT(EPOCH FROM %(time)s - %%(origin)s)
+            FROM %(table)s
+            WHERE %(user)s = ANY(%%(user_ids)s)
+              AND %(time)s BETWEEN %%(start_date)s AND %%(end_date)s
+            ORDER BY %(user)s, %(time)s
+            ''' % {'table': table, 'user': user_column, 'time': time_column},
+            params)
+        rows = np.array(cursor.fetchall(), dtype=np.float64).reshape(-1, 2)
+        # Rows are ordered by user, so that every user's events are a slice
+        for u in user_ids:
+            first = rows[:,0].searchsorted(u, 'left')
+            last = rows[:,0].searchsorted(u, 'right')
+            times[u].append(rows[first:last,1])
+
+    return dict((u, tuple(t)) for u, t in times.iteritems())
+
+def eventsPerDay(user_ids, start_date, end_date):
+    """ Creates histograms of how many nodes the given users annotated
+    (created or edited tree nodes and connectors) and reviewed on each day
+    between <start_date> and <end_date>, based on the user activity rollup of
+    all projects. Returned is a dictionary that maps every user to a tuple of
+    the annotation and the review histogram.
     """
-    dr = (start_date, end_date)
-    tns = Treenode.objects.filter(
-        editor_id = user_id,
-        edition_time__range=dr).values_list('edition_time', flat=True)
-    cns = Connector.objects.filter(
-        editor_id = user_id,
-        edition_time__range=dr).values_list('edition_time', flat=True)
-    rns = Review.objects.filter(
-        reviewer_id = user_id,
-        review_time__range=dr).values_list('review_time', flat=True)
-
-    return list(tns), list(cns), list(rns)
+    daycount = (end_date - start_date).days
+    origin = dayStart(start_date)
+    events = dict((u, (np.zeros(daycount), np.zeros(daycount)))
+            for u in user_ids)
+    for a in get_user_activity(None, start_date, end_date, interval='day',
+            user_ids=events.keys()):
+        i = (a['date'] - origin).days
+        if i < 0 or i >= daycount:
+            continue
+        annotations, reviews = events[a['user_id']]
+        annotations[i] += a['n_treenodes_created'] + \
+                a['n_treenodes_edited'] + a['n_connectors_created'] + \
+                a['n_connectors_edited']
+        reviews[i] += a['n_reviews']
+
+    return events
 
 def eventsPerInterval(times, start_date, end_date, interval='day'):
     """ Creates a histogram of how many events fall into all intervals between
-    <start_data> and <end_date>. The interval type can be day, hour and
-    halfhour. Returned is a tuple containing two elemens: the histogram and a
-    time axis, labeling every bin.
+    <start_data> and <end_date>. The event times are expected in seconds since
+    the start of the day of <start_date>. The interval type can be day, hour
+    and halfhour. Returned is a tuple containing two elemens: the histogram
+    and a time axis, labeling every bin.
     """
     if interval=='day':
         intervalsPerDay = 1
@@ -107,97 +127,68 @@ def eventsPerInterval(times, start_date, end_date, interval='day'):
         raise ValueError('Interval options are day, hour, or halfhour')
 
     # Generate axis
-    daycount = (end_date - start_date).days
+    nbins = intervalsPerDay * (end_date - start_date).days
+    origin = dayStart(start_date)
     dt = timedelta(0, secondsPerInterval)
-    timeaxis = [start_date + n*dt for n in xrange(intervalsPerDay * daycount)]
+    timeaxis = [origin + n*dt for n in xrange(nbins)]
     # Calculate bins
-    timebins = np.zeros(intervalsPerDay * daycount)
-    intervalsPerSecond = 1.0 / secondsPerInterval
-    for t in times:
-        i = int((t - start_date).total_seconds() * intervalsPerSecond)
-        timebins[i] += 1
-    
+    bins = (np.asarray(times) // secondsPerInterval).astype(np.int)
+    bins = bins[(bins >= 0) & (bins < nbins)]
+    if 0 == len(bins):
+        return np.zeros(nbins), timeaxis
+    timebins = np.bincount(bins, minlength=nbins)
+
     return timebins, timeaxis
 
 def activeTimes( alltimes, gapThresh ):
     """ Goes through the sorted array of time differences between all events
-    stored in <alltimes>. If two events are closer together than <gapThresh>
-    minutes, they are counted as events within one bout. A tuple containing a
-    list of bout start dates as well as a list with total numbers of events for
-    each bout is returned.
+    (in seconds) stored in <alltimes>. If two events are closer together than
+    <gapThresh> minutes, they are counted as events within one bout. A tuple
+    of three arrays is returned: the start time, the end time and the number
+    of events of every bout.
     """
     # Sort all events and create a list of (time) differences between them
-    alltimes.sort()
-    dts = np.diff(alltimes)
-    # Threshold between to events to be counted as separate bouts (seconds)
-    threshold = 60 * gapThresh
-    # Indicates whether we are currently in a bout and since we haven't even
-    # looked at the first event, we are initially not.
-    bout = None
-    # Go through all events
-    for i, e in enumerate(alltimes):
-        if i > 0 and dts[i-1].total_seconds() < threshold:
-            # Increment current bout's event counter and continue with the
-            # next element as long as the time difference to the next
-            # element is below our threshold.
-            bout.addEvent(e)
-            continue
-        else:
-            # Return current bout (not available in first iteration) and create
-            # a new one.
-            if bout:
-                yield bout
-            bout = Bout(e)
-
-    # Return last bout, if it hasn't been returned, yet
-    if bout:
-        yield bout
-    
-def activeTimesPerDay(active_bouts):
+    alltimes = np.sort(np.asarray(alltimes, dtype=np.float64))
+    if 0 == len(alltimes):
+        return alltimes, alltimes, np.zeros(0, dtype=np.int)
+    # A new bout starts after every gap of at least the threshold (seconds)
+    newBout = np.diff(alltimes) >= 60 * gapThresh
+    firsts = np.concatenate(([0], np.flatnonzero(newBout) + 1))
+    lasts = np.concatenate((firsts[1:] - 1, [len(alltimes) - 1]))
+
+    return alltimes[firsts], alltimes[lasts], lasts - firsts + 1
+
+def activeTimesPerDay(active_bouts, start_date, end_date):
     """ Creates a tuple containing the active time in hours for every day
-    between the first event of the first bout and the last event of the last
-    bout as well as a list with the date for every day.
+    between <start_date> and <end_date> as well as a list with the date for
+    every day. The active time of a bout is counted for the day it starts.
     """
-    # Return right away if there are no bouts
-    if not active_bouts:
-      return [], []
-
-    # Find first event of first bout
-    daystart = active_bouts[0].start.replace(
-            hour=0, minute=0, second=0, microsecond=0)
-    # Find last event of last bout
-    dayend = active_bouts[-1].end
-    # Get total number of between first event and last event
-    numdays = (dayend - daystart).days + 1
-    # Create a list of dates for every day between first and last event
-    timeaxis = [daystart.date() + timedelta(d) for d in range(numdays)]
-
-    # Calculate the netto active time for each day
-    net_active_time = np.array(np.zeros(numdays))
-    for bout in active_bouts:
-        active_time = (bout.end - bout.start).total_seconds()
-        net_active_time[(bout.start - daystart).days] += active_time
+    daycount = (end_date - start_date).days
+    origin = dayStart(start_date)
+    timeaxis = [origin.date() + timedelta(d) for d in range(daycount)]
+
+    starts, ends, _ = active_bouts
+    days = (starts // 86400).astype(np.int)
+    valid = (days >= 0) & (days < daycount)
+    if not valid.any():
+        return np.zeros(daycount), timeaxis
+    net_active_time = np.bincount(days[valid],
+            weights=(ends - starts)[valid], minlength=daycount)
 
     # Return a tuple containing the active time for every
     # day in hours and the list of days.
     return np.divide(net_active_time, 3600), timeaxis
 
-def singleDayEvents( alltimes, start_hour, end_hour ):
-    alltimes.sort()
-    timeaxis = [n for n in np.add(start_hour,range(end_hour-start_hour+1))]
-    activity = np.zeros(end_hour-start_hour+1)
-    for a in alltimes:
-        if a.hour >= start_hour:
-            if a.hour < end_hour:
-                activity[a.hour-start_hour] += 1
-    return np.true_divide(activity,(alltimes[-1] - alltimes[0]).days), timeaxis
-    
-def singleDayActiveness( activebouts, increment, start_hour, end_hour ):
-    """ Returns a ... for all bouts between <start_hour> and <end_hour> of the
-    day.
+def singleDayActiveness( activebouts, increment, start_hour, end_hour,
+        start_date ):
+    """ Returns for every <increment> minutes between <start_hour> and
+    <end_hour> of the day the average fraction of this period that was
+    active on weekdays, along with a list of timepoints labeling them. Bout
+    times are expected in seconds since the start of the day of <start_date>.
     """
+    starts, ends, _ = activebouts
     # Return right away, when there are no bouts given
-    if not activebouts:
+    if 0 == len(starts):
         return [], []
     # Make sure 60 can be cleanly devided by <incement>
     if np.mod(60, increment) > 0:
@@ -205,75 +196,45 @@ def singleDayActiveness( activebouts, increment, start_hour, end_hour ):
 
     # Some constants
     stepsPerHour = 60 / increment
-    hoursConsidered = (end_hour - start_hour) + 1
-    daysConsidered = (activebouts[-1].end - activebouts[0].start).days + 1
+    stepsPerDay = 24 * stepsPerHour
+    secondsPerStep = 60 * increment
+    firstDay = int(starts[0] // 86400)
+    daysConsidered = int(ends[-1] // 86400) - firstDay + 1
 
-    # Get start of current day
-    starttime = datetime.now()
-    # FIXME: replace doesn't replace in place, but returns a new object
-    starttime.replace(hour=start_hour,minute=0,second=0,microsecond=0)
     # Create time axis list with entry for every <increment> minutes between
     # <start_hour> and <end_hour>.
-    timeaxis = [starttime + timedelta(0, 0, 0, 0, n * increment) \
-            for n in range(stepsPerHour * hoursConsidered)]
-
-    # Loop through all days considered to find number of weekend days
-    weekendCorrection = 0
-    for d in range(daysConsidered):
-        # TODO: Why is 0 and 6 used for comparison?
-        saturday = (activebouts[0].start + timedelta(d)).isoweekday() == 0
-        sunday = (activebouts[0].start + timedelta(d)).isoweekday() == 6
-        if saturday or sunday:
-            weekendCorrection += 1
-
-    # Initialize list for minutes per period with zeros
-    durPerPeriod = np.zeros(stepsPerHour * hoursConsidered)
-    for bout in activebouts:
-        # Ignore bouts what start after requested <end_hour> or end before
-        # requested <start_hour>.
-        if bout.start.hour > end_hour:
-            continue
-        elif bout.end.hour < start_hour:
-            continue
-        # Crop start and end times of every valid bout to request period
-        elif bout.start.hour < start_hour:
-            # FIXME: replace doesn't replace in place, but returns a new object
-            bout.start.replace(hour=start_hour,minute=0,second=0,microsecond=0)
-        elif bout.end.hour > end_hour:
-            # FIXME: replace doesn't replace in place, but returns a new object
-            bout.end.replace(hour=end_hour,minute=0,second=0,microsecond=0)
-
-        # Go through every sub bout, defined by periods if <increment> minutes,
-        # and store the number of minutes for every time-fraction considered.
-        for subbout in splitBout(bout,increment):
-            subboutSeconds = (subbout.end - subbout.start).total_seconds()
-            i = stepsPerHour * (subbout.start.hour - start_hour) + \
-                    subbout.start.minute / increment
-            durPerPeriod[i] += np.true_divide(subboutSeconds, 60)
-
-    # Divide each period (in seconds) by ?
-    n = increment * (daysConsidered - weekendCorrection)
-    durations = np.true_divide(durPerPeriod, n)
+    origin = dayStart(start_date) + timedelta(firstDay)
+    timeaxis = [origin + timedelta(0, 0, 0, 0, n * increment, start_hour) \
+            for n in range(stepsPerHour * (end_hour - start_hour + 1))]
+
+    # Bouts don't overlap, so the total active time until any point in time
+    # is the duration of all earlier bouts plus the part of the current one.
+    # Evaluating this at the borders of every period gives the active time
+    # within each period.
+    boundaries = secondsPerStep * (firstDay * stepsPerDay +
+            np.arange(daysConsidered * stepsPerDay + 1))
+    durations = ends - starts
+    activeBefore = np.concatenate(([0], np.cumsum(durations)))
+    current = np.searchsorted(starts, boundaries, 'right') - 1
+    started = current >= 0
+    current = np.maximum(current, 0)
+    activeUntil = np.where(started, activeBefore[current] +
+            np.clip(boundaries - starts[current], 0, durations[current]), 0)
+    secondsPerPeriod = np.diff(activeUntil).reshape(daysConsidered, stepsPerDay)
+
+    # Only consider weekdays and the requested hours of the day
+    weekdays = np.array([(origin + timedelta(d)).isoweekday() < 6
+            for d in range(daysConsidered)], dtype=bool)
+    if not weekdays.any():
+        return np.zeros(len(timeaxis)), timeaxis
+    secondsPerPeriod = secondsPerPeriod[weekdays,
+            start_hour * stepsPerHour:(end_hour + 1) * stepsPerHour]
+
+    # Divide the active time of each period by its total length on all days
+    n = secondsPerStep * weekdays.sum()
+    durations = np.true_divide(secondsPerPeriod.sum(axis=0), n)
     # Return a tuple containing a list durations and a list of timepoints
     return durations, timeaxis
-                    
-def splitBout(bout,increment):
-    """ Splits one bout in periods of <increment> minutes.
-    """
-    if np.mod(60, increment) > 0:
-        raise RuntimeError('Increments must divide 60 evenly')
-    
-    boutListOut = []
-    currtime = bout.start
-    nexttime = bout.start
-    while nexttime < bout.end:
-        basemin = increment * ( currtime.minute / increment )
-        nexttime = currtime.replace(minute=0,second=0,microsecond=0) + timedelta(0,0,0,0,basemin+increment)
-        if nexttime > bout.end:
-            nexttime = bout.end
-        boutListOut.append(Bout(currtime, nexttime))
-        currtime = nexttime    
-    return boutListOut
 
 def generateErrorImage(msg):
     """ Creates an empty image (based on image nr. 1) and adds a message to it.
@@ -283,22 +244,59 @@ def generateErrorImage(msg):
     fig.suptitle(msg)
     return fig
 
+def computeReports( user_ids, activeTimeThresh, start_date, end_date ):
+    """ Computes the data shown in the report of every given user, which can
+    be plotted with plotReport(). Returned is a dictionary that maps every
+    user to a dictionary with the daily annotation and review events, the
+    bouts of activity and the net active time per day. Users that didn't edit
+    any tree nodes during the given period are mapped to None.
+    """
+    times = eventTimes( user_ids, start_date, end_date )
+    events = eventsPerDay( user_ids, start_date, end_date )
+
+    reports = {}
+    for user_id in user_ids:
+        # nts: node times, cts: connector times, rts: review times
+        nts, cts, rts = times[user_id]
+        if len(nts) == 0:
+            reports[user_id] = None
+            continue
+
+        annotationEvents, reviewEvents = events[user_id]
+        activeBouts = activeTimes( np.concatenate((nts, cts, rts)),
+                activeTimeThresh )
+        netActiveTime, timeaxis = activeTimesPerDay( activeBouts,
+                start_date, end_date )
+        reports[user_id] = {
+            'annotationEvents': annotationEvents,
+            'reviewEvents': reviewEvents,
+            'activeBouts': activeBouts,
+            'netActiveTime': netActiveTime,
+            'timeaxis': timeaxis,
+        }
+
+    return reports
+
 def generateReport( user_id, activeTimeThresh, start_date, end_date ):
-    """ nts: node times
-        cts: connector times
-        rts: review times """
-    nts, cts, rts = eventTimes( user_id, start_date, end_date )
+    """ Creates the report figure of a single user.
+    """
+    report = computeReports( [user_id], activeTimeThresh, start_date,
+            end_date )[user_id]
 
     # If no nodes have been found, return an image with a descriptive text.
-    if len(nts) == 0:
+    if report is None:
         return generateErrorImage("No tree nodes were edited during the " +
                 "defined period if time.")
-    
-    annotationEvents, ae_timeaxis = eventsPerInterval( nts + cts, start_date, end_date )
-    reviewEvents, re_timeaxis = eventsPerInterval( rts, start_date, end_date )
 
-    activeBouts = list(activeTimes( nts+cts+rts, activeTimeThresh ))
-    netActiveTime, at_timeaxis = activeTimesPerDay( activeBouts )
+    return plotReport( report, start_date, end_date )
+
+def plotReport( report, start_date, end_date ):
+    """ Draws the report data of one user computed by computeReports() into a
+    new figure.
+    """
+    timeaxis = report['timeaxis']
+    annotationEvents = report['annotationEvents']
+    reviewEvents = report['reviewEvents']
 
     dayformat = DateFormatter('%b %d')
 
@@ -306,8 +304,8 @@ def generateReport( user_id, activeTimeThresh, start_date, end_date ):
 
     # Top left plot: created and edited nodes per day
     ax1 = plt.subplot2grid((2,2), (0,0))
-    an = ax1.bar( ae_timeaxis, annotationEvents, color='#0000AA')
-    rv = ax1.bar( re_timeaxis, reviewEvents, bottom=annotationEvents, color='#AA0000')
+    an = ax1.bar( timeaxis, annotationEvents, color='#0000AA')
+    rv = ax1.bar( timeaxis, reviewEvents, bottom=annotationEvents, color='#AA0000')
     ax1.set_xlim((start_date,end_date))
     
     ax1.legend( (an, rv), ('Annotated', 'Reviewed'), loc=2,frameon=False )
@@ -321,7 +319,7 @@ def generateReport( user_id, activeTimeThresh, start_date, end_date ):
 
     # Bottom left plot: net active time per day
     ax2 = plt.subplot2grid((2,2), (1,0))
-    ax2.bar( at_timeaxis, netActiveTime, color='k')
+    ax2.bar( timeaxis, report['netActiveTime'], color='k')
     ax2.set_xlim((start_date,end_date))
     ax2.set_ylabel('Hours')
     yl = ax2.get_yticklabels()
@@ -331,14 +329,9 @@ def generateReport( user_id, activeTimeThresh, start_date, end_date ):
     plt.setp(xl, rotation=30, fontsize=10)
     ax2.set_title('Net daily active time', fontsize=10)
 
-    """
-    ax3 = fig.add_subplot(223)
-    ax3 = eventsPerIntervalPerDayPlot(ax3, rts+nts+cts, start_date, end_date, 30 )
-    """
-
     # Right column plot: bouts over days
     ax4 = plt.subplot2grid((2,2), (0,1), rowspan=2)
-    ax4 = dailyActivePlotFigure( activeBouts, ax4, start_date, end_date )
+    ax4 = dailyActivePlotFigure( report['activeBouts'], ax4, start_date, end_date )
     
     yl = ax4.get_yticklabels()
     plt.setp(yl, fontsize=10)
@@ -366,77 +359,20 @@ def dailyActivePlotFigure( activebouts, ax, start_date, end_date ):
     ax.xaxis.set_major_locator(DayLocator())
 
     # Draw all bouts
-    for bout in activebouts:
-        # Ignore bouts that span accross midnight
-        # TODO: Draw midnight spanning bouts, too.
-        if bout.start.day == bout.end.day:
-            isodate = bout.start.isocalendar()
-            ax.bar( bout.start.replace(hour=0,minute=0,second=0,microsecond=0),
-                    np.true_divide((bout.end-bout.start).total_seconds(), 3600),
-                    bottom=bout.start.hour + bout.start.minute/60.0 + bout.start.second/3600.0,
-                    alpha=0.5, color='#0000AA')
+    starts, ends, _ = activebouts
+    days = starts // 86400
+    # Ignore bouts that span accross midnight
+    # TODO: Draw midnight spanning bouts, too.
+    sameDay = days == ends // 86400
+    if sameDay.any():
+        origin = dayStart(start_date)
+        ax.bar( [origin + timedelta(int(d)) for d in days[sameDay]],
+                np.true_divide((ends - starts)[sameDay], 3600),
+                bottom=np.true_divide(starts[sameDay] - 86400 * days[sameDay], 3600),
+                alpha=0.5, color='#0000AA')
 
     # Set Axis limits
     ax.set_ylim((0, 24))
     ax.set_xlim((start_date, end_date))
 
     return ax
-
-def eventsPerIntervalPerDayPlot(ax,times,start_date,end_date,interval=60):
-    if np.mod(24 * 60, interval) > 0:
-        raise ValueError('Interval in minutes must divide the day evenly')
-        
-    daycount = (end_date-start_date).days
-    timebins = {}
-    
-    for i in range(daycount):
-        timebins[i] = np.zeros(24 * 60 / interval)
-        
-    dayList = []
-    daylabels = []
-
-    for i in range(daycount):
-        day = start_date + timedelta( i )
-        dayList.append( day )
-        daylabels.append( str(day.month) + '/' + str(day.day) )
-
-    timeaxis = [i for i in range(24 * 60 / interval )]
-    timelabels = []
-    for i in range(24 * 60 / 30):
-        if np.mod(i,2)==0:
-            timelabels.append( str(i/2) + ':00' )
-        else:
-            timelabels.append( str( (i-1)/2 ) + ':30' )
-    
-    for t in times:
-        timebins[np.floor((t-start_date).days)][ np.floor(np.divide(t.hour*60+t.minute, interval)) ] += 1
-    meandat = np.zeros(len(timebins[0]))
-    ignoredDays = 0
-    ind = 0
-    cm = plt.get_cmap('jet',len(timebins))
-    dats = []
-    for dat in timebins.values():
-        if np.sum(dat)==0:
-            ignoredDays += 1
-        else:
-           tmp, = ax.plot( timeaxis, dat, marker='s', linestyle='-.',alpha=0.5, color=cm(ind) )
-           dats.append(tmp)
-           meandat += dat
-        ind += 1
-
-    meandat = np.divide(meandat, daycount-ignoredDays)
-    tmp,  = ax.plot( timeaxis, meandat, color='k', linewidth=4, linestyle='-')
-    dats.append(tmp)
-    daylabels.append('Mean')
-    
-    ax.set_xticks( timeaxis )
-    ax.set_xticklabels( timelabels )
-    xl = ax.get_xticklabels()
-    plt.setp(xl, rotation=30, fontsize=10)
-    yl = ax.get_yticklabels()
-    plt.setp(yl, fontsize=10)
-    ax.set_ylabel('Events',fontsize=10)
-    ax.set_xlim( 8 * 60 / interval, 19 * 60 / interval )
-    ax.legend(dats,daylabels,loc=2,frameon=False) 
-    
-    return ax
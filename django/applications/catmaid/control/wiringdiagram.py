@@ -2,57 +2,35 @@ import json
 import networkx as nx
 from networkx.readwrite import json_graph
 
+from django.db import connection
 from django.http import HttpResponse
 from django.db.models import Count
 
-from catmaid.models import Treenode, TreenodeConnector, UserRole
+from catmaid.models import Treenode, UserRole
 from catmaid.control.authentication import requires_user_role
 
 
 def get_wiring_diagram(project_id=None, lower_treenode_number_limit=0):
 
-    # result dictionary: {connectorid: presyn_skeletonid}
-    tmp={}
-    result={}
-    # get the presynaptic connections
-    qs = TreenodeConnector.objects.filter(
-        project=project_id,
-        relation__relation_name = 'presynaptic_to'
-    )
-    for e in qs:
-        if not e.connector_id in tmp:
-            tmp[e.connector_id]=e.skeleton_id
-            result[e.skeleton_id]={}
-        else:
-            # connector with multiple presynaptic connections
-            pass
-
     skeletons={}
     qs = Treenode.objects.filter(project=project_id).values('skeleton').annotate(Count('skeleton'))
     for e in qs:
         skeletons[ e['skeleton'] ]=e['skeleton__count']
 
-    # get the postsynaptic connections
-    qs = TreenodeConnector.objects.filter(
-        project=project_id,
-        relation__relation_name = 'postsynaptic_to'
-    )
-    for e in qs:
-        if e.connector_id in tmp:
-
-            # limit the skeletons to include
-            if skeletons[ tmp[e.connector_id] ] < lower_treenode_number_limit or\
-               skeletons[ e.skeleton_id ] < lower_treenode_number_limit:
-                continue
-
-            # an existing connector, so we add a connection
-            if e.skeleton_id in result[tmp[e.connector_id]]:
-                result[tmp[e.connector_id]][e.skeleton_id] += 1
-            else:
-                result[tmp[e.connector_id]][e.skeleton_id] = 1
-        else:
-            # connector with only postsynaptic connections
-            pass
+    # result dictionary: {presyn_skeletonid: {postsyn_skeletonid: count}}
+    result={}
+    cursor = connection.cursor()
+    cursor.execute('''
+    SELECT pre_skeleton_id, post_skeleton_id, n_synapses
+    FROM synapse_edge
+    WHERE project_id = %s
+    ''', (int(project_id),))
+    for pre, post, n_synapses in cursor.fetchall():
+        # limit the skeletons to include
+        if skeletons[ pre ] < lower_treenode_number_limit or\
+           skeletons[ post ] < lower_treenode_number_limit:
+            continue
+        result.setdefault(pre, {})[post] = n_synapses
 
     nodes_tmp={}
     edges=[]
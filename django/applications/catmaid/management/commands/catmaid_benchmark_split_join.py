@@ -0,0 +1,117 @@
+import time
+
+from django.core.management.base import NoArgsCommand, CommandError
+from django.db import connection, transaction
+from optparse import make_option
+
+from catmaid.models import *
+from catmaid.control.skeleton import _split_skeleton, _join_skeleton
+
+
+class Rollback(Exception):
+    pass
+
+
+class Command(NoArgsCommand):
+    help = "Measure how long splitting and joining skeletons of different " \
+           "sizes takes. All created data is rolled back afterwards."
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('--project', dest='project_id',
+            help='The ID of a project that is set up for tracing'),
+        make_option('--user', dest='user_id',
+            help='The ID of the user who will own the test skeletons'),
+        make_option('--sizes', dest='sizes', default='10000,100000,1000000',
+            help='A comma separated list of skeleton sizes to test'),
+        )
+
+    def handle_noargs(self, **options):
+        if not (options['project_id'] and options['user_id']):
+            raise CommandError("You must specify both --project and --user")
+
+        project_id = int(options['project_id'])
+        user = User.objects.get(pk=options['user_id'])
+        sizes = [int(s) for s in options['sizes'].split(',')]
+
+        for n_nodes in sizes:
+            try:
+                with transaction.atomic():
+                    split_time, join_time = self.benchmark(user, project_id,
+                            n_nodes)
+                    raise Rollback()
+            except Rollback:
+                pass
+            self.stdout.write("%9d nodes: split %8.3fs, join %8.3fs" % (
+                    n_nodes, split_time, join_time))
+
+    def create_skeleton(self, user, project_id, n_nodes):
+        """ Create a neuron with a skeleton of n_nodes treenodes, which has
+        the shape of a long backbone with a short side branch at every tenth
+        node. Returns the IDs of the treenodes in order of creation.
+        """
+        skeleton = ClassInstance.objects.create(user=user,
+                project_id=project_id, name='Benchmark skeleton',
+                class_column=Class.objects.get(class_name='skeleton',
+                    project_id=project_id))
+        neuron = ClassInstance.objects.create(user=user,
+                project_id=project_id, name='Benchmark neuron',
+                class_column=Class.objects.get(class_name='neuron',
+                    project_id=project_id))
+        ClassInstanceClassInstance.objects.create(user=user,
+                project_id=project_id, class_instance_a=skeleton,
+                class_instance_b=neuron, relation=Relation.objects.get(
+                    relation_name='model_of', project_id=project_id))
+
+        cursor = connection.cursor()
+        cursor.execute('''
+        INSERT INTO treenode (user_id, editor_id, project_id, creation_time,
+            edition_time, location_x, location_y, location_z, radius,
+            confidence, skeleton_id)
+        SELECT %(user_id)s, %(user_id)s, %(project_id)s, now(), now(),
+            i, i %% 10, 0, -1, 5, %(skeleton_id)s
+        FROM generate_series(0, %(n_nodes)s - 1) i
+        ORDER BY i
+        RETURNING id
+        ''', {
+            'user_id': user.id,
+            'project_id': project_id,
+            'skeleton_id': skeleton.id,
+            'n_nodes': n_nodes,
+        })
+        treenode_ids = sorted(row[0] for row in cursor.fetchall())
+
+        # Every tenth node starts a new side branch at the node ten positions
+        # before it, all others continue from their predecessor.
+        cursor.execute('''
+        WITH nodes AS (
+            SELECT id, row_number() OVER (ORDER BY id) - 1 AS i
+            FROM treenode
+            WHERE skeleton_id = %s
+        )
+        UPDATE treenode t
+        SET parent_id = p.id
+        FROM nodes c, nodes p
+        WHERE t.id = c.id
+          AND c.i > 0
+          AND p.i = CASE WHEN c.i %% 10 = 0 THEN c.i - 10 ELSE c.i - 1 END
+        ''', (skeleton.id,))
+
+        return treenode_ids
+
+    def benchmark(self, user, project_id, n_nodes):
+        """ Split the test skeleton in the middle and join both parts again.
+        Returns the time needed for each operation in seconds.
+        """
+        treenode_ids = self.create_skeleton(user, project_id, n_nodes)
+        split_node = Treenode.objects.get(pk=treenode_ids[len(treenode_ids) / 2])
+        parent_id = split_node.parent_id
+
+        start = time.time()
+        _split_skeleton(user, split_node.id, project_id, {}, {})
+        split_time = time.time() - start
+
+        start = time.time()
+        _join_skeleton(user, parent_id, split_node.id, project_id, {})
+        join_time = time.time() - start
+
+        return split_time, join_time
@@ -0,0 +1,74 @@
+import os
+
+from multiprocessing import Pool
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand, CommandError
+from django.db import connection
+
+from catmaid.models import Project
+from catmaid.control.projectexport import ProjectExport
+
+
+def init_worker():
+    # Database connections can't be shared with the parent process, every
+    # worker opens its own one when needed.
+    connection.close()
+
+def export_part(args):
+    project_id, output_path, name, part = args
+    export = ProjectExport(project_id, output_path, name)
+    export.load_plan()
+    export.export_part(part)
+    return part
+
+
+class Command(NoArgsCommand):
+    help = "Export all skeletons, synapses and annotations of a project to " \
+           "gzip compressed CSV and GraphML files."
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('--project', dest='project_id',
+            help='The ID of the project to export'),
+        make_option('--output', dest='output_path', default='.',
+            help='The folder to write the files to'),
+        make_option('--name', dest='name',
+            help='The prefix of all files, defaults to project_<id>'),
+        make_option('--processes', dest='processes', default='1',
+            help='The number of processes exporting in parallel'),
+        make_option('--chunks', dest='chunks', default='64',
+            help='The number of skeleton ID ranges the export is split into'),
+        make_option('--resume', dest='resume', action='store_true',
+            default=False, help='Continue an interrupted export with the ' \
+            'same output folder and name'),
+        )
+
+    def handle_noargs(self, **options):
+        if not options['project_id']:
+            raise CommandError("You must specify a project with --project")
+        project = Project.objects.get(pk=options['project_id'])
+        output_path = os.path.abspath(options['output_path'])
+        name = options['name'] or 'project_%s' % project.id
+        processes = int(options['processes'])
+
+        export = ProjectExport(project.id, output_path, name,
+                int(options['chunks']))
+        export.prepare(options['resume'])
+        n_parts = len(export.parts())
+
+        if processes > 1:
+            connection.close()
+            pool = Pool(processes, init_worker)
+            tasks = [(project.id, output_path, name, i) for i in range(n_parts)]
+            for n, part in enumerate(pool.imap_unordered(export_part, tasks)):
+                self.stdout.write("Exported part %s of %s" % (n + 1, n_parts))
+            pool.close()
+            pool.join()
+        else:
+            for i in range(n_parts):
+                export.export_part(i)
+                self.stdout.write("Exported part %s of %s" % (i + 1, n_parts))
+
+        export.combine()
+        for output_name in export.output_names():
+            self.stdout.write("Created %s" % os.path.join(output_path, output_name))
@@ -0,0 +1,27 @@
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+
+from catmaid.models import Project
+from catmaid.control.stats import update_user_activity
+
+
+class Command(NoArgsCommand):
+    help = "Add all tree node, connector and review events that happened " \
+           "since the last update to the user activity counters."
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('--project', dest='project_id',
+            help='The ID of the project to update, all projects are ' \
+            'updated by default'),
+        )
+
+    def handle_noargs(self, **options):
+        if options['project_id']:
+            projects = [Project.objects.get(pk=options['project_id'])]
+        else:
+            projects = Project.objects.all()
+
+        for project in projects:
+            update_user_activity(project.id)
+            self.stdout.write("Updated user activity of project %s" % project.id)
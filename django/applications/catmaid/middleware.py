@@ -6,6 +6,8 @@ from django.contrib.auth.models import User
 from django.conf import settings
 from traceback import format_exc
 
+from catmaid.control.common import increment_pending_cache_versions
+
 class AnonymousAuthenticationMiddleware(object):
     """ This middleware class tests whether the current user is the
     anonymous user. If so, it replaces the request.user object with
@@ -19,6 +21,15 @@ class AnonymousAuthenticationMiddleware(object):
             request.user.is_authenticated = lambda: False
         return None
 
+class CacheVersionMiddleware(object):
+    """ Increments the cache versions that were incremented during a request
+    again, after its transaction has been committed (see
+    catmaid.control.common.increment_cache_version).
+    """
+    def process_response(self, request, response):
+        increment_pending_cache_versions()
+        return response
+
 class AjaxExceptionMiddleware(object):
 
     def process_exception(self, request, exception):
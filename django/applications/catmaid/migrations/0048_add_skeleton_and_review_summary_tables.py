@@ -0,0 +1,790 @@
+# -*- coding: utf-8 -*-
+from south.utils import datetime_utils as datetime
+from south.db import db
+from south.v2 import SchemaMigration
+from django.db import models
+
+
+class Migration(SchemaMigration):
+
+    def forwards(self, orm):
+        # The skeleton_summary table stores for every skeleton its number of
+        # treenodes and the number of its treenodes that have been reviewed by
+        # at least one user. The review_summary table stores for every
+        # skeleton and reviewer the number of reviewed treenodes and a lower
+        # bound of their review times. Both are kept up to date by triggers on
+        # treenode and review, which makes them independent of the code path
+        # that changes treenodes or reviews (tracing, reviewing, splitting,
+        # joining, deleting). Row triggers only collect the changes in delta
+        # tables, which are added up and applied to the summaries once per
+        # statement. Otherwise, a split or join would update the summaries of
+        # both skeletons once for every moved treenode and review.
+        db.execute('''
+            CREATE TABLE skeleton_summary (
+                skeleton_id integer PRIMARY KEY
+                    REFERENCES class_instance (id) ON DELETE CASCADE
+                    DEFERRABLE INITIALLY DEFERRED,
+                project_id integer NOT NULL,
+                num_nodes integer NOT NULL DEFAULT 0,
+                num_reviewed_nodes integer NOT NULL DEFAULT 0
+            );''')
+        db.execute('''
+            CREATE TABLE review_summary (
+                skeleton_id integer NOT NULL
+                    REFERENCES class_instance (id) ON DELETE CASCADE
+                    DEFERRABLE INITIALLY DEFERRED,
+                reviewer_id integer NOT NULL,
+                project_id integer NOT NULL,
+                num_reviewed_nodes integer NOT NULL DEFAULT 0,
+                first_review_time timestamp with time zone NOT NULL,
+                PRIMARY KEY (skeleton_id, reviewer_id)
+            );''')
+
+        db.execute('''
+            CREATE TABLE skeleton_summary_delta (
+                txid bigint NOT NULL DEFAULT txid_current(),
+                skeleton_id integer NOT NULL,
+                project_id integer NOT NULL,
+                num_nodes integer NOT NULL,
+                num_reviewed_nodes integer NOT NULL
+            );''')
+        db.execute('''
+            CREATE INDEX skeleton_summary_delta_txid_index
+            ON skeleton_summary_delta (txid);''')
+        db.execute('''
+            CREATE TABLE review_summary_delta (
+                txid bigint NOT NULL DEFAULT txid_current(),
+                skeleton_id integer NOT NULL,
+                reviewer_id integer NOT NULL,
+                project_id integer NOT NULL,
+                num_reviewed_nodes integer NOT NULL,
+                review_time timestamp with time zone NOT NULL
+            );''')
+        db.execute('''
+            CREATE INDEX review_summary_delta_txid_index
+            ON review_summary_delta (txid);''')
+
+        db.execute('''
+            /* Adds <n_nodes> treenodes and <n_reviewed> reviewed treenodes to
+             * the summary of a skeleton, which is created if needed. Deleting
+             * a skeleton deletes its summary, which must not be recreated by
+             * deleting its treenodes and reviews afterwards.
+             */
+            CREATE OR REPLACE FUNCTION skeleton_summary_add(skid integer,
+                    pid integer, n_nodes integer, n_reviewed integer)
+                RETURNS void AS
+            $$
+                BEGIN
+                    LOOP
+                        UPDATE skeleton_summary
+                        SET num_nodes = num_nodes + n_nodes,
+                            num_reviewed_nodes = num_reviewed_nodes + n_reviewed
+                        WHERE skeleton_id = skid;
+                        -- There is nothing to remove from skeletons without
+                        -- summary, i.e. skeletons that have been deleted.
+                        IF FOUND OR n_nodes < 0 OR n_reviewed < 0 THEN
+                            RETURN;
+                        END IF;
+                        BEGIN
+                            INSERT INTO skeleton_summary (skeleton_id,
+                                project_id, num_nodes, num_reviewed_nodes)
+                            VALUES (skid, pid, n_nodes, n_reviewed);
+                            RETURN;
+                        EXCEPTION WHEN unique_violation THEN
+                            -- Another transaction inserted the summary
+                            -- concurrently, update it instead.
+                        END;
+                    END LOOP;
+                END
+            $$
+            LANGUAGE plpgsql;''')
+
+        db.execute('''
+            /* Adds <delta> reviewed treenodes of a reviewer to the summary of
+             * a skeleton, which is created if needed. The first review time
+             * is only ever lowered, hence it is a lower bound of the review
+             * times of the reviewer in this skeleton. Like above, missing
+             * summaries are only created when reviews are added.
+             */
+            CREATE OR REPLACE FUNCTION review_summary_add(skid integer,
+                    rid integer, pid integer, delta integer,
+                    rtime timestamp with time zone)
+                RETURNS void AS
+            $$
+                BEGIN
+                    LOOP
+                        UPDATE review_summary
+                        SET num_reviewed_nodes = num_reviewed_nodes + delta,
+                            first_review_time = least(first_review_time, rtime)
+                        WHERE skeleton_id = skid AND reviewer_id = rid;
+                        IF FOUND OR delta <= 0 THEN
+                            RETURN;
+                        END IF;
+                        BEGIN
+                            INSERT INTO review_summary (skeleton_id,
+                                reviewer_id, project_id, num_reviewed_nodes,
+                                first_review_time)
+                            VALUES (skid, rid, pid, delta, rtime);
+                            RETURN;
+                        EXCEPTION WHEN unique_violation THEN
+                            -- Another transaction inserted the summary
+                            -- concurrently, update it instead.
+                        END;
+                    END LOOP;
+                END
+            $$
+            LANGUAGE plpgsql;''')
+
+        db.execute('''
+            CREATE OR REPLACE FUNCTION on_change_treenode_update_skeleton_summary()
+                RETURNS trigger AS
+            $$
+                BEGIN
+                    IF TG_OP = 'INSERT' THEN
+                        INSERT INTO skeleton_summary_delta (skeleton_id,
+                            project_id, num_nodes, num_reviewed_nodes)
+                        VALUES (NEW.skeleton_id, NEW.project_id, 1, 0);
+                    ELSIF TG_OP = 'DELETE' THEN
+                        INSERT INTO skeleton_summary_delta (skeleton_id,
+                            project_id, num_nodes, num_reviewed_nodes)
+                        VALUES (OLD.skeleton_id, OLD.project_id, -1, 0);
+                    ELSE
+                        INSERT INTO skeleton_summary_delta (skeleton_id,
+                            project_id, num_nodes, num_reviewed_nodes)
+                        VALUES (OLD.skeleton_id, OLD.project_id, -1, 0),
+                               (NEW.skeleton_id, NEW.project_id, 1, 0);
+                    END IF;
+                    RETURN NULL;
+                END
+            $$
+            LANGUAGE plpgsql;''')
+
+        db.execute('''
+            CREATE TRIGGER on_insert_delete_treenode_update_skeleton_summary
+            AFTER INSERT OR DELETE ON treenode
+            FOR EACH ROW EXECUTE PROCEDURE
+                on_change_treenode_update_skeleton_summary();''')
+        db.execute('''
+            CREATE TRIGGER on_update_treenode_update_skeleton_summary
+            AFTER UPDATE OF skeleton_id ON treenode
+            FOR EACH ROW
+            WHEN (OLD.skeleton_id <> NEW.skeleton_id)
+            EXECUTE PROCEDURE on_change_treenode_update_skeleton_summary();''')
+
+        db.execute('''
+            /* Records a change by <delta> of the review summaries the passed
+             * in review is part of. The number of reviewed nodes of its
+             * skeleton only changes if there is no other review of the same
+             * treenode in the skeleton. The review itself is excluded by its
+             * ID, which allows to use this function in BEFORE triggers for
+             * both the old and the new version of an updated row.
+             */
+            CREATE OR REPLACE FUNCTION review_summary_add_review(r review,
+                    delta integer)
+                RETURNS void AS
+            $$
+                BEGIN
+                    -- Serialize reviews of a treenode. Without this, two
+                    -- transactions that review the same treenode at the same
+                    -- time wouldn't see each other's review and the treenode
+                    -- would be counted twice. A row lock is used, because
+                    -- unlike advisory locks, row locks don't take up space
+                    -- in the shared lock table, of which a statement that
+                    -- changes thousands of reviews would run out. It doesn't
+                    -- conflict with the key share lock of the review's
+                    -- foreign key check. If the treenode has been deleted in
+                    -- this transaction, so are its reviews.
+                    PERFORM 1 FROM treenode WHERE id = r.treenode_id
+                    FOR NO KEY UPDATE;
+
+                    INSERT INTO review_summary_delta (skeleton_id,
+                        reviewer_id, project_id, num_reviewed_nodes,
+                        review_time)
+                    VALUES (r.skeleton_id, r.reviewer_id, r.project_id, delta,
+                        r.review_time);
+
+                    PERFORM 1 FROM review
+                    WHERE treenode_id = r.treenode_id
+                      AND skeleton_id = r.skeleton_id
+                      AND id <> r.id;
+                    IF NOT FOUND THEN
+                        INSERT INTO skeleton_summary_delta (skeleton_id,
+                            project_id, num_nodes, num_reviewed_nodes)
+                        VALUES (r.skeleton_id, r.project_id, 0, delta);
+                    END IF;
+                END
+            $$
+            LANGUAGE plpgsql;''')
+
+        db.execute('''
+            /* This has to be a BEFORE trigger: within a statement that
+             * changes multiple reviews of the same treenode (e.g. a split or
+             * the deletion of a skeleton), it sees the reviews processed
+             * before as changed and the following ones as unchanged. Hence
+             * every reviewed treenode is accounted for exactly once.
+             */
+            CREATE OR REPLACE FUNCTION on_change_review_update_review_summary()
+                RETURNS trigger AS
+            $$
+                BEGIN
+                    IF TG_OP = 'INSERT' THEN
+                        PERFORM review_summary_add_review(NEW, 1);
+                        RETURN NEW;
+                    ELSIF TG_OP = 'DELETE' THEN
+                        PERFORM review_summary_add_review(OLD, -1);
+                        RETURN OLD;
+                    END IF;
+
+                    IF OLD.skeleton_id <> NEW.skeleton_id
+                            OR OLD.treenode_id <> NEW.treenode_id
+                            OR OLD.reviewer_id <> NEW.reviewer_id THEN
+                        PERFORM review_summary_add_review(OLD, -1);
+                        PERFORM review_summary_add_review(NEW, 1);
+                    ELSIF NEW.review_time < OLD.review_time THEN
+                        INSERT INTO review_summary_delta (skeleton_id,
+                            reviewer_id, project_id, num_reviewed_nodes,
+                            review_time)
+                        VALUES (NEW.skeleton_id, NEW.reviewer_id,
+                            NEW.project_id, 0, NEW.review_time);
+                    END IF;
+                    RETURN NEW;
+                END
+            $$
+            LANGUAGE plpgsql;''')
+
+        db.execute('''
+            CREATE TRIGGER on_change_review_update_review_summary
+            BEFORE INSERT OR UPDATE OR DELETE ON review
+            FOR EACH ROW EXECUTE PROCEDURE
+                on_change_review_update_review_summary();''')
+
+        db.execute('''
+            /* Applies the changes collected in the delta tables by this
+             * transaction to the summaries. Summaries are updated in the order
+             * of their skeleton IDs, so that concurrent statements can't
+             * deadlock each other.
+             */
+            CREATE OR REPLACE FUNCTION on_change_apply_summary_deltas()
+                RETURNS trigger AS
+            $$
+                DECLARE
+                    d record;
+                BEGIN
+                    FOR d IN
+                        WITH deleted AS (
+                            DELETE FROM skeleton_summary_delta
+                            WHERE txid = txid_current()
+                            RETURNING *)
+                        SELECT skeleton_id, project_id,
+                            sum(num_nodes)::integer AS num_nodes,
+                            sum(num_reviewed_nodes)::integer AS num_reviewed
+                        FROM deleted
+                        GROUP BY skeleton_id, project_id
+                        ORDER BY skeleton_id
+                    LOOP
+                        IF d.num_nodes <> 0 OR d.num_reviewed <> 0 THEN
+                            PERFORM skeleton_summary_add(d.skeleton_id,
+                                d.project_id, d.num_nodes, d.num_reviewed);
+                        END IF;
+                    END LOOP;
+
+                    FOR d IN
+                        WITH deleted AS (
+                            DELETE FROM review_summary_delta
+                            WHERE txid = txid_current()
+                            RETURNING *)
+                        SELECT skeleton_id, reviewer_id, project_id,
+                            sum(num_reviewed_nodes)::integer AS num_reviewed,
+                            min(review_time) AS review_time
+                        FROM deleted
+                        GROUP BY skeleton_id, reviewer_id, project_id
+                        ORDER BY skeleton_id, reviewer_id
+                    LOOP
+                        PERFORM review_summary_add(d.skeleton_id,
+                            d.reviewer_id, d.project_id, d.num_reviewed,
+                            d.review_time);
+                    END LOOP;
+                    RETURN NULL;
+                END
+            $$
+            LANGUAGE plpgsql;''')
+
+        db.execute('''
+            CREATE TRIGGER on_change_treenode_apply_summary_deltas
+            AFTER INSERT OR DELETE OR UPDATE OF skeleton_id ON treenode
+            FOR EACH STATEMENT EXECUTE PROCEDURE
+                on_change_apply_summary_deltas();''')
+        db.execute('''
+            CREATE TRIGGER on_change_review_apply_summary_deltas
+            AFTER INSERT OR UPDATE OR DELETE ON review
+            FOR EACH STATEMENT EXECUTE PROCEDURE
+                on_change_apply_summary_deltas();''')
+
+        # Populate the tables from the existing treenodes and reviews
+        db.execute('''
+            INSERT INTO skeleton_summary (skeleton_id, project_id, num_nodes)
+            SELECT skeleton_id, project_id, count(*)
+            FROM treenode
+            GROUP BY skeleton_id, project_id;''')
+        db.execute('''
+            UPDATE skeleton_summary s
+            SET num_reviewed_nodes = r.n
+            FROM (SELECT skeleton_id, count(DISTINCT treenode_id) AS n
+                  FROM review
+                  GROUP BY skeleton_id) r
+            WHERE s.skeleton_id = r.skeleton_id;''')
+        db.execute('''
+            INSERT INTO review_summary (skeleton_id, reviewer_id, project_id,
+                num_reviewed_nodes, first_review_time)
+            SELECT skeleton_id, reviewer_id, project_id, count(*),
+                min(review_time)
+            FROM review
+            GROUP BY skeleton_id, reviewer_id, project_id;''')
+
+
+    def backwards(self, orm):
+        db.execute('''DROP TRIGGER IF EXISTS
+            on_change_review_apply_summary_deltas ON review;''')
+        db.execute('''DROP TRIGGER IF EXISTS
+            on_change_treenode_apply_summary_deltas ON treenode;''')
+        db.execute('''DROP TRIGGER IF EXISTS
+            on_change_review_update_review_summary ON review;''')
+        db.execute('''DROP TRIGGER IF EXISTS
+            on_insert_delete_treenode_update_skeleton_summary ON treenode;''')
+        db.execute('''DROP TRIGGER IF EXISTS
+            on_update_treenode_update_skeleton_summary ON treenode;''')
+        db.execute('DROP FUNCTION IF EXISTS on_change_apply_summary_deltas();')
+        db.execute('DROP FUNCTION IF EXISTS on_change_review_update_review_summary();')
+        db.execute('DROP FUNCTION IF EXISTS review_summary_add_review(review, integer);')
+        db.execute('DROP FUNCTION IF EXISTS on_change_treenode_update_skeleton_summary();')
+        db.execute('DROP FUNCTION IF EXISTS review_summary_add(integer, integer, integer, integer, timestamp with time zone);')
+        db.execute('DROP FUNCTION IF EXISTS skeleton_summary_add(integer, integer, integer, integer);')
+        db.execute('DROP TABLE IF EXISTS review_summary_delta;')
+        db.execute('DROP TABLE IF EXISTS skeleton_summary_delta;')
+        db.execute('DROP TABLE IF EXISTS review_summary;')
+        db.execute('DROP TABLE IF EXISTS skeleton_summary;')
+
+
+    models = {
+        u'auth.group': {
+            'Meta': {'object_name': 'Group'},
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '80'}),
+            'permissions': ('django.db.models.fields.related.ManyToManyField', [], {'to': u"orm['auth.Permission']", 'symmetrical': 'False', 'blank': 'True'})
+        },
+        u'auth.permission': {
+            'Meta': {'ordering': "(u'content_type__app_label', u'content_type__model', u'codename')", 'unique_together': "((u'content_type', u'codename'),)", 'object_name': 'Permission'},
+            'codename': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'content_type': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['contenttypes.ContentType']"}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '50'})
+        },
+        u'auth.user': {
+            'Meta': {'object_name': 'User'},
+            'date_joined': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'email': ('django.db.models.fields.EmailField', [], {'max_length': '75', 'blank': 'True'}),
+            'first_name': ('django.db.models.fields.CharField', [], {'max_length': '30', 'blank': 'True'}),
+            'groups': ('django.db.models.fields.related.ManyToManyField', [], {'symmetrical': 'False', 'related_name': "u'user_set'", 'blank': 'True', 'to': u"orm['auth.Group']"}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'is_active': ('django.db.models.fields.BooleanField', [], {'default': 'True'}),
+            'is_staff': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'is_superuser': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'last_login': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'last_name': ('django.db.models.fields.CharField', [], {'max_length': '30', 'blank': 'True'}),
+            'password': ('django.db.models.fields.CharField', [], {'max_length': '128'}),
+            'user_permissions': ('django.db.models.fields.related.ManyToManyField', [], {'symmetrical': 'False', 'related_name': "u'user_set'", 'blank': 'True', 'to': u"orm['auth.Permission']"}),
+            'username': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '30'})
+        },
+        u'catmaid.apikey': {
+            'Meta': {'object_name': 'ApiKey'},
+            'description': ('django.db.models.fields.TextField', [], {}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'key': ('django.db.models.fields.CharField', [], {'max_length': '128'})
+        },
+        u'catmaid.brokenslice': {
+            'Meta': {'object_name': 'BrokenSlice', 'db_table': "'broken_slice'"},
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'index': ('django.db.models.fields.IntegerField', [], {}),
+            'stack': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['catmaid.Stack']"})
+        },
+        u'catmaid.cardinalityrestriction': {
+            'Meta': {'object_name': 'CardinalityRestriction', 'db_table': "'cardinality_restriction'"},
+            'cardinality_type': ('django.db.models.fields.IntegerField', [], {}),
+            'creation_time': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'edition_time': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'enabled': ('django.db.models.fields.BooleanField', [], {'default': 'True'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'project': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['catmaid.Project']"}),
+            'restricted_link': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['catmaid.ClassClass']"}),
+            'user': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['auth.User']"}),
+            'value': ('django.db.models.fields.IntegerField', [], {})
+        },
+        u'catmaid.changerequest': {
+            'Meta': {'object_name': 'ChangeRequest', 'db_table': "'change_request'"},
+            'approve_action': ('django.db.models.fields.TextField', [], {}),
+            'completion_time': ('django.db.models.fields.DateTimeField', [], {'default': 'None', 'null': 'True'}),
+            'connector': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['catmaid.Connector']"}),
+            'creation_time': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'description': ('django.db.models.fields.TextField', [], {}),
+            'edition_time': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'location': ('catmaid.fields.Double3DField', [], {}),
+            'project': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['catmaid.Project']"}),
+            'recipient': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'change_recipient'", 'db_column': "'recipient_id'", 'to': u"orm['auth.User']"}),
+            'reject_action': ('django.db.models.fields.TextField', [], {}),
+            'status': ('django.db.models.fields.IntegerField', [], {'default': '0'}),
+            'treenode': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['catmaid.Treenode']"}),
+            'type': ('django.db.models.fields.CharField', [], {'max_length': '32'}),
+            'user': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['auth.User']"}),
+            'validate_action': ('django.db.models.fields.TextField', [], {})
+        },
+        u'catmaid.class': {
+            'Meta': {'object_name': 'Class', 'db_table': "'class'"},
+            'class_name': ('django.db.models.fields.CharField', [], {'max_length': '255'}),
+            'creation_time': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'description': ('django.db.models.fields.TextField', [], {}),
+            'edition_time': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'project': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['catmaid.Project']"}),
+            'user': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['auth.User']"})
+        },
+        u'catmaid.classclass': {
+            'Meta': {'object_name': 'ClassClass', 'db_table': "'class_class'"},
+            'class_a': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'classes_a'", 'db_column': "'class_a'", 'to': u"orm['catmaid.Class']"}),
+            'class_b': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'classes_b'", 'db_column': "'class_b'", 'to': u"orm['catmaid.Class']"}),
+            'creation_time': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'edition_time': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'project': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['catmaid.Project']"}),
+            'relation': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['catmaid.Relation']"}),
+            'user': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['auth.User']"})
+        },
+        u'catmaid.classinstance': {
+            'Meta': {'object_name': 'ClassInstance', 'db_table': "'class_instance'"},
+            'class_column': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['catmaid.Class']", 'db_column': "'class_id'"}),
+            'creation_time': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'edition_time': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '255'}),
+            'project': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['catmaid.Project']"}),
+            'user': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['auth.User']"})
+        },
+        u'catmaid.classinstanceclassinstance': {
+            'Meta': {'object_name': 'ClassInstanceClassInstance', 'db_table': "'class_instance_class_instance'"},
+            'class_instance_a': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'cici_via_a'", 'db_column': "'class_instance_a'", 'to': u"orm['catmaid.ClassInstance']"}),
+            'class_instance_b': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'cici_via_b'", 'db_column': "'class_instance_b'", 'to': u"orm['catmaid.ClassInstance']"}),
+            'creation_time': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'edition_time': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'project': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['catmaid.Project']"}),
+            'relation': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['catmaid.Relation']"}),
+            'user': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['auth.User']"})
+        },
+        u'catmaid.concept': {
+            'Meta': {'object_name': 'Concept', 'db_table': "'concept'"},
+            'creation_time': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'edition_time': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'project': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['catmaid.Project']"}),
+            'user': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['auth.User']"})
+        },
+        u'catmaid.connector': {
+            'Meta': {'object_name': 'Connector', 'db_table': "'connector'"},
+            'confidence': ('django.db.models.fields.IntegerField', [], {'default': '5'}),
+            'creation_time': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'edition_time': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'editor': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'connector_editor'", 'db_column': "'editor_id'", 'to': u"orm['auth.User']"}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'location_x': ('django.db.models.fields.FloatField', [], {}),
+            'location_y': ('django.db.models.fields.FloatField', [], {}),
+            'location_z': ('django.db.models.fields.FloatField', [], {}),
+            'project': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['catmaid.Project']"}),
+            'user': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['auth.User']"})
+        },
+        u'catmaid.connectorclassinstance': {
+            'Meta': {'object_name': 'ConnectorClassInstance', 'db_table': "'connector_class_instance'"},
+            'class_instance': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['catmaid.ClassInstance']"}),
+            'connector': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['catmaid.Connector']"}),
+            'creation_time': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'edition_time': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'project': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['catmaid.Project']"}),
+            'relation': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['catmaid.Relation']"}),
+            'user': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['auth.User']"})
+        },
+        u'catmaid.dataview': {
+            'Meta': {'ordering': "('position',)", 'object_name': 'DataView', 'db_table': "'data_view'"},
+            'comment': ('django.db.models.fields.TextField', [], {'default': "''", 'null': 'True', 'blank': 'True'}),
+            'config': ('django.db.models.fields.TextField', [], {'default': "'{}'"}),
+            'data_view_type': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['catmaid.DataViewType']"}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'is_default': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'position': ('django.db.models.fields.IntegerField', [], {'default': '0'}),
+            'title': ('django.db.models.fields.TextField', [], {})
+        },
+        u'catmaid.dataviewtype': {
+            'Meta': {'object_name': 'DataViewType', 'db_table': "'data_view_type'"},
+            'code_type': ('django.db.models.fields.TextField', [], {}),
+            'comment': ('django.db.models.fields.TextField', [], {'null': 'True', 'blank': 'True'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'title': ('django.db.models.fields.TextField', [], {})
+        },
+        u'catmaid.deprecatedappliedmigrations': {
+            'Meta': {'object_name': 'DeprecatedAppliedMigrations', 'db_table': "'applied_migrations'"},
+            'id': ('django.db.models.fields.CharField', [], {'max_length': '32', 'primary_key': 'True'})
+        },
+        u'catmaid.deprecatedsession': {
+            'Meta': {'object_name': 'DeprecatedSession', 'db_table': "'sessions'"},
+            'data': ('django.db.models.fields.TextField', [], {'default': "''"}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'last_accessed': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'session_id': ('django.db.models.fields.CharField', [], {'max_length': '26'})
+        },
+        u'catmaid.location': {
+            'Meta': {'object_name': 'Location', 'db_table': "'location'"},
+            'creation_time': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'edition_time': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'editor': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'location_editor'", 'db_column': "'editor_id'", 'to': u"orm['auth.User']"}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'location_x': ('django.db.models.fields.FloatField', [], {}),
+            'location_y': ('django.db.models.fields.FloatField', [], {}),
+            'location_z': ('django.db.models.fields.FloatField', [], {}),
+            'project': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['catmaid.Project']"}),
+            'user': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['auth.User']"})
+        },
+        u'catmaid.log': {
+            'Meta': {'object_name': 'Log', 'db_table': "'log'"},
+            'creation_time': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'edition_time': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'freetext': ('django.db.models.fields.TextField', [], {}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'location': ('catmaid.fields.Double3DField', [], {}),
+            'operation_type': ('django.db.models.fields.CharField', [], {'max_length': '255'}),
+            'project': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['catmaid.Project']"}),
+            'user': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['auth.User']"})
+        },
+        u'catmaid.message': {
+            'Meta': {'object_name': 'Message', 'db_table': "'message'"},
+            'action': ('django.db.models.fields.TextField', [], {'null': 'True', 'blank': 'True'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'read': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'text': ('django.db.models.fields.TextField', [], {'default': "'New message'", 'null': 'True', 'blank': 'True'}),
+            'time': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'title': ('django.db.models.fields.TextField', [], {}),
+            'user': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['auth.User']"})
+        },
+        u'catmaid.overlay': {
+            'Meta': {'object_name': 'Overlay', 'db_table': "'overlay'"},
+            'default_opacity': ('django.db.models.fields.IntegerField', [], {'default': '0'}),
+            'file_extension': ('django.db.models.fields.TextField', [], {}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'image_base': ('django.db.models.fields.TextField', [], {}),
+            'stack': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['catmaid.Stack']"}),
+            'tile_height': ('django.db.models.fields.IntegerField', [], {'default': '512'}),
+            'tile_source_type': ('django.db.models.fields.IntegerField', [], {'default': '1'}),
+            'tile_width': ('django.db.models.fields.IntegerField', [], {'default': '512'}),
+            'title': ('django.db.models.fields.TextField', [], {})
+        },
+        u'catmaid.project': {
+            'Meta': {'object_name': 'Project', 'db_table': "'project'"},
+            'comment': ('django.db.models.fields.TextField', [], {'null': 'True', 'blank': 'True'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'stacks': ('django.db.models.fields.related.ManyToManyField', [], {'to': u"orm['catmaid.Stack']", 'through': u"orm['catmaid.ProjectStack']", 'symmetrical': 'False'}),
+            'title': ('django.db.models.fields.TextField', [], {})
+        },
+        u'catmaid.projectstack': {
+            'Meta': {'object_name': 'ProjectStack', 'db_table': "'project_stack'"},
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'orientation': ('django.db.models.fields.IntegerField', [], {'default': '0'}),
+            'project': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['catmaid.Project']"}),
+            'stack': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['catmaid.Stack']"}),
+            'translation': ('catmaid.fields.Double3DField', [], {'default': '(0, 0, 0)'})
+        },
+        u'catmaid.regionofinterest': {
+            'Meta': {'object_name': 'RegionOfInterest', 'db_table': "'region_of_interest'"},
+            'creation_time': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'edition_time': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'editor': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'roi_editor'", 'db_column': "'editor_id'", 'to': u"orm['auth.User']"}),
+            'height': ('django.db.models.fields.FloatField', [], {}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'location_x': ('django.db.models.fields.FloatField', [], {}),
+            'location_y': ('django.db.models.fields.FloatField', [], {}),
+            'location_z': ('django.db.models.fields.FloatField', [], {}),
+            'project': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['catmaid.Project']"}),
+            'rotation_cw': ('django.db.models.fields.FloatField', [], {}),
+            'stack': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['catmaid.Stack']"}),
+            'user': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['auth.User']"}),
+            'width': ('django.db.models.fields.FloatField', [], {}),
+            'zoom_level': ('django.db.models.fields.IntegerField', [], {})
+        },
+        u'catmaid.regionofinterestclassinstance': {
+            'Meta': {'object_name': 'RegionOfInterestClassInstance', 'db_table': "'region_of_interest_class_instance'"},
+            'class_instance': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['catmaid.ClassInstance']"}),
+            'creation_time': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'edition_time': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'project': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['catmaid.Project']"}),
+            'region_of_interest': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['catmaid.RegionOfInterest']"}),
+            'relation': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['catmaid.Relation']"}),
+            'user': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['auth.User']"})
+        },
+        u'catmaid.relation': {
+            'Meta': {'object_name': 'Relation', 'db_table': "'relation'"},
+            'creation_time': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'description': ('django.db.models.fields.TextField', [], {}),
+            'edition_time': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'isreciprocal': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'project': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['catmaid.Project']"}),
+            'relation_name': ('django.db.models.fields.CharField', [], {'max_length': '255'}),
+            'uri': ('django.db.models.fields.TextField', [], {}),
+            'user': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['auth.User']"})
+        },
+        u'catmaid.relationinstance': {
+            'Meta': {'object_name': 'RelationInstance', 'db_table': "'relation_instance'"},
+            'creation_time': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'edition_time': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'project': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['catmaid.Project']"}),
+            'relation': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['catmaid.Relation']"}),
+            'user': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['auth.User']"})
+        },
+        u'catmaid.restriction': {
+            'Meta': {'object_name': 'Restriction', 'db_table': "'restriction'"},
+            'creation_time': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'edition_time': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'enabled': ('django.db.models.fields.BooleanField', [], {'default': 'True'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'project': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['catmaid.Project']"}),
+            'restricted_link': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['catmaid.ClassClass']"}),
+            'user': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['auth.User']"})
+        },
+        u'catmaid.review': {
+            'Meta': {'object_name': 'Review', 'db_table': "'review'"},
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'project': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['catmaid.Project']"}),
+            'review_time': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'reviewer': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['auth.User']"}),
+            'skeleton': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['catmaid.ClassInstance']"}),
+            'treenode': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['catmaid.Treenode']"})
+        },
+        u'catmaid.reviewerwhitelist': {
+            'Meta': {'unique_together': "(('project', 'user', 'reviewer'),)", 'object_name': 'ReviewerWhitelist', 'db_table': "'reviewer_whitelist'"},
+            'accept_after': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime(1, 1, 1, 0, 0)'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'project': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['catmaid.Project']"}),
+            'reviewer': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'+'", 'to': u"orm['auth.User']"}),
+            'user': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['auth.User']"})
+        },
+        u'catmaid.settings': {
+            'Meta': {'object_name': 'Settings', 'db_table': "'settings'"},
+            'key': ('django.db.models.fields.TextField', [], {'primary_key': 'True'}),
+            'value': ('django.db.models.fields.TextField', [], {'null': 'True'})
+        },
+        u'catmaid.stack': {
+            'Meta': {'object_name': 'Stack', 'db_table': "'stack'"},
+            'comment': ('django.db.models.fields.TextField', [], {'null': 'True', 'blank': 'True'}),
+            'dimension': ('catmaid.fields.Integer3DField', [], {}),
+            'file_extension': ('django.db.models.fields.TextField', [], {'default': "'jpg'", 'blank': 'True'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'image_base': ('django.db.models.fields.TextField', [], {}),
+            'metadata': ('django.db.models.fields.TextField', [], {'default': "''", 'blank': 'True'}),
+            'num_zoom_levels': ('django.db.models.fields.IntegerField', [], {'default': '-1'}),
+            'resolution': ('catmaid.fields.Double3DField', [], {}),
+            'tile_height': ('django.db.models.fields.IntegerField', [], {'default': '256'}),
+            'tile_source_type': ('django.db.models.fields.IntegerField', [], {'default': '1'}),
+            'tile_width': ('django.db.models.fields.IntegerField', [], {'default': '256'}),
+            'title': ('django.db.models.fields.TextField', [], {}),
+            'trakem2_project': ('django.db.models.fields.BooleanField', [], {'default': 'False'})
+        },
+        u'catmaid.textlabel': {
+            'Meta': {'object_name': 'Textlabel', 'db_table': "'textlabel'"},
+            'colour': ('catmaid.fields.RGBAField', [], {'default': '(1, 0.5, 0, 1)'}),
+            'creation_time': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'deleted': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'edition_time': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'font_name': ('django.db.models.fields.TextField', [], {'null': 'True'}),
+            'font_size': ('django.db.models.fields.FloatField', [], {'default': '32'}),
+            'font_style': ('django.db.models.fields.TextField', [], {'null': 'True'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'project': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['catmaid.Project']"}),
+            'scaling': ('django.db.models.fields.BooleanField', [], {'default': 'True'}),
+            'text': ('django.db.models.fields.TextField', [], {'default': "'Edit this text ...'"}),
+            'type': ('django.db.models.fields.CharField', [], {'max_length': '32'})
+        },
+        u'catmaid.textlabellocation': {
+            'Meta': {'object_name': 'TextlabelLocation', 'db_table': "'textlabel_location'"},
+            'deleted': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'location': ('catmaid.fields.Double3DField', [], {}),
+            'textlabel': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['catmaid.Textlabel']"})
+        },
+        u'catmaid.treenode': {
+            'Meta': {'object_name': 'Treenode', 'db_table': "'treenode'"},
+            'confidence': ('django.db.models.fields.IntegerField', [], {'default': '5'}),
+            'creation_time': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'edition_time': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'editor': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'treenode_editor'", 'db_column': "'editor_id'", 'to': u"orm['auth.User']"}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'location_x': ('django.db.models.fields.FloatField', [], {}),
+            'location_y': ('django.db.models.fields.FloatField', [], {}),
+            'location_z': ('django.db.models.fields.FloatField', [], {}),
+            'parent': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'children'", 'null': 'True', 'to': u"orm['catmaid.Treenode']"}),
+            'project': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['catmaid.Project']"}),
+            'radius': ('django.db.models.fields.FloatField', [], {}),
+            'skeleton': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['catmaid.ClassInstance']"}),
+            'user': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['auth.User']"})
+        },
+        u'catmaid.treenodeclassinstance': {
+            'Meta': {'object_name': 'TreenodeClassInstance', 'db_table': "'treenode_class_instance'"},
+            'class_instance': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['catmaid.ClassInstance']"}),
+            'creation_time': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'edition_time': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'project': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['catmaid.Project']"}),
+            'relation': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['catmaid.Relation']"}),
+            'treenode': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['catmaid.Treenode']"}),
+            'user': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['auth.User']"})
+        },
+        u'catmaid.treenodeconnector': {
+            'Meta': {'object_name': 'TreenodeConnector', 'db_table': "'treenode_connector'"},
+            'confidence': ('django.db.models.fields.IntegerField', [], {'default': '5'}),
+            'connector': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['catmaid.Connector']"}),
+            'creation_time': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'edition_time': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'project': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['catmaid.Project']"}),
+            'relation': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['catmaid.Relation']"}),
+            'skeleton': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['catmaid.ClassInstance']"}),
+            'treenode': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['catmaid.Treenode']"}),
+            'user': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['auth.User']"})
+        },
+        u'catmaid.userprofile': {
+            'Meta': {'object_name': 'UserProfile'},
+            'color': ('catmaid.fields.RGBAField', [], {'default': '(0.523688999783034, 1.0, 0.9154808475404868, 1)'}),
+            'display_stack_reference_lines': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'independent_ontology_workspace_is_default': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'inverse_mouse_wheel': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'prefer_webgl_layers': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'show_cropping_tool': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'show_ontology_tool': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'show_roi_tool': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'show_segmentation_tool': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'show_tagging_tool': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'show_text_label_tool': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'show_tracing_tool': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'tracing_overlay_scale': ('django.db.models.fields.FloatField', [], {'default': '1'}),
+            'tracing_overlay_screen_scaling': ('django.db.models.fields.BooleanField', [], {'default': 'True'}),
+            'user': ('django.db.models.fields.related.OneToOneField', [], {'to': u"orm['auth.User']", 'unique': 'True'})
+        },
+        u'contenttypes.contenttype': {
+            'Meta': {'ordering': "('name',)", 'unique_together': "(('app_label', 'model'),)", 'object_name': 'ContentType', 'db_table': "'django_content_type'"},
+            'app_label': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'model': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '100'})
+        }
+    }
+
+    complete_apps = ['catmaid']
\ No newline at end of file
@@ -588,19 +588,22 @@ class CardinalityRestriction(models.Model):
                 relation=self.restricted_link.relation,
                 class_instance_a__class_column=ctype).count()
 
-    def would_violate(self, ci, c):
+    def would_violate(self, ci, c, num_linked_ci=None):
         """ Test if it would violate this restriction if a new instance
         of <c> is linked to <ci> with the guarded link. Note: This will
         return *false as well* if adding a new class instance would bring
         the restriction closer to being not violated. E.g.: if exactly 3
         elements are needed, this method would return false for the firs
-        three new class instances.
+        three new class instances. If known, the number of class instances
+        linked to <ci> with the guarded relation (only those of class <c>
+        for types 3 and 4) can be passed in as <num_linked_ci>.
         """
         if self.cardinality_type == 0 or self.cardinality_type == 1:
             # Type 0 and type 1: exactly <value> number of class instances
             # can be instantiated. A new instance violates if there are
             # already <value> or more instances.
-            num_linked_ci = self.get_num_class_instances(ci)
+            if num_linked_ci is None:
+                num_linked_ci = self.get_num_class_instances(ci)
             too_much_items = num_linked_ci >= self.value
             return too_much_items
         elif self.cardinality_type == 2:
@@ -611,7 +614,8 @@ class CardinalityRestriction(models.Model):
             # Type 3 and type 4: exactly <value> number of class instances are
             # allowed for each sub-type. A new instance violates if there are
             # already <value> or more instances of a certain type.
-            num_linked_ci = self.get_num_class_instances(ci, c)
+            if num_linked_ci is None:
+                num_linked_ci = self.get_num_class_instances(ci, c)
             too_much_items = num_linked_ci >= self.value
             return too_much_items
         elif self.cardinality_type == 5:
@@ -813,9 +813,15 @@ TracingTool.goToNearestInNeuronOrSkeleton = function(type, objectID) {
   });
 };
 
+/**
+ * The number of search results that are requested at once.
+ */
+TracingTool.SEARCH_PAGE_SIZE = 100;
+
 TracingTool.search = function()
 {
-  if( $('#search-box').val() === '' ) {
+  var substring = $('#search-box').val();
+  if( substring === '' ) {
     return;
   }
 
@@ -824,15 +830,117 @@ TracingTool.search = function()
     $('#search-results').append($('<i/>').text(message));
   };
 
-  setSearchingMessage('Search in progress...');
-  requestQueue.register(django_url + project.id + '/search', "GET", {
-    pid: project.id,
-    substring: $('#search-box').val()
-  }, function (status, text) {
-    var i, table, tbody, row, actionLink, data;
-    if (status !== 200) {
-      setSearchingMessage('Search failed with HTTP status'+status);
+  var action = function(type) {
+    return function() {
+        TracingTool.goToNearestInNeuronOrSkeleton(type, parseInt($(this).attr('id')));
+        return false;
+    };
+  };
+  var actionaddstage = function(type) {
+    return function() {
+      // Find an open Selection, or open one if none
+      var selection = SelectionTable.prototype.getOrCreate();
+      selection.addSkeletons([parseInt($(this).attr('id'))]);
+      return false;
+    };
+  };
+  var removelabel = function(id) {
+    return function() {
+      requestQueue.register(django_url + project.id + '/label/remove', "POST", {
+      class_instance_id: id
+      }, function (status, text) {});
+      return false;
+    };
+  };
+  var createRow = function(result, index) {
+    var actionLink, row = $('<tr/>');
+    row.append($('<td/>').text(index));
+    row.append($('<td/>').text(result.id));
+    row.append($('<td/>').text(result.name));
+    row.append($('<td/>').text(result.class_name));
+    if (result.class_name === 'neuron' || result.class_name === 'skeleton') {
+      var tdd = $('<td/>');
+      actionLink = $('<a/>');
+      actionLink.attr({'id': ''+result.id});
+      actionLink.attr({'href':''});
+      actionLink.click(action(result.class_name));
+      actionLink.text("Go to nearest node");
+      tdd.append(actionLink);
+      if( result.class_name === 'skeleton' ) {
+        actionLink = $('<a/>');
+        actionLink.attr({'id': ''+result.id});
+        actionLink.attr({'href':''});
+        actionLink.click(actionaddstage(result.class_name));
+        actionLink.text(" Add to selection table");
+        tdd.append(actionLink);
+      }
+      row.append(tdd);
+    } else if (result.class_name === 'label') {
+      // Create a link that will then query, when clicked, for the list of nodes
+      // that point to the label, and show a list [1], [2], [3] ... clickable,
+      // or better, insert a table below this row with x,y,z,parent skeleton, parent neuron.
+      if (result.hasOwnProperty('nodes')) {
+        var td = $('<td/>');
+        row.append(td);
+        result.nodes.reduce(function(index, node) {
+          // Local copies
+          var z = parseInt(node.z);
+          var y = parseInt(node.y);
+          var x = parseInt(node.x);
+          var id = parseInt(node.id);
+          var skid = parseInt(node.skid);
+          td.append(
+            $('<a/>').attr({'id': '' + id})
+                     .attr({'href':''})
+                     .click(function(event) {
+                       SkeletonAnnotations.staticMoveTo(z, y, x,
+                         function() {
+                           SkeletonAnnotations.staticSelectNode(id, skid);
+                         });
+                       return false;
+                     })
+                     .text("[" + index + "]")
+            ).append("&nbsp;");
+          if( index % 20 === 0)
+            td.append('<br />');
+          return index + 1;
+        }, 1);
+      } else {
+        // no nodes, option to remove the label
+        actionLink = $('<a/>');
+        actionLink.attr({'id': ''+result.id});
+        actionLink.attr({'href':''});
+        actionLink.click(removelabel(result.id));
+        actionLink.text("Remove label");
+        row.append($('<td/>').append(actionLink));
+      }
     } else {
+      row.append($('<td/>').text('IMPLEMENT ME'));
+    }
+    row.append($('<td/>').text(index));
+    return row;
+  };
+
+  var tbody, nResults = 0;
+
+  // Results are requested page by page, the cursor returned with a page
+  // points to the next one.
+  var loadPage = function(cursor) {
+    var params = {
+      pid: project.id,
+      substring: substring,
+      limit: TracingTool.SEARCH_PAGE_SIZE
+    };
+    if (cursor) {
+      params.cursor = cursor;
+    }
+    requestQueue.register(django_url + project.id + '/search', "GET", params,
+        function (status, text) {
+      var data, table, facets;
+      if (status !== 200) {
+        setSearchingMessage('Search failed with HTTP status'+status);
+        return;
+      }
       data = $.parseJSON(text);
       if (null === data) {
         setSearchingMessage('Search failed, parseJSON returned null. Check javascript console.');
@@ -840,110 +948,40 @@ TracingTool.search = function()
       }
       if (data.error) {
         setSearchingMessage('Search failed with error: '+data.error);
-      } else {
+        return;
+      }
+      if (!cursor) {
+        facets = Object.keys(data.facets).sort().map(function(className) {
+          return className + ': ' + data.facets[className];
+        });
         $('#search-results').empty();
-        $('#search-results').append($('<i/>').data('Found '+data.length+' results:'));
+        $('#search-results').append($('<i/>').text('Found ' + data.n_matches +
+            ' results' + (facets.length ? ' (' + facets.join(', ') + ')' : '') + ':'));
         table = $('<table/>');
         $('#search-results').append(table);
         tbody = $('<tbody/>');
         tbody.append('<tr><th></th><th>ID</th><th>Name</th><th>Class</th><th>Action</th><th></th></tr>');
         table.append(tbody);
-        var action = function(type) {
-          return function() {
-              TracingTool.goToNearestInNeuronOrSkeleton(type, parseInt($(this).attr('id')));
+      }
+      $('#search-more').remove();
+      data.results.forEach(function(result) {
+        nResults += 1;
+        tbody.append(createRow(result, nResults));
+      });
+      if (data.cursor) {
+        $('#search-results').append($('<a/>')
+            .attr({'id': 'search-more', 'href': ''})
+            .text('Show more results')
+            .click(function() {
+              loadPage(data.cursor);
               return false;
-          };
-        };
-        var actionaddstage = function(type) {
-          return function() {
-            // Find an open Selection, or open one if none
-            var selection = SelectionTable.prototype.getOrCreate();
-            selection.addSkeletons([parseInt($(this).attr('id'))]);
-            return false;
-          };
-        };
-        var removelabel = function(id) {
-          return function() {
-            requestQueue.register(django_url + project.id + '/label/remove', "POST", {
-            class_instance_id: id
-            }, function (status, text) {});
-            return false;
-          };
-        };
-        for (i = 0; i < data.length; ++i) {
-          row = $('<tr/>');
-          row.append($('<td/>').text(i+1));
-          row.append($('<td/>').text(data[i].id));
-          row.append($('<td/>').text(data[i].name));
-          row.append($('<td/>').text(data[i].class_name));
-          if (data[i].class_name === 'neuron' || data[i].class_name === 'skeleton') {
-            var tdd = $('<td/>');
-            actionLink = $('<a/>');
-            actionLink.attr({'id': ''+data[i].id});
-            actionLink.attr({'href':''});
-            actionLink.click(action(data[i].class_name));
-            actionLink.text("Go to nearest node");
-            tdd.append(actionLink);
-            if( data[i].class_name === 'skeleton' ) {
-              actionLink = $('<a/>');
-              actionLink.attr({'id': ''+data[i].id});
-              actionLink.attr({'href':''});
-              actionLink.click(actionaddstage(data[i].class_name));
-              actionLink.text(" Add to selection table");
-              tdd.append(actionLink);
-            }
-            row.append(tdd);
-          } else if (data[i].class_name === 'label') {
-            // Create a link that will then query, when clicked, for the list of nodes
-            // that point to the label, and show a list [1], [2], [3] ... clickable,
-            // or better, insert a table below this row with x,y,z,parent skeleton, parent neuron.
-            if (data[i].hasOwnProperty('nodes')) {
-              var td = $('<td/>');
-              row.append(td);
-              data[i].nodes.reduce(function(index, node) {
-                // Local copies
-                var z = parseInt(node.z);
-                var y = parseInt(node.y);
-                var x = parseInt(node.x);
-                var id = parseInt(node.id);
-                var skid = parseInt(node.skid);
-                td.append(
-                  $('<a/>').attr({'id': '' + id})
-                           .attr({'href':''})
-                           .click(function(event) {
-                             SkeletonAnnotations.staticMoveTo(z, y, x,
-                               function() {
-                                 SkeletonAnnotations.staticSelectNode(id, skid);
-                               });
-                             return false;
-                           })
-                           .text("[" + index + "]")
-                  ).append("&nbsp;");
-                if( index % 20 === 0)
-                  td.append('<br />');
-                return index + 1;
-              }, 1);
-            } else {
-              // no nodes, option to remove the label
-              actionLink = $('<a/>');
-              actionLink.attr({'id': ''+data[i].id});
-              actionLink.attr({'href':''});
-              actionLink.click(removelabel(data[i].id));
-              actionLink.text("Remove label");
-              row.append($('<td/>').append(actionLink));
-            }
-          } else {
-            row.append($('<td/>').text('IMPLEMENT ME'));
-          }
-          row.append($('<td/>').text(i+1));
-          tbody.append(row);
-        }
+            }));
       }
-    }
-    return true;
-  });
-
+    });
+  };
 
+  setSearchingMessage('Search in progress...');
+  loadPage();
 };
 
 /**
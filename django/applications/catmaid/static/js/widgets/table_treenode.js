@@ -119,12 +119,12 @@ var TreenodeTable = function(skid)
       {
         "sClass": "center",
         "bSearchable": true,
-        "bSortable": false,
+        "bSortable": true,
         "sWidth": "50px"
       }, // type
       {
         "bSearchable": true,
-        "bSortable": false,
+        "bSortable": true,
         "sWidth": "150px"
       }, // labels
       {
@@ -147,8 +147,8 @@ var TreenodeTable = function(skid)
       {
         "sClass": "center",
         "bSearchable": false,
-        "bSortable": false
-      }, // section index: not sortable due to the index being computed after sorting
+        "bSortable": true
+      }, // section index: sorted by Z
       {
         "sClass": "center",
         "bSearchable": false
@@ -162,7 +162,7 @@ var TreenodeTable = function(skid)
       }, // last modified
       {
           "bSearchable": false,
-          "bSortable": false
+          "bSortable": true
       } // reviewer
       ]
     });
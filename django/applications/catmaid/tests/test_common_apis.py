@@ -1,24 +1,61 @@
 from django.contrib.auth.models import Permission
 from django.conf import settings
 from django.test import TestCase, TransactionTestCase
+from django.test.utils import override_settings
 from django.test.client import Client
 from django.http import HttpResponse
 from django.db import connection, transaction
 from django.shortcuts import get_object_or_404
-from guardian.shortcuts import assign_perm
+from guardian.shortcuts import assign_perm, remove_perm
+import gzip
 import os
 import re
+import shutil
+import struct
+import tempfile
 import urllib
 import json
 import datetime
+import StringIO
+from contextlib import closing
+
+import h5py
+import numpy as np
+from PIL import Image
 
 from catmaid.models import Project, Stack, ProjectStack
-from catmaid.models import ClassInstance, Log, Message, TextlabelLocation
+from catmaid.models import Class, ClassInstance, Relation, Log, Message, \
+        TextlabelLocation
 from catmaid.models import Treenode, Connector, TreenodeConnector, User, Review, ReviewerWhitelist
 from catmaid.models import Textlabel, TreenodeClassInstance, ClassInstanceClassInstance
 from catmaid.fields import Double3D, Integer3D
-from catmaid.control.common import get_relation_to_id_map, get_class_to_id_map
-from catmaid.control.neuron_annotations import _annotate_entities, create_annotation_query
+from catmaid.control.common import get_relation_to_id_map, \
+        get_class_to_id_map, increment_pending_cache_versions
+from catmaid.control.arbor_cache import get_arbor, get_skeleton_version, \
+        invalidate_skeletons
+from catmaid.control.neuron_annotations import _annotate_entities, \
+        create_annotation_query, create_basic_annotated_entity_query, \
+        get_sub_annotation_ids
+from catmaid.control.array_tree import ArrayTree
+from catmaid.control.tree_util import lazy_load_trees, stream_array_trees
+from catmaid.control.skeleton import get_connectivity_matrix
+from catmaid.control.review import get_review_status
+from catmaid.control.user_evaluation import _evaluate
+from catmaid.control.stats import get_user_activity, update_user_activity
+from catmaid.control.useranalytics import activeTimes, eventsPerInterval, \
+        singleDayActiveness
+from catmaid.control.spatial import NodeIndex, fetch_section, \
+        invalidate_project, nearest_treenode, skeleton_node_index
+from catmaid.control.ontology import Feature, FeatureLink
+from catmaid.control.ontology_cache import get_ontology, invalidate_ontology
+from catmaid.control.clustering import create_binary_matrix
+from catmaid.control.projectexport import ProjectExport
+from catmaid.control import tile
+from catmaid.control.cropping import CropJob, ImageRetrievalError, \
+        TiffWriter, get_image_parts, get_stack_bounding_boxes, \
+        imagej_description, iter_substack, process_crop_job
+from catmaid.control.treenodeexport import _fetch_tile, _tile_range, \
+        _write_image
 
 
 class TransactionTests(TransactionTestCase):
@@ -584,6 +621,94 @@ class ViewPageTests(TestCase):
         parsed_response = json.loads(response.content)
         self.assertEqual(expected_result, parsed_response)
 
+    def test_stream_array_trees(self):
+        trees = list(stream_array_trees([235, 373],
+                ('location_x', 'location_y', 'location_z', 'user_id')))
+        self.assertEqual([235, 373], [skid for skid, tree in trees])
+        tree = trees[0][1]
+        self.assertEqual(28, len(tree))
+        self.assertEqual(237, tree.ids[tree.root()])
+        self.assertEqual((28, 3), tree.locations.shape)
+        self.assertEqual(set([3]), set(tree.properties['user_id'].tolist()))
+
+        for skid, graph in lazy_load_trees([235], ('user_id',)):
+            self.assertEqual(28, graph.number_of_nodes())
+            self.assertEqual(27, graph.number_of_edges())
+            self.assertEqual(3, graph.node[237]['user_id'])
+
+    def test_evaluate_user(self):
+        # Datetimes are streamed like Django returns them
+        trees = list(stream_array_trees([235], ('creation_time',)))
+        creation_times = trees[0][1].properties['creation_time']
+        self.assertTrue(all(t.tzinfo is None for t in creation_times))
+
+        # Fully review skeleton 235, which was traced by test2
+        review_time = datetime.datetime(2011, 12, 10, 12, 0)
+        for node_id in Treenode.objects.filter(skeleton_id=235) \
+                .values_list('id', flat=True):
+            Review.objects.create(project_id=self.test_project_id,
+                    reviewer_id=1, review_time=review_time, skeleton_id=235,
+                    treenode_id=node_id)
+
+        evaluations = _evaluate(self.test_project_id, 3,
+                datetime.datetime(2011, 9, 1), datetime.datetime(2011, 11, 1),
+                datetime.timedelta(3), 1)
+        self.assertTrue(evaluations)
+        for e in evaluations:
+            self.assertEqual(235, e['skeleton_id'])
+            self.assertEqual(1, e['reviewer_id'])
+            self.assertEqual('2011-10-07', e['timepoint'])
+
+    def test_user_activity(self):
+        self.fake_authentication()
+        cursor = connection.cursor()
+        def count_rollup_treenodes():
+            cursor.execute('''
+                SELECT sum(n_treenodes_created) FROM user_activity
+                WHERE project_id = %s''', (self.test_project_id,))
+            return cursor.fetchone()[0]
+
+        # The rollup starts out empty and is filled on first use
+        self.assertEqual(None, count_rollup_treenodes())
+        activity = get_user_activity(self.test_project_id)
+        created = dict((a['user_id'], a['n_treenodes_created']) for a in activity)
+        self.assertEqual({1: 4, 2: 2, 3: 83},
+                dict((k, v) for k, v in created.iteritems() if v))
+        self.assertEqual(89, count_rollup_treenodes())
+
+        # Further updates don't change the results
+        update_user_activity(self.test_project_id, delay=0)
+        self.assertEqual(89, count_rollup_treenodes())
+        self.assertEqual(activity, get_user_activity(self.test_project_id))
+
+        # Events after the update are added to the rollup counts
+        Treenode.objects.create(project_id=self.test_project_id,
+                user_id=self.test_user_id, editor_id=self.test_user_id,
+                location_x=0, location_y=0, location_z=0, radius=-1,
+                skeleton_id=235, parent_id=237)
+        activity = get_user_activity(self.test_project_id,
+                user_id=self.test_user_id)
+        self.assertEqual(1, len(activity))
+        self.assertEqual(created[self.test_user_id] + 1,
+                activity[0]['n_treenodes_created'])
+
+        response = self.client.get('/%d/stats/nodecount' % self.test_project_id)
+        self.assertEqual(response.status_code, 200)
+        parsed_response = json.loads(response.content)
+        self.assertIn('test2 (84)', parsed_response['users'])
+
+        # Over all projects, the rollup is combined with the events each
+        # project has after its own last update.
+        Treenode.objects.create(project_id=5,
+                user_id=self.test_user_id, editor_id=self.test_user_id,
+                location_x=0, location_y=0, location_z=0, radius=-1,
+                skeleton_id=235, parent_id=237)
+        activity = get_user_activity(None, user_ids=[self.test_user_id])
+        self.assertEqual(1, len(activity))
+        self.assertEqual(created[self.test_user_id] + 2,
+                activity[0]['n_treenodes_created'])
+        self.assertEqual([], get_user_activity(None, user_ids=[]))
+
     def test_multiple_treenodes(self):
         pass
         # self.fake_authentication()
@@ -657,7 +782,7 @@ class ViewPageTests(TestCase):
         self.assertEqual(response.status_code, 200)
         expected_result = {
                 "iTotalRecords": 28,
-                "iTotalDisplayRecords": 28,
+                "iTotalDisplayRecords": 1,
                 "aaData": [
                     ["261", "L", "TODO", "5", "2820.00", "1345.00", "0.00", 0, "-1.0", "test2", "05-12-2011 13:51", "None"]]}
         parsed_response = json.loads(response.content)
@@ -750,6 +875,28 @@ class ViewPageTests(TestCase):
         for (expected, parsed) in zip(expected_result['aaData'], parsed_response['aaData']):
             self.assertEqual(expected, parsed)
 
+    def test_list_treenode_table_paging(self):
+        self.fake_authentication()
+        response = self.client.post(
+                '/%d/treenode/table/list' % (self.test_project_id), {
+                    'iDisplayStart': 2,
+                    'iDisplayLength': 2,
+                    'iSortingCols': 1,
+                    'iSortCol_0': 1,
+                    'sSortDir_0': 'asc',
+                    'skeleton_0': 235,
+                    'skeleton_nr': 1,
+                    'sSearch_1': 'BL',
+                    'pid': 3,
+                    'stack_id': 3})
+        self.assertEqual(response.status_code, 200)
+        parsed_response = json.loads(response.content)
+        # Branch nodes 253 and 265 come first, followed by the leaves
+        self.assertEqual(28, parsed_response['iTotalRecords'])
+        self.assertEqual(5, parsed_response['iTotalDisplayRecords'])
+        self.assertEqual([["261", "L"], ["277", "L"]],
+                [row[:2] for row in parsed_response['aaData']])
+
     def test_list_treenode_table_empty(self):
         self.fake_authentication()
         response = self.client.post(
@@ -1074,6 +1221,121 @@ class ViewPageTests(TestCase):
         expected_response = [2323, 231, 233, 235]
         self.assertEqual(expected_response, parsed_response)
 
+    @override_settings(ONTOLOGY_CACHE_SIZE=10)
+    def test_list_ontology(self):
+        self.fake_authentication()
+        url = '/%d/ontology/list' % self.test_project_id
+        # Don't use an ontology cached by another test
+        invalidate_ontology(self.test_project_id)
+        increment_pending_cache_versions()
+
+        def post(path, data):
+            response = self.client.post('/%d/ontology/%s' % (
+                    self.test_project_id, path), data)
+            self.assertEqual(response.status_code, 200)
+            return json.loads(response.content)
+
+        # Link neuron to root with part_of and group to neuron with is_a
+        link_id = post('links/add', {'classaid': 5, 'classbid': 112,
+                'relid': 9})['class_class_id']
+        post('links/add', {'classaid': 106, 'classbid': 5, 'relid': 8})
+
+        response = self.client.get(url, {'rootclass': 'root'})
+        self.assertEqual(response.status_code, 200)
+        expected_result = [{
+            'data': {'title': 'root (112)'},
+            'attr': {'id': 'node_112', 'rel': 'root', 'cname': 'root'},
+            'state': 'closed'}]
+        self.assertEqual(expected_result, json.loads(response.content))
+
+        response = self.client.get(url, {'parenttype': 'root',
+                'parentid': 112})
+        self.assertEqual(response.status_code, 200)
+        expected_result = [{
+            'data': {'title': 'part_of (9)'},
+            'attr': {'id': 'node_9', 'rel': 'relation', 'name': 'part_of',
+                     'classbname': 'root', 'classbid': 112},
+            'state': 'closed'}]
+        self.assertEqual(expected_result, json.loads(response.content))
+
+        response = self.client.get(url, {'parenttype': 'relation',
+                'parentid': 9, 'classbid': 112})
+        self.assertEqual(response.status_code, 200)
+        expected_result = [{
+            'data': {'title': 'neuron (5)'},
+            'attr': {'id': 'node_5', 'rel': 'class', 'restrictions': '{}',
+                     'cname': 'neuron', 'ccid': link_id},
+            'state': 'closed'}]
+        self.assertEqual(expected_result, json.loads(response.content))
+
+        # The ontology is cached until it is changed
+        ontology = get_ontology(self.test_project_id)
+        self.assertIs(ontology, get_ontology(self.test_project_id))
+
+        # A new restriction is listed right away
+        restriction_id = post('restrictions/add', {'linkid': link_id,
+                'restriction': 'cardinality', 'cardinality': 1,
+                'cardinalitytype': 1})['new_restriction']
+        response = self.client.get(url, {'parenttype': 'relation',
+                'parentid': 9, 'classbid': 112})
+        self.assertEqual(response.status_code, 200)
+        parsed_response = json.loads(response.content)
+        self.assertEqual('neuron (5)*', parsed_response[0]['data']['title'])
+        self.assertEqual({'cardinality': [{'id': restriction_id, 'type': 1,
+                'value': 1}]},
+                json.loads(parsed_response[0]['attr']['restrictions']))
+        self.assertIsNot(ontology, get_ontology(self.test_project_id))
+
+        # Renamed classes are listed with their new name
+        post('classes/rename', {'classid': 5, 'newname': 'cell'})
+        response = self.client.get(url, {'parenttype': 'relation',
+                'parentid': 9, 'classbid': 112})
+        self.assertEqual(response.status_code, 200)
+        parsed_response = json.loads(response.content)
+        self.assertEqual('cell (5)*', parsed_response[0]['data']['title'])
+
+        # An ontology that is loaded before a change is committed, could
+        # still contain the old state. It is only used until the version is
+        # incremented again after the commit.
+        neuron_class = Class.objects.get(id=5)
+        neuron_class.class_name = 'neuron'
+        neuron_class.save()
+        ontology = get_ontology(self.test_project_id)
+        self.assertIs(ontology, get_ontology(self.test_project_id))
+        increment_pending_cache_versions()
+        self.assertIsNot(ontology, get_ontology(self.test_project_id))
+
+    def test_create_binary_matrix(self):
+        def create_instance(class_id, parent=None, relation_id=None):
+            ci = ClassInstance.objects.create(user_id=self.test_user_id,
+                    project_id=self.test_project_id, class_column_id=class_id,
+                    name='instance')
+            if parent:
+                ClassInstanceClassInstance.objects.create(
+                        user_id=self.test_user_id,
+                        project_id=self.test_project_id,
+                        relation_id=relation_id, class_instance_a=ci,
+                        class_instance_b=parent)
+            return ci
+
+        # A group graph with a neuron part of it, modeled by a skeleton and
+        # an empty group graph.
+        graph = create_instance(106)
+        neuron = create_instance(5, graph, 9)
+        create_instance(14, neuron, 10)
+        empty_graph = create_instance(106)
+
+        classes = Class.objects.in_bulk([5, 14, 106])
+        relations = Relation.objects.in_bulk([9, 10])
+        features = [
+            Feature([FeatureLink(classes[5], classes[106], relations[9])]),
+            Feature([FeatureLink(classes[5], classes[106], relations[9]),
+                     FeatureLink(classes[14], classes[5], relations[10])]),
+            Feature([FeatureLink(classes[14], classes[106], relations[9])])]
+
+        matrix = create_binary_matrix([graph, empty_graph], features)
+        self.assertEqual([[1, 1, 0], [0, 0, 0]], matrix.tolist())
+
     def test_list_connector_empty(self):
         self.fake_authentication()
         response = self.client.post(
@@ -1158,6 +1420,25 @@ class ViewPageTests(TestCase):
                      u"test2", 415, u'07-10-2011 07:02']]}
         self.assertEqual(expected_result, parsed_response)
 
+    def test_list_connector_csv(self):
+        self.fake_authentication()
+        response = self.client.post(
+                '/%d/connector/table/list' % self.test_project_id, {
+                    'relation_type': 0,
+                    'skeleton_id': 373,
+                    'format': 'csv'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual('text/csv', response['Content-Type'])
+        lines = ''.join(response.streaming_content).splitlines()
+        self.assertEqual(3, len(lines))
+        self.assertEqual('connector_id,other_skeleton_id,x,y,z,confidence,'
+                'labels,n_partner_nodes,username,other_treenode_id,'
+                'last_modified,this_treenode_id', lines[0])
+        self.assertEqual(['356', '235'], lines[1].split(',')[:2])
+        self.assertEqual(['421', '235'], lines[2].split(',')[:2])
+        self.assertEqual(['28', 'test2', '415', '07-10-2011 07:02'],
+                lines[2].split(',')[7:11])
+
     def test_one_to_many_skeletons_connector_list(self):
         self.fake_authentication()
         response = self.client.post(
@@ -1713,6 +1994,60 @@ class ViewPageTests(TestCase):
         self.assertEqual(0, treenode_skeleton_relation.count())
         self.assertEqual(1, neuron_skeleton_relation.count())
 
+    def test_create_treenodes(self):
+        self.fake_authentication()
+        class_map = get_class_to_id_map(self.test_project_id)
+        treenode_count = Treenode.objects.all().count()
+        skeleton_count = ClassInstance.objects.filter(
+                project=self.test_project_id,
+                class_column=class_map['skeleton']).count()
+
+        # A new skeleton with three nodes and two nodes appended to the
+        # existing node 237 of skeleton 235.
+        nodes = [
+            {'id': 'a', 'x': 5, 'y': 10, 'z': 15},
+            {'id': 'b', 'parent': 'a', 'x': 6, 'y': 10, 'z': 15},
+            {'id': 'c', 'parent': 'b', 'x': 7, 'y': 10, 'z': 15, 'radius': 2},
+            {'id': 'd', 'parent': 'e', 'x': 1000, 'y': 3000, 'z': 0},
+            {'id': 'e', 'parent_id': 237, 'x': 1010, 'y': 3010, 'z': 0},
+        ]
+        response = self.client.post(
+                '/%d/treenode/create/batch' % self.test_project_id,
+                {'treenodes': json.dumps(nodes)})
+        self.assertEqual(response.status_code, 200)
+        parsed_response = json.loads(response.content)
+        treenode_ids = parsed_response['treenode_ids']
+        skeleton_ids = parsed_response['skeleton_ids']
+
+        self.assertEqual(treenode_count + 5, Treenode.objects.all().count())
+        self.assertEqual(skeleton_count + 1, ClassInstance.objects.filter(
+                project=self.test_project_id,
+                class_column=class_map['skeleton']).count())
+        self.assertEqual(235, skeleton_ids['d'])
+        self.assertEqual(235, skeleton_ids['e'])
+        new_skeleton_id = skeleton_ids['a']
+        self.assertEqual(new_skeleton_id, skeleton_ids['c'])
+        self.assertEqual('skeleton %d' % new_skeleton_id,
+                ClassInstance.objects.get(id=new_skeleton_id).name)
+
+        c = Treenode.objects.get(id=treenode_ids['c'])
+        self.assertEqual(treenode_ids['b'], c.parent_id)
+        self.assertEqual(2, c.radius)
+        self.assertEqual(new_skeleton_id, c.skeleton_id)
+        self.assertEqual(None, Treenode.objects.get(id=treenode_ids['a']).parent_id)
+        self.assertEqual(237, Treenode.objects.get(id=treenode_ids['e']).parent_id)
+
+        # Nothing is created if a parent doesn't exist
+        response = self.client.post(
+                '/%d/treenode/create/batch' % self.test_project_id,
+                {'treenodes': json.dumps([{'id': 1, 'parent': 2, 'x': 0,
+                    'y': 0, 'z': 0}, {'id': 2, 'parent_id': 555555, 'x': 0,
+                    'y': 0, 'z': 0}])})
+        self.assertEqual(response.status_code, 200)
+        parsed_response = json.loads(response.content)
+        self.assertIn('error', parsed_response)
+        self.assertEqual(treenode_count + 5, Treenode.objects.all().count())
+
     def test_create_treenode_with_nonexisting_parent_failure(self):
         self.fake_authentication()
         parent_id = 555555
@@ -1953,6 +2288,48 @@ class ViewPageTests(TestCase):
                 {"id":233, "name":"branched neuron", "class_name":"neuron"}]
         self.assertEqual(expected_result, parsed_response)
 
+    def test_search_with_paging(self):
+        self.fake_authentication()
+
+        def search(params):
+            params['substring'] = 't'
+            response = self.client.get(
+                    '/%d/search' % self.test_project_id, params)
+            self.assertEqual(response.status_code, 200)
+            return json.loads(response.content)
+
+        # Exact matches come first, followed by names that start with the
+        # search string.
+        parsed_response = search({'limit': 3})
+        self.assertEqual([2345, 351, 465],
+                [r['id'] for r in parsed_response['results']])
+        self.assertEqual([
+                {"id":349, "x":3580, "y":3350, "z":252, "skid":1},
+                {"id":261, "x":2820, "y":1345, "z":0, "skid":235}],
+                parsed_response['results'][1]['nodes'])
+        self.assertEqual(19, parsed_response['n_matches'])
+        self.assertEqual({'driver_line': 1, 'group': 2, 'label': 4,
+                'neuron': 2, 'skeleton': 10}, parsed_response['facets'])
+
+        # Following the cursors yields every match exactly once
+        ids = [r['id'] for r in parsed_response['results']]
+        while parsed_response['cursor']:
+            parsed_response = search({'limit': 3,
+                    'cursor': parsed_response['cursor']})
+            self.assertTrue(len(parsed_response['results']) <= 3)
+            ids.extend(r['id'] for r in parsed_response['results'])
+        self.assertEqual(19, len(ids))
+        self.assertEqual(frozenset([465, 4, 364, 2353, 2345, 351, 2342, 374,
+                362, 1, 235, 2364, 2388, 2411, 2433, 2440, 2451, 361, 373]),
+                frozenset(ids))
+
+        # Results can be restricted to classes
+        parsed_response = search({'limit': 10, 'class_names[0]': 'neuron'})
+        self.assertEqual([374, 362],
+                [r['id'] for r in parsed_response['results']])
+        self.assertEqual(2, parsed_response['n_matches'])
+        self.assertEqual(None, parsed_response['cursor'])
+
     def test_delete_link_success(self):
         self.fake_authentication()
         connector_id = 356
@@ -2042,6 +2419,48 @@ class ViewPageTests(TestCase):
 
         self.assertEqual(new_skeleton_id, get_object_or_404(TreenodeConnector, id=2405).skeleton_id)
 
+    def test_split_skeleton(self):
+        self.fake_authentication()
+
+        skeleton_id = 235
+        split_at = 263
+        downstream = set([263, 265, 267, 269, 271, 273, 275, 277, 279, 281,
+                          283, 285, 289, 415, 417])
+        skeleton_nodes = set(Treenode.objects.filter(
+                skeleton=skeleton_id).values_list('id', flat=True))
+
+        response = self.client.post(
+                '/%d/skeleton/split' % self.test_project_id, {
+                    'treenode_id': split_at,
+                    'upstream_annotation_map': '{}',
+                    'downstream_annotation_map': '{}'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual({}, json.loads(response.content))
+
+        new_skeleton_id = get_object_or_404(Treenode, id=split_at).skeleton_id
+        self.assertNotEqual(skeleton_id, new_skeleton_id)
+        self.assertEqual(None, get_object_or_404(Treenode, id=split_at).parent_id)
+        self.assertEqual(downstream, set(Treenode.objects.filter(
+                skeleton=new_skeleton_id).values_list('id', flat=True)))
+        self.assertEqual(skeleton_nodes - downstream, set(Treenode.objects.filter(
+                skeleton=skeleton_id).values_list('id', flat=True)))
+
+        self.assertEqual(new_skeleton_id, get_object_or_404(TreenodeConnector, id=360).skeleton_id)
+        self.assertEqual(new_skeleton_id, get_object_or_404(TreenodeConnector, id=425).skeleton_id)
+        self.assertEqual(skeleton_id, get_object_or_404(TreenodeConnector, id=437).skeleton_id)
+
+    def test_split_skeleton_at_root(self):
+        self.fake_authentication()
+
+        response = self.client.post(
+                '/%d/skeleton/split' % self.test_project_id, {
+                    'treenode_id': 237,
+                    'upstream_annotation_map': '{}',
+                    'downstream_annotation_map': '{}'})
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('error', json.loads(response.content))
+        self.assertEqual(28, Treenode.objects.filter(skeleton=235).count())
+
     def test_treenode_info_nonexisting_treenode_failure(self):
         self.fake_authentication()
         treenode_id = 55555
@@ -2619,6 +3038,25 @@ class ViewPageTests(TestCase):
             self.assertEqual(z[i], node.location_z)
             i += 1
 
+    def test_node_update_json(self):
+        self.fake_authentication()
+        treenodes = [[2368, 2990, 5200, 1], [2370, 3060, 4460, 2]]
+        connectors = [[356, 3640, 5060, 5]]
+
+        response = self.client.post(
+                '/%d/node/update' % self.test_project_id, {
+                    't': json.dumps(treenodes),
+                    'c': json.dumps(connectors)})
+        self.assertEqual(response.status_code, 200)
+        parsed_response = json.loads(response.content)
+        self.assertEqual({'updated': 3}, parsed_response)
+        for Kind, nodes in ((Treenode, treenodes), (Connector, connectors)):
+            for node_id, x, y, z in nodes:
+                node = Kind.objects.get(id=node_id)
+                self.assertEqual([x, y, z],
+                        [node.location_x, node.location_y, node.location_z])
+                self.assertEqual(self.test_user_id, node.editor_id)
+
     def test_node_no_update_many_nodes(self):
         self.fake_authentication()
         self.maxDiff = None
@@ -2732,6 +3170,299 @@ class ViewPageTests(TestCase):
         for row in expected_c_result:
             self.assertTrue(row in parsed_response[1])
 
+    def test_node_list_cache_invalidation(self):
+        self.fake_authentication()
+        params = {
+            'sid': 3,
+            'z': 0,
+            'top': 4625,
+            'left': 2860,
+            'width': 8000,
+            'height': 3450,
+            'zres': 9,
+            'as': 0,
+            'labels': False,
+        }
+        def list_treenode_ids():
+            response = self.client.post('/%d/node/list' % self.test_project_id, params)
+            self.assertEqual(response.status_code, 200)
+            return set(row[0] for row in json.loads(response.content)[0])
+
+        with self.settings(NODE_LIST_CACHE_TIMEOUT=60):
+            treenode_ids = list_treenode_ids()
+            self.assertEqual(treenode_ids, list_treenode_ids())
+
+            response = self.client.post('/%d/treenode/create' % self.test_project_id, {
+                'x': 5000,
+                'y': 5000,
+                'z': 0,
+                'confidence': 5,
+                'parent_id': -1,
+                'radius': 2})
+            self.assertEqual(response.status_code, 200)
+            new_treenode_id = json.loads(response.content)['treenode_id']
+
+            treenode_ids.add(new_treenode_id)
+            self.assertEqual(treenode_ids, list_treenode_ids())
+
+    @override_settings(NODE_LIST_CACHE_TIMEOUT=60, NODE_LIST_CACHE_GRID_SIZE=4096)
+    def test_node_list_cache_dense_section(self):
+        cursor = connection.cursor()
+        # Don't reuse sections cached by another test
+        invalidate_project(self.test_project_id)
+        increment_pending_cache_versions()
+        def fetch_treenode_ids(limit):
+            trows, crows = fetch_section(cursor, {
+                'project_id': self.test_project_id,
+                'z': 0,
+                'left': 3500,
+                'top': 2000,
+                'right': 4000,
+                'bottom': 3300,
+                'limit': limit})
+            return set(row[0] for row in trows)
+
+        # The aligned section has more rows than the limit, the requested
+        # bounding box has to be queried instead.
+        self.assertEqual(set([7, 253, 263]), fetch_treenode_ids(10))
+        self.assertEqual(set([7, 253, 263]), fetch_treenode_ids(10))
+
+        # Below the limit, the whole aligned section is cached
+        treenode_ids = fetch_treenode_ids(5000)
+        self.assertTrue(set([7, 237, 253, 263]).issubset(treenode_ids))
+        self.assertEqual(treenode_ids, fetch_treenode_ids(5000))
+
+    @override_settings(ARBOR_CACHE_SIZE=10)
+    def test_arbor_cache(self):
+        self.fake_authentication()
+        cursor = connection.cursor()
+        skeleton_id = 235
+        # Don't reuse an Arbor cached by another test
+        invalidate_skeletons([skeleton_id])
+        increment_pending_cache_versions()
+        arbor = get_arbor(cursor, skeleton_id)
+        self.assertEqual(28, len(arbor))
+        self.assertIs(arbor, get_arbor(cursor, skeleton_id))
+
+        # An edit invalidates the Arbor before its transaction is committed.
+        # Until then, other processes still load and cache the old topology
+        # under the new version.
+        invalidate_skeletons([skeleton_id])
+        stale_arbor = get_arbor(cursor, skeleton_id)
+        treenode = Treenode.objects.create(project_id=self.test_project_id,
+                user_id=self.test_user_id, editor_id=self.test_user_id,
+                location_x=0, location_y=0, location_z=0, radius=-1,
+                skeleton_id=skeleton_id, parent_id=237)
+        self.assertIs(stale_arbor, get_arbor(cursor, skeleton_id))
+        # After the commit, the version is incremented again
+        increment_pending_cache_versions()
+        arbor = get_arbor(cursor, skeleton_id)
+        self.assertEqual(29, len(arbor))
+        self.assertEqual(treenode.id, arbor.node_id(arbor.index_of(treenode.id)))
+
+        # Requests increment the versions they changed again when they end
+        version = get_skeleton_version(skeleton_id)
+        response = self.client.post('/%d/treenode/create' % self.test_project_id, {
+            'x': 5,
+            'y': 10,
+            'z': 15,
+            'confidence': 5,
+            'parent_id': 237,
+            'radius': 2})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(version + 2, get_skeleton_version(skeleton_id))
+        self.assertEqual(30, len(get_arbor(cursor, skeleton_id)))
+
+    @override_settings(NODE_INDEX_CACHE_SIZE=10)
+    def test_node_index_cache(self):
+        cursor = connection.cursor()
+        skeleton_id = 235
+        far_away = (1e6, 1e6, 1e6)
+        # Don't reuse an index cached by another test
+        invalidate_project(self.test_project_id)
+        increment_pending_cache_versions()
+        index = skeleton_node_index(cursor, self.test_project_id, skeleton_id)
+        self.assertEqual(28, len(index.ids))
+        self.assertIs(index, skeleton_node_index(cursor,
+                self.test_project_id, skeleton_id))
+
+        # Like the Arbor cache, an index loaded before the edit is committed
+        # is only invalidated once the version is incremented again.
+        invalidate_project(self.test_project_id)
+        stale_index = skeleton_node_index(cursor, self.test_project_id,
+                skeleton_id)
+        treenode = Treenode.objects.create(project_id=self.test_project_id,
+                user_id=self.test_user_id, editor_id=self.test_user_id,
+                location_x=far_away[0], location_y=far_away[1],
+                location_z=far_away[2], radius=-1, skeleton_id=skeleton_id,
+                parent_id=237)
+        self.assertIs(stale_index, skeleton_node_index(cursor,
+                self.test_project_id, skeleton_id))
+        increment_pending_cache_versions()
+        self.assertEqual((treenode.id, skeleton_id, far_away),
+                nearest_treenode(cursor, self.test_project_id, [skeleton_id],
+                        far_away))
+
+    def test_compact_skeleton_binary(self):
+        self.fake_authentication()
+        skeleton_id = 235
+        url = '/%d/%d/1/1/compact-skeleton' % (self.test_project_id, skeleton_id)
+
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        nodes, connectors, tags = json.loads(response.content)
+
+        response = self.client.get(url, {'format': 'binary'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual('application/octet-stream', response['Content-Type'])
+        data = response.content
+        magic, version, kind, n_nodes, n_connectors, tags_length = \
+                struct.unpack('<4sHHIII4x', data[:24])
+        self.assertEqual('CMSK', magic)
+        self.assertEqual(1, version)
+        self.assertEqual(0, kind)
+        self.assertEqual(len(nodes), n_nodes)
+        self.assertEqual(len(connectors), n_connectors)
+
+        ids = struct.unpack('<%dq' % n_nodes, data[24:24 + 8 * n_nodes])
+        parent_ids = struct.unpack('<%dq' % n_nodes,
+                data[24 + 8 * n_nodes:24 + 16 * n_nodes])
+        self.assertEqual([n[0] for n in nodes], list(ids))
+        self.assertEqual([-1 if n[1] is None else n[1] for n in nodes],
+                list(parent_ids))
+        self.assertEqual(tags, json.loads(data[-tags_length:]))
+
+    def assertEdgesMatchLinks(self):
+        cursor = connection.cursor()
+        cursor.execute('''
+            SELECT tc1.skeleton_id, tc2.skeleton_id, count(*)
+            FROM treenode_connector tc1,
+                 treenode_connector tc2,
+                 relation r1,
+                 relation r2
+            WHERE tc1.connector_id = tc2.connector_id
+              AND tc1.relation_id = r1.id
+              AND r1.relation_name = 'presynaptic_to'
+              AND tc2.relation_id = r2.id
+              AND r2.relation_name = 'postsynaptic_to'
+            GROUP BY tc1.skeleton_id, tc2.skeleton_id''')
+        expected_edges = set(cursor.fetchall())
+        cursor.execute('''
+            SELECT pre_skeleton_id, post_skeleton_id, n_synapses
+            FROM synapse_edge''')
+        self.assertEqual(expected_edges, set(cursor.fetchall()))
+        return expected_edges
+
+    def test_synapse_edge_table(self):
+        self.fake_authentication()
+        cursor = connection.cursor()
+        assertEdgesMatchLinks = self.assertEdgesMatchLinks
+
+        self.assertTrue(assertEdgesMatchLinks())
+
+        # Link a new postsynaptic partner
+        response = self.client.post('/%d/link/create' % self.test_project_id, {
+            'from_id': 237,
+            'to_id': 432,
+            'link_type': 'postsynaptic_to'})
+        self.assertEqual(response.status_code, 200)
+        assertEdgesMatchLinks()
+
+        # Join two skeletons, which moves all their links
+        response = self.client.post('/%d/skeleton/join' % self.test_project_id, {
+            'from_id': 2415,
+            'to_id': 2394,
+            'annotation_set': '{}'})
+        self.assertEqual(response.status_code, 200)
+        assertEdgesMatchLinks()
+
+        # Remove a link
+        response = self.client.post('/%d/link/delete' % self.test_project_id, {
+            'connector_id': 356,
+            'treenode_id': 377})
+        self.assertEqual(response.status_code, 200)
+        assertEdgesMatchLinks()
+
+        # Connectivity is read from the edge table
+        matrix = get_connectivity_matrix(self.test_project_id, (235, 373), (235, 373))
+        cursor.execute('''
+            SELECT pre_skeleton_id, post_skeleton_id, n_synapses
+            FROM synapse_edge
+            WHERE pre_skeleton_id IN (235, 373)
+              AND post_skeleton_id IN (235, 373)''')
+        for pre, post, n_synapses in cursor.fetchall():
+            self.assertEqual(n_synapses, matrix[pre][post])
+
+    def test_split_skeleton_with_many_links(self):
+        self.fake_authentication()
+        # Link the nodes 263 and 237 as pre- and postsynaptic partners to
+        # more connectors than locks fit into the default shared lock table.
+        n_connectors = 7000
+        relations = get_relation_to_id_map(self.test_project_id)
+        cursor = connection.cursor()
+        cursor.execute('''
+            WITH c AS (
+                INSERT INTO connector (project_id, user_id, editor_id,
+                    location_x, location_y, location_z)
+                SELECT %(project_id)s, %(user_id)s, %(user_id)s, 0, 0, 0
+                FROM generate_series(1, %(n)s)
+                RETURNING id)
+            INSERT INTO treenode_connector (project_id, user_id,
+                relation_id, treenode_id, connector_id, skeleton_id)
+            SELECT %(project_id)s, %(user_id)s, l.relation_id, l.treenode_id,
+                c.id, 235
+            FROM c, (VALUES (%(pre)s, 263), (%(post)s, 237))
+                AS l (relation_id, treenode_id)
+            ''', {
+                'project_id': self.test_project_id,
+                'user_id': self.test_user_id,
+                'n': n_connectors,
+                'pre': relations['presynaptic_to'],
+                'post': relations['postsynaptic_to']})
+        self.assertEdgesMatchLinks()
+
+        # Splitting at 263 moves all presynaptic links to the new skeleton
+        response = self.client.post(
+                '/%d/skeleton/split' % self.test_project_id, {
+                    'treenode_id': 263,
+                    'upstream_annotation_map': '{}',
+                    'downstream_annotation_map': '{}'})
+        self.assertEqual(response.status_code, 200)
+        new_skeleton_id = get_object_or_404(Treenode, id=263).skeleton_id
+        edges = dict(((pre, post), n)
+                for pre, post, n in self.assertEdgesMatchLinks())
+        self.assertTrue(edges[(new_skeleton_id, 235)] >= n_connectors)
+        self.assertEqual(0, TreenodeConnector.objects.filter(
+                treenode_id=263).exclude(skeleton=new_skeleton_id).count())
+
+    def test_project_export(self):
+        output_path = tempfile.mkdtemp()
+        try:
+            export = ProjectExport(self.test_project_id, output_path, 'test', 3)
+            export.run()
+
+            cursor = connection.cursor()
+            cursor.execute('''
+                SELECT count(*) FROM treenode
+                WHERE project_id = %s
+                  AND skeleton_id IN (SELECT skeleton_id FROM treenode
+                    GROUP BY skeleton_id HAVING count(*) > 1)''',
+                (self.test_project_id,))
+            n_treenodes = cursor.fetchone()[0]
+            with gzip.open(os.path.join(output_path, 'test.skeletons.csv.gz')) as f:
+                lines = f.read().splitlines()
+            self.assertEqual(n_treenodes + 1, len(lines))
+            self.assertEqual(n_treenodes, len(set(l.split(',')[1] for l in lines[1:])))
+
+            with gzip.open(os.path.join(output_path, 'test.graphml.gz')) as f:
+                graphml = f.read()
+            self.assertTrue(graphml.startswith('<?xml'))
+            self.assertTrue(graphml.endswith('</graphml>'))
+            self.assertEqual(n_treenodes, graphml.count('<node '))
+            self.assertFalse(os.path.exists(export.work_path))
+        finally:
+            shutil.rmtree(output_path)
+
     def test_textlabels_empty(self):
         self.fake_authentication()
         expected_result = {}
@@ -2853,6 +3584,90 @@ class ViewPageTests(TestCase):
         self.assertEqual(aq[0].name, 'myannotation')
         self.assertEqual(aq[1].name, 'pattern 10 test-2-annotation')
 
+    def test_sub_annotation_query(self):
+        self.fake_authentication()
+
+        classes = get_class_to_id_map(self.test_project_id)
+        relations = get_relation_to_id_map(self.test_project_id)
+
+        def query(params):
+            entities = create_basic_annotated_entity_query(
+                    self.test_project_id, params, relations, classes,
+                    allowed_classes=['neuron'])
+            return frozenset(entities.distinct().values_list('id', flat=True))
+
+        # Build the hierarchy C > B > A, where neuron 2365 is annotated with A
+        # and neuron 2381 with B.
+        a = _annotate_entities(self.test_project_id, [2365],
+                {'A': self.test_user_id}).keys()[0]
+        b = _annotate_entities(self.test_project_id, [2381, a.id],
+                {'B': self.test_user_id}).keys()[0]
+        c = _annotate_entities(self.test_project_id, [b.id],
+                {'C': self.test_user_id}).keys()[0]
+
+        sub_annotation_ids = get_sub_annotation_ids(self.test_project_id,
+                [b.id, c.id], relations, classes)
+        self.assertEqual(frozenset([a.id]), frozenset(sub_annotation_ids[b.id]))
+        self.assertEqual(frozenset([a.id, b.id]),
+                frozenset(sub_annotation_ids[c.id]))
+
+        self.assertEqual(frozenset(), query({
+                'neuron_query_by_annotation': c.id}))
+        self.assertEqual(frozenset([2381]), query({
+                'neuron_query_by_annotation': b.id}))
+        self.assertEqual(frozenset([2365, 2381]), query({
+                'neuron_query_by_annotation': c.id,
+                'neuron_query_include_subannotation': c.id}))
+        # Multiple annotations are intersected
+        self.assertEqual(frozenset([2365]), query({
+                'neuron_query_by_annotation0': a.id,
+                'neuron_query_by_annotation1': c.id,
+                'neuron_query_include_subannotation1': c.id}))
+
+        # Removing the link between A and B removes A from the closure of
+        # both B and C.
+        response = self.client.post(
+                '/%d/annotations/%d/remove' % (self.test_project_id, b.id),
+                {'entity_ids[0]': a.id})
+        self.assertEqual(response.status_code, 200)
+        sub_annotation_ids = get_sub_annotation_ids(self.test_project_id,
+                [b.id, c.id], relations, classes)
+        self.assertEqual([], sub_annotation_ids[b.id])
+        self.assertEqual([b.id], sub_annotation_ids[c.id])
+        self.assertEqual(frozenset([2381]), query({
+                'neuron_query_by_annotation': c.id,
+                'neuron_query_include_subannotation': c.id}))
+
+    def test_annotator_query(self):
+        self.fake_authentication()
+
+        classes = get_class_to_id_map(self.test_project_id)
+        relations = get_relation_to_id_map(self.test_project_id)
+
+        def query(params):
+            entities = create_basic_annotated_entity_query(
+                    self.test_project_id, params, relations, classes,
+                    allowed_classes=['neuron'])
+            return frozenset(entities.distinct().values_list('id', flat=True))
+
+        # Neuron 2365 is annotated with X by test0 and with Y by test2,
+        # neuron 2381 is annotated with X by test2.
+        x = _annotate_entities(self.test_project_id, [2365],
+                {'X': 1}).keys()[0]
+        _annotate_entities(self.test_project_id, [2381], {'X': 3})
+        _annotate_entities(self.test_project_id, [2365], {'Y': 3})
+
+        # The annotator constrains the link to the requested annotation
+        self.assertEqual(frozenset([2381]), query({
+                'neuron_query_by_annotation': x.id,
+                'neuron_query_by_annotator': 3}))
+        self.assertEqual(frozenset([2365]), query({
+                'neuron_query_by_annotation': x.id,
+                'neuron_query_by_annotator': 1}))
+        # Without annotation, any annotation link of the annotator matches
+        self.assertEqual(frozenset([2365, 2381]), query({
+                'neuron_query_by_annotator': 3}))
+
     def test_review_status(self):
         self.fake_authentication()
 
@@ -2894,6 +3709,139 @@ class ViewPageTests(TestCase):
         expected_result = {'2388': 33}
         self.assertJSONEqual(response.content, expected_result)
 
+    def assertSummariesAreConsistent(self):
+        cursor = connection.cursor()
+        cursor.execute('''
+            SELECT s.skeleton_id, s.num_nodes, coalesce(r.n, 0)
+            FROM (SELECT skeleton_id, count(*) AS num_nodes
+                  FROM treenode GROUP BY skeleton_id) s
+            LEFT JOIN (SELECT skeleton_id, count(DISTINCT treenode_id) AS n
+                       FROM review GROUP BY skeleton_id) r
+              ON s.skeleton_id = r.skeleton_id''')
+        expected = sorted(cursor.fetchall())
+        cursor.execute('''
+            SELECT skeleton_id, num_nodes, num_reviewed_nodes
+            FROM skeleton_summary
+            WHERE num_nodes > 0 OR num_reviewed_nodes > 0''')
+        self.assertEqual(expected, sorted(cursor.fetchall()))
+
+        cursor.execute('''
+            SELECT skeleton_id, reviewer_id, count(*)
+            FROM review GROUP BY skeleton_id, reviewer_id''')
+        expected = sorted(cursor.fetchall())
+        cursor.execute('''
+            SELECT skeleton_id, reviewer_id, num_reviewed_nodes
+            FROM review_summary
+            WHERE num_reviewed_nodes > 0''')
+        self.assertEqual(expected, sorted(cursor.fetchall()))
+
+        # All changes have been applied
+        cursor.execute('''
+            SELECT (SELECT count(*) FROM skeleton_summary_delta) +
+                   (SELECT count(*) FROM review_summary_delta)''')
+        self.assertEqual(0, cursor.fetchone()[0])
+
+    def test_review_summary(self):
+        self.fake_authentication()
+        assertSummariesAreConsistent = self.assertSummariesAreConsistent
+
+        skeleton_id = 235
+        review_time = "2014-03-17T00:00:00"
+        for reviewer_id, treenode_id in ((3, 263), (2, 263), (3, 265), (2, 237)):
+            Review.objects.create(project_id=self.test_project_id,
+                    reviewer_id=reviewer_id, review_time=review_time,
+                    skeleton_id=skeleton_id, treenode_id=treenode_id)
+        assertSummariesAreConsistent()
+        self.assertEqual({skeleton_id: 10}, get_review_status([skeleton_id]))
+        self.assertEqual({skeleton_id: 7},
+                get_review_status([skeleton_id], user_ids=[2]))
+        self.assertEqual({skeleton_id: 7},
+                get_review_status([skeleton_id], excluding_user_ids=[2]))
+
+        # Reviews of reviewer 3 are too old to be accepted by the whitelist
+        ReviewerWhitelist.objects.create(project_id=self.test_project_id,
+                user_id=self.test_user_id, reviewer_id=2, accept_after=review_time)
+        ReviewerWhitelist.objects.create(project_id=self.test_project_id,
+                user_id=self.test_user_id, reviewer_id=3,
+                accept_after="2014-03-18T00:00:00")
+        self.assertEqual({skeleton_id: 7}, get_review_status([skeleton_id],
+                project_id=self.test_project_id, whitelist_id=self.test_user_id))
+
+        # Split off the part with the reviewed nodes 263 and 265
+        response = self.client.post(
+                '/%d/skeleton/split' % self.test_project_id, {
+                    'treenode_id': 263,
+                    'upstream_annotation_map': '{}',
+                    'downstream_annotation_map': '{}'})
+        self.assertEqual(response.status_code, 200)
+        new_skeleton_id = get_object_or_404(Treenode, id=263).skeleton_id
+        assertSummariesAreConsistent()
+        self.assertEqual({new_skeleton_id: 13},
+                get_review_status([new_skeleton_id]))
+        self.assertEqual({new_skeleton_id: 6},
+                get_review_status([new_skeleton_id], user_ids=[2]))
+
+        Review.objects.filter(treenode_id=265).delete()
+        assertSummariesAreConsistent()
+
+        # Join both parts again
+        response = self.client.post(
+                '/%d/skeleton/join' % self.test_project_id, {
+                    'from_id': 237,
+                    'to_id': 263,
+                    'annotation_set': '{}'})
+        self.assertEqual(response.status_code, 200)
+        assertSummariesAreConsistent()
+        self.assertEqual({skeleton_id: 7}, get_review_status([skeleton_id]))
+
+    def test_split_and_join_skeleton_with_many_reviews(self):
+        self.fake_authentication()
+        # Add more reviewed nodes below node 263 than locks fit into the
+        # default shared lock table.
+        n_nodes = 7000
+        cursor = connection.cursor()
+        cursor.execute('''
+            WITH t AS (
+                INSERT INTO treenode (project_id, location_x, location_y,
+                    location_z, editor_id, user_id, skeleton_id, parent_id)
+                SELECT %(project_id)s, 0, 0, 0, %(user_id)s, %(user_id)s,
+                    235, 263
+                FROM generate_series(1, %(n)s)
+                RETURNING id, skeleton_id)
+            INSERT INTO review (project_id, reviewer_id, review_time,
+                skeleton_id, treenode_id)
+            SELECT %(project_id)s, %(user_id)s, now(), t.skeleton_id, t.id
+            FROM t
+            ''', {
+                'project_id': self.test_project_id,
+                'user_id': self.test_user_id,
+                'n': n_nodes})
+        self.assertSummariesAreConsistent()
+
+        response = self.client.post(
+                '/%d/skeleton/split' % self.test_project_id, {
+                    'treenode_id': 263,
+                    'upstream_annotation_map': '{}',
+                    'downstream_annotation_map': '{}'})
+        self.assertEqual(response.status_code, 200)
+        new_skeleton_id = get_object_or_404(Treenode, id=263).skeleton_id
+        self.assertSummariesAreConsistent()
+        cursor.execute('''
+            SELECT num_reviewed_nodes FROM skeleton_summary
+            WHERE skeleton_id = %s''', (new_skeleton_id,))
+        self.assertEqual(n_nodes, cursor.fetchone()[0])
+
+        response = self.client.post(
+                '/%d/skeleton/join' % self.test_project_id, {
+                    'from_id': 253,
+                    'to_id': 263,
+                    'annotation_set': '{}'})
+        self.assertEqual(response.status_code, 200)
+        self.assertSummariesAreConsistent()
+        cursor.execute('''
+            SELECT num_reviewed_nodes FROM skeleton_summary
+            WHERE skeleton_id = 235''')
+        self.assertEqual(n_nodes, cursor.fetchone()[0])
     def test_export_review_skeleton(self):
         self.fake_authentication()
 
@@ -3038,6 +3986,446 @@ class TreenodeTests(TestCase):
             treenodeconnector__treenode__treenodeclassinstance__class_instance=skeleton)
         self.assertEqual(len(connectors), 3)
 
+class ArrayTreeTests(TestCase):
+
+    def setUp(self):
+        # A root node with a single child, which is a branch node with a
+        # single end node on one side and a slab and an end node on the other.
+        self.tree = ArrayTree(
+                [1, 2, 3, 4, 5],
+                [-1, 1, 2, 2, 3],
+                [[0, 0, 0], [1, 0, 0], [2, 0, 0], [1, 1, 0], [3, 0, 0]])
+
+    def test_partition(self):
+        ids = self.tree.ids.tolist()
+        sequences = [[ids[i] for i in s] for s in self.tree.partition()]
+        self.assertEqual([[5, 3, 2, 1], [4, 2]], sequences)
+
+    def test_measure(self):
+        measurements = self.tree.measure()
+        self.assertAlmostEqual(4.0, measurements['raw_cable'])
+        self.assertAlmostEqual(4.0, measurements['smooth_cable'])
+        self.assertAlmostEqual(3.0, measurements['principal_branch_cable'])
+        self.assertEqual(3, measurements['n_ends'])
+        self.assertEqual(1, measurements['n_branch'])
+
+    def test_unordered_input(self):
+        tree = ArrayTree([5, 3, 1, 4, 2], [3, 2, -1, 2, 1],
+                [[3, 0, 0], [2, 0, 0], [0, 0, 0], [1, 1, 0], [1, 0, 0]])
+        self.assertEqual(self.tree.ids.tolist(), tree.ids.tolist())
+        self.assertEqual(self.tree.parents.tolist(), tree.parents.tolist())
+        self.assertEqual(self.tree.measure(), tree.measure())
+
+    def test_missing_parent(self):
+        self.assertRaises(ValueError, ArrayTree, [1, 2], [-1, 3])
+
+    def test_children_and_subtree_sizes(self):
+        children, offsets = self.tree.children()
+        self.assertEqual([1, 2, 3, 4], children.tolist())
+        self.assertEqual([0, 1, 3, 4, 4, 4], offsets.tolist())
+        self.assertEqual([5, 4, 2, 1, 1], self.tree.subtree_sizes().tolist())
+
+    def test_to_digraph(self):
+        tree = ArrayTree([2, 1, 3], [1, -1, 1],
+                properties={'user_id': [5, 6, 7]})
+        graph = tree.to_digraph()
+        self.assertEqual([(2, 1), (3, 1)], sorted(graph.edges()))
+        self.assertEqual({'user_id': 6}, graph.node[1])
+        self.assertEqual({'user_id': 5}, graph.node[2])
+
+
+class NodeIndexTests(TestCase):
+
+    def setUp(self):
+        self.index = NodeIndex([10, 11, 12, 13], [1, 1, 2, 2],
+                [[0, 0, 0], [10, 0, 0], [0, 10, 0], [3, 4, 0]])
+
+    def test_nearest(self):
+        distances, indices = self.index.nearest((4, 4, 0), 2)
+        self.assertEqual([13, 10], list(self.index.ids[indices]))
+        self.assertAlmostEqual(1.0, distances[0])
+
+    def test_within(self):
+        self.assertEqual([10, 13],
+                list(self.index.ids[self.index.within((0, 0, 0), 5)]))
+
+    def test_without_kd_tree(self):
+        self.index.tree = None
+        distances, indices = self.index.nearest((9, 1, 0))
+        self.assertEqual([11], list(self.index.ids[indices]))
+        self.assertEqual([10, 13],
+                list(self.index.ids[self.index.within((0, 0, 0), 5)]))
+
+
+class UserAnalyticsTests(TestCase):
+
+    def setUp(self):
+        # A Monday, event times are in seconds since its start
+        self.start_date = datetime.datetime(2014, 3, 3, 15, 30)
+        self.end_date = datetime.datetime(2014, 3, 6, 15, 30)
+
+    def test_active_times(self):
+        starts, ends, counts = activeTimes([100, 0, 50, 1000, 1030, 5000], 10)
+        self.assertEqual([0, 1000, 5000], starts.tolist())
+        self.assertEqual([100, 1030, 5000], ends.tolist())
+        self.assertEqual([3, 2, 1], counts.tolist())
+
+        starts, ends, counts = activeTimes([], 10)
+        self.assertEqual(0, len(starts))
+        self.assertEqual(0, len(ends))
+        self.assertEqual(0, len(counts))
+
+    def test_events_per_interval(self):
+        times = [0, 3599, 3600, 86410, 3 * 86400, -5]
+        hist, timeaxis = eventsPerInterval(times, self.start_date,
+                self.end_date)
+        self.assertEqual([3, 1, 0], hist.tolist())
+        self.assertEqual([datetime.datetime(2014, 3, 3),
+                datetime.datetime(2014, 3, 4),
+                datetime.datetime(2014, 3, 5)], timeaxis)
+
+        hist, timeaxis = eventsPerInterval(times, self.start_date,
+                self.end_date, 'hour')
+        self.assertEqual(72, len(hist))
+        self.assertEqual(72, len(timeaxis))
+        self.assertEqual(datetime.datetime(2014, 3, 4, 1), timeaxis[25])
+        self.assertEqual([2, 1], hist[0:2].tolist())
+        self.assertEqual(1, hist[24])
+        self.assertEqual(4, hist.sum())
+
+        hist, timeaxis = eventsPerInterval([], self.start_date, self.end_date)
+        self.assertEqual([0, 0, 0], hist.tolist())
+
+        self.assertRaises(ValueError, eventsPerInterval, times,
+                self.start_date, self.end_date, 'week')
+
+    def test_single_day_activeness(self):
+        # Monday 9:00-9:30, Tuesday 9:15-10:00 and Saturday 9:00-10:00
+        hour = 3600
+        bouts = activeTimes([9 * hour, 9.5 * hour,
+                86400 + 9.25 * hour, 86400 + 9.5 * hour, 86400 + 10 * hour,
+                5 * 86400 + 9 * hour, 5 * 86400 + 9.5 * hour,
+                5 * 86400 + 10 * hour], 60)
+        self.assertEqual(3, len(bouts[0]))
+        durations, timeaxis = singleDayActiveness(bouts, 30, 9, 10,
+                self.start_date)
+        self.assertEqual([datetime.datetime(2014, 3, 3, 9),
+                datetime.datetime(2014, 3, 3, 9, 30),
+                datetime.datetime(2014, 3, 3, 10),
+                datetime.datetime(2014, 3, 3, 10, 30)], timeaxis)
+        # The weekend is ignored, the active time is averaged over the five
+        # weekdays from Monday to Friday.
+        expected = [0.3, 0.2, 0.0, 0.0]
+        self.assertEqual(len(expected), len(durations))
+        for e, d in zip(expected, durations):
+            self.assertAlmostEqual(e, d)
+
+        # Only weekend activity
+        weekend = activeTimes([5 * 86400 + 9 * hour], 60)
+        durations, timeaxis = singleDayActiveness(weekend, 30, 9, 10,
+                self.start_date)
+        self.assertEqual([0, 0, 0, 0], durations.tolist())
+        self.assertEqual(datetime.datetime(2014, 3, 8, 9), timeaxis[0])
+
+        self.assertEqual(([], []), singleDayActiveness(activeTimes([], 60),
+                30, 9, 10, self.start_date))
+        self.assertRaises(ValueError, singleDayActiveness, bouts, 7, 9, 10,
+                self.start_date)
+
+
+class TileTests(TestCase):
+
+    def setUp(self):
+        tile._tiles.clear()
+        tile._tiles_size[0] = 0
+        self.addCleanup(tile._tiles.clear)
+
+    def test_read_tile(self):
+        data = np.arange(20, dtype=np.uint8).reshape(4, 5)
+        hfile = {'/0/3/data': data}
+        self.assertEqual(data[1:3, 2:4].tolist(),
+                tile._read_tile(hfile, 0, 2, 1, 3, 2, 2).tolist())
+
+        # Tiles at the border of the image are filled up with zeros
+        expected = np.zeros((4, 4), dtype=np.uint8)
+        expected[:2, :2] = data[2:, 3:]
+        padded = tile._read_tile(hfile, 0, 3, 2, 3, 4, 4)
+        self.assertEqual(np.uint8, padded.dtype)
+        self.assertEqual(expected.tolist(), padded.tolist())
+
+        # Missing scale levels and sections
+        self.assertIsNone(tile._read_tile(hfile, 1, 0, 0, 3, 2, 2))
+        self.assertIsNone(tile._read_tile(hfile, 0, 0, 0, 4, 2, 2))
+
+    @override_settings(TILE_CACHE_SIZE=10)
+    def test_cache_tile(self):
+        tile._cache_tile('a', 1, 'image/png', 'aaaa')
+        tile._cache_tile('b', 1, 'image/png', 'bbbb')
+        self.assertEqual(8, tile._tiles_size[0])
+        self.assertEqual(('image/png', 'aaaa'), tile._get_cached_tile('a', 1))
+
+        # The least recently used tile is evicted
+        tile._cache_tile('c', 1, 'image/png', 'cccc')
+        self.assertEqual(['a', 'c'], list(tile._tiles))
+        self.assertEqual(8, tile._tiles_size[0])
+
+        # Replacing a tile accounts for the size of the old one
+        tile._cache_tile('a', 1, 'image/png', 'aa')
+        self.assertEqual(6, tile._tiles_size[0])
+
+        # Tiles larger than the cache aren't stored
+        tile._cache_tile('d', 1, 'image/png', 'd' * 11)
+        self.assertEqual(['c', 'a'], list(tile._tiles))
+
+        # A tile of a modified file is removed
+        self.assertIsNone(tile._get_cached_tile('c', 2))
+        self.assertEqual(['a'], list(tile._tiles))
+        self.assertEqual(2, tile._tiles_size[0])
+
+    def test_encode_tile(self):
+        data = np.array([[0, 50, 100], [150, 200, 250]], dtype=np.uint8)
+        content_type, encoded = tile._encode_tile(data, 3, 2, 'png')
+        self.assertEqual('image/png', content_type)
+        image = Image.open(StringIO.StringIO(encoded))
+        self.assertEqual((3, 2), image.size)
+        self.assertEqual(data.tolist(), np.asarray(image).tolist())
+
+        content_type, encoded = tile._encode_tile(data, 3, 2, 'jpg')
+        self.assertEqual('image/jpeg', content_type)
+        self.assertEqual('JPEG', Image.open(StringIO.StringIO(encoded)).format)
+
+    def test_blank_tile(self):
+        blank = tile._blank_tile(3, 2, 'png')
+        self.assertIs(blank, tile._blank_tile(3, 2, 'png'))
+        image = Image.open(StringIO.StringIO(blank[1]))
+        self.assertEqual((3, 2), image.size)
+        self.assertEqual([[0, 0, 0], [0, 0, 0]], np.asarray(image).tolist())
+
+        # Missing files are answered with a blank tile
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        with self.settings(HDF5_STORAGE_PATH=tmpdir):
+            response = self.client.get('/3/stack/3/tile', {
+                'width': 3, 'height': 2, 'file_extension': 'png'})
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(blank[1], response.content)
+
+        self.assertRaises(ValueError, self.client.get, '/3/stack/3/tile',
+                {'width': 3, 'height': 2, 'file_extension': 'bmp'})
+
+    @override_settings(HDF5_FILE_POOL_SIZE=1)
+    def test_hdf5_file_pool(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        paths = [os.path.join(tmpdir, name) for name in ('a.hdf', 'b.hdf')]
+        for path in paths:
+            with closing(h5py.File(path, 'w')) as hfile:
+                hfile['/0/0/data'] = np.ones((2, 2), dtype=np.uint8)
+
+        a = tile._open_hdf5_file(paths[0], 1)
+        self.assertIs(a, tile._open_hdf5_file(paths[0], 1))
+        tile._release_hdf5_file(a)
+        # Opening another file evicts the first one, which stays open until
+        # its last user released it.
+        b = tile._open_hdf5_file(paths[1], 1)
+        self.assertEqual([paths[1]], list(tile._hdf5_files))
+        self.assertEqual([[1, 1], [1, 1]],
+                tile._read_tile(a[1], 0, 0, 0, 0, 2, 2).tolist())
+        tile._release_hdf5_file(a)
+        self.assertFalse(a[1].id.valid)
+        tile._release_hdf5_file(b)
+        self.assertTrue(b[1].id.valid)
+        tile._close_hdf5_file(paths[1])
+        self.assertFalse(b[1].id.valid)
+
+def tiff_tag(image, tag):
+    # Depending on the Pillow version, all tag values are tuples
+    value = image.tag[tag]
+    return value[0] if isinstance(value, tuple) else value
+
+def tiff_pages(path):
+    image = Image.open(path)
+    pages = []
+    try:
+        while True:
+            pages.append(np.asarray(image))
+            image.seek(len(pages))
+    except EOFError:
+        pass
+    return image, pages
+
+
+@override_settings(CROPPING_TILE_CACHE_MAX_AGE=0)
+class CroppingTests(TestCase):
+    fixtures = ['catmaid_testdata']
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        # Two sections of 10x6 pixels in tiles of 4x4 pixels, the tiles at
+        # the right and bottom border are filled up with zeros.
+        self.stack = Stack.objects.create(title='Cropping test stack',
+                image_base='file://%s/' % self.tmpdir,
+                dimension=Integer3D(x=10, y=6, z=2),
+                resolution=Double3D(x=2.0, y=4.0, z=1.0),
+                file_extension='png', tile_width=4, tile_height=4,
+                tile_source_type=1)
+        ProjectStack.objects.create(project_id=3, stack=self.stack)
+        self.sections = []
+        for z in range(2):
+            section = (np.arange(60).reshape(6, 10) + 100 * z).astype(np.uint8)
+            self.sections.append(section)
+            os.mkdir(os.path.join(self.tmpdir, str(z)))
+            padded = np.zeros((8, 12), dtype=np.uint8)
+            padded[:6, :10] = section
+            for y in range(2):
+                for x in range(3):
+                    Image.fromarray(padded[4*y:4*y+4, 4*x:4*x+4]).save(
+                            os.path.join(self.tmpdir, str(z),
+                                '%s_%s_0.png' % (y, x)))
+
+    def crop_job(self, rotation_cw=0):
+        # Pixels 1 to 9 in x and 1 to 5 in y of both sections
+        return CropJob(User.objects.get(pk=3), 3, [self.stack.id], 2, 18,
+                4, 20, 0, 1, rotation_cw, 0, single_channel=True,
+                output_path=os.path.join(self.tmpdir, 'crop.tiff'))
+
+    def test_get_image_parts(self):
+        job = self.crop_job()
+        job.initialize()
+        bb = get_stack_bounding_boxes(job)[self.stack.id]
+        self.assertEqual((8, 4), (bb.width, bb.height))
+        parts = get_image_parts(job, self.stack, bb, 1)
+        self.assertEqual([
+                (1, 4, 1, 4, 0, 0), (1, 4, 0, 1, 0, 3),
+                (0, 4, 1, 4, 3, 0), (0, 4, 0, 1, 3, 3),
+                (0, 1, 1, 4, 7, 0), (0, 1, 0, 1, 7, 3)],
+                [(p.x_min_src, p.x_max_src, p.y_min_src, p.y_max_src,
+                    p.x_dst, p.y_dst) for p in parts])
+        self.assertEqual('file://%s/1/1_2_0.png' % self.tmpdir, parts[-1].path)
+
+    def test_iter_substack(self):
+        slices = list(iter_substack(self.crop_job()))
+        self.assertEqual([s[1:5, 1:9].tolist() for s in self.sections],
+                [s.tolist() for s in slices])
+
+        # Rotations by multiples of 90 degrees are done on the arrays
+        slices = list(iter_substack(self.crop_job(90)))
+        self.assertEqual([(8, 4), (8, 4)], [s.shape for s in slices])
+        self.assertEqual([np.rot90(s[1:5, 1:9]).tolist() for s in self.sections],
+                [s.tolist() for s in slices])
+
+    def test_imagej_description(self):
+        job = self.crop_job()
+        self.assertEqual('ImageJ=1.45p\nunit=nm\n', imagej_description(job, 1))
+        self.assertEqual('ImageJ=1.45p\nunit=nm\nimages=2\nchannels=1\n'
+                'slices=2\nhyperstack=true\nmode=color\n',
+                imagej_description(job, 2))
+        job.stacks.append(self.stack)
+        self.assertRaises(ValueError, imagej_description, job, 3)
+
+    def test_tiff_writer(self):
+        gray = np.arange(6, dtype=np.uint8).reshape(2, 3)
+        rgb = np.arange(60, dtype=np.uint8).reshape(4, 5, 3)
+        path = os.path.join(self.tmpdir, 'pages.tiff')
+        with open(path, 'wb') as f:
+            writer = TiffWriter(f, 0.5, 0.25, 'Test')
+            writer.write_page(gray)
+            writer.write_page(rgb)
+            writer.set_description('A description')
+            self.assertRaises(ValueError, writer.set_description,
+                    'x' * TiffWriter.description_length)
+        self.assertEqual(2, writer.n_pages)
+
+        image, pages = tiff_pages(path)
+        self.assertEqual([gray.tolist(), rgb.tolist()],
+                [p.tolist() for p in pages])
+        self.assertEqual('RGB', image.mode)
+        self.assertEqual((5, 4), image.size)
+        self.assertEqual('A description', tiff_tag(image, 270).rstrip('\n\0'))
+        self.assertEqual((1, 2), tiff_tag(image, 282))
+        self.assertEqual((1, 4), tiff_tag(image, 283))
+
+    def test_process_crop_job(self):
+        job = self.crop_job()
+        self.assertIsNone(process_crop_job(job, create_message=False))
+        image, pages = tiff_pages(job.output_path)
+        self.assertEqual([s[1:5, 1:9].tolist() for s in self.sections],
+                [p.tolist() for p in pages])
+        self.assertEqual((8, 4), image.size)
+        self.assertEqual(imagej_description(job, 2),
+                tiff_tag(image, 270).rstrip('\n\0') + '\n')
+        # Pixels per nm
+        self.assertEqual((1, 2), tiff_tag(image, 282))
+        self.assertEqual((1, 4), tiff_tag(image, 283))
+
+class TreenodeExportTests(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        # A section of 10x6 pixels in tiles of 4x4 pixels
+        self.stack = Stack(dimension=Integer3D(x=10, y=6, z=1),
+                resolution=Double3D(x=2.0, y=4.0, z=1.0),
+                tile_width=4, tile_height=4)
+        self.section = np.arange(60, dtype=np.uint8).reshape(6, 10)
+        # Tiles at the right and bottom border of the stack are smaller
+        self.tiles = {}
+        for ty in range(2):
+            for tx in range(3):
+                self.tiles[(tx, ty)] = \
+                        self.section[4*ty:4*ty+4, 4*tx:4*tx+4].copy()
+
+    def test_tile_range(self):
+        self.assertEqual(([0, 1], [0]),
+                _tile_range(self.stack, 1, 1, 4, 2))
+        self.assertEqual(([1], [0]), _tile_range(self.stack, 4, 0, 4, 4))
+        # Regions are clipped to the stack
+        self.assertEqual(([2], [1]), _tile_range(self.stack, 8, 4, 5, 5))
+        self.assertEqual(([0], [0]), _tile_range(self.stack, -3, -3, 5, 5))
+        self.assertEqual(([0, 1, 2], [0, 1]),
+                _tile_range(self.stack, -1, -1, 20, 20))
+        self.assertEqual(([], []), _tile_range(self.stack, 10, 0, 4, 4))
+        self.assertEqual(([], []), _tile_range(self.stack, -5, 0, 5, 5))
+
+    @override_settings(CROPPING_TILE_CACHE_MAX_AGE=0)
+    def test_fetch_tile(self):
+        path = os.path.join(self.tmpdir, '0_0_0.png')
+        Image.fromarray(self.tiles[(0, 0)]).save(path)
+        self.assertEqual(self.tiles[(0, 0)].tolist(),
+                _fetch_tile('file://' + path).tolist())
+        error = _fetch_tile('file://' + path + '.missing')
+        self.assertIsInstance(error, ImageRetrievalError)
+
+    def test_write_image(self):
+        # A region that reaches over the bottom right corner of the stack
+        path = os.path.join(self.tmpdir, 'image.tiff')
+        self.assertIsNone(_write_image(
+                (self.stack, self.tiles, path, 7, 3, 6, 5)))
+        expected = np.zeros((5, 6), dtype=np.uint8)
+        expected[:3, :3] = self.section[3:, 7:]
+        image, pages = tiff_pages(path)
+        self.assertEqual([expected.tolist()], [p.tolist() for p in pages])
+        self.assertEqual((6, 5), image.size)
+        self.assertEqual(imagej_description(None, 1),
+                tiff_tag(image, 270).rstrip('\n\0') + '\n')
+        # Pixels per nm
+        self.assertEqual((1, 2), tiff_tag(image, 282))
+        self.assertEqual((1, 4), tiff_tag(image, 283))
+
+        # A region within a single tile
+        self.assertIsNone(_write_image(
+                (self.stack, self.tiles, path, 5, 1, 2, 2)))
+        image, pages = tiff_pages(path)
+        self.assertEqual([self.section[1:3, 5:7].tolist()],
+                [p.tolist() for p in pages])
+
+        # Missing tiles are reported
+        error = ImageRetrievalError('file:///missing', 'Not found')
+        self.tiles[(1, 1)] = error
+        self.assertIs(error, _write_image(
+                (self.stack, self.tiles, path, 0, 0, 10, 6)))
+
 class PermissionTests(TestCase):
     fixtures = ['catmaid_testdata']
 
@@ -3099,6 +4487,24 @@ class PermissionTests(TestCase):
             # currently not assigned any permissions
             self.assertJSONEqual(response.content, [{},[]])
 
+    def test_permission_cache_invalidation(self):
+        anon_user = User.objects.get(pk=settings.ANONYMOUS_USER_ID)
+        p = Project.objects.get(pk=self.test_project_id)
+        api = '/%d/stats/nodecount' % self.test_project_id
+
+        def has_permission_error():
+            response = self.client.get(api)
+            self.assertEqual(response.status_code, 200)
+            return 'permission_error' in json.loads(response.content)
+
+        with self.settings(PERMISSION_CACHE_TIMEOUT=60):
+            self.assertTrue(has_permission_error())
+            assign_perm('can_browse', anon_user, p)
+            self.assertFalse(has_permission_error())
+            self.assertFalse(has_permission_error())
+            remove_perm('can_browse', anon_user, p)
+            self.assertTrue(has_permission_error())
+
     def test_can_browse_access(self):
         # Give anonymous user browse permissions for the test project
         anon_user = User.objects.get(pk=settings.ANONYMOUS_USER_ID)
@@ -166,6 +166,7 @@ urlpatterns += patterns('catmaid.control.node',
 # Treenode access
 urlpatterns += patterns('catmaid.control.treenode',
     (r'^(?P<project_id>\d+)/treenode/create$', 'create_treenode'),
+    (r'^(?P<project_id>\d+)/treenode/create/batch$', 'create_treenodes'),
     (r'^(?P<project_id>\d+)/treenode/create/interpolated$', 'create_interpolated_treenode'),
     (r'^(?P<project_id>\d+)/treenode/delete$', 'delete_treenode'),
     (r'^(?P<project_id>\d+)/treenode/info$', 'treenode_info'),
@@ -239,6 +240,11 @@ urlpatterns += patterns('catmaid.control.treenodeexport',
     (r'^(?P<project_id>\d+)/treenodearchive/export$', 'export_treenodes'),
 )
 
+# Export of whole projects
+urlpatterns += patterns('catmaid.control.projectexport',
+    (r'^(?P<project_id>\d+)/project/export$', 'export_project'),
+)
+
 # Cropping
 urlpatterns += patterns('catmaid.control.cropping',
     (r'^(?P<project_id>\d+)/stack/(?P<stack_ids>%s)/crop/(?P<x_min>%s),(?P<x_max>%s)/(?P<y_min>%s),(?P<y_max>%s)/(?P<z_min>%s),(?P<z_max>%s)/(?P<zoom_level>\d+)/(?P<single_channel>[0|1])/$' % (intlist, num, num, num, num, num, num), 'crop'),
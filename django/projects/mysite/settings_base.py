@@ -33,6 +33,7 @@ MIDDLEWARE_CLASSES = (
     'django.contrib.messages.middleware.MessageMiddleware',
     'catmaid.middleware.AnonymousAuthenticationMiddleware',
     'catmaid.middleware.AjaxExceptionMiddleware',
+    'catmaid.middleware.CacheVersionMiddleware',
 )
 
 ROOT_URLCONF = 'mysite.urls'
@@ -143,20 +144,80 @@ ROI_AUTO_CREATE_IMAGE = False
 IMPORTER_DEFAULT_TILE_WIDTH = 256
 IMPORTER_DEFAULT_TILE_HEIGHT = 256
 
-# Some tools and widgets create files (e.g. cropping, ROIs, NeuroHDF5 and
-# treenode export). These files will be created in a folder for each tool
+# Some tools and widgets create files (e.g. cropping, ROIs, NeuroHDF5, treenode
+# and project export). These files will be created in a folder for each tool
 # relative to the path defined in Django's MEDIA_ROOT variable. These are
 # the default sub-folders, all of them need to be writable:
 MEDIA_HDF5_SUBDIRECTORY = 'hdf5'
 MEDIA_CROPPING_SUBDIRECTORY = 'cropping'
 MEDIA_ROI_SUBDIRECTORY = 'roi'
 MEDIA_TREENODE_SUBDIRECTORY = 'treenode_archives'
+MEDIA_EXPORT_SUBDIRECTORY = 'exports'
 
 # The maximum allowed size in Bytes for generated files. The cropping tool, for
 # instance, uses this to cancel a request if the generated file grows larger
 # than this. This defaults to 50 Megabyte.
 GENERATED_FILES_MAXIMUM_SIZE = 52428800
 
+# The cropping tool fetches the tiles of a slice in parallel, using up to
+# CROPPING_FETCH_THREADS threads per cropping job. Fetched tiles can be cached
+# in the "tiles" folder of the cropping output folder, where they are shared
+# by all cropping jobs. Cached tiles are used for at most
+# CROPPING_TILE_CACHE_MAX_AGE seconds. A value of 0 disables this cache.
+CROPPING_FETCH_THREADS = 8
+CROPPING_TILE_CACHE_MAX_AGE = 0
+
+# The following caches keep data in every server process and are disabled by
+# a value of 0. Edits invalidate cached data through version numbers that are
+# kept in Django's cache. If any of them is enabled, a cache backend that is
+# shared between all server processes (e.g. memcached) has to be configured in
+# the CACHES setting.
+
+# The tracing overlay's node queries can be cached, so that users looking at
+# the same part of a project share the database results. Cached entries live
+# at most NODE_LIST_CACHE_TIMEOUT seconds and every edit invalidates all
+# cached entries of a project. The bounding box of queries is extended to
+# multiples of NODE_LIST_CACHE_GRID_SIZE (in project coordinates) so that
+# slightly different views can share entries.
+NODE_LIST_CACHE_TIMEOUT = 0
+NODE_LIST_CACHE_GRID_SIZE = 1024
+
+# Nearest node queries use a KD-tree of all treenodes of a skeleton. Every
+# server process keeps the ones of the NODE_INDEX_CACHE_SIZE most recently used
+# skeletons in memory, until an edit happens in their project.
+NODE_INDEX_CACHE_SIZE = 0
+
+# Navigating to the next or previous branch node of a skeleton needs its
+# topology. Every server process keeps the ones of the ARBOR_CACHE_SIZE most
+# recently used skeletons in memory, until the skeleton is changed.
+ARBOR_CACHE_SIZE = 0
+
+# The ontology and classification editors look up the classes, class-class
+# links and restrictions of a workspace in an in-memory copy of them. Every
+# server process keeps the ones of the ONTOLOGY_CACHE_SIZE most recently used
+# workspaces in memory, until the semantic space of the workspace is changed.
+ONTOLOGY_CACHE_SIZE = 0
+
+# Tiles of HDF5 backed stacks are read from files that every server process
+# keeps open, up to HDF5_FILE_POOL_SIZE files at a time. Encoded tiles can be
+# kept in memory by every process as well, up to a total of TILE_CACHE_SIZE
+# bytes. A value of 0 disables the respective cache.
+HDF5_FILE_POOL_SIZE = 0
+TILE_CACHE_SIZE = 0
+
+# Search results for labels list the treenodes that are labeled with them. At
+# most SEARCH_MAX_LABEL_NODES treenodes are returned per label, the most
+# recently created ones.
+SEARCH_MAX_LABEL_NODES = 100
+
+# The roles of users in projects and the set of users whose data a user can
+# edit can be cached in every server process for PERMISSION_CACHE_TIMEOUT
+# seconds. Changes to users, groups and permissions invalidate cached entries
+# right away in all processes that share a cache backend, other processes
+# notice them at the latest after this timeout. A value of 0 disables this
+# cache.
+PERMISSION_CACHE_TIMEOUT = 0
+
 # Specifies if user registration is allowed
 USER_REGISTRATION_ALLOWED = False
 
@@ -169,6 +230,8 @@ CELERY_IMPORTS = (
     'catmaid.control.cropping',
     'catmaid.control.roi',
     'catmaid.control.treenodeexport',
+    'catmaid.control.projectexport',
+    'catmaid.control.stats',
 )
 
 # We use django-pipeline to compress and reference JavaScript and CSS files. To